@@ -0,0 +1,160 @@
+import datetime
+import hashlib
+import json
+
+from django.db.models import Count, Max, Sum
+from django.utils.encoding import force_str
+from rest_framework import serializers
+from rest_framework.relations import PKOnlyObject
+
+from api.serializers import FullCalendarEventSerializer
+from invoices.employee import Employee
+from invoices.events import AssignedAdditionalEmployee, Event
+from invoices.helpers.eventfeed import event_feed_version
+from invoices.models import Patient, SubContractor
+
+
+class FullCalendarEventFeed:
+    """
+    Events of a range of days as ``FullCalendarEventSerializer`` renders them, with every value as a string.
+
+    The rows are built out of ``values()`` and the employees, patients, sub contractors and additional employees of
+    the whole range are loaded once, so a range costs the same number of queries whatever its size. ``etag`` only
+    aggregates the range and is meant to answer ``If-None-Match`` before anything is built.
+    """
+    chunk_size = 500
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.events = Event.objects.filter(day__range=[start, end])
+        self.fields = FullCalendarEventSerializer().fields
+        self.model_fields = [name for name, field in self.fields.items()
+                             if not isinstance(field, serializers.SerializerMethodField)]
+        self._version = None
+
+    @property
+    def version(self):
+        if self._version is None:
+            self._version = self.events.order_by().aggregate(count=Count('id'), ids=Sum('id'),
+                                                              updated_on=Max('updated_on'),
+                                                              patients=Max('patient__updated_on'),
+                                                              sub_contractors=Max('sub_contractor__updated_on'))
+        return self._version
+
+    def etag(self):
+        version = self.version
+        token = '%s:%s:%s:%s:%s:%s:%s:%s' % (self.start, self.end, version['count'], version['ids'],
+                                             version['updated_on'], version['patients'], version['sub_contractors'],
+                                             event_feed_version.get())
+        return '"%s"' % hashlib.md5(token.encode('utf-8')).hexdigest()
+
+    def __len__(self):
+        return self.version['count']
+
+    def _related(self):
+        employees = {employee.id: employee for employee in Employee.objects.select_related('user').filter(
+            id__in=self.events.values('employees_id'))}
+        patients = {patient.id: patient for patient in Patient.objects.filter(id__in=self.events.values('patient_id'))}
+        sub_contractors = {sub_contractor.id: sub_contractor for sub_contractor in SubContractor.objects.filter(
+            id__in=self.events.values('sub_contractor_id'))}
+        assigned = {}
+        for event_id, abbreviation in AssignedAdditionalEmployee.objects.filter(
+                event_assigned_to__in=self.events.values('id')).values_list(
+                'event_assigned_to_id', 'assigned_additional_employee__abbreviation'):
+            assigned.setdefault(event_id, []).append(abbreviation)
+        avatar_field = serializers.ImageField()
+        avatars = {employee_id: avatar_field.to_representation(employee.avatar) if employee.avatar else None
+                   for employee_id, employee in employees.items()}
+        return employees, patients, sub_contractors, assigned, avatars
+
+    @staticmethod
+    def _state(state):
+        if state is None or state == "":
+            return ""
+        if 0 <= state <= len(Event.STATES):
+            return {"state_id": state, "state_name": force_str(Event.STATES[state - 1][1])}
+        return {"state_id": state, "state_name": str(state)}
+
+    @staticmethod
+    def _description(row, employee, patient):
+        description = '<div id="mypopup">'
+        if employee is not None:
+            description += '<h5>' "%s chez %s" % (employee, str(patient)) + '</h5>'
+        else:
+            description += '<h5>' "%s" % (str(patient)) + '</h5>'
+        if row['notes'] is not None and row['notes'] != "":
+            description += '<p><b>Notes</b>:' + row['notes'] + '</p>'
+        if row['event_report'] is not None and row['event_report'] != "":
+            description += '<p><b>Rapport</b>:' + row['event_report'] + '</p>'
+        state = row['state']
+        if state is not None and state != "":
+            if 0 <= state <= len(Event.STATES):
+                state_name = force_str(Event.STATES[state - 1][1])
+                if state == 2:
+                    description += '<p class="state-valid">' + state_name + '</p>'
+                elif state == 3:
+                    description += '<p class="state-done">' + state_name + '</p>'
+                else:
+                    description += '<p class="state-cancelled">' + state_name + '</p>'
+            else:
+                description += '<p>' + str(state) + '</p>'
+        if employee and employee.minified_avatar_base64:
+            description += '<img src="' + employee.minified_avatar_base64 + '">'
+        description += '</div>'
+        return description + "(%s)" % row['id']
+
+    def _represent(self, name, value):
+        if value is None:
+            return None
+        if isinstance(self.fields[name], serializers.PrimaryKeyRelatedField):
+            return self.fields[name].to_representation(PKOnlyObject(pk=value))
+        return self.fields[name].to_representation(value)
+
+    def rows(self):
+        employees, patients, sub_contractors, assigned, avatars = self._related()
+        columns = dict.fromkeys(self.model_fields + ['notes', 'event_report', 'state', 'patient'])
+        for row in self.events.values(*columns).iterator(chunk_size=2000):
+            employee = employees.get(row['employees'])
+            patient = patients.get(row['patient'])
+            day, time_start_event, time_end_event = row['day'], row['time_start_event'], row['time_end_event']
+            computed = {
+                'start': datetime.datetime.combine(day, time_start_event or datetime.time(0, 0)).strftime(
+                    "%Y-%m-%dT%H:%M:%S%z"),
+                'end': datetime.datetime.combine(day, time_end_event).strftime(
+                    "%Y-%m-%dT%H:%M:%S%z") if time_end_event is not None else None,
+                'title': Event.describe(row['event_type_enum'], day, patient,
+                                        sub_contractor=sub_contractors.get(row['sub_contractor']),
+                                        employee_abbreviation=employee.abbreviation if employee else None,
+                                        assigned_abbreviations=[abbreviation for abbreviation in
+                                                                assigned.get(row['id'], []) if abbreviation]),
+                'color': employee.color_cell if employee else "#98FB98",
+                'textcolor': employee.color_text if employee else "#808080",
+                'description': self._description(row, employee, patient),
+                'resourceId': employee.id if employee else None,
+                'patient': row['patient'],
+                'notes': row['notes'] or "",
+                'state': self._state(row['state']),
+                'event_report': row['event_report'] or "",
+                'minified_avatar': avatars.get(row['employees']),
+                'minified_avatar_svg': employee.minified_avatar_base64 or None if employee else None,
+            }
+            yield {name: str(computed[name] if name in computed else self._represent(name, row[name]))
+                   for name in self.fields}
+
+    def as_json(self):
+        return json.dumps(list(self.rows()))
+
+    def iter_json(self):
+        """The JSON array in pieces of ``chunk_size`` events, for ranges too large to be built in one go."""
+        yield '['
+        chunk = []
+        first = True
+        for row in self.rows():
+            chunk.append(json.dumps(row))
+            if len(chunk) == self.chunk_size:
+                yield ('' if first else ',') + ','.join(chunk)
+                first, chunk = False, []
+        if chunk:
+            yield ('' if first else ',') + ','.join(chunk)
+        yield ']'
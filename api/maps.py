@@ -1,63 +1,169 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import requests
 
-from invoices.distancematrix import DistanceMatrix
-
-
-def create_distance_matrix(location_dict, api_key):
-    url = "https://maps.googleapis.com/maps/api/distancematrix/json"
-    distance_matrix = {}
-    duration_matrix = {}
-    # build a list of addresses but keep patient id as key
-    addresses_dict = {custom_id: location_dict[custom_id] for custom_id in location_dict.keys()}
-
-    # loop over the addresses_dict to build the distance matrix
-    for o in addresses_dict.keys():
-        for d in addresses_dict.keys():
-            if o == d:
-                # Distance to the same location is zero
-                distance_matrix[o] = {}
-                distance_matrix[o][d] = 0
-            else:
-                if DistanceMatrix.objects.filter(patient_origin=o, patient_destination=d).exists():
-                    # If a distance matrix already exists, either for the same origin and destination or the reverse
-                    # then take the next one
+from invoices.distancematrix import DistanceMatrix, travel_time_graph
+
+DISTANCE_MATRIX_URL = "https://maps.googleapis.com/maps/api/distancematrix/json"
+# Google answers at most 100 elements (origins x destinations) per request
+MAX_ELEMENTS_PER_REQUEST = 100
+# statuses worth asking again after a while, any other one is an error of the request itself
+RETRYABLE_STATUSES = ('OVER_QUERY_LIMIT', 'UNKNOWN_ERROR')
+
+
+class DistanceMatrixBuilder:
+    """
+    Fills ``DistanceMatrix`` for a set of locations keyed by patient (or patient id).
+
+    The pairs already stored are read with one query, the missing ones are grouped in tiles of at most
+    ``MAX_ELEMENTS_PER_REQUEST`` elements, each tile being one multi-origin/multi-destination request. The tiles are
+    requested concurrently, a failed request is retried with an exponential backoff, and the results of each tile are
+    written with ``bulk_create`` as soon as it answers. A tile still failing after its retries is reported in
+    ``failed_tiles``, the distances of the other tiles are kept. When ``symmetric`` is set, the distance from B to A is the one from A to B: only one of the two
+    directions is requested and a direction already stored is copied to the other one.
+    """
+
+    def __init__(self, api_key, url=DISTANCE_MATRIX_URL, symmetric=True, max_workers=4, retries=3, backoff=1.0,
+                 timeout=30):
+        self.api_key = api_key
+        self.url = url
+        self.symmetric = symmetric
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.tile_size = int(MAX_ELEMENTS_PER_REQUEST ** 0.5)
+        self.requests_count = 0
+        # (origins, destinations, error) of the tiles that could not be fetched
+        self.failed_tiles = []
+
+    def missing_pairs(self, patient_ids):
+        """The ordered pairs without a distance, and the ones that can be copied from the reverse direction."""
+        known = {(origin, destination): (distance, duration) for origin, destination, distance, duration in
+                 DistanceMatrix.objects.filter(patient_origin_id__in=patient_ids,
+                                               patient_destination_id__in=patient_ids).values_list(
+                     'patient_origin_id', 'patient_destination_id', 'distance_in_km', 'duration_in_mn')}
+        missing, reversed_pairs = set(), {}
+        for origin in patient_ids:
+            for destination in patient_ids:
+                if origin == destination or (origin, destination) in known:
                     continue
-                params = {
-                    'origins': addresses_dict[o],
-                    'destinations': addresses_dict[d],
-                    'key': api_key,
-                    'mode': 'driving',
-                    'language': 'en-EN',
-                    'units': 'metric'
-                }
-                response = requests.get(url, params=params)
-                result = response.json()
-                if result['status'] != 'OK':
-                    raise Exception(result['error_message'])
-                distance = result['rows'][0]['elements'][0]['distance']['text']
-                duration = result['rows'][0]['elements'][0]['duration']['text']
-                # convert distance to integer knowing that the distance is in km and looks like that '35.0 km'
-                distance = int(float(distance.split(' ')[0]))
-                # convert duration to integer
-                duration = int(duration.split(' ')[0])
-                distance_matrix[o] = {}
-                distance_matrix[o][d] = distance
-                duration_matrix[o] = {}
-                duration_matrix[o][d] = duration
-                print(o, d, distance, duration)
-                # If a distance matrix already exists, either for the same origin and destination or the reverse
-                # then take the next one
-                dmatrix = DistanceMatrix.objects.create(
-                    patient_origin=o,
-                    patient_destination=d,
-                    distance_in_km=distance,
-                    duration_in_mn=duration
-                )
-                dmatrix.save()
-
-
-    return distance_matrix
+                if self.symmetric and (destination, origin) in known:
+                    reversed_pairs[(origin, destination)] = known[(destination, origin)]
+                else:
+                    missing.add((origin, destination))
+        return missing, reversed_pairs
+
+    def tiles(self, patient_ids, pairs):
+        """
+        Requests covering ``pairs``: the locations are cut in blocks of ``tile_size`` and a tile asks for the pairs
+        going from one block to another. Symmetric pairs are only asked in one direction.
+        """
+        position = {patient_id: index // self.tile_size for index, patient_id in enumerate(sorted(patient_ids))}
+        tiles = {}
+        for origin, destination in pairs:
+            if self.symmetric and (destination, origin) in pairs and origin > destination:
+                continue
+            origins, destinations = tiles.setdefault((position[origin], position[destination]), (set(), set()))
+            origins.add(origin)
+            destinations.add(destination)
+        return [(sorted(origins), sorted(destinations)) for origins, destinations in tiles.values()]
+
+    def request(self, origins, destinations, addresses):
+        params = {
+            'origins': '|'.join(addresses[origin] for origin in origins),
+            'destinations': '|'.join(addresses[destination] for destination in destinations),
+            'key': self.api_key,
+            'mode': 'driving',
+            'language': 'en-EN',
+            'units': 'metric'
+        }
+        for attempt in range(self.retries + 1):
+            error = None
+            try:
+                response = requests.get(self.url, params=params, timeout=self.timeout)
+                if response.status_code == 429 or response.status_code >= 500:
+                    error = "HTTP %s" % response.status_code
+                else:
+                    result = response.json()
+                    if result['status'] == 'OK':
+                        return result
+                    if result['status'] not in RETRYABLE_STATUSES:
+                        raise Exception(result.get('error_message', result['status']))
+                    error = result['status']
+            except requests.RequestException as e:
+                error = e
+            if attempt < self.retries:
+                print("Distance matrix request failed (%s), retrying" % error)
+                time.sleep(self.backoff * 2 ** attempt)
+        raise Exception("Distance matrix request failed after %s attempts: %s" % (self.retries + 1, error))
+
+    def fetch(self, tile, addresses):
+        origins, destinations = tile
+        result = self.request(origins, destinations, addresses)
+        distances = {}
+        for origin, row in zip(origins, result['rows']):
+            for destination, element in zip(destinations, row['elements']):
+                if origin == destination:
+                    continue
+                if element.get('status') != 'OK':
+                    print("No distance from %s to %s: %s" % (origin, destination, element.get('status')))
+                    continue
+                # values are in meters and seconds
+                distances[(origin, destination)] = (int(round(element['distance']['value'] / 1000)),
+                                                    int(round(element['duration']['value'] / 60)))
+        return distances
+
+    def store(self, pairs, found):
+        """Writes the distances of ``pairs`` and adds them to ``found``."""
+        DistanceMatrix.objects.bulk_create([DistanceMatrix(patient_origin_id=origin,
+                                                           patient_destination_id=destination,
+                                                           distance_in_km=distance,
+                                                           duration_in_mn=duration)
+                                            for (origin, destination), (distance, duration) in pairs.items()],
+                                           batch_size=1000, ignore_conflicts=True)
+        found.update(pairs)
+
+    def build(self, location_dict):
+        """Stores the missing distances between the locations and returns the distances in km that were added."""
+        addresses = {getattr(key, 'pk', key): address for key, address in location_dict.items()}
+        patient_ids = list(addresses)
+        missing, reversed_pairs = self.missing_pairs(patient_ids)
+        found = {}
+        self.store(reversed_pairs, found)
+        tiles = self.tiles(patient_ids, missing)
+        self.requests_count += len(tiles)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.fetch, tile, addresses): tile for tile in tiles}
+            # the requests are paid for, each tile is stored as it completes
+            for future in as_completed(futures):
+                try:
+                    distances = future.result()
+                except Exception as e:
+                    origins, destinations = futures[future]
+                    print("Distances from %s to %s could not be fetched: %s" % (origins, destinations, e))
+                    self.failed_tiles.append((origins, destinations, str(e)))
+                    continue
+                pairs = {}
+                for (origin, destination), values in distances.items():
+                    if (origin, destination) in missing:
+                        pairs[(origin, destination)] = values
+                    if self.symmetric and (destination, origin) in missing and (destination, origin) not in pairs:
+                        pairs[(destination, origin)] = values
+                self.store(pairs, found)
+        if found:
+            # bulk_create sends no signal
+            travel_time_graph.invalidate()
+        distance_matrix = {patient_id: {patient_id: 0} for patient_id in patient_ids}
+        for (origin, destination), (distance, duration) in found.items():
+            distance_matrix[origin][destination] = distance
+        return distance_matrix
+
+
+def create_distance_matrix(location_dict, api_key, **kwargs):
+    return DistanceMatrixBuilder(api_key, **kwargs).build(location_dict)
 
 # Example usage
-#locations = ['XX', 'YY', 'ZZ']
+#locations = {patient_x.id: 'XX', patient_y.id: 'YY', patient_z.id: 'ZZ'}
 # matrix = create_distance_matrix(locations, api_key)
@@ -661,3 +661,10 @@ class CarSerializer(serializers.ModelSerializer):
         return obj.can_user_unlock(self.context['request'].user)
 
 
+class TourRequestSerializer(serializers.Serializer):
+    """Options of a visit order proposal, the time budget is capped at 60 seconds."""
+    time_budget = serializers.FloatField(default=10, min_value=0)
+    genetic_algorithm = serializers.BooleanField(default=False)
+
+    def validate_time_budget(self, value):
+        return min(value, 60)
@@ -0,0 +1,86 @@
+import json
+from datetime import date, time
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+
+from api.fullcalendar import FullCalendarEventFeed
+from api.serializers import FullCalendarEventSerializer
+from api.views import FullCalendarEventViewSet
+from invoices.employee import Employee, JobPosition
+from invoices.events import AssignedAdditionalEmployee, Event
+from invoices.models import Patient
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                       'LOCATION': 'fullcalendar-events'}})
+class FullCalendarEventFeedTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        job_position = JobPosition.objects.create(name='name 0')
+        self.employees = []
+        for abbreviation in ('AA', 'BB'):
+            user = User.objects.create_user(abbreviation.lower(), email='%s@test.com' % abbreviation.lower(),
+                                            password='testing')
+            self.employees += Employee.objects.bulk_create([Employee(user=user, start_contract=date(2020, 1, 1),
+                                                                     abbreviation=abbreviation,
+                                                                     occupation=job_position)])
+        self.patient = Patient.objects.create(code_sn='code_sn0', first_name='first name 0', name='name 0',
+                                              address='address 0', zipcode='zipcode 0', city='city 0',
+                                              phone_number='000')
+        events = Event.objects.bulk_create([
+            Event(day=date(2023, 3, 1), time_start_event=time(8, 0), time_end_event=time(9, 0), state=2,
+                  event_type_enum='CARE', employees=self.employees[0], patient=self.patient, notes='notes'),
+            Event(day=date(2023, 3, 2), time_start_event=time(10, 0), state=3, event_type_enum='GENERIC',
+                  patient=self.patient, event_report='report'),
+            Event(day=date(2023, 3, 3), time_start_event=time(11, 0), time_end_event=time(12, 0), state=1,
+                  event_type_enum='CARE', employees=self.employees[1], patient=self.patient),
+        ])
+        AssignedAdditionalEmployee.objects.bulk_create([
+            AssignedAdditionalEmployee(event_assigned_to=events[2], assigned_additional_employee=employee)
+            for employee in self.employees])
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.employees[0].user)
+
+    def test_rows_match_the_serializer(self):
+        events = Event.objects.filter(day__range=[date(2023, 3, 1), date(2023, 3, 31)])
+        expected = [{key: str(value) for key, value in item.items() if key != 'state'}
+                    for item in FullCalendarEventSerializer(events, many=True).data]
+        # employees, patients, sub contractors, additional employees and the events
+        with self.assertNumQueries(5):
+            rows = list(FullCalendarEventFeed(date(2023, 3, 1), date(2023, 3, 31)).rows())
+        self.assertEqual(expected, [{key: value for key, value in row.items() if key != 'state'} for row in rows])
+        self.assertEqual("{'state_id': 2, 'state_name': 'Valid'}", rows[2]['state'])
+        self.assertEqual('AA,BB ++ name 0', rows[0]['title'])
+
+    def test_etag_and_streaming(self):
+        params = {'start': '2023-03-01T00:00:00', 'end': '2023-03-31T00:00:00'}
+        response = self.client.get('/fullcalendar-events/', params)
+        self.assertEqual(3, len(response.json()))
+        etag = response['ETag']
+        response = self.client.get('/fullcalendar-events/', params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        self.employees[1].color_cell = '#000000'
+        self.employees[1].save()
+        response = self.client.get('/fullcalendar-events/', params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response['ETag'])
+
+        etag = response['ETag']
+        self.employees[1].user.username = 'cc'
+        self.employees[1].user.save()
+        response = self.client.get('/fullcalendar-events/', params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        etag = response['ETag']
+        self.client.login(username='aa', password='testing')
+        response = self.client.get('/fullcalendar-events/', params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+
+        with patch.object(FullCalendarEventViewSet, 'streaming_threshold', 1):
+            response = self.client.get('/fullcalendar-events/', params)
+        self.assertTrue(response.streaming)
+        self.assertEqual(['2023-03-03', '2023-03-02', '2023-03-01'],
+                         [row['day'] for row in json.loads(b''.join(response.streaming_content))])
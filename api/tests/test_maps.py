@@ -0,0 +1,119 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from django.test import TestCase
+
+from api.maps import DistanceMatrixBuilder
+from invoices.distancematrix import DistanceMatrix
+from invoices.models import Patient
+
+
+class DistanceMatrixStub(BaseHTTPRequestHandler):
+    """Distance Matrix API where the addresses are kilometer marks on a straight road driven at 60 km/h."""
+    requests = []
+    failures = 0
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        origins, destinations = query['origins'][0].split('|'), query['destinations'][0].split('|')
+        DistanceMatrixStub.requests.append((origins, destinations))
+        if DistanceMatrixStub.failures:
+            DistanceMatrixStub.failures -= 1
+            self.send_response(503)
+            self.end_headers()
+            return
+        rows = [{'elements': [{'status': 'OK',
+                               'distance': {'value': abs(int(origin) - int(destination)) * 1000},
+                               'duration': {'value': abs(int(origin) - int(destination)) * 60}}
+                              for destination in destinations]} for origin in origins]
+        body = json.dumps({'status': 'OK', 'rows': rows}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class DistanceMatrixBuilderTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), DistanceMatrixStub)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = 'http://127.0.0.1:%s/' % cls.server.server_port
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        DistanceMatrixStub.requests = []
+        DistanceMatrixStub.failures = 0
+        self.patients = Patient.objects.bulk_create([
+            Patient(code_sn='code_sn%s' % index, first_name='first name %s' % index, name='name %s' % index,
+                    address='address %s' % index, zipcode='zipcode %s' % index, city='city %s' % index,
+                    phone_number='000') for index in range(12)])
+        # the address of a patient is its kilometer mark
+        self.addresses = {patient.id: str(index * 2) for index, patient in enumerate(self.patients)}
+
+    def _builder(self, **kwargs):
+        return DistanceMatrixBuilder('key', url=self.url, backoff=0, **kwargs)
+
+    def test_symmetric_tiles(self):
+        distance_matrix = self._builder().build(self.addresses)
+        # 12 locations are cut in blocks of 10, one direction only: 3 tiles instead of 132 requests
+        self.assertEqual(3, len(DistanceMatrixStub.requests))
+        self.assertTrue(all(len(origins) * len(destinations) <= 100
+                            for origins, destinations in DistanceMatrixStub.requests))
+        self.assertEqual(12 * 11, DistanceMatrix.objects.count())
+        first, last = self.patients[0].id, self.patients[11].id
+        self.assertEqual(22, distance_matrix[first][last])
+        self.assertEqual(22, distance_matrix[last][first])
+        self.assertEqual((22, 22), DistanceMatrix.objects.filter(patient_origin_id=last, patient_destination_id=first)
+                         .values_list('distance_in_km', 'duration_in_mn').get())
+        # nothing is missing anymore
+        self._builder().build(self.addresses)
+        self.assertEqual(3, len(DistanceMatrixStub.requests))
+
+    def test_stored_direction_is_reused_and_failures_are_retried(self):
+        first, second = self.patients[0].id, self.patients[1].id
+        DistanceMatrix.objects.create(patient_origin_id=first, patient_destination_id=second, distance_in_km=5,
+                                      duration_in_mn=7)
+        DistanceMatrixStub.failures = 1
+        builder = self._builder(max_workers=1)
+        addresses = {first: self.addresses[first], second: self.addresses[second]}
+        self.assertEqual({first: {first: 0}, second: {second: 0, first: 5}}, builder.build(addresses))
+        self.assertEqual([], DistanceMatrixStub.requests)
+        addresses[self.patients[2].id] = self.addresses[self.patients[2].id]
+        builder.build(addresses)
+        # the first request failed with a 503 and was asked again
+        self.assertEqual(2, len(DistanceMatrixStub.requests))
+        self.assertEqual(6, DistanceMatrix.objects.count())
+
+    def test_directions_are_requested_separately_when_not_symmetric(self):
+        self._builder(symmetric=False).build(self.addresses)
+        self.assertEqual(4, len(DistanceMatrixStub.requests))
+        self.assertEqual(12 * 11, DistanceMatrix.objects.count())
+
+    def test_failed_tile_does_not_lose_the_other_ones(self):
+        # the first tile fails on every attempt, the two other ones answer
+        DistanceMatrixStub.failures = 4
+        builder = self._builder(max_workers=1, retries=3)
+        builder.build(self.addresses)
+        self.assertEqual(1, len(builder.failed_tiles))
+        origins, destinations, error = builder.failed_tiles[0]
+        stored = DistanceMatrix.objects.count()
+        self.assertTrue(0 < stored < 12 * 11)
+        DistanceMatrixStub.requests = []
+        self._builder().build(self.addresses)
+        # only the failed tile is asked again
+        self.assertEqual([([self.addresses[origin] for origin in origins],
+                           [self.addresses[destination] for destination in destinations])],
+                         DistanceMatrixStub.requests)
+        self.assertEqual(12 * 11, DistanceMatrix.objects.count())
@@ -1,27 +1,29 @@
 import json
 import os
 import random
-from datetime import datetime
+from datetime import date, datetime
 from zoneinfo import ZoneInfo
 
 from constance import config
 from django.contrib.auth import authenticate
 from django.contrib.auth.models import User, Group
 from django.db.models import Count
-from django.http import FileResponse
+from django.http import FileResponse, StreamingHttpResponse
 from django.http import JsonResponse, HttpResponseForbidden
 from django.utils import timezone
+from django.utils.cache import get_conditional_response
 from django.utils.translation import gettext_lazy as _
 from django.views.decorators.cache import cache_page
 from rest_framework import viewsets, filters, status, generics
 from rest_framework.authtoken.models import Token
-from rest_framework.decorators import api_view, renderer_classes
+from rest_framework.decorators import api_view, renderer_classes, action
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from api.fullcalendar import FullCalendarEventFeed
 from api.maps import create_distance_matrix
 from api.serializers import UserSerializer, GroupSerializer, CareCodeSerializer, PatientSerializer, \
     PrestationSerializer, \
@@ -32,7 +34,8 @@ from api.serializers import UserSerializer, GroupSerializer, CareCodeSerializer,
     EmployeeAvatarSerializer, EmployeeSerializer, EmployeeContractSerializer, FullCalendarEventSerializer, \
     FullCalendarEmployeeSerializer, FullCalendarPatientSerializer, \
     LongTermMonthlyActivitySerializer, DistanceMatrixSerializer, ShiftSerializer, EmployeeShiftSerializer, \
-    SubContractorSerializer, SimplifiedTimesheetSerializer, CarSerializer, CarBookingSerializer
+    SubContractorSerializer, SimplifiedTimesheetSerializer, CarSerializer, CarBookingSerializer, \
+    TourRequestSerializer
 from api.utils import get_settings
 from dependence.activity import LongTermMonthlyActivity
 from dependence.careplan import CarePlanDetail, CarePlanMaster
@@ -42,17 +45,19 @@ from helpers.employee import get_employee_id_by_abbreviation, \
     get_current_employee_contract_details_by_employee_abbreviation
 from helpers.patient import get_patient_by_id
 from invoices import settings
-from invoices.distancematrix import DistanceMatrix
+from invoices.distancematrix import DistanceMatrix, travel_time_graph
 from invoices.employee import JobPosition, Employee, EmployeeContractDetail, Shift, EmployeeShift
 from invoices.employee import get_employee_by_abbreviation
 from invoices.enums.event import EventTypeEnum
 from invoices.enums.holidays import HolidayRequestWorkflowStatus
-from invoices.events import EventType, Event, create_or_update_google_calendar
+from invoices.events import EventType, Event
+from invoices.helpers.roster import IDLE_EVENT_STATES, day_roster
 from invoices.holidays import HolidayRequest
 from invoices.models import CareCode, Patient, Prestation, InvoiceItem, Physician, MedicalPrescription, Hospitalization, \
     ValidityDate, InvoiceItemBatch, SubContractor
 from invoices.processors.birthdays import process_and_generate
 from invoices.processors.events import delete_events_created_by_script
+from invoices.processors.tours import get_tour_proposal, optimize_employee_tour
 from invoices.resources import Car, CarBooking
 from invoices.timesheet import Timesheet, TimesheetTask, SimplifiedTimesheetDetail, SimplifiedTimesheet
 
@@ -139,15 +144,93 @@ class DistanceAPIView(APIView):
     def get(self, request, origin, destination):
         # Assuming patient1 and patient2 are the addresses or identifiers
         # You need to retrieve these addresses from your patients database
-
+        if origin == destination:
+            return Response({'text': 'Distance to the same location is zero', 'distance': 0, 'duration': 0})
         try:
-            if origin == destination:
-                return Response({'text': 'Distance to the same location is zero', 'distance': 0, 'duration': 0})
-            distance_record = DistanceMatrix.objects.get(patient_origin_id=origin, patient_destination_id=destination)
-            return Response({'text': str(distance_record), 'distance': distance_record.distance_in_km,
-                             'duration': distance_record.duration_in_mn})
-        except DistanceMatrix.DoesNotExist:
+            leg = travel_time_graph.leg(int(origin), int(destination))
+        except ValueError:
+            leg = None
+        if leg is None:
             return Response({'error': 'Distance not found'}, status=404)
+        patients = Patient.objects.in_bulk([int(origin), int(destination)])
+        distance, duration = leg
+        return Response({'text': f"Distance from {patients.get(int(origin))} to {patients.get(int(destination))} is "
+                                 f"{distance} km and it takes {duration} mn",
+                         'distance': distance, 'duration': duration})
+
+
+def parse_day(day):
+    try:
+        return date.fromisoformat(day)
+    except ValueError:
+        return None
+
+
+def evaluate_route(patient_ids):
+    route = travel_time_graph.evaluate(patient_ids)
+    return Response({'patient_ids': patient_ids,
+                     'distance': route.distance_in_km,
+                     'duration': route.duration_in_mn,
+                     'legs': [{'origin': origin, 'destination': destination,
+                               'distance': leg[0] if leg else None, 'duration': leg[1] if leg else None}
+                              for origin, destination, leg in zip(patient_ids, patient_ids[1:], route.legs)],
+                     'missing_legs': route.missing_legs})
+
+
+class RouteAPIView(APIView):
+    """
+    Totals of an ordered sequence of visits, the patients posted as ``patient_ids``.
+    """
+
+    def post(self, request):
+        return evaluate_route([int(patient_id) for patient_id in request.data.get('patient_ids', [])])
+
+
+class EmployeeDayRouteAPIView(APIView):
+    """
+    Totals of the day of a nurse, the patients of the events of the employee that day in the order of their start
+    time.
+    """
+
+    def get(self, request, employee_id, day):
+        day = parse_day(day)
+        if day is None:
+            return Response({'error': 'Invalid day'}, status=status.HTTP_400_BAD_REQUEST)
+        patient_ids = list(Event.objects.filter(employees_id=employee_id, day=day, patient__isnull=False).exclude(
+            state__in=IDLE_EVENT_STATES).order_by('time_start_event').values_list('patient_id', flat=True))
+        return evaluate_route(patient_ids)
+
+
+class TourAPIView(APIView):
+    """
+    Visit order proposal for the day of a nurse: POST computes it (in a worker unless running locally) with an
+    optional ``time_budget`` in seconds and ``genetic_algorithm`` flag, GET returns the last proposal computed.
+    """
+
+    def get(self, request, employee_id, day):
+        day = parse_day(day)
+        if day is None:
+            return Response({'error': 'Invalid day'}, status=status.HTTP_400_BAD_REQUEST)
+        proposal = get_tour_proposal(employee_id, day)
+        if proposal is None:
+            return Response({'error': 'No tour proposal'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(proposal)
+
+    def post(self, request, employee_id, day):
+        day = parse_day(day)
+        if day is None:
+            return Response({'error': 'Invalid day'}, status=status.HTTP_400_BAD_REQUEST)
+        serializer = TourRequestSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        time_budget = serializer.validated_data['time_budget']
+        use_genetic_algorithm = serializer.validated_data['genetic_algorithm']
+        if os.environ.get('LOCAL_ENV', None) or config.SKIP_DJANGORQ:
+            return Response(optimize_employee_tour(employee_id, day, time_budget=time_budget,
+                                                   use_genetic_algorithm=use_genetic_algorithm))
+        optimize_employee_tour.delay(employee_id, day, time_budget=time_budget,
+                                     use_genetic_algorithm=use_genetic_algorithm)
+        return Response({'status': 'queued'}, status=status.HTTP_202_ACCEPTED)
 
 
 class EmployeeContractDetailSerializerViewSet(viewsets.ModelViewSet):
@@ -254,6 +337,14 @@ class BatchViewSet(viewsets.ModelViewSet):
     queryset = InvoiceItemBatch.objects.all()
     serializer_class = InvoiceItemBatchSerializer
 
+    @action(detail=True, methods=['get'], url_path='dirty-events')
+    def dirty_events(self, request, pk=None):
+        """
+        Events of the batch period that have no prestation for their patient on their day.
+        """
+        event_serializer = EventSerializer(self.get_object().events_during_batch_periods(), many=True)
+        return Response(event_serializer.data, status=status.HTTP_200_OK)
+
 
 class TimesheetViewSet(viewsets.ModelViewSet):
     """
@@ -419,20 +510,31 @@ class FullCalendarEventViewSet(generics.ListCreateAPIView):
     serializer_class = FullCalendarEventSerializer
     pagination_class = StandardResultsSetPagination
 
+    # above this number of events the feed is streamed instead of being built in memory
+    streaming_threshold = 2000
+
     def get(self, request, *args, **kwargs):
-        queryset = self.get_queryset()
-        serializer = self.get_serializer(queryset, many=True)
-        # Convert __proxy__ objects to strings
-        data = [{str(key): str(value) for key, value in item.items()} for item in serializer.data]
-        json_data = json.dumps(data)
-        return HttpResponse(json_data, content_type='application/json')
+        feed = FullCalendarEventFeed(*self.get_range())
+        etag = feed.etag()
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            return not_modified
+        if len(feed) > self.streaming_threshold:
+            response = StreamingHttpResponse(feed.iter_json(), content_type='application/json')
+        else:
+            response = HttpResponse(feed.as_json(), content_type='application/json')
+        response['ETag'] = etag
+        return response
 
-    def get_queryset(self, *args, **kwargs):
+    def get_range(self):
         start_param = self.request.query_params.get('start', datetime.today().date())
         end_param = self.request.query_params.get('end', datetime.today().date())
         start = datetime.strptime(start_param, '%Y-%m-%dT%H:%M:%S').date()
         end = datetime.strptime(end_param, '%Y-%m-%dT%H:%M:%S').date()
-        queryset = Event.objects.filter(day__range=[start, end])
+        return start, end
+
+    def get_queryset(self, *args, **kwargs):
+        queryset = Event.objects.filter(day__range=self.get_range())
         return queryset
 
     def patch(self, request, *args, **kwargs):
@@ -542,21 +644,24 @@ class AvailableEmployeeList(generics.ListCreateAPIView):
         day = start.date()
         start_time = start.time()
         end_time = end.time()
-        # get the list of employees on holiday
-        # get holidays with start date and end date include day
-        holiday_list = HolidayRequest.objects.filter(start_date__lte=day, end_date__gte=day,
-                                                     request_status=HolidayRequestWorkflowStatus.ACCEPTED)
-        # get the list of employees assigned to an event at the same time, must remove current event otherwise it will be
-        # removed from the list
-        event_list = Event.objects.filter(day=day, time_start_event__lte=end_time,
-                                          time_end_event__gte=start_time).exclude(
-            id=self.request.query_params['id']).exclude(employees=None).exclude(state__in=[4, 5, 6])
-        # get the list of employees not on holiday and not assigned to an event at the same time
+        # employees on accepted leave or assigned to an event at the same time come from the day roster, must
+        # remove current event otherwise it will be removed from the list
         # take only employees who still have a contract
-        queryset = Employee.objects.exclude(user_id__in=holiday_list.values_list('employee', flat=True)).exclude(
-            id__in=event_list.values_list('employees', flat=True)).exclude(end_contract__lt=day)
-        serializer = self.get_serializer(queryset, many=True)
-        json_data = json.dumps(serializer.data)
+        # with until=YYYY-MM-DD the same time slot is looked up for every day up to that one
+        until = self.request.query_params.get('until', None)
+        available = day_roster.available(day, datetime.strptime(until, '%Y-%m-%d').date() if until else None,
+                                         start_time=start_time, end_time=end_time,
+                                         exclude_event_id=self.request.query_params.get('id', None),
+                                         active_only=False)
+        employees = {employee.id: employee for employee in Employee.objects.select_related('user').filter(
+            id__in={x['id'] for available_employees in available.values() for x in available_employees})}
+        serialized = {employee_id: data for employee_id, data in
+                      zip(employees, self.get_serializer(list(employees.values()), many=True).data)}
+        if until:
+            json_data = json.dumps({day.isoformat(): [serialized[x['id']] for x in available_employees]
+                                    for day, available_employees in available.items()})
+        else:
+            json_data = json.dumps([serialized[x['id']] for x in available[day]])
         return HttpResponse(json_data, content_type='application/json')
 
     def post(self, request, *args, **kwargs):
@@ -580,32 +685,21 @@ class EventList(generics.ListCreateAPIView):
         return self.list(request, *args, **kwargs)
 
     def post(self, request, *args, **kwargs):
+        employee_bis = None
         if request.data['employees']:
             emp_id = get_employee_id_by_abbreviation(request.data['employees']).id
             request.data['employees'] = emp_id
-            employee_bis = None
             if request.data['notes'].startswith("+"):
                 employee_bis = get_employee_id_by_abbreviation(request.data['notes'].split("+")[1])
         result = self.create(request, *args, **kwargs)
-        if result.status_code == status.HTTP_201_CREATED:
+        # the event is pushed to google calendar by the outbox drain, which fills calendar_id and calendar_url
+        if result.status_code == status.HTTP_201_CREATED and employee_bis:
             instance = Event.objects.get(pk=result.data.get('id'))
-            if employee_bis:
-                instance.notes = request.data['notes'] + "\n En collaboration avec %s %s - Tél %s" % (
-                    employee_bis.user.last_name,
-                    employee_bis.user.first_name,
-                    employee_bis.phone_number)
-            assert isinstance(instance, Event)
-            # if instance.event_type_enum == EventTypeEnum.BIRTHDAY:
-            #     return "Birthday created"
-            if instance.event_type_enum != EventTypeEnum.SUB_CARE:
-                gmail_event = create_or_update_google_calendar(instance)
-                if gmail_event.get('id'):
-                    instance.calendar_id = gmail_event.get('id')
-                    instance.calendar_url = gmail_event.get('htmlLink')
-                    instance.save()
-                else:
-                    instance.delete()
-                    return JsonResponse(result.data, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            instance.notes = request.data['notes'] + "\n En collaboration avec %s %s - Tél %s" % (
+                employee_bis.user.last_name,
+                employee_bis.user.first_name,
+                employee_bis.phone_number)
+            instance.save()
 
         return result
 
@@ -630,21 +724,15 @@ def calculate_distance_matrix(request):
             date_of_death__isnull=True).filter(date_of_exit__isnull=True)
         # create a list that is intersection of active patients and patient_ids
         patient_ids = list(set(patient_ids).union(set(active_patients.values_list('id', flat=True))))
-        # build a dict with patient as key and address as value
-        patient_address_dict = {}
-        for patient_id in patient_ids:
-            patient = Patient.objects.get(pk=patient_id)
-            patient_address_dict[patient] = patient.full_address
-            # print("%s : %s" % (patient, patient.full_address))
+        # build a dict with patient id as key and address as value
+        patient_address_dict = {patient.id: patient.full_address for patient in
+                                Patient.objects.filter(pk__in=patient_ids)}
         create_distance_matrix(patient_address_dict, config.DISTANCE_MATRIX_API_KEY)
         return Response(status=status.HTTP_200_OK)
     active_patients = Patient.objects.filter(is_under_dependence_insurance=True).filter(
         date_of_death__isnull=True).filter(date_of_exit__isnull=True)
-    # build a dict with patient as key and address as value
-    patient_address_dict = {}
-    for active_patient in active_patients:
-        patient_address_dict[active_patient] = active_patient.full_address
-        # print("%s : %s" % (active_patient, active_patient.full_address))
+    # build a dict with patient id as key and address as value
+    patient_address_dict = {active_patient.id: active_patient.full_address for active_patient in active_patients}
     create_distance_matrix(patient_address_dict, config.DISTANCE_MATRIX_API_KEY)
     return Response(status=status.HTTP_200_OK)
 
@@ -687,7 +775,7 @@ def my_memory_debug_view(request):
 
 
 class SimplifiedTimesheetViewSet(viewsets.ModelViewSet):
-    queryset = SimplifiedTimesheet.objects.all()
+    queryset = SimplifiedTimesheet.objects.select_related('employee', 'summary')
     serializer_class = SimplifiedTimesheetSerializer
     filter_backends = [filters.SearchFilter]
     search_fields = ['employee__abbreviation', 'time_sheet_year', 'time_sheet_month']
@@ -736,17 +824,24 @@ def get_patient_details_by_id(request):
         return Response(status=status.HTTP_404_NOT_FOUND)
 
 
+def parse_until(data):
+    # optional last day (included) of a range, the answer is then keyed by day
+    return datetime.strptime(data["until"], "%Y-%m-%d").date() if data.get("until") else None
+
+
 @api_view(['POST'])
 def whois_off(request):
     if 'POST' == request.method:  # user posting data
-        reqs = holidays.whois_off(datetime.strptime(request.data["day_off"], "%Y-%m-%d"))
+        reqs = holidays.whois_off(datetime.strptime(request.data["day_off"], "%Y-%m-%d"),
+                                  until=parse_until(request.data))
         return Response(reqs, status=status.HTTP_200_OK)
 
 
 @api_view(['POST'])
 def whois_available(request):
     if 'POST' == request.method:  # user posting data
-        reqs = holidays.whois_available(datetime.strptime(request.data["working_day"], "%Y-%m-%d"))
+        reqs = holidays.whois_available(datetime.strptime(request.data["working_day"], "%Y-%m-%d"),
+                                        until=parse_until(request.data))
         return (Response(reqs, status=status.HTTP_200_OK))
 
 
@@ -755,14 +850,16 @@ def whois_available(request):
 def whois_available_with_avatars_and_ids(request):
     if 'POST' == request.method:  # user posting data
         data = json.loads(request.body)
-        reqs = holidays.whois_available_with_avatars_and_ids(datetime.strptime(data["working_day"], "%Y-%m-%d"))
+        reqs = holidays.whois_available_with_avatars_and_ids(datetime.strptime(data["working_day"], "%Y-%m-%d"),
+                                                             until=parse_until(data))
         return Response(reqs, status=status.HTTP_200_OK)
 
 
 @api_view(['POST'])
 def which_shift(request):
     if 'POST' == request.method:  # user posting data
-        reqs = holidays.which_shift(datetime.strptime(request.data["working_day"], "%Y-%m-%d"))
+        reqs = holidays.which_shift(datetime.strptime(request.data["working_day"], "%Y-%m-%d"),
+                                    until=parse_until(request.data))
         return Response(reqs, status=status.HTTP_200_OK)
 
 
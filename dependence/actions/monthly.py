@@ -1,15 +1,19 @@
 import calendar
+from collections import defaultdict
+from dataclasses import dataclass, field
 from datetime import datetime, timezone, date
 
 from django.db import transaction
-from django.db.models import Q
+from django.db.models import Q, Prefetch
 
 from dependence.activity import LongTermMonthlyActivityDetail, LongTermMonthlyActivity
-from dependence.detailedcareplan import get_summaries_between_two_dates
+from dependence.cnscommunications import InformalCaregiverUnavailability
+from dependence.detailedcareplan import MedicalCareSummaryPerPatient, build_summaries_between_two_dates, \
+    summary_applies_between_two_dates, unavailabilities_between_two_dates
 from dependence.invoicing import LongTermCareMonthlyStatement, LongTermCareInvoiceFile, LongTermCareInvoiceLine, \
     LongTermCareInvoiceItem
 # LongTermCareInvoiceItem
-from dependence.longtermcareitem import LongTermPackage, LongTermCareItem
+from dependence.longtermcareitem import LongTermPackage
 from invoices.models import Patient
 
 
@@ -151,70 +155,181 @@ def create_assurance_dependance_invoices_june_selected_patient_2023(self, reques
     # display admin message
     self.message_user(request, "Factures AEV créées pour les patients sélectionnés {}".format(statement))
 
-def create_monthly_invoice(patient_list, month, year):
+# activity detail code -> (invoiced LongTermPackage code, quantity multiplier)
+ACTIVITY_INVOICE_ITEM_PACKAGES = {
+    "AMD-GI": ("AMDGI", 2),
+    "AAI": ("AAII", 2),
+    "AMD-GDN": ("AMDGN", 1),
+    "AMD-GG": ("AMDGG", 2),
+    "AMD-GDD": ("AMDGD", 2),
+}
+
+
+@dataclass
+class MonthlyInvoiceDiff:
+    """
+    What create_monthly_invoice adds to the monthly statement, the objects are not saved on a dry run.
+    """
+    statement: LongTermCareMonthlyStatement = None
+    invoices: list = field(default_factory=list)
+    lines: list = field(default_factory=list)
+    items: list = field(default_factory=list)
+
+    def __str__(self):
+        return "%s factures, %s lignes et %s items à créer" % (len(self.invoices), len(self.lines), len(self.items))
+
+
+class MonthlyPackages:
+    """
+    All the LongTermPackages loaded once, looked up like the ``.get()`` they replace.
+    """
+
+    def __init__(self):
+        self.by_code = {}
+        self.by_dependence_level = defaultdict(list)
+        for package in LongTermPackage.objects.all():
+            self.by_code[package.code] = package
+            self.by_dependence_level[package.dependence_level].append(package)
+
+    def get_by_code(self, code):
+        try:
+            return self.by_code[code]
+        except KeyError:
+            raise LongTermPackage.DoesNotExist("LongTermPackage %s does not exist" % code)
+
+    def get_by_dependence_level(self, dependence_level):
+        packages = self.by_dependence_level.get(dependence_level, [])
+        if len(packages) == 0:
+            raise LongTermPackage.DoesNotExist("No LongTermPackage for dependence level %s" % dependence_level)
+        if len(packages) > 1:
+            raise LongTermPackage.MultipleObjectsReturned(
+                "%s LongTermPackages for dependence level %s" % (len(packages), dependence_level))
+        return packages[0]
+
+    def get_for_summary(self, summary):
+        medical_summary = summary.medicalSummaryPerPatient
+        if medical_summary.special_package is not None and medical_summary.level_of_needs == 780:
+            return self.get_by_code("AEVFSP")
+        if medical_summary.nature_package is not None:
+            return self.get_by_dependence_level(medical_summary.nature_package)
+        return self.get_by_dependence_level(medical_summary.level_of_needs)
+
+
+def create_monthly_invoice(patient_list, month, year, dry_run=False):
     """
-    Create a monthly invoice for a patient
+    Create the monthly invoices of the patients, activities, summaries, packages and what is already invoiced are
+    loaded upfront and the missing invoices, lines and items are written with bulk_create in one transaction.
+    Running it again for the same month only adds what is missing.
     :param patient_list: list of patients
     :param month: int
     :param year: int
+    :param dry_run: nothing is written, the MonthlyInvoiceDiff is returned instead of the statement
     :return: LongTermCareMonthlyStatement
     """
-    # get all activities for this patient for this month
-    # activities = LongTermCareActivity.objects.filter(patient=patient, date__month=month, date__year=year)
-    # create a new invoice
-    statement, created = LongTermCareMonthlyStatement.objects.get_or_create(month=month, year=year)
-    for patient in patient_list:
-        create_monthly_invoice_line_v2(patient, statement, month=month, year=year)
-        create_monthly_invoice_items(patient, statement, month=month, year=year)
+    with transaction.atomic():
+        if dry_run:
+            statement = LongTermCareMonthlyStatement.objects.filter(month=month, year=year).first()
+        else:
+            statement, created = LongTermCareMonthlyStatement.objects.get_or_create(month=month, year=year)
+        diff = compute_monthly_invoice_diff(patient_list, statement, month, year)
+        if dry_run:
+            return diff
+        LongTermCareInvoiceFile.objects.bulk_create(diff.invoices)
+        LongTermCareInvoiceLine.objects.bulk_create(diff.lines)
+        LongTermCareInvoiceItem.objects.bulk_create(diff.items)
     return statement
 
 
-def create_packages(invoice, start_period, end_period, long_term_package):
-    return LongTermCareInvoiceLine.objects.get_or_create(invoice=invoice,
-                                                         start_period=start_period,
-                                                         end_period=end_period,
-                                                         long_term_care_package=long_term_package)
-
+def compute_monthly_invoice_diff(patient_list, statement, month, year):
+    start_period = date(year, month, 1)
+    # end period is last day of the month
+    end_period = date(year, month, calendar.monthrange(year, month)[1])
+    patients = list({patient.id: patient for patient in patient_list}.values())
+    patient_ids = [patient.id for patient in patients]
+    diff = MonthlyInvoiceDiff(statement=statement)
 
+    invoices = {}
+    existing_lines = set()
+    existing_items = set()
+    if statement is not None and statement.pk:
+        for invoice in LongTermCareInvoiceFile.objects.filter(link_to_monthly_statement=statement,
+                                                              patient_id__in=patient_ids,
+                                                              invoice_start_period=start_period,
+                                                              invoice_end_period=end_period).order_by('id'):
+            invoices.setdefault(invoice.patient_id, invoice)
+        existing_lines = set(LongTermCareInvoiceLine.objects.filter(invoice__in=list(invoices.values())).values_list(
+            'invoice_id', 'start_period', 'end_period', 'long_term_care_package_id'))
+        existing_items = set(
+            (invoice_id, care_date, package_id, float(quantity)) for invoice_id, care_date, package_id, quantity in
+            LongTermCareInvoiceItem.objects.filter(invoice__in=list(invoices.values())).values_list(
+                'invoice_id', 'care_date', 'long_term_care_package_id', 'quantity'))
+    activities = {activity.patient_id: activity for activity in
+                  LongTermMonthlyActivity.objects.filter(patient_id__in=patient_ids, year=year,
+                                                         month=month).prefetch_related(
+                      Prefetch('activity_details',
+                               queryset=LongTermMonthlyActivityDetail.objects.select_related('activity').order_by(
+                                   'activity_date', 'id')))}
+    summaries = defaultdict(list)
+    # superset of the filters of get_summaries_between_two_dates for any period within the month
+    for summary in MedicalCareSummaryPerPatient.objects.filter(patient_id__in=patient_ids).filter(
+            Q(date_of_decision__lte=end_period) | Q(date_of_start_of_plan_for_us__lte=end_period)).order_by(
+            'date_of_decision', 'id'):
+        summaries[summary.patient_id].append(summary)
+    unavailabilities = defaultdict(list)
+    for unavailability in InformalCaregiverUnavailability.objects.filter(
+            patient_id__in=patient_ids, unavailability_date__gte=start_period,
+            unavailability_date__lte=end_period).order_by('id'):
+        unavailabilities[unavailability.patient_id].append(unavailability)
+    packages = MonthlyPackages()
 
+    for patient in patients:
+        invoice = invoices.get(patient.id)
+        if invoice is None:
+            invoice = LongTermCareInvoiceFile(link_to_monthly_statement=statement, patient=patient,
+                                              invoice_start_period=start_period, invoice_end_period=end_period)
+            diff.invoices.append(invoice)
+        activity = activities.get(patient.id)
+        if activity is None:
+            continue
+        details = list(activity.activity_details.all())
+        if len(details) == 0:
+            continue
+        first_day = details[0].activity_date
+        last_day = details[-1].activity_date
+        unavailability_start, unavailability_end = unavailabilities_between_two_dates(unavailabilities[patient.id],
+                                                                                      first_day, last_day)
+        patient_summaries = build_summaries_between_two_dates(
+            [summary for summary in summaries[patient.id] if
+             summary_applies_between_two_dates(summary, first_day, last_day)],
+            unavailability_start, unavailability_end, first_day, last_day)
+        has_amdm = any(detail.activity.code == "AMD-M" for detail in details)
+        lines = set()
 
-def create_monthly_invoice_line_v2(patient, statement, month, year):
-    start_period = date(year, month, 1)
-    # end period is last day of the month
-    last_day = calendar.monthrange(year, month)[1]
-    end_period = date(year, month, last_day)
-    invoice, created = LongTermCareInvoiceFile.objects.get_or_create(link_to_monthly_statement=statement,
-                                                                     patient=patient,
-                                                                     invoice_start_period=start_period,
-                                                                     invoice_end_period=end_period)
-    if LongTermMonthlyActivity.objects.filter(patient=patient, year=start_period.year,
-                                              month=start_period.month).count() == 0:
-        return invoice
+        def add_line(summary, long_term_package):
+            key = (invoice.id, summary.start_date, summary.end_date, long_term_package.id)
+            if key in existing_lines or key[1:] in lines:
+                return
+            lines.add(key[1:])
+            diff.lines.append(LongTermCareInvoiceLine(invoice=invoice, start_period=summary.start_date,
+                                                      end_period=summary.end_date,
+                                                      long_term_care_package=long_term_package))
 
-    activity = LongTermMonthlyActivity.objects.filter(patient=patient, year=start_period.year,
-                                                      month=start_period.month).get()
-    first_day = activity.get_first_date_for_activity_detail()
-    last_day = activity.get_last_date_for_activity_detail()
-    summaries = get_summaries_between_two_dates(patient, first_day, last_day)
-    for summary in summaries:
-        if summary.medicalSummaryPerPatient.special_package is not None and summary.medicalSummaryPerPatient.level_of_needs == 780:
-            # create an invoice line for each activity
-            forfait_soins_palliatifs_long_term_package = LongTermPackage.objects.filter(code="AEVFSP").get()
-            create_packages(invoice, summary.start_date, summary.end_date, forfait_soins_palliatifs_long_term_package)
-        elif summary.medicalSummaryPerPatient.nature_package is not None:
-            aev_long_term_package = LongTermPackage.objects.filter(
-                dependence_level=summary.medicalSummaryPerPatient.nature_package).get()
-            create_packages(invoice, summary.start_date, summary.end_date, aev_long_term_package)
-        elif summary.medicalSummaryPerPatient.nature_package is None:
-            aev_long_term_package = LongTermPackage.objects.filter(
-                dependence_level=summary.medicalSummaryPerPatient.level_of_needs).get()
-            create_packages(invoice, summary.start_date, summary.end_date, aev_long_term_package)
-        amdm_activity_item = LongTermCareItem.objects.filter(code="AMD-M").get()
-        if activity.how_many_occurrence_of_activity(amdm_activity_item, first_day, last_day) > 0:
-            # create an invoice line for each activity
-            amdm_long_term_package = LongTermPackage.objects.filter(code="FAMDM").get()
-            create_packages(invoice, summary.start_date, summary.end_date, amdm_long_term_package)
-    return invoice
+        for summary in patient_summaries:
+            add_line(summary, packages.get_for_summary(summary))
+            if has_amdm:
+                add_line(summary, packages.get_by_code("FAMDM"))
+        for detail in details:
+            if detail.activity.code not in ACTIVITY_INVOICE_ITEM_PACKAGES:
+                continue
+            package_code, multiplier = ACTIVITY_INVOICE_ITEM_PACKAGES[detail.activity.code]
+            long_term_package = packages.get_by_code(package_code)
+            quantity = detail.quantity * multiplier
+            if (invoice.id, detail.activity_date, long_term_package.id, float(quantity)) in existing_items:
+                continue
+            diff.items.append(LongTermCareInvoiceItem(invoice=invoice, care_date=detail.activity_date,
+                                                      long_term_care_package=long_term_package,
+                                                      quantity=quantity))
+    return diff
 
 
 def create_invoice_items(patient, statement, month, year, quantity, long_term_package, date_of_care):
@@ -243,64 +358,3 @@ def create_invoice_items(patient, statement, month, year, quantity, long_term_pa
                                                                           code=invoice_item.code).get(),
                                                                       quantity=dtl.quantity * quantity)
     return invoice
-
-
-def create_monthly_invoice_items(patient, statement, month, year):
-    start_period = date(year, month, 1)
-    # end period is last day of the month
-    last_day = calendar.monthrange(year, month)[1]
-    end_period = date(year, month, last_day)
-    invoice, created = LongTermCareInvoiceFile.objects.get_or_create(link_to_monthly_statement=statement,
-                                                                     patient=patient,
-                                                                     invoice_start_period=start_period,
-                                                                     invoice_end_period=end_period)
-    if LongTermMonthlyActivity.objects.filter(patient=patient, year=start_period.year,
-                                              month=start_period.month).count() == 0:
-        return invoice
-    long_term_monthly_activity = LongTermMonthlyActivity.objects.filter(patient=patient, year=start_period.year,
-                                                                        month=start_period.month).get()
-    dtls = LongTermMonthlyActivityDetail.objects.filter(long_term_monthly_activity=long_term_monthly_activity).order_by(
-        'activity_date')
-    for dtl in dtls:
-        if "AMD-GI" == dtl.activity.code:
-            print(dtl.activity.code + " " + str(dtl.activity_date) + " " + str(dtl.quantity) + " " + str(patient))
-            # create as many invoice items as quantity
-            LongTermCareInvoiceItem.objects.create(invoice=invoice,
-                                                       care_date=dtl.activity_date,
-                                                       long_term_care_package=LongTermPackage.objects.filter(
-                                                           code="AMDGI").get(),
-                                                       quantity=dtl.quantity * 2)
-        elif "AAI" == dtl.activity.code:
-            print(dtl.activity.code + " " + str(dtl.activity_date) + " " + str(dtl.quantity))
-            # create as many invoice items as quantity
-            invoice_item = LongTermCareInvoiceItem.objects.create(invoice=invoice,
-                                                                      care_date=dtl.activity_date,
-                                                                      long_term_care_package=LongTermPackage.objects.filter(
-                                                                          code="AAII").get(),
-                                                                      quantity=dtl.quantity * 2)
-        elif "AMD-GDN" == dtl.activity.code:
-            print(dtl.activity.code + " " + str(dtl.activity_date) + " " + str(dtl.quantity))
-            # create as many invoice items as quantity
-            invoice_item = LongTermCareInvoiceItem.objects.create(invoice=invoice,
-                                                                      care_date=dtl.activity_date,
-                                                                      long_term_care_package=LongTermPackage.objects.filter(
-                                                                          code="AMDGN").get(),
-                                                                      quantity=dtl.quantity * 1)
-        elif "AMD-GG" == dtl.activity.code:
-            print(dtl.activity.code + " " + str(dtl.activity_date) + " " + str(dtl.quantity))
-            # create as many invoice items as quantity
-            invoice_item = LongTermCareInvoiceItem.objects.create(invoice=invoice,
-                                                                      care_date=dtl.activity_date,
-                                                                      long_term_care_package=LongTermPackage.objects.filter(
-                                                                          code="AMDGG").get(),
-                                                                      quantity=dtl.quantity * 2)
-        elif "AMD-GDD" == dtl.activity.code:
-            print(dtl.activity.code + " " + str(dtl.activity_date) + " " + str(dtl.quantity))
-            # create as many invoice items as quantity
-            invoice_item = LongTermCareInvoiceItem.objects.create(invoice=invoice,
-                                                                      care_date=dtl.activity_date,
-                                                                      long_term_care_package=LongTermPackage.objects.filter(
-                                                                          code="AMDGD").get(),
-                                                                      quantity=dtl.quantity * 2)
-
-
@@ -1,9 +1,7 @@
 import calendar
 import datetime
-import os
 
 import lxml.etree as ElementTree
-import xmlschema
 from constance import config
 from django.core.files.base import ContentFile
 from django.db import models
@@ -11,6 +9,7 @@ from django.db.models import Count
 from django.utils.translation import gettext_lazy as _
 
 from dependence.longtermcareitem import LongTermCareItem
+from dependence.xsdschemas import get_schema, DECLARATION_XSD
 
 
 def long_term_care_activity_declaration_file_path(instance, filename):
@@ -98,18 +97,8 @@ class LongTermMonthlyActivityFile(models.Model):
         super().save(*args, **kwargs)
 
     def generate_xml_using_xmlschema(self):
-        # Load the XSD schema file
-        # go one folder up
-        # Get the current script's directory
-        current_directory = os.path.dirname(os.path.abspath(__file__))
-
-        # Construct the path to the XSD file
-        xsd_path = os.path.join(current_directory, 'xsd', 'ad-declaration-14.xsd')
-
-        # Load the XSD schema
-        xsd_schema = xmlschema.XMLSchema(xsd_path)
-
-        # xsd_schema = xmlschema.XMLSchema(settings.BASE_DIR + '/dependence/xsd/ad-declaration-14.xsd')
+        # Load the compiled XSD schema
+        xsd_schema = get_schema(DECLARATION_XSD)
         # create element tree object
         root = ElementTree.Element("Declarations")
         # create sub element Type
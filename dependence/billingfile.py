@@ -0,0 +1,137 @@
+from datetime import timedelta
+
+import lxml.etree as ElementTree
+import xmlschema
+from constance import config
+
+from dependence.xsdschemas import get_schema, INVOICE_FILE_XSD
+
+# billing files bigger than that are spooled to disk while they are saved
+BILLING_FILE_MEMORY_SIZE = 5 * 1024 * 1024
+# care codes billed under the provider code of the subcontractor who did them
+SUBCONTRACTOR_CARE_CODES = ("AMDGG", "AAIG")
+
+
+def text_element(tag, text):
+    element = ElementTree.Element(tag)
+    element.text = text
+    return element
+
+
+def amounts_element(tag, number, amount):
+    element = ElementTree.Element(tag)
+    ElementTree.SubElement(element, "nombre").text = number
+    ElementTree.SubElement(element, "devise").text = "EUR"
+    ElementTree.SubElement(element, "montantBrut").text = amount
+    ElementTree.SubElement(element, "montantNet").text = amount
+    return element
+
+
+def prestation_element(reference, code, start, end, number, amount, executant):
+    prestation = ElementTree.Element("prestation")
+    ElementTree.SubElement(prestation, "referencePrestation").text = reference
+    ElementTree.SubElement(ElementTree.SubElement(prestation, "acte"), "codeTarif").text = code
+    period = ElementTree.SubElement(prestation, "periodePrestation")
+    ElementTree.SubElement(period, "dateDebut").text = start
+    if end is not None:
+        ElementTree.SubElement(period, "dateFin").text = end
+    prestation.append(amounts_element("demandePrestation", number, amount))
+    ElementTree.SubElement(prestation, "identifiantExecutant").text = executant
+    return prestation
+
+
+class MonthlyBillingFile:
+    """
+    ``decompteFacturation`` file of a ``LongTermCareMonthlyStatement``, written element by element with
+    ``lxml.etree.xmlfile``.
+
+    The invoices, lines and items are fetched once by ``get_invoices_with_lines_and_items`` and priced once each:
+    only the header totals are computed before writing, and the prestation of each day of a forfait line is written
+    as soon as it is built, so the file is never held in memory as a tree.
+    """
+
+    def __init__(self, statement, sending_to_update):
+        if not sending_to_update:
+            raise Exception("Sending to update is not implemented yet")
+        self.statement = statement
+        self.date_of_sending = sending_to_update.date_of_sending_xml_file.strftime("%Y-%m-%d")
+        self.code_prestataire = config.CODE_PRESTATAIRE
+
+    def priced_invoices(self):
+        """
+        Invoices to bill with their amount to be sent to the CNS, invoices with nothing left to pay are skipped, and
+        the total of the statement.
+        """
+        invoices = [(invoice, invoice.calculate_price_to_be_sent_to_CNS())
+                    for invoice in self.statement.get_invoices_with_lines_and_items()]
+        total = sum(amount for invoice, amount in invoices)
+        return [(invoice, amount) for invoice, amount in invoices if invoice.calculate_price() != 0], total
+
+    def executant(self, item):
+        if item.subcontractor and item.long_term_care_package.code in SUBCONTRACTOR_CARE_CODES:
+            if item.subcontractor.provider_code is None:
+                raise Exception(f"Provider code is not set for {item.subcontractor}")
+            return item.subcontractor.provider_code
+        return self.code_prestataire
+
+    def prestations(self, invoice, counter):
+        """Prestation elements of an invoice, ``counter`` numbers the prestations of the whole file."""
+        for item in invoice.invoice_item.all():
+            if item.paid:
+                continue
+            counter[0] += 1
+            care_date = item.care_date.strftime("%Y-%m-%d")
+            yield prestation_element(str(invoice.id) + str(counter[0]) + str(item.id),
+                                     item.long_term_care_package.code, care_date, care_date,
+                                     str(int(item.quantity)), str(item.calculate_price_to_be_sent_to_CNS()),
+                                     self.executant(item))
+        for line in invoice.invoice_line.all():
+            if line.paid:
+                continue
+            price_per_day = str(line.calculate_price_per_day())
+            for day in range((line.end_period - line.start_period).days + 1):
+                counter[0] += 1
+                care_date = (line.start_period + timedelta(days=day)).strftime("%Y-%m-%d")
+                yield prestation_element(str(invoice.id) + str(counter[0]), line.long_term_care_package.code,
+                                         care_date, None, "1", price_per_day, self.code_prestataire)
+
+    def write(self, output):
+        """Writes the file to the binary file object ``output``."""
+        invoices, total = self.priced_invoices()
+        with ElementTree.xmlfile(output, encoding='UTF-8') as xf:
+            xf.write_declaration()
+            with xf.element("decompteFacturation"):
+                type_decompte = ElementTree.Element("typeDecompte")
+                ElementTree.SubElement(type_decompte, "cadreLegal").text = "ASD"
+                ElementTree.SubElement(type_decompte, "layout").text = "2"
+                ElementTree.SubElement(type_decompte, "type").text = "FAC"
+                xf.write(type_decompte)
+                entete = ElementTree.Element("entete")
+                ElementTree.SubElement(entete, "identifiantFacturier").text = self.code_prestataire
+                ElementTree.SubElement(entete, "organisme").text = "19"
+                ElementTree.SubElement(entete, "dateEnvoi").text = self.date_of_sending
+                ElementTree.SubElement(entete, "referenceFichierFacturation").text = str(self.statement.id)
+                periode = ElementTree.SubElement(entete, "periodeDecompte")
+                ElementTree.SubElement(periode, "exercice").text = str(self.statement.year)
+                ElementTree.SubElement(periode, "mois").text = str(self.statement.get_month_in_2_digits)
+                entete.append(amounts_element("demandeDecompte", str(len(invoices)), str(total)))
+                xf.write(entete)
+                counter = [0]
+                for invoice_count, (invoice, amount) in enumerate(invoices, start=1):
+                    with xf.element("facture"):
+                        xf.write(text_element("referenceFacture",
+                                              str(self.statement.year) + str(self.statement.month) + str(invoice.id)))
+                        xf.write(text_element("identifiantPersonneProtegee", invoice.patient.code_sn))
+                        xf.write(text_element("dateEtablissementFacture", self.date_of_sending))
+                        for prestation in self.prestations(invoice, counter):
+                            xf.write(prestation)
+                        xf.write(amounts_element("demandeFacture", str(invoice_count), str(amount)))
+                    xf.flush()
+
+
+def validate_billing_file(source):
+    """
+    Validates the billing file read from ``source`` (a path or a binary file object) without building it in memory,
+    raises ``xmlschema.XMLSchemaValidationError`` when it is not valid.
+    """
+    get_schema(INVOICE_FILE_XSD).validate(xmlschema.XMLResource(source, lazy=True))
@@ -3,7 +3,6 @@ from ftplib import FTP
 from io import TextIOWrapper
 
 import lxml.etree as ElementTree
-import xmlschema
 from constance import config
 from django.core.exceptions import ValidationError
 from django.core.files.base import ContentFile
@@ -14,13 +13,14 @@ from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 from dependence.enums.longtermcare_enums import ChangeTypeChoices, UnavailabilityTypeChoices
+from dependence.xsdschemas import get_schema, DECLARATION_XSD
 from invoices.models import Patient
 from invoices.notifications import notify_system_via_google_webhook
 
 
 def generate_xml_using_xmlschema_using_instance(instance):
     # Load the XSD schema file
-    xsd_schema = xmlschema.XMLSchema('dependence/xsd/ad-declaration-14.xsd')
+    xsd_schema = get_schema(DECLARATION_XSD)
     # create element tree object
     root = ElementTree.Element("Declarations")
     # create sub element Type
@@ -181,7 +181,7 @@ class ChangeDeclarationFile(models.Model):
 
     def generate_xml_using_xmlschema(self):
         # Load the XSD schema file
-        xsd_schema = xmlschema.XMLSchema('dependence/xsd/ad-declaration-14.xsd')
+        xsd_schema = get_schema(DECLARATION_XSD)
         # create element tree object
         root = ElementTree.Element("Declarations")
         # create sub element Type
@@ -387,7 +387,7 @@ class InformalCaregiverUnavailability(models.Model):
         return f"Indisponibilité aidant du {self.unavailability_date} type {self.unavailability_type} ref {self.unavailability_reference}"
 def treat_xml_return_check(instance):
     if instance.generated_return_xml:
-        xsd_schema = xmlschema.XMLSchema('dependence/xsd/ad-declaration-14.xsd')
+        xsd_schema = get_schema(DECLARATION_XSD)
 
         # if self.generated_return_xml name is emtpy, then the file has not been generated yet
         if instance.generated_return_xml.name and instance.generated_return_xml.name != '':
@@ -1,5 +1,4 @@
 import lxml.etree as ElementTree
-import xmlschema
 from constance import config
 from django.core.files.base import ContentFile
 from django.db import models
@@ -8,6 +7,7 @@ from django.utils.translation import gettext_lazy as _
 from lxml import etree
 
 from dependence.enums.longtermcare_enums import ChangeTypeChoices
+from dependence.xsdschemas import get_schema, DECLARATION_XSD
 from invoices.models import Patient
 
 
@@ -132,7 +132,7 @@ class LongTermCareDeclaration(models.Model):
 
     def generate_xml_using_xmlschema(self):
         # Load the XSD schema file
-        xsd_schema = xmlschema.XMLSchema('dependence/xsd/ad-declaration-14.xsd')
+        xsd_schema = get_schema(DECLARATION_XSD)
         # create element tree object
         root = ElementTree.Element("Declarations")
         # create sub element Type
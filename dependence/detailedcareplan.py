@@ -197,7 +197,6 @@ def get_summaries_between_two_dates(patient, start_date, end_date):
                                                             date_of_start_of_plan_for_us__lte=start_date).order_by(
                     "date_of_decision")
 
-    summary_data = []
     # check if there InformalCaregiverUnavailability linked to this patient for the period
     unavailability_start = InformalCaregiverUnavailability.objects.filter(patient=patient,
                                                                           unavailability_date__gte=start_date,
@@ -208,6 +207,43 @@ def get_summaries_between_two_dates(patient, start_date, end_date):
                                                                         unavailability_date__gt=start_date,
                                                                         unavailability_date__lte=end_date,
                                                                         unavailability_type=UnavailabilityTypeChoices.RETOUR).first()
+    return build_summaries_between_two_dates(summaries, unavailability_start, unavailability_end, start_date, end_date)
+
+
+def summary_applies_between_two_dates(summary, start_date, end_date):
+    """
+    In memory version of the filters of get_summaries_between_two_dates, used when the summaries of several
+    patients are loaded at once.
+    """
+    date_of_decision = summary.date_of_decision
+    date_of_change_to_new_plan = summary.date_of_change_to_new_plan
+    date_of_start_of_plan_for_us = summary.date_of_start_of_plan_for_us
+    if date_of_decision is not None and date_of_decision <= end_date and (
+            date_of_change_to_new_plan is None or date_of_decision >= start_date):
+        return True
+    if date_of_change_to_new_plan is None:
+        return date_of_start_of_plan_for_us is not None and date_of_start_of_plan_for_us <= end_date
+    return date_of_change_to_new_plan >= end_date and date_of_start_of_plan_for_us is not None \
+        and date_of_start_of_plan_for_us <= start_date
+
+
+def unavailabilities_between_two_dates(unavailabilities, start_date, end_date):
+    """
+    In memory version of the unavailability lookups of get_summaries_between_two_dates, ``unavailabilities`` must be
+    the InformalCaregiverUnavailability of one patient ordered by id.
+    """
+    unavailability_start = next((unavailability for unavailability in unavailabilities
+                                 if unavailability.unavailability_type == UnavailabilityTypeChoices.DEBUT
+                                 and start_date <= unavailability.unavailability_date <= end_date), None)
+    unavailability_end = next((unavailability for unavailability in unavailabilities
+                               if unavailability.unavailability_type == UnavailabilityTypeChoices.RETOUR
+                               and unavailability.unavailability_date == end_date
+                               and unavailability.unavailability_date > start_date), None)
+    return unavailability_start, unavailability_end
+
+
+def build_summaries_between_two_dates(summaries, unavailability_start, unavailability_end, start_date, end_date):
+    summary_data = []
     for summary in summaries:
         medical_start_date = None
         medical_end_date = end_date
@@ -1,13 +1,14 @@
 import lxml.etree as ElementTree
 import pandas as pd
-import xmlschema
 from constance import config
 
+from dependence.xsdschemas import get_schema, INVOICE_FILE_XSD
+
 
 def generate_invoice_file(instance):
     # generate xml
     # Load the XSD schema file
-    xsd_schema = xmlschema.XMLSchema('dependence/xsd/ad-fichierfacturation-505.xsd')
+    xsd_schema = get_schema(INVOICE_FILE_XSD)
     # create element tree object
     root = ElementTree.Element("decompteFacturation")
     # create sub element Type
@@ -3,6 +3,7 @@ import hashlib
 import io
 import locale
 import os
+import tempfile
 import traceback
 import xml.etree.ElementTree as ET
 from dataclasses import dataclass
@@ -14,25 +15,35 @@ import fitz
 import xmlschema
 from constance import config
 from django.core.exceptions import ValidationError
+from django.core.files import File
 from django.core.files.base import ContentFile
 from django.core.files.storage import default_storage
-from django.db import models
-from django.db.models import Q, F, CharField
-from django.db.models.functions import Concat, ExtractYear, ExtractMonth
+from django.db import models, transaction
+from django.db.models import Q, Prefetch
 from django.db.models.signals import pre_save
 from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.safestring import mark_safe
 from django.utils.translation import gettext_lazy as _
 
+from dependence.billingfile import BILLING_FILE_MEMORY_SIZE, MonthlyBillingFile, validate_billing_file
 from dependence.detailedcareplan import get_summaries_between_two_dates, MedicalCareSummaryPerPatientDetail
 from dependence.longtermcareitem import LongTermCareItem, LongTermPackage
+from dependence.xsdschemas import get_schema, INVOICE_FILE_XSD, INVOICE_RETURN_FILE_XSD
 from invoices.employee import Employee
 from invoices.models import Patient, Hospitalization, SubContractor, PatientSubContractorRelationship
 from invoices.modelspackage import InvoicingDetails
 from invoices.notifications import notify_system_via_google_webhook
 
 
+def prefetch_invoice_lines_and_items(invoices):
+    return invoices.select_related('patient').prefetch_related(
+        Prefetch('invoice_line',
+                 queryset=LongTermCareInvoiceLine.objects.select_related('long_term_care_package', 'subcontractor')),
+        Prefetch('invoice_item',
+                 queryset=LongTermCareInvoiceItem.objects.select_related('long_term_care_package', 'subcontractor')))
+
+
 def long_term_care_monthly_statement_file_path(instance, filename):
     # Ainsi le nom des fichiers commence toujours :
     # - par la lettre ‘D’ pour les fichiers de l’assurance dépendance
@@ -187,219 +198,43 @@ class LongTermCareMonthlyStatement(models.Model):
         sending_to_update.scan_of_signed_invoice = pdf_file
         sending_to_update.save()
 
-    def generate_xml_using_xmlschema(self, sending_to_update=None):
-
-        # Load the XSD schema file
-        # go one folder up
-        # Get the current script's directory
-        current_directory = os.path.dirname(os.path.abspath(__file__))
-
-        # Construct the path to the XSD file
-        xsd_path = os.path.join(current_directory, 'xsd', 'ad-fichierfacturation-505.xsd')
-
-        # Load the XSD schema
-        xsd_schema = xmlschema.XMLSchema(xsd_path)
-        # xsd_schema = xmlschema.XMLSchema(settings.BASE_DIR + '/dependence/xsd/ad-declaration-14.xsd')
-        # create element tree object
-        root = ElementTree.Element("decompteFacturation")
-        # create sub element typeDecompte
-        typeDecompte = ElementTree.SubElement(root, "typeDecompte")
-        # create sub element cadreLegal
-        cadreLegal = ElementTree.SubElement(typeDecompte, "cadreLegal")
-        cadreLegal.text = "ASD"
-        # create sub element layout
-        layout = ElementTree.SubElement(typeDecompte, "layout")
-        layout.text = "2"
-        # create sub element Type
-        type = ElementTree.SubElement(typeDecompte, "type")
-        type.text = "FAC"
-
-        # create sub element entete
-        entete = ElementTree.SubElement(root, "entete")
-        # create sub element identifiantFacturier
-        identifiantFacturier = ElementTree.SubElement(entete, "identifiantFacturier")
-        identifiantFacturier.text = config.CODE_PRESTATAIRE
-        # create sub element organisme
-        organisme = ElementTree.SubElement(entete, "organisme")
-        organisme.text = "19"
-        # create sub element dateEnvoi
-        if sending_to_update:
-            dateEnvoi = ElementTree.SubElement(entete, "dateEnvoi")
-            dateEnvoi.text = sending_to_update.date_of_sending_xml_file.strftime("%Y-%m-%d")
-        else:
-            raise Exception("Sending to update is not implemented yet")
-        # create sub element referenceFichierFacturation
-        referenceFichierFacturation = ElementTree.SubElement(entete, "referenceFichierFacturation")
-        referenceFichierFacturation.text = str(self.id)
-        # create sub element periodeDecompte
-        periodeDecompte = ElementTree.SubElement(entete, "periodeDecompte")
-        # create sub element exercice
-        exercice = ElementTree.SubElement(periodeDecompte, "exercice")
-        exercice.text = str(self.year)
-        # create sub element mois
-        mois = ElementTree.SubElement(periodeDecompte, "mois")
-        mois.text = str(self.get_month_in_2_digits)
-        # create sub element demandeDecompte
-        demandeDecompte = ElementTree.SubElement(entete, "demandeDecompte")
-        # create sub element nombre
-        nombre = ElementTree.SubElement(demandeDecompte, "nombre")
-        # set number of invoices per patient
-        invoices = LongTermCareInvoiceFile.objects.filter(link_to_monthly_statement=self).all().all()
-        nombre.text = str(self.get_number_of_invoices)
-        # create sub element devise
-        devise = ElementTree.SubElement(demandeDecompte, "devise")
-        devise.text = "EUR"
-        # create sub element montantBrut
-        montantBrut = ElementTree.SubElement(demandeDecompte, "montantBrut")
-        montantBrut.text = str(self.calculate_total_price_to_be_sent_to_CNS())
-        # create sub element montantNet
-        montantNet = ElementTree.SubElement(demandeDecompte, "montantNet")
-        montantNet.text = str(self.calculate_total_price_to_be_sent_to_CNS())
-        # loop through all LongTermCareInvoiceFile
-        _counter = 0
-        invoice_count = 0
-        for invoice in invoices:
-            if invoice.calculate_price() == 0:
-                # skip invoice already paid
-                continue
-            invoice_count += 1
-            # create sub element facture
-            facture = ElementTree.SubElement(root, "facture")
-            print(invoice)
-            # create sub element referenceFacture
-            referenceFacture = ElementTree.SubElement(facture, "referenceFacture")
-            # set referenceFacture is year _ month _  invoice.id
-            referenceFacture.text = str(self.year) + str(self.month) + str(invoice.id)
-            # create sub element identifiantPersonneProtegee
-            identifiantPersonneProtegee = ElementTree.SubElement(facture, "identifiantPersonneProtegee")
-            identifiantPersonneProtegee.text = invoice.patient.code_sn
-            # create sub element dateEtablissementFacture
-            if sending_to_update:
-                dateEtablissementFacture = ElementTree.SubElement(facture, "dateEtablissementFacture")
-                dateEtablissementFacture.text = sending_to_update.date_of_sending_xml_file.strftime("%Y-%m-%d")
-            else:
-                raise Exception("Sending to update is not implemented yet")
-            # loop through all LongTermCareInvoiceLine
-            for item in LongTermCareInvoiceItem.objects.filter(invoice=invoice).all().all():
-                if item.paid:
-                    # skip invoice line already paid
-                    continue
-                _counter += 1
-                # create sub element prestation
-                prestation = ElementTree.SubElement(facture, "prestation")
-                # create sub element codePrestation
-                referencePrestation = ElementTree.SubElement(prestation, "referencePrestation")
-                referencePrestation.text = str(invoice.id) + str(_counter) + str(item.id)
-                # create sub element acte
-                acte = ElementTree.SubElement(prestation, "acte")
-                # create sub element codeTarif
-                codeTarif = ElementTree.SubElement(acte, "codeTarif")
-                codeTarif.text = item.long_term_care_package.code
-                # create sub element periodePrestation
-                periodePrestation = ElementTree.SubElement(prestation, "periodePrestation")
-                # create sub element dateDebut
-                dateDebut = ElementTree.SubElement(periodePrestation, "dateDebut")
-                dateDebut.text = item.care_date.strftime("%Y-%m-%d")
-                # create sub element dateFin
-                dateFin = ElementTree.SubElement(periodePrestation, "dateFin")
-                dateFin.text = item.care_date.strftime("%Y-%m-%d")
-                # create sub element demandePrestation
-                demandePrestation = ElementTree.SubElement(prestation, "demandePrestation")
-                # create sub element nombre
-                nombre = ElementTree.SubElement(demandePrestation, "nombre")
-                nombre.text = str(int(item.quantity))
-                # create sub element devise
-                devise = ElementTree.SubElement(demandePrestation, "devise")
-                devise.text = "EUR"
-                # create sub element montantBrut
-                montantBrut = ElementTree.SubElement(demandePrestation, "montantBrut")
-                montantBrut.text = str(item.calculate_price_to_be_sent_to_CNS())
-                # create sub element montantNet
-                montantNet = ElementTree.SubElement(demandePrestation, "montantNet")
-                montantNet.text = str(item.calculate_price_to_be_sent_to_CNS())
-                # create sub element identifiantExecutant
-                identifiantExecutant = ElementTree.SubElement(prestation, "identifiantExecutant")
-                if item.subcontractor and item.long_term_care_package.code in ("AMDGG", "AAIG"):
-                    if item.subcontractor.provider_code is None:
-                        raise   Exception(f"Provider code is not set for {item.subcontractor}")
-                    identifiantExecutant.text = item.subcontractor.provider_code
-                else:
-                    identifiantExecutant.text = config.CODE_PRESTATAIRE
-
-            for line in LongTermCareInvoiceLine.objects.filter(invoice=invoice).all().all():
-                if line.paid:
-                    # skip invoice line already paid
-                    continue
-                for line_per_day in line.get_line_item_per_each_day_of_period():
-                    _counter += 1
-                    # create sub element prestation
-                    prestation = ElementTree.SubElement(facture, "prestation")
-                    # create sub element codePrestation
-                    referencePrestation = ElementTree.SubElement(prestation, "referencePrestation")
-                    referencePrestation.text = str(invoice.id) + str(_counter)
-                    # create sub element acte
-                    acte = ElementTree.SubElement(prestation, "acte")
-                    # create sub element codeTarif
-                    codeTarif = ElementTree.SubElement(acte, "codeTarif")
-                    codeTarif.text = line.long_term_care_package.code
-                    # create sub element periodePrestation
-                    periodePrestation = ElementTree.SubElement(prestation, "periodePrestation")
-                    # create sub element dateDebut
-                    dateDebut = ElementTree.SubElement(periodePrestation, "dateDebut")
-                    # dateDebut.text = line.start_period.strftime("%Y-%m-%d")
-                    dateDebut.text = line_per_day.care_date.strftime("%Y-%m-%d")
-                    # create sub element dateFin
-                    # dateFin = ElementTree.SubElement(periodePrestation, "dateFin")
-                    # dateFin.text = line.end_period.strftime("%Y-%m-%d")
-
-                    # create sub element demandePrestation
-                    demandePrestation = ElementTree.SubElement(prestation, "demandePrestation")
-                    # create sub element nombre
-                    nombre = ElementTree.SubElement(demandePrestation, "nombre")
-                    nombre.text = "1"
-                    # create sub element devise
-                    devise = ElementTree.SubElement(demandePrestation, "devise")
-                    devise.text = "EUR"
-                    # create sub element montantBrut
-                    montantBrut = ElementTree.SubElement(demandePrestation, "montantBrut")
-                    montantBrut.text = str(line.calculate_price_per_day())
-                    # create sub element montantNet
-                    montantNet = ElementTree.SubElement(demandePrestation, "montantNet")
-                    montantNet.text = str(line.calculate_price_per_day())
-                    # create sub element identifiantExecutant
-                    identifiantExecutant = ElementTree.SubElement(prestation, "identifiantExecutant")
-                    identifiantExecutant.text = config.CODE_PRESTATAIRE
-            # create sub element demandeFacture
-            demandeFacture = ElementTree.SubElement(facture, "demandeFacture")
-            # create sub element nombre
-            nombre = ElementTree.SubElement(demandeFacture, "nombre")
-            nombre.text = str(invoice_count)
-            # create sub element devise
-            devise = ElementTree.SubElement(demandeFacture, "devise")
-            devise.text = "EUR"
-            # create sub element montantBrut
-            montantBrut = ElementTree.SubElement(demandeFacture, "montantBrut")
-            montantBrut.text = str(invoice.calculate_price_to_be_sent_to_CNS())
-            # create sub element montantNet
-            montantNet = ElementTree.SubElement(demandeFacture, "montantNet")
-            montantNet.text = str(invoice.calculate_price_to_be_sent_to_CNS())
-        # create a new XML file with the results
-        mydata = ElementTree.tostring(root, xml_declaration=True, encoding='UTF-8')
-        if xsd_schema.is_valid(mydata):
+    def generate_xml_using_xmlschema(self, sending_to_update=None, output=None, validate=True):
+        """
+        Billing file of the statement, see dependence.billingfile.MonthlyBillingFile. Returns its bytes, or writes it
+        to the binary file object ``output`` and returns ``output`` rewound to the start of the file. The file is
+        validated against the xsd unless ``validate`` is False.
+        """
+        billing_file = MonthlyBillingFile(self, sending_to_update)
+        if output is None:
+            output = io.BytesIO()
+            self.generate_xml_using_xmlschema(sending_to_update, output=output, validate=validate)
+            return output.getvalue()
+        start = output.tell()
+        billing_file.write(output)
+        if validate:
+            output.seek(start)
+            validate_billing_file(output)
             print("The XML instance is valid!")
-        else:
-            xsd_schema.validate(mydata)
-        return mydata
+        output.seek(start)
+        return output
+
+    def get_invoices_with_lines_and_items(self):
+        """
+        Invoices of the statement with their lines and items fetched upfront, prices come from
+        dependence.pricing.long_term_package_prices so totaling them does not query per line.
+        """
+        return prefetch_invoice_lines_and_items(
+            LongTermCareInvoiceFile.objects.filter(link_to_monthly_statement=self).order_by('id'))
 
     def calculate_total_price(self):
         total_price = 0
-        for invoice in LongTermCareInvoiceFile.objects.filter(link_to_monthly_statement=self).all().all():
+        for invoice in self.get_invoices_with_lines_and_items():
             total_price += invoice.calculate_price()
         return total_price
 
     def calculate_total_price_to_be_sent_to_CNS(self):
         total_price = 0
-        for invoice in LongTermCareInvoiceFile.objects.filter(link_to_monthly_statement=self).all().all():
+        for invoice in self.get_invoices_with_lines_and_items():
             total_price += invoice.calculate_price_to_be_sent_to_CNS()
         return total_price
 
@@ -447,11 +282,7 @@ class LongTermCareMonthlyStatement(models.Model):
 
     @property
     def get_number_of_invoices(self):
-        all_invoices = LongTermCareInvoiceFile.objects.filter(link_to_monthly_statement=self).all()
-        for inv in all_invoices:
-            if inv.calculate_price() == 0:
-                all_invoices = all_invoices.exclude(id=inv.id)
-        return all_invoices.count()
+        return len([invoice for invoice in self.get_invoices_with_lines_and_items() if invoice.calculate_price() != 0])
 
     @property
     def get_month_in_2_digits(self):
@@ -506,14 +337,15 @@ def create_and_save_invoice_file(sender, instance, **kwargs):
         try:
             if sending_to_update.date_of_sending_xml_file is None:
                 sending_to_update.date_of_sending_xml_file = timezone.now()
-            xml_str = instance.generate_xml_using_xmlschema(sending_to_update=sending_to_update)
-            # update a pdf file with invoice data
-            instance.generate_invoice_pdf_from_template_from_field_forms(sending_to_update=sending_to_update)
-            # save the file
-            xml_file = ContentFile(xml_str, name=f"{instance.year}_{instance.month}.xml")
-            sending_to_update.xml_invoice_file = xml_file
-            sending_to_update.link_to_monthly_statement = instance
-            sending_to_update.save()
+            # the file only stays in memory while it is small
+            with tempfile.SpooledTemporaryFile(max_size=BILLING_FILE_MEMORY_SIZE) as output:
+                instance.generate_xml_using_xmlschema(sending_to_update=sending_to_update, output=output)
+                # update a pdf file with invoice data
+                instance.generate_invoice_pdf_from_template_from_field_forms(sending_to_update=sending_to_update)
+                # save the file
+                sending_to_update.xml_invoice_file = File(output, name=f"{instance.year}_{instance.month}.xml")
+                sending_to_update.link_to_monthly_statement = instance
+                sending_to_update.save()
         except Exception as e:
             message = f"Le fichier de factures mensuel {instance} n'a pas pu être généré. Erreur : {e}. Date heure : {timezone.now()}"
             message += f" Détails de l'erreur : {traceback.format_exc()}"
@@ -564,15 +396,181 @@ def has_no_anomalie_prestation(element):
     # if element has key 'anomaliePrestation' and its value is not None, return False
     return 'anomaliePrestation' not in element or element['anomaliePrestation'] is None
 
+def anomalies_as_text(anomalies):
+    return "".join(f"Type: {anomalie['type']} - Code: {anomalie['code']} - Motif: {anomalie['motif']}"
+                   for anomalie in anomalies)
+
+
+def index_sent_prestations(invoice_root):
+    """
+    Maps the referencePrestation of every prestation of the sent invoice file to its (dateDebut, codeTarif).
+    """
+    sent_prestations = {}
+    for invoiced_prestation in invoice_root.iterfind('.//facture/prestation'):
+        sent_prestations.setdefault(invoiced_prestation.findtext('referencePrestation'), (
+            date.fromisoformat(invoiced_prestation.findtext('periodePrestation/dateDebut')),
+            invoiced_prestation.findtext('acte/codeTarif')))
+    return sent_prestations
+
+
+def map_invoice_references(references):
+    """
+    Maps invoice references (year, month and id concatenated, see LongTermCareInvoiceFile.invoice_reference) to
+    their LongTermCareInvoiceFile in one query.
+    """
+    candidate_ids = set()
+    for reference in references:
+        # the month takes one or two digits
+        for id_start in (5, 6):
+            if reference[id_start:].isdigit():
+                candidate_ids.add(int(reference[id_start:]))
+    invoices_per_reference = {}
+    for invoice in LongTermCareInvoiceFile.objects.filter(id__in=candidate_ids):
+        if invoice.invoice_reference in invoices_per_reference:
+            raise LongTermCareInvoiceFile.MultipleObjectsReturned(
+                f"Several invoices match the reference {invoice.invoice_reference}")
+        invoices_per_reference[invoice.invoice_reference] = invoice
+    return invoices_per_reference
+
+
+@dataclass
+class ReconciliationReport:
+    anomalies: list
+    invoices_paid: int = 0
+    invoices_in_error: int = 0
+    prestations_paid: int = 0
+    prestations_refused: int = 0
+    lines_updated: int = 0
+    items_updated: int = 0
+    errors_created: int = 0
+    errors_deleted: int = 0
+    unknown_prestations: list = None
+
+    def __str__(self):
+        return (f"{self.invoices_paid} factures payées, {self.invoices_in_error} factures en anomalie, "
+                f"{self.prestations_paid} prestations payées, {self.prestations_refused} prestations refusées, "
+                f"{self.lines_updated} lignes et {self.items_updated} items mis à jour, "
+                f"{self.errors_created} erreurs créées, {self.errors_deleted} erreurs supprimées, "
+                f"prestations inconnues : {self.unknown_prestations}")
+
+
+def reconcile_return_document(instance, xml_document, invoice_root):
+    """
+    Applies the CNS return file ``xml_document`` (as parsed by xmlschema) to the invoices of the sent file
+    ``invoice_root``. Sent prestations are indexed once by referencePrestation, lines and items of all the invoices in
+    error are loaded upfront and saved with bulk_update, so the number of queries does not depend on the size of the
+    return file.
+    """
+    factures = xml_document['fichierFacturation']['facture']
+    report = ReconciliationReport(anomalies=[], unknown_prestations=[])
+    sent_prestations = index_sent_prestations(invoice_root)
+    invoices_per_reference = map_invoice_references(
+        [facture['referenceFacture'] for facture in factures if facture['referenceFacture'] is not None])
+
+    def get_invoice(reference_facture):
+        try:
+            return invoices_per_reference[reference_facture]
+        except KeyError:
+            raise LongTermCareInvoiceFile.DoesNotExist(f"No invoice matches the reference {reference_facture}")
+
+    invoices_in_error = {}
+    paid_invoice_ids = []
+    for facture in factures:
+        reference_facture = facture['referenceFacture'] if facture['referenceFacture'] is not None else "Unknown"
+        if facture.get('anomalieFacture') is not None:
+            invoices_in_error[get_invoice(reference_facture).id] = facture
+        elif float(facture['montantNet']) == float(facture['montantBrut']):
+            paid_invoice_ids.append(get_invoice(reference_facture).id)
+        else:
+            raise ValueError(
+                f"Montant net and montant brut are not equal {facture['montantNet']} {facture['montantBrut']}")
+
+    lines_per_code = {}
+    for line in LongTermCareInvoiceLine.objects.filter(invoice_id__in=invoices_in_error).select_related(
+            'long_term_care_package'):
+        lines_per_code.setdefault((line.invoice_id, line.long_term_care_package.code), []).append(line)
+    items_per_code_and_date = {}
+    for item in LongTermCareInvoiceItem.objects.filter(invoice_id__in=invoices_in_error).select_related(
+            'long_term_care_package'):
+        items_per_code_and_date.setdefault((item.invoice_id, item.long_term_care_package.code, item.care_date),
+                                           []).append(item)
+    existing_errors = set(InvoiceError.objects.filter(invoice_id__in=invoices_in_error,
+                                                      statement_sending=instance).values_list('invoice_id',
+                                                                                              flat=True))
+    changed_lines = {}
+    changed_items = {}
+    errors_to_create = []
+    errors_to_delete = []
+
+    def set_prestation_status(invoice_id, prestation, paid, comment):
+        try:
+            date_prestation, invoiced_code_acte = sent_prestations[prestation['referencePrestation']]
+        except KeyError:
+            report.unknown_prestations.append(prestation['referencePrestation'])
+            return
+        lines = lines_per_code.get((invoice_id, invoiced_code_acte), [])
+        if len(lines) == 1:
+            targets, changed = lines, changed_lines
+        else:
+            targets = items_per_code_and_date.get((invoice_id, invoiced_code_acte, date_prestation), [])
+            changed = changed_items
+        for target in targets:
+            target.paid = paid
+            target.refused_by_insurance = not paid
+            target.comment = comment
+            changed[target.id] = target
+
+    for invoice_id, facture in invoices_in_error.items():
+        reference_facture = facture['referenceFacture']
+        prestations_without_anomalies = [prestation for prestation in facture['prestation'] if
+                                         has_no_anomalie_prestation(prestation)]
+        prestations_with_anomalies = [prestation for prestation in facture['prestation'] if
+                                      not has_no_anomalie_prestation(prestation)]
+        for prestation in prestations_without_anomalies:
+            set_prestation_status(invoice_id, prestation, paid=True, comment="")
+        error_messages = [f"Facture {reference_facture} has anomaly {anomalie['code']} - {anomalie['motif']}"
+                          for anomalie in facture['anomalieFacture']]
+        for prestation in prestations_with_anomalies:
+            anomalies_text = anomalies_as_text(prestation['anomaliePrestation'])
+            set_prestation_status(invoice_id, prestation, paid=False, comment=anomalies_text)
+            error_messages.append(
+                f"reference prestation : {prestation['referencePrestation']} - Error messages: {anomalies_text}")
+        report.prestations_paid += len(prestations_without_anomalies)
+        report.prestations_refused += len(prestations_with_anomalies)
+        # a second processing of the same sending clears the errors of the first one
+        if invoice_id in existing_errors:
+            errors_to_delete.append(invoice_id)
+        else:
+            errors_to_create.append(InvoiceError(
+                invoice_id=invoice_id, statement_sending=instance, error_message=str(error_messages),
+                error_message_hash=hashlib.sha256(str(error_messages).encode('utf-8')).hexdigest()))
+        report.anomalies.append((reference_facture, facture['anomalieFacture']))
+
+    with transaction.atomic():
+        LongTermCareInvoiceLine.objects.bulk_update(list(changed_lines.values()),
+                                                    ['paid', 'refused_by_insurance', 'comment'], batch_size=500)
+        LongTermCareInvoiceItem.objects.bulk_update(list(changed_items.values()),
+                                                    ['paid', 'refused_by_insurance', 'comment'], batch_size=500)
+        InvoiceError.objects.bulk_create(errors_to_create)
+        if errors_to_delete:
+            InvoiceError.objects.filter(invoice_id__in=errors_to_delete, statement_sending=instance).delete()
+        if paid_invoice_ids:
+            # set lines and items as paid
+            LongTermCareInvoiceLine.objects.filter(invoice_id__in=paid_invoice_ids).update(paid=True)
+            LongTermCareInvoiceItem.objects.filter(invoice_id__in=paid_invoice_ids).update(paid=True)
+    report.invoices_paid = len(paid_invoice_ids)
+    report.invoices_in_error = len(invoices_in_error)
+    report.lines_updated = len(changed_lines)
+    report.items_updated = len(changed_items)
+    report.errors_created = len(errors_to_create)
+    report.errors_deleted = len(errors_to_delete)
+    return report
+
+
 def detect_anomalies(instance):
-    # Get the current script's directory
-    current_directory = os.path.dirname(os.path.abspath(__file__))
     # Parse the XML file
-    # Load the XSD schema file
-    xsd_path = os.path.join(current_directory, 'xsd', 'ad-fichierfacturationretour-506.xsd')
-    xsd_schema = xmlschema.XMLSchema(xsd_path)
-
-    #xml_file = instance.received_invoice_file_response.storage.open(instance.received_invoice_file_response.name)
+    # Load the compiled XSD schema
+    xsd_schema = get_schema(INVOICE_RETURN_FILE_XSD)
 
     # Parse and validate the XML document
     try:
@@ -581,9 +579,6 @@ def detect_anomalies(instance):
         print(f"XML document is not valid: {e}")
         return
 
-    # Now xml_document is a Python dictionary that represents your XML document
-    # You can navigate and validate the XML document using standard Python dictionary operations
-
     # Extract montantBrut and montantNet
     montant_brut = xml_document['fichierFacturation']['montantBrut']
     montant_net = xml_document['fichierFacturation']['montantNet']
@@ -591,130 +586,11 @@ def detect_anomalies(instance):
     # Compare montantBrut and montantNet
     if montant_brut != montant_net:
         print(f"Warning: montantBrut ({montant_brut}) and montantNet ({montant_net}) are not equal.")
-
-        # parse the xml sent to find the invoice
-        # Parse the XML file
-        invoice_tree = ET.parse(instance.xml_invoice_file)
-        invoice_root = invoice_tree.getroot()
-
-        # Extract facture elements with anomalies
-        anomalies = []
-        # loop through all 'facture' elements in xml_document
-        for facture in xml_document['fichierFacturation']['facture']:
-        #for facture in invoice_root.findall('.//facture'):
-            anomaliesFactures = None
-            reference_facture = facture['referenceFacture'] if facture['referenceFacture'] is not None else "Unknown"
-            # check if there's  'anomalieFacture' key first in facture element
-            if 'anomalieFacture' in facture and facture['anomalieFacture'] is not None:
-                anomaliesFactures = facture['anomalieFacture']
-            items = LongTermCareInvoiceFile.objects.annotate(
-                invoice_reference_filter=Concat(
-                    ExtractYear('invoice_start_period'),
-                    ExtractMonth('invoice_start_period'),
-                    F('id'),
-                    output_field=CharField()
-                )
-            )
-            if anomaliesFactures is not None:
-                # find prestation without anomalies
-                # Manually filter the prestations
-                prestations_without_anomalies = [prestation for prestation in facture['prestation'] if
-                                                 has_no_anomalie_prestation(prestation)]
-                invoice_in_error = items.filter(invoice_reference_filter=reference_facture).get()
-                for prestation in prestations_without_anomalies:
-                    invoiced_prestation = invoice_root.find('.//facture/prestation/[referencePrestation="{}"]'.format(
-                        prestation['referencePrestation']))
-                    date_prestation_text = invoiced_prestation.find('periodePrestation/dateDebut').text
-                    date_prestation = date.fromisoformat(date_prestation_text)
-                    invoiced_code_acte = invoiced_prestation.find('acte/codeTarif').text
-                    reference_prestation = prestation['referencePrestation']
-                    if len(LongTermCareInvoiceLine.objects.filter(invoice=invoice_in_error).filter(long_term_care_package__code=invoiced_code_acte)) == 1:
-                        LongTermCareInvoiceLine.objects.filter(invoice=invoice_in_error).filter(
-                            long_term_care_package__code=invoiced_code_acte).update(paid=True,
-                                                                                    refused_by_insurance=False,
-                                                                                    comment="")
-                    else:
-                        LongTermCareInvoiceItem.objects.filter(invoice=invoice_in_error).filter(
-                            long_term_care_package__code=invoiced_code_acte).filter(care_date=date_prestation).update(paid=True,
-                                                                                                                      refused_by_insurance=False,
-                                                                                                                      comment="")
-                error_messages = []
-                for anom in anomaliesFactures:
-                    error_messages.append(f"Facture {reference_facture} has anomaly {anom['code']} - {anom['motif']}")
-                # Find all 'prestation' elements with 'anomaliePrestation' child within the current 'facture'
-                prestations_with_anomalies = [prestation for prestation in facture['prestation'] if not has_no_anomalie_prestation(prestation)]
-                for prestation in prestations_with_anomalies:
-                    # find the invoiced prestation from the invoice file
-                    invoiced_prestation = invoice_root.find('.//facture/prestation/[referencePrestation="{}"]'.format(
-                        prestation['referencePrestation']))
-                    date_prestation_text = invoiced_prestation.find('periodePrestation/dateDebut').text
-                    date_prestation = date.fromisoformat(date_prestation_text)
-                    invoiced_code_acte = invoiced_prestation.find('acte/codeTarif').text
-                    reference_prestation = prestation['referencePrestation']
-                    anomaliesPrestations = prestation['anomaliePrestation']
-                    anomlies_text = ""
-                    for anomalie in anomaliesPrestations:
-                        anomalie_type = anomalie['type']
-                        anomalie_code = anomalie['code']
-                        anomalie_motif = anomalie['motif']
-                        anomlies_text += f"Type: {anomalie_type} - Code: {anomalie_code} - Motif: {anomalie_motif}"
-                    if len(LongTermCareInvoiceLine.objects.filter(invoice=invoice_in_error).filter(long_term_care_package__code=invoiced_code_acte)) == 1:
-                        LongTermCareInvoiceLine.objects.filter(invoice=invoice_in_error).filter(
-                            long_term_care_package__code=invoiced_code_acte).update(paid=False,
-                                                                                    refused_by_insurance=True,
-                                                                                    comment=anomlies_text)
-                    else:
-                        LongTermCareInvoiceItem.objects.filter(invoice=invoice_in_error).filter(
-                            long_term_care_package__code=invoiced_code_acte).filter(care_date=date_prestation).update(paid=False,
-                                                                                                                      refused_by_insurance=True,
-                                                                                                                      comment=anomlies_text)
-                    code_acte_paye = prestation['codeActePaye']
-                    anomalies = prestation['anomaliePrestation']
-                    anomaliesPrestationsText = ""
-                    for anomalie in anomalies:
-                        anomalie_type = anomalie['type']
-                        anomalie_code = anomalie['code']
-                        anomalie_motif = anomalie['motif']
-                        anomaliesPrestationsText += f"Type: {anomalie_type} - Code: {anomalie_code} - Motif: {anomalie_motif}"
-                    # prestation reference looks like "%s%s%s" % (self.invoice.id, self.long_term_care_package.id, date_of_line_str) extract long_term_care_package.id knowing that invoice.id is invoice_in_error.id
-                    long_term_care_package_id = reference_prestation[len(str(invoice_in_error.id)):-10]
-                    print(long_term_care_package_id)
-                    long_term_care_package = LongTermPackage.objects.get(code=code_acte_paye)
-
-                    # Display the extracted information
-                    print(f"  - Prestation Reference: {reference_prestation} - anomalies : {anomaliesPrestationsText}")
-                    error_messages.append(
-                        f"reference prestation : {reference_prestation} - Error messages: {anomaliesPrestationsText}")
-
-                # generate a hash for all error_messages
-                error_messages_hash = hashlib.sha256(str(error_messages).encode('utf-8')).hexdigest()
-                # check if error message already exists
-                if not InvoiceError.objects.filter(invoice=invoice_in_error,
-                                                   statement_sending=instance).exists():
-                    InvoiceError.objects.create(invoice=invoice_in_error,
-                                                statement_sending=instance,
-                                                error_message=error_messages)
-                    print(f"Facture {invoice_in_error} has anomaly {error_messages}")
-                else:
-                    print(f"deleting error message for facture {invoice_in_error} and sending {instance}")
-                    InvoiceError.objects.filter(invoice=invoice_in_error,
-                                                statement_sending=instance).delete()
-                # appends anomaliesFactures to anomalies
-                anomalies.append((reference_facture, anomaliesFactures))
-                #anomalies.append((reference_facture, code, motif))
-            else:
-                print(f"Facture {reference_facture} has no anomalies")
-                montant_net_facture = facture['montantNet']
-                montant_brut_facture = facture['montantBrut']
-                if float(montant_net_facture) == float(montant_brut_facture):
-                    invoice_paid = items.filter(invoice_reference_filter=reference_facture).get()
-                    # set lines and items as paid
-                    LongTermCareInvoiceLine.objects.filter(invoice=invoice_paid).update(paid=True)
-                    LongTermCareInvoiceItem.objects.filter(invoice=invoice_paid).update(paid=True)
-                else:
-                    raise ValueError(
-                        "Montant net and montant brut are not equal {montant_net_facture} {montant_brut_facture}")
-        return anomalies
+        # parse the xml sent to find the invoiced prestations
+        invoice_root = ET.parse(instance.xml_invoice_file).getroot()
+        report = reconcile_return_document(instance, xml_document, invoice_root)
+        print(report)
+        return report.anomalies
     else:
         print("No anomalies detected.")
         return None
@@ -858,22 +734,23 @@ class LongTermCareInvoiceFile(models.Model):
         return new_invoice
 
     def calculate_price(self):
-        lines = LongTermCareInvoiceLine.objects.filter(invoice=self)
+        # invoice_line / invoice_item use the prefetched rows when built by prefetch_invoice_lines_and_items
+        lines = self.invoice_line.all()
         total = 0
         for line in lines:
             total += line.calculate_price()
-        items = LongTermCareInvoiceItem.objects.filter(invoice=self)
+        items = self.invoice_item.all()
         for item in items:
             total += item.calculate_price()
         total_price = round(total, 2)
         return total_price
 
     def calculate_price_to_be_sent_to_CNS(self):
-        lines = LongTermCareInvoiceLine.objects.filter(invoice=self)
+        lines = self.invoice_line.all()
         total = 0
         for line in lines:
             total += line.calculate_price()
-        items = LongTermCareInvoiceItem.objects.filter(invoice=self)
+        items = self.invoice_item.all()
         for item in items:
             total += item.calculate_price_to_be_sent_to_CNS()
         total_price = round(total, 2)
@@ -1,8 +1,9 @@
-from datetime import date
-
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.db import models
-from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from dependence.pricing import long_term_package_prices
 
 
 class LongTermCareItem(models.Model):
@@ -41,11 +42,8 @@ class LongTermPackage(models.Model):
     weekly_package = models.PositiveIntegerField(blank=True, null=True)
 
     def price_per_day(self, date):
-        try:
-            price = LongTermPackagePrice.objects.get(package=self, start_date__lte=date, end_date__gte=date)
-            return price.price
-        except LongTermPackagePrice.DoesNotExist:
-            return None
+        return long_term_package_prices.price_per_day(self.id, date)
+
     def get_latest_price_and_date(self):
         try:
             price = LongTermPackagePrice.objects.filter(package=self).latest('start_date')
@@ -55,16 +53,7 @@ class LongTermPackage(models.Model):
 
 
     def price_per_year_month(self, year, month):
-        try:
-            target_date = date(year, month, 1)
-            price = LongTermPackagePrice.objects.get(
-                Q(package=self),
-                Q(start_date__lte=target_date),
-                Q(Q(end_date__gte=target_date) | Q(end_date__isnull=True))
-            )
-            return price.price
-        except LongTermPackagePrice.DoesNotExist:
-            return None
+        return long_term_package_prices.price_per_year_month(self.id, year, month)
 
     class Meta:
         ordering = ['code']
@@ -92,3 +81,8 @@ class LongTermPackagePrice(models.Model):
 
     def __str__(self):
         return "{0} / {1} - {2}".format(self.start_date, self.package, self.price)
+
+
+@receiver([post_save, post_delete], sender=LongTermPackagePrice, dispatch_uid="invalidate_long_term_package_prices")
+def invalidate_long_term_package_prices(sender, instance, **kwargs):
+    long_term_package_prices.invalidate()
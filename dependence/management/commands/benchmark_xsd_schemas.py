@@ -0,0 +1,40 @@
+import os
+import tempfile
+import time
+
+import xmlschema
+from django.core.management.base import BaseCommand
+
+from dependence.xsdschemas import SchemaRegistry, XSD_DIRECTORY
+
+
+class Command(BaseCommand):
+    help = 'Compares the time per call needed to get a CNS xsd schema by compiling it, from a pickle made at build ' \
+           'time and from the schema registry'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=20)
+
+    def handle(self, *args, **options):
+        # the pickles of the benchmark do not replace the ones made at build time
+        with tempfile.TemporaryDirectory() as compiled_directory:
+            self.benchmark(options['calls'], SchemaRegistry(compiled_directory=compiled_directory))
+
+    def benchmark(self, calls, registry):
+        registry.precompile()
+        names = sorted(name for name in os.listdir(XSD_DIRECTORY) if name.endswith('.xsd'))
+        for name in names:
+            started_at = time.monotonic()
+            for _ in range(calls):
+                xmlschema.XMLSchema(registry.xsd_path(name))
+            compiled = (time.monotonic() - started_at) / calls
+            started_at = time.monotonic()
+            for _ in range(calls):
+                SchemaRegistry(compiled_directory=registry.compiled_directory).get(name)
+            unpickled = (time.monotonic() - started_at) / calls
+            started_at = time.monotonic()
+            for _ in range(calls):
+                registry.get(name)
+            cached = (time.monotonic() - started_at) / calls
+            self.stdout.write("%s: %.1f ms compiled, %.1f ms unpickled, %.3f ms from the registry" % (
+                name, compiled * 1000, unpickled * 1000, cached * 1000))
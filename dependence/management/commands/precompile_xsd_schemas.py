@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from dependence.xsdschemas import schema_registry
+
+
+class Command(BaseCommand):
+    help = 'Compiles the CNS xsd schemas and pickles them so that processes load them instead of compiling them'
+
+    def handle(self, *args, **options):
+        for path in schema_registry.precompile():
+            self.stdout.write(path)
+        self.stdout.write(self.style.SUCCESS('Successfully precompiled xsd schemas'))
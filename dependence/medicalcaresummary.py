@@ -1,6 +1,5 @@
 from datetime import datetime
 
-import xmlschema
 from django.db import models, IntegrityError
 from django.db.models.signals import post_save
 from django.dispatch import receiver
@@ -10,6 +9,7 @@ from django.utils.translation import gettext_lazy as _
 from dependence.detailedcareplan import MedicalCareSummaryPerPatient, MedicalCareSummaryPerPatientDetail, \
     SharedMedicalCareSummaryPerPatientDetail
 from dependence.longtermcareitem import LongTermCareItem
+from dependence.xsdschemas import get_schema, MEDICAL_CARE_SUMMARY_XSD
 from invoices.models import Patient
 from invoices.notifications import notify_system_via_google_webhook
 
@@ -53,7 +53,7 @@ def get_description_by_code_acte(data, code_acte):
     return None
 def parse_xml_using_xmlschema(instance):
     # Load the XSD schema file
-    xsd_schema = xmlschema.XMLSchema('dependence/xsd/ad-synthesepriseencharge-20.xsd')
+    xsd_schema = get_schema(MEDICAL_CARE_SUMMARY_XSD)
     # parse the XML file using the schema
     xml_file = instance.generated_return_xml
     xml_file.open()
@@ -0,0 +1,39 @@
+from datetime import date
+
+from invoices.pricing import PriceIndex
+
+
+class LongTermPackagePriceIndex(PriceIndex):
+    """
+    Prices of the LongTermPackagePrices of all the LongTermPackages.
+
+    Prices resolved for a (package, year, month) are memoized so that totaling a monthly statement costs no query
+    per line or item.
+    """
+
+    def price_rows(self):
+        from dependence.longtermcareitem import LongTermPackagePrice
+        return LongTermPackagePrice.objects.order_by('package_id', 'start_date', 'id').values_list(
+            'package_id', 'start_date', 'end_date', 'price')
+
+    def price_per_year_month(self, package_id, year, month):
+        """
+        Returns the price of the package valid on the first day of the month, or None if there is none.
+        """
+        key = (package_id, year, month)
+        self._get_intervals()
+        per_month = self._memo
+        try:
+            return per_month[key]
+        except KeyError:
+            price = per_month[key] = self.lookup(package_id, date(year, month, 1))
+            return price
+
+    def price_per_day(self, package_id, day):
+        """
+        Returns the price of the package valid on ``day`` among the prices having an end date, or None.
+        """
+        return self.lookup(package_id, day, open_ended=False)
+
+
+long_term_package_prices = LongTermPackagePriceIndex()
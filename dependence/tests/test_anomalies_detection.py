@@ -1,9 +1,15 @@
 import unittest
+import xml.etree.ElementTree as ET
+from datetime import date
 from unittest.mock import patch, MagicMock
 
 from django.test import TestCase
 
-from dependence.invoicing import detect_anomalies, LongTermCareMonthlyStatementSending
+from dependence.invoicing import detect_anomalies, LongTermCareMonthlyStatementSending, reconcile_return_document, \
+    LongTermCareMonthlyStatement, LongTermCareInvoiceFile, LongTermCareInvoiceLine, LongTermCareInvoiceItem, \
+    InvoiceError
+from dependence.longtermcareitem import LongTermPackage
+from invoices.models import Patient
 
 
 # from invoices import settings as my_settings
@@ -48,5 +54,80 @@ class TestDetectAnomalies(TestCase):
         mock_root.find.assert_any_call('./entete/paiementGroupeTraitement/montantBrut')
 
 
+class TestReconcileReturnDocument(TestCase):
+    def setUp(self):
+        self.patient = Patient.objects.create(name="John", is_under_dependence_insurance=True, date_of_exit=None)
+        self.statement = LongTermCareMonthlyStatement.objects.create(year=2023, month=4)
+        self.sending = LongTermCareMonthlyStatementSending.objects.create(link_to_monthly_statement=self.statement)
+        self.forfait = LongTermPackage.objects.create(dependence_level=1, package=True, code="AEVF01",
+                                                      description="forfait")
+        self.care = LongTermPackage.objects.create(package=False, code="AMDGI", description="care")
+
+    def _create_invoice(self):
+        invoice = LongTermCareInvoiceFile.objects.create(patient=self.patient, link_to_monthly_statement=self.statement,
+                                                         invoice_start_period=date(2023, 4, 1),
+                                                         invoice_end_period=date(2023, 4, 30))
+        line = LongTermCareInvoiceLine.objects.create(invoice=invoice, start_period=date(2023, 4, 1),
+                                                      end_period=date(2023, 4, 2), long_term_care_package=self.forfait)
+        items = [LongTermCareInvoiceItem.objects.create(invoice=invoice, care_date=date(2023, 4, day),
+                                                        long_term_care_package=self.care, quantity=2)
+                 for day in (1, 2)]
+        return invoice, line, items
+
+    @staticmethod
+    def _sent_prestation(facture, reference, code, day):
+        prestation = ET.SubElement(facture, "prestation")
+        ET.SubElement(prestation, "referencePrestation").text = reference
+        ET.SubElement(ET.SubElement(prestation, "acte"), "codeTarif").text = code
+        ET.SubElement(ET.SubElement(prestation, "periodePrestation"), "dateDebut").text = day.isoformat()
+
+    def _documents(self, invoices):
+        root = ET.Element("decompteFacturation")
+        factures = []
+        for invoice, line, items in invoices:
+            facture = ET.SubElement(root, "facture")
+            self._sent_prestation(facture, "%s1" % invoice.id, "AEVF01", date(2023, 4, 1))
+            self._sent_prestation(facture, "%s2" % invoice.id, "AMDGI", date(2023, 4, 1))
+            self._sent_prestation(facture, "%s3" % invoice.id, "AMDGI", date(2023, 4, 2))
+            anomalie = {'type': 'R', 'code': '123', 'motif': 'refused'}
+            factures.append({'referenceFacture': invoice.invoice_reference, 'montantBrut': 10, 'montantNet': 5,
+                             'anomalieFacture': [anomalie],
+                             'prestation': [{'referencePrestation': "%s1" % invoice.id},
+                                            {'referencePrestation': "%s2" % invoice.id, 'anomaliePrestation': None},
+                                            {'referencePrestation': "%s3" % invoice.id,
+                                             'anomaliePrestation': [anomalie]}]})
+        return {'fichierFacturation': {'facture': factures}}, root
+
+    def test_paid_and_refused_prestations(self):
+        invoice, line, items = self._create_invoice()
+        xml_document, invoice_root = self._documents([(invoice, line, items)])
+        report = reconcile_return_document(self.sending, xml_document, invoice_root)
+        line.refresh_from_db()
+        self.assertTrue(line.paid)
+        first_item, second_item = LongTermCareInvoiceItem.objects.filter(invoice=invoice).order_by('care_date')
+        self.assertTrue(first_item.paid)
+        self.assertFalse(second_item.paid)
+        self.assertTrue(second_item.refused_by_insurance)
+        self.assertEqual("Type: R - Code: 123 - Motif: refused", second_item.comment)
+        self.assertEqual(1, InvoiceError.objects.filter(invoice=invoice, statement_sending=self.sending).count())
+        self.assertEqual((1, 2, 1, 1, 2), (report.invoices_in_error, report.prestations_paid,
+                                           report.prestations_refused, report.lines_updated, report.items_updated))
+        # processing the same sending again clears its errors
+        report = reconcile_return_document(self.sending, xml_document, invoice_root)
+        self.assertEqual(1, report.errors_deleted)
+        self.assertFalse(InvoiceError.objects.filter(invoice=invoice).exists())
+
+    def test_query_count_does_not_depend_on_invoices(self):
+        xml_document, invoice_root = self._documents([self._create_invoice()])
+        with self.assertNumQueries(9):
+            reconcile_return_document(self.sending, xml_document, invoice_root)
+        InvoiceError.objects.all().delete()
+        xml_document, invoice_root = self._documents([self._create_invoice() for _ in range(5)])
+        with self.assertNumQueries(9):
+            report = reconcile_return_document(self.sending, xml_document, invoice_root)
+        self.assertEqual(5, report.errors_created)
+        self.assertEqual(10, report.items_updated)
+
+
 if __name__ == '__main__':
     unittest.main()
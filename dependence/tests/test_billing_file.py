@@ -0,0 +1,75 @@
+import io
+import tempfile
+from datetime import date
+from types import SimpleNamespace
+
+import lxml.etree as ElementTree
+import xmlschema
+from constance.test import override_config
+from django.test import TestCase
+
+from dependence.invoicing import LongTermCareInvoiceFile, LongTermCareInvoiceItem, LongTermCareInvoiceLine, \
+    LongTermCareMonthlyStatement
+from dependence.longtermcareitem import LongTermPackage, LongTermPackagePrice
+from invoices.models import Patient
+
+
+@override_config(CODE_PRESTATAIRE='90012345')
+class MonthlyBillingFileTestCase(TestCase):
+    def setUp(self):
+        forfait = LongTermPackage.objects.create(dependence_level=1, package=True, code="FORF", description="forfait")
+        care = LongTermPackage.objects.create(dependence_level=0, package=False, code="AMDGG", description="care")
+        for package, price in ((forfait, 10.5), (care, 20)):
+            LongTermPackagePrice.objects.create(package=package, start_date=date(2023, 1, 1), price=price)
+        self.statement = LongTermCareMonthlyStatement.objects.create(year=2023, month=4)
+        self.patients = Patient.objects.bulk_create([
+            Patient(code_sn='194501010%04d' % index, first_name='first name', name='name %s' % index,
+                    address='address', zipcode='1234', city='city', phone_number='000') for index in range(3)])
+        self.invoices = []
+        for index, patient in enumerate(self.patients):
+            invoice = LongTermCareInvoiceFile.objects.create(patient=patient, link_to_monthly_statement=self.statement,
+                                                             invoice_start_period=date(2023, 4, 1),
+                                                             invoice_end_period=date(2023, 4, 30))
+            self.invoices.append(invoice)
+            LongTermCareInvoiceLine.objects.create(invoice=invoice, start_period=date(2023, 4, 1),
+                                                   end_period=date(2023, 4, 10 + index),
+                                                   long_term_care_package=forfait, paid=index == 2)
+            LongTermCareInvoiceItem.objects.create(invoice=invoice, care_date=date(2023, 4, 3),
+                                                   long_term_care_package=care, quantity=2, paid=index == 2)
+            LongTermCareInvoiceItem.objects.create(invoice=invoice, care_date=date(2023, 4, 4),
+                                                   long_term_care_package=care, quantity=1)
+        self.sending = SimpleNamespace(date_of_sending_xml_file=date(2023, 5, 2))
+
+    def test_billing_file(self):
+        # the configuration, the invoices with their lines and items, and the package prices
+        with self.assertNumQueries(6):
+            xml = self.statement.generate_xml_using_xmlschema(sending_to_update=self.sending, validate=False)
+        self.assertTrue(xml.startswith(b"<?xml version='1.0' encoding='UTF-8'?>\n<decompteFacturation>"))
+        root = ElementTree.fromstring(xml)
+        self.assertEqual(['3', '360.50'], [root.findtext('entete/demandeDecompte/nombre'),
+                                           root.findtext('entete/demandeDecompte/montantBrut')])
+        factures = root.findall('facture')
+        # items first, then one prestation per day of the forfait lines, paid ones are left out
+        self.assertEqual([12, 13, 1], [len(facture.findall('prestation')) for facture in factures])
+        self.assertEqual(['165.00', '175.50', '20.00'],
+                         [facture.findtext('demandeFacture/montantBrut') for facture in factures])
+        self.assertEqual(['1', '2', '3'], [facture.findtext('demandeFacture/nombre') for facture in factures])
+        prestation = factures[1].findall('prestation')[-1]
+        self.assertEqual(['FORF', '2023-04-11', None, '10.50'],
+                         [prestation.findtext('acte/codeTarif'), prestation.findtext('periodePrestation/dateDebut'),
+                          prestation.findtext('periodePrestation/dateFin'),
+                          prestation.findtext('demandePrestation/montantNet')])
+        # prestations are numbered across the whole file
+        second_invoice, first_item = self.invoices[1], self.invoices[1].invoice_item.order_by('id').first()
+        self.assertEqual('%s13%s' % (second_invoice.id, first_item.id),
+                         factures[1].findtext('prestation/referencePrestation'))
+
+    def test_billing_file_is_written_and_validated_as_a_stream(self):
+        with tempfile.TemporaryFile() as output:
+            self.statement.generate_xml_using_xmlschema(sending_to_update=self.sending, output=output)
+            self.assertEqual(self.statement.generate_xml_using_xmlschema(sending_to_update=self.sending),
+                             output.read())
+        with override_config(CODE_PRESTATAIRE=''), self.assertRaises(xmlschema.XMLSchemaValidationError):
+            self.statement.generate_xml_using_xmlschema(sending_to_update=self.sending, output=io.BytesIO())
+        with self.assertRaises(Exception):
+            self.statement.generate_xml_using_xmlschema()
@@ -3,7 +3,8 @@ from datetime import date
 
 from django.test import TestCase
 
-from dependence.invoicing import LongTermCareInvoiceLine, LongTermCareInvoiceFile, LongTermCareInvoiceItem
+from dependence.invoicing import LongTermCareInvoiceLine, LongTermCareInvoiceFile, LongTermCareInvoiceItem, \
+    LongTermCareMonthlyStatement
 from dependence.longtermcareitem import LongTermPackage, LongTermPackagePrice
 from invoices.models import Patient
 
@@ -156,3 +157,33 @@ class TestLongTermCareInvoiceItemAndLine(TestCase):
         self.assertEqual(invoice_test.total_number_of_lines(), 14)
 
 
+
+    def test_monthly_statement_total_price_query_count(self):
+        package = LongTermPackage.objects.create(dependence_level=1, package=True, code="TESTFORF",
+                                                 description="TESTDESC")
+        care = LongTermPackage.objects.create(dependence_level=1, package=False, code="TESTCARE",
+                                              description="TESTDESC")
+        LongTermPackagePrice.objects.create(package=package, start_date=date(2023, 1, 1), price=10.00)
+        LongTermPackagePrice.objects.create(package=care, start_date=date(2023, 1, 1), price=2.50)
+        statement = LongTermCareMonthlyStatement.objects.create(year=2023, month=4)
+
+        def add_invoice(days):
+            invoice = LongTermCareInvoiceFile.objects.create(patient=self.patient_john,
+                                                             link_to_monthly_statement=statement,
+                                                             invoice_start_period=date(2023, 4, 1),
+                                                             invoice_end_period=date(2023, 4, 30))
+            LongTermCareInvoiceLine.objects.create(invoice=invoice, start_period=date(2023, 4, 1),
+                                                   end_period=date(2023, 4, days), long_term_care_package=package)
+            for day in range(1, days + 1):
+                LongTermCareInvoiceItem.objects.create(invoice=invoice, care_date=date(2023, 4, day),
+                                                       long_term_care_package=care)
+
+        add_invoice(2)
+        # warm up the package price index
+        statement.calculate_total_price()
+        with self.assertNumQueries(3):
+            self.assertEqual(statement.calculate_total_price(), Decimal('25.00'))
+        add_invoice(10)
+        add_invoice(10)
+        with self.assertNumQueries(3):
+            self.assertEqual(statement.calculate_total_price(), Decimal('275.00'))
@@ -2,7 +2,12 @@ from datetime import date
 
 from django.test import TestCase
 
-from dependence.invoicing import LongTermCareInvoiceFile, LongTermCareMonthlyStatement
+from dependence.actions.monthly import create_monthly_invoice
+from dependence.activity import LongTermMonthlyActivity, LongTermMonthlyActivityDetail
+from dependence.detailedcareplan import MedicalCareSummaryPerPatient
+from dependence.invoicing import LongTermCareInvoiceFile, LongTermCareMonthlyStatement, LongTermCareInvoiceLine, \
+    LongTermCareInvoiceItem
+from dependence.longtermcareitem import LongTermCareItem
 from invoices.models import Patient
 
 
@@ -35,3 +40,68 @@ class TestLongTermCareInvoiceFile(TestCase):
         self.assertEqual(self.invoice_file_2.link_to_monthly_statement, self.invoice_file_1.link_to_monthly_statement)
         monthly_statement = LongTermCareMonthlyStatement.objects.get(id=id_of_monthly_statement)
         self.assertEqual(monthly_statement.get_invoices.count(), 2)
+
+
+class TestBulkMonthlyInvoiceCreation(TestCase):
+    fixtures = ['longtermpackage.json', 'longtermitems.json']
+
+    def _create_patient(self, name):
+        patient = Patient.objects.create(name=name, is_under_dependence_insurance=True, date_of_exit=None)
+        MedicalCareSummaryPerPatient.objects.create(patient=patient,
+                                                    date_of_decision=date(2022, 1, 10),
+                                                    date_of_evaluation=date(2022, 1, 1),
+                                                    date_of_request=date(2021, 12, 1),
+                                                    date_of_notification=date(2022, 1, 11),
+                                                    date_of_notification_to_provider=date(2022, 1, 12),
+                                                    plan_number="123456789",
+                                                    decision_number="123456789",
+                                                    start_of_support=date(2022, 1, 1),
+                                                    level_of_needs=1,
+                                                    nature_package=1)
+        activity = LongTermMonthlyActivity.objects.create(month=4, year=2023, patient=patient)
+        for day in range(1, 4):
+            LongTermMonthlyActivityDetail.objects.create(long_term_monthly_activity=activity,
+                                                         activity_date=date(2023, 4, day),
+                                                         activity=LongTermCareItem.objects.get(code="AEVH01"),
+                                                         quantity=5)
+        LongTermMonthlyActivityDetail.objects.create(long_term_monthly_activity=activity,
+                                                     activity_date=date(2023, 4, 2),
+                                                     activity=LongTermCareItem.objects.get(code="AMD-GI"),
+                                                     quantity=1)
+        LongTermMonthlyActivityDetail.objects.create(long_term_monthly_activity=activity,
+                                                     activity_date=date(2023, 4, 3),
+                                                     activity=LongTermCareItem.objects.get(code="AMD-M"),
+                                                     quantity=1)
+        return patient
+
+    def test_dry_run_does_not_write(self):
+        patient = self._create_patient("John")
+        diff = create_monthly_invoice([patient], 4, 2023, dry_run=True)
+        self.assertEqual(1, len(diff.invoices))
+        self.assertEqual(["AEVF01", "FAMDM"], [line.long_term_care_package.code for line in diff.lines])
+        self.assertEqual([(date(2023, 4, 2), "AMDGI", 2)],
+                         [(item.care_date, item.long_term_care_package.code, item.quantity) for item in diff.items])
+        self.assertFalse(LongTermCareMonthlyStatement.objects.exists())
+        self.assertFalse(LongTermCareInvoiceFile.objects.exists())
+
+    def test_creation_is_idempotent(self):
+        patient = self._create_patient("John")
+        statement = create_monthly_invoice([patient], 4, 2023)
+        invoice = LongTermCareInvoiceFile.objects.get(link_to_monthly_statement=statement, patient=patient)
+        self.assertEqual(2, LongTermCareInvoiceLine.objects.filter(invoice=invoice).count())
+        self.assertEqual(1, LongTermCareInvoiceItem.objects.filter(invoice=invoice).count())
+        diff = create_monthly_invoice([patient], 4, 2023, dry_run=True)
+        self.assertEqual((0, 0, 0), (len(diff.invoices), len(diff.lines), len(diff.items)))
+        self.assertEqual(statement, create_monthly_invoice([patient], 4, 2023))
+        self.assertEqual(1, LongTermCareInvoiceFile.objects.count())
+        self.assertEqual(2, LongTermCareInvoiceLine.objects.count())
+        self.assertEqual(1, LongTermCareInvoiceItem.objects.count())
+
+    def test_query_count_does_not_depend_on_patients(self):
+        patients = [self._create_patient("John")]
+        with self.assertNumQueries(8):
+            create_monthly_invoice(patients, 4, 2023, dry_run=True)
+        patients += [self._create_patient("David"), self._create_patient("Lucy")]
+        with self.assertNumQueries(8):
+            diff = create_monthly_invoice(patients, 4, 2023, dry_run=True)
+        self.assertEqual((3, 6, 3), (len(diff.invoices), len(diff.lines), len(diff.items)))
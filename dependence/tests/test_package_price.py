@@ -21,3 +21,28 @@ class LongTermPackagePriceTest(TestCase):
         self.assertEqual(package.price_per_year_month(2023,4), Decimal('10.00'))
         self.assertIsNone(package.price_per_year_month(2023,1))
 
+
+    def test_price_per_year_month_is_memoized_until_prices_change(self):
+        package = LongTermPackage.objects.create(dependence_level=1, package=True, code="TESTCODE",
+                                                 description="TESTDESC")
+        LongTermPackagePrice.objects.create(package=package, start_date=date(2023, 1, 1), price=10.00)
+        self.assertEqual(package.price_per_year_month(2023, 5), Decimal('10.00'))
+        with self.assertNumQueries(0):
+            self.assertEqual(package.price_per_year_month(2023, 5), Decimal('10.00'))
+            self.assertEqual(package.price_per_year_month(2023, 6), Decimal('10.00'))
+        LongTermPackagePrice.objects.filter(package=package).get().delete()
+        LongTermPackagePrice.objects.create(package=package, start_date=date(2023, 1, 1), end_date=date(2023, 5, 31),
+                                            price=10.00)
+        LongTermPackagePrice.objects.create(package=package, start_date=date(2023, 6, 1), price=12.50)
+        self.assertEqual(package.price_per_year_month(2023, 5), Decimal('10.00'))
+        self.assertEqual(package.price_per_year_month(2023, 6), Decimal('12.50'))
+
+    def test_price_per_day_needs_an_end_date(self):
+        package = LongTermPackage.objects.create(dependence_level=1, package=True, code="TESTCODE",
+                                                 description="TESTDESC")
+        LongTermPackagePrice.objects.create(package=package, start_date=date(2023, 3, 1), end_date=date(2023, 3, 31),
+                                            price=5.00)
+        LongTermPackagePrice.objects.create(package=package, start_date=date(2023, 4, 1), price=10.00)
+        self.assertEqual(package.price_per_day(date(2023, 3, 15)), Decimal('5.00'))
+        self.assertIsNone(package.price_per_day(date(2023, 4, 15)))
+        self.assertIsNone(package.price_per_day(date(2023, 2, 15)))
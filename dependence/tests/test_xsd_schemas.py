@@ -0,0 +1,27 @@
+import os
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from dependence.xsdschemas import DECLARATION_XSD, SchemaRegistry, get_schema, schema_registry
+
+
+class SchemaRegistryTestCase(SimpleTestCase):
+    def test_schema_is_compiled_once(self):
+        self.assertIs(get_schema(DECLARATION_XSD), schema_registry.get(DECLARATION_XSD))
+        self.assertFalse(get_schema(DECLARATION_XSD).is_valid('<Declarations/>'))
+
+    def test_precompiled_schema_is_unpickled(self):
+        with tempfile.TemporaryDirectory() as directory:
+            paths = SchemaRegistry(compiled_directory=directory).precompile([DECLARATION_XSD])
+            self.assertTrue(os.path.exists(paths[0]))
+            with mock.patch('dependence.xsdschemas.xmlschema.XMLSchema') as compile_schema:
+                schema = SchemaRegistry(compiled_directory=directory).get(DECLARATION_XSD)
+            compile_schema.assert_not_called()
+            self.assertEqual(get_schema(DECLARATION_XSD).root_elements[0].name, schema.root_elements[0].name)
+            # a pickle older than its xsd is ignored
+            os.utime(paths[0], (0, 0))
+            with mock.patch('dependence.xsdschemas.xmlschema.XMLSchema') as compile_schema:
+                SchemaRegistry(compiled_directory=directory).get(DECLARATION_XSD)
+            compile_schema.assert_called_once()
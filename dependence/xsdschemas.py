@@ -0,0 +1,84 @@
+import os
+import pickle
+import threading
+
+import xmlschema
+
+XSD_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'xsd')
+DECLARATION_XSD = 'ad-declaration-14.xsd'
+INVOICE_FILE_XSD = 'ad-fichierfacturation-505.xsd'
+INVOICE_RETURN_FILE_XSD = 'ad-fichierfacturationretour-506.xsd'
+MEDICAL_CARE_SUMMARY_XSD = 'ad-synthesepriseencharge-20.xsd'
+# where the schemas compiled at build time are pickled, see the precompile_xsd_schemas command
+COMPILED_XSD_DIRECTORY = os.environ.get('COMPILED_XSD_DIRECTORY', os.path.join(XSD_DIRECTORY, 'compiled'))
+
+
+class SchemaRegistry:
+    """
+    Compiled ``xmlschema.XMLSchema`` of the CNS xsd files, shared by the whole process.
+
+    Compiling an xsd takes a few hundred milliseconds, so a schema is compiled the first time it is asked for and then
+    kept. When ``precompile`` was run at build time, the schema is unpickled instead of compiled, unless the xsd file is
+    newer than the pickle or the pickle was made by another version of xmlschema.
+    """
+
+    def __init__(self, directory=XSD_DIRECTORY, compiled_directory=COMPILED_XSD_DIRECTORY):
+        self.directory = directory
+        self.compiled_directory = compiled_directory
+        self._schemas = {}
+        self._lock = threading.Lock()
+
+    def xsd_path(self, name):
+        return os.path.join(self.directory, name)
+
+    def compiled_path(self, name):
+        return os.path.join(self.compiled_directory, '%s.%s.pickle' % (name, xmlschema.__version__))
+
+    def _unpickle(self, name):
+        path = self.compiled_path(name)
+        try:
+            if os.path.getmtime(path) < os.path.getmtime(self.xsd_path(name)):
+                return None
+            with open(path, 'rb') as compiled_file:
+                return pickle.load(compiled_file)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print("Compiled schema %s could not be loaded, compiling it again: %s" % (path, e))
+            return None
+
+    def get(self, name):
+        schema = self._schemas.get(name)
+        if schema is None:
+            with self._lock:
+                schema = self._schemas.get(name)
+                if schema is None:
+                    schema = self._unpickle(name) or xmlschema.XMLSchema(self.xsd_path(name))
+                    self._schemas[name] = schema
+        return schema
+
+    def precompile(self, names=None):
+        """Pickles the compiled schemas (all the xsd files by default) and returns the paths written."""
+        names = names or sorted(name for name in os.listdir(self.directory) if name.endswith('.xsd'))
+        os.makedirs(self.compiled_directory, exist_ok=True)
+        paths = []
+        for name in names:
+            schema = xmlschema.XMLSchema(self.xsd_path(name))
+            path = self.compiled_path(name)
+            with open(path, 'wb') as compiled_file:
+                pickle.dump(schema, compiled_file, protocol=pickle.HIGHEST_PROTOCOL)
+            with self._lock:
+                self._schemas[name] = schema
+            paths.append(path)
+        return paths
+
+    def clear(self):
+        with self._lock:
+            self._schemas = {}
+
+
+schema_registry = SchemaRegistry()
+
+
+def get_schema(name):
+    return schema_registry.get(name)
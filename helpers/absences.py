@@ -0,0 +1,332 @@
+import threading
+from collections import namedtuple, defaultdict
+from datetime import date, datetime, timedelta
+
+import holidays
+import numpy as np
+
+from invoices.employee import Employee
+from invoices.enums.generic import HolidayRequestChoice
+from invoices.enums.holidays import HolidayRequestWorkflowStatus
+
+Computation = namedtuple('Computation', 'num_days num_days_sickness hours_jour jours_feries')
+
+# monday to friday
+WEEKMASK = '1111100'
+# hours off earned per month for each contractual hour per week (26 days a year for 40 hours a week)
+HOURS_OFF_PER_MONTH_PER_WEEKLY_HOUR = 0.43333333333333335
+
+
+def _as_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
+
+def _as_days(values):
+    return np.array([_as_date(value) for value in values], dtype='datetime64[D]')
+
+
+class LuxembourgCalendar:
+    """
+    Process wide calendar of the public holidays of Luxembourg as a sorted datetime64 array and a numpy
+    busdaycalendar, so that days, working days and public holidays of many periods are counted in one call.
+
+    ``holidays.Luxembourg`` is only built again when a period falls in a year that was not covered yet.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = (range(0), np.array([], dtype='datetime64[D]'), np.busdaycalendar(weekmask=WEEKMASK))
+
+    def _get_state(self, *days):
+        years, public_holidays, busdaycalendar = self._state
+        bounds = [day for array in days if len(array) for day in (array.min(), array.max())]
+        if not bounds:
+            return public_holidays, busdaycalendar
+        first_year = int(min(bounds).astype('datetime64[Y]').astype(int)) + 1970
+        last_year = int(max(bounds).astype('datetime64[Y]').astype(int)) + 1970
+        if first_year not in years or last_year not in years:
+            with self._lock:
+                years, public_holidays, busdaycalendar = self._state
+                if first_year not in years or last_year not in years:
+                    if len(years):
+                        first_year, last_year = min(first_year, years.start), max(last_year, years.stop - 1)
+                    years = range(first_year, last_year + 1)
+                    public_holidays = np.array(sorted(holidays.Luxembourg(years=years).keys()),
+                                               dtype='datetime64[D]')
+                    busdaycalendar = np.busdaycalendar(weekmask=WEEKMASK, holidays=public_holidays)
+                    self._state = (years, public_holidays, busdaycalendar)
+        return public_holidays, busdaycalendar
+
+    def working_days(self, starts, stops):
+        """
+        Number of weekdays that are not public holidays in each [start, stop) period.
+        """
+        starts, stops = _as_days(starts), _as_days(stops)
+        _, busdaycalendar = self._get_state(starts, stops)
+        return np.busday_count(starts, np.maximum(starts, stops), busdaycal=busdaycalendar)
+
+    def weekdays(self, starts, ends):
+        """
+        Number of weekdays, public holidays included, in each [start, end] period.
+        """
+        starts, ends = _as_days(starts), _as_days(ends)
+        return np.busday_count(starts, np.maximum(starts, ends + 1), weekmask=WEEKMASK)
+
+    def public_holidays_count(self, starts, ends):
+        """
+        Number of public holidays, whatever their weekday, in each [start, end] period.
+        """
+        starts, ends = _as_days(starts), _as_days(ends)
+        public_holidays, _ = self._get_state(starts, ends)
+        return np.maximum(np.searchsorted(public_holidays, ends, side='right')
+                          - np.searchsorted(public_holidays, starts, side='left'), 0)
+
+    def is_public_holiday(self, days):
+        days = _as_days(days)
+        public_holidays, _ = self._get_state(days)
+        return np.isin(days, public_holidays)
+
+    def public_holidays_between(self, start, stop):
+        """
+        Public holidays in [start, stop) as dates, like slicing ``holidays.Luxembourg()``.
+        """
+        start, stop = _as_days([start])[0], _as_days([stop])[0]
+        public_holidays, _ = self._get_state(np.array([start, stop]))
+        return public_holidays[(public_holidays >= start) & (public_holidays < stop)].tolist()
+
+    def working_days_in_month(self, start_date):
+        """
+        Number of working days from ``start_date`` over as many days as its month has.
+        """
+        start_date = _as_date(start_date)
+        days_in_month = (date(start_date.year + start_date.month // 12, start_date.month % 12 + 1, 1)
+                         - date(start_date.year, start_date.month, 1)).days
+        return int(self.working_days([start_date], [start_date + timedelta(days=days_in_month)])[0])
+
+
+luxembourg_calendar = LuxembourgCalendar()
+
+
+class ContractTimeline:
+    """
+    EmployeeContractDetail of an employee sorted by id, resolved in memory the way the querysets using ``first()``
+    resolved them.
+    """
+
+    def __init__(self, contracts):
+        self.contracts = sorted(contracts, key=lambda contract: contract.id)
+
+    @classmethod
+    def for_user(cls, user_id):
+        from invoices.employee import EmployeeContractDetail
+        return cls(EmployeeContractDetail.objects.filter(employee_link__user_id=user_id))
+
+    def covering_period(self, start_date, end_date):
+        """
+        First contract started on ``start_date`` and ending after ``end_date`` or never, None if there is none.
+        """
+        start_date, end_date = _as_date(start_date), _as_date(end_date)
+        for contract in self.contracts:
+            if contract.start_date <= start_date and (contract.end_date is None or contract.end_date >= end_date):
+                return contract
+        return None
+
+    def on_first_day_of_month(self, year, month):
+        first_day = date(year, month, 1)
+        for contract in self.contracts:
+            if contract.start_date <= first_day and contract.end_date is None:
+                return contract
+        for contract in self.contracts:
+            if contract.start_date <= first_day and contract.end_date is not None and contract.end_date > first_day:
+                return contract
+        return None
+
+    def for_holiday_request(self, holiday_request):
+        start_date = _as_date(holiday_request.start_date)
+        contracts = [contract for contract in self.contracts
+                     if contract.start_date <= start_date and contract.end_date is None]
+        if len(contracts) > 1:
+            raise Exception("More than one contract for employee when calculating holiday request %s id %s" % (
+                holiday_request, holiday_request.id))
+        if len(contracts) == 0:
+            contracts = [contract for contract in self.contracts if contract.start_date <= start_date and
+                         contract.end_date is not None and contract.end_date >= start_date]
+            if len(contracts) == 0:
+                # for employees who have a contract than ended before the start date of the holiday request
+                contracts = sorted([contract for contract in self.contracts if contract.start_date <= start_date and
+                                    contract.end_date is not None and contract.end_date <= start_date],
+                                   key=lambda contract: contract.end_date, reverse=True)
+                if len(contracts) == 0:
+                    raise Exception("No contract for employee when calculating holiday request %s id %s" % (
+                        holiday_request, holiday_request.id))
+            if len(contracts) > 1:
+                raise Exception("More than one contract for this employee %s for holiday request %s" % (
+                    holiday_request.employee, holiday_request))
+        return contracts[0]
+
+    def is_active_in(self, year):
+        return any(contract.end_date is None or contract.end_date.year == year for contract in self.contracts)
+
+
+def _days_value(count, half_day):
+    # whole days stay integers, like the counters of the day by day loops
+    count = int(count)
+    return count * 0.5 if half_day and count else count
+
+
+def absence_days_in_period(holiday_requests, period_start, period_end, skip_leaves_starting_on_public_holiday=False):
+    """
+    Returns the days of leave (reason 1), of sickness (reason 2) and of exceptional break (reason 5) of the holiday
+    requests within the period: weekdays that are not public holidays, halved for the requests of half days.
+
+    Like the loops it replaces, a request of several days counts from its first day in the period up to the day
+    before its last one, and with ``skip_leaves_starting_on_public_holiday`` a leave whose first counted day is a
+    public holiday is not counted at all.
+    """
+    holiday_requests = [holiday_request for holiday_request in holiday_requests if holiday_request.reason in (1, 2, 5)]
+    if not holiday_requests:
+        return 0, 0, 0
+    period_start, period_end = _as_date(period_start), _as_date(period_end)
+    starts, stops = [], []
+    for holiday_request in holiday_requests:
+        if holiday_request.start_date == holiday_request.end_date:
+            starts.append(holiday_request.start_date)
+            stops.append(holiday_request.start_date + timedelta(days=1))
+        else:
+            starts.append(max(holiday_request.start_date, period_start))
+            stops.append(min(holiday_request.end_date, period_end))
+    counts = luxembourg_calendar.working_days(starts, stops)
+    skipped = [False] * len(holiday_requests)
+    if skip_leaves_starting_on_public_holiday:
+        skipped = luxembourg_calendar.is_public_holiday(starts)
+    totals = {1: 0, 2: 0, 5: 0}
+    for holiday_request, count, skip in zip(holiday_requests, counts, skipped):
+        if holiday_request.reason == 1 and skip:
+            continue
+        totals[holiday_request.reason] += _days_value(
+            count, holiday_request.requested_period != HolidayRequestChoice.req_full_day)
+    return totals[1], totals[2], totals[5]
+
+
+class HolidayRequestAbsences:
+    """
+    Hours taken and available for a list of HolidayRequest (typically a page of the admin changelist).
+
+    Employees and contracts of all the requests are loaded in two queries and the days of all the requests are
+    counted in one pass over ``luxembourg_calendar``; the accepted leaves needed by ``total_days_in_current_year``
+    are loaded in one more query the first time it is called.
+    """
+
+    def __init__(self, holiday_requests):
+        self.holiday_requests = list(holiday_requests)
+        user_ids = {holiday_request.employee_id for holiday_request in self.holiday_requests}
+        self.employees = {employee.user_id: employee for employee in
+                          Employee.objects.filter(user_id__in=user_ids).prefetch_related('employeecontractdetail_set')}
+        self.timelines = {user_id: ContractTimeline(employee.employeecontractdetail_set.all())
+                          for user_id, employee in self.employees.items()}
+        self._computations = dict(zip((id(holiday_request) for holiday_request in self.holiday_requests),
+                                      self.compute(self.holiday_requests)))
+        self._days_in_year = None
+
+    @staticmethod
+    def prefetch(holiday_requests):
+        holiday_requests = list(holiday_requests)
+        absences = HolidayRequestAbsences(holiday_requests)
+        for holiday_request in holiday_requests:
+            holiday_request.prefetched_absences = absences
+        return absences
+
+    def _employee(self, user_id):
+        try:
+            return self.employees[user_id]
+        except KeyError:
+            raise Employee.DoesNotExist("Employee matching query does not exist.")
+
+    def compute(self, holiday_requests, same_year_only=False):
+        """
+        Returns the Computation (or "Non applicable") of each request, see ``HolidayRequest.hours_calculations``.
+        """
+        if not holiday_requests:
+            return []
+        ends = []
+        for holiday_request in holiday_requests:
+            end_date = holiday_request.end_date
+            if same_year_only and end_date.year != holiday_request.start_date.year:
+                end_date = end_date.replace(year=holiday_request.start_date.year, month=12, day=31)
+            ends.append(end_date)
+        starts = [holiday_request.start_date for holiday_request in holiday_requests]
+        weekdays = luxembourg_calendar.weekdays(starts, ends)
+        public_holidays = luxembourg_calendar.public_holidays_count(starts, ends)
+        computations = []
+        for holiday_request, weekdays_count, public_holidays_count in zip(holiday_requests, weekdays,
+                                                                          public_holidays):
+            employee = self._employee(holiday_request.employee_id)
+            if _as_date(holiday_request.end_date) < employee.start_contract:
+                computations.append(Computation(0, 0, 0, 0))
+                continue
+            if holiday_request.reason > 2:
+                computations.append("Non applicable")
+                continue
+            days = _days_value(weekdays_count, holiday_request.requested_period != HolidayRequestChoice.req_full_day)
+            hours_jour = self.timelines[holiday_request.employee_id].for_holiday_request(
+                holiday_request).number_of_hours / 5
+            computations.append(Computation(days if holiday_request.reason == 1 else 0,
+                                            days if holiday_request.reason == 2 else 0,
+                                            hours_jour, int(public_holidays_count)))
+        return computations
+
+    def computation(self, holiday_request, same_year_only=False):
+        if not same_year_only and id(holiday_request) in self._computations:
+            return self._computations[id(holiday_request)]
+        return self.compute([holiday_request], same_year_only=same_year_only)[0]
+
+    def hours_taken(self, holiday_request):
+        computation = self.computation(holiday_request)
+        if isinstance(computation, str):
+            return computation
+        return [(computation.num_days - computation.jours_feries) * computation.hours_jour,
+                "explication: ( (%.2f jours congés + %.2f jours maladie ) - %d jours fériés )  x %d nombre h. /j" % (
+                    computation.num_days,
+                    computation.num_days_sickness,
+                    computation.jours_feries,
+                    computation.hours_jour)]
+
+    def total_days_in_current_year(self, holiday_request):
+        if self._days_in_year is None:
+            from invoices.holidays import HolidayRequest
+            keys = {(request.employee_id, request.start_date.year) for request in self.holiday_requests}
+            leaves = [leave for leave in HolidayRequest.objects.filter(
+                employee_id__in={user_id for user_id, _ in keys},
+                start_date__year__in={year for _, year in keys},
+                request_status=HolidayRequestWorkflowStatus.ACCEPTED,
+                reason=HolidayRequest.REASONS[0][0]).order_by('id')
+                if (leave.employee_id, leave.start_date.year) in keys]
+            missing_user_ids = {leave.employee_id for leave in leaves} - set(self.employees)
+            if missing_user_ids:
+                for employee in Employee.objects.filter(user_id__in=missing_user_ids).prefetch_related(
+                        'employeecontractdetail_set'):
+                    self.employees[employee.user_id] = employee
+                    self.timelines[employee.user_id] = ContractTimeline(employee.employeecontractdetail_set.all())
+            days_in_year = defaultdict(int)
+            for leave, computation in zip(leaves, self.compute(leaves, same_year_only=True)):
+                days_in_year[(leave.employee_id, leave.start_date.year)] += computation.num_days
+            self._days_in_year = days_in_year
+        return self._days_in_year[(holiday_request.employee_id, holiday_request.start_date.year)]
+
+    def total_hours_off_available(self, holiday_request, year=None):
+        if year is None:
+            year = holiday_request.start_date.year
+        self._employee(holiday_request.employee_id)
+        timeline = self.timelines[holiday_request.employee_id]
+        if not timeline.is_active_in(year):
+            return None
+        last_month = holiday_request.end_date.month if holiday_request.start_date.year == year else 12
+        hours_off_available = 0
+        for month in range(1, last_month + 1):
+            contract = timeline.on_first_day_of_month(year, month)
+            if contract is not None:
+                # round to 2 decimals commercial
+                hours_off_available += round(contract.number_of_hours * HOURS_OFF_PER_MONTH_PER_WEEKLY_HOUR, 2)
+        return hours_off_available
@@ -1,16 +1,14 @@
-import base64
-import os
 from calendar import monthrange
 from datetime import timedelta, date
 
-import holidays
-import requests
 from django.db.models import Q
 
+from helpers.absences import ContractTimeline, absence_days_in_period, luxembourg_calendar
 from helpers.models import SicknessHolidayDaysCalculations
 from invoices.employee import Employee
 from invoices.enums.generic import HolidayRequestChoice
 from invoices.enums.holidays import HolidayRequestWorkflowStatus
+from invoices.helpers.roster import as_day, day_roster
 from invoices.holidays import HolidayRequest
 
 
@@ -93,7 +91,6 @@ def how_many_hours_taken_in_period_v2(data, public_holidays):
         Q(start_date__lte=data['end_date'], end_date__gte=data['end_date'])
     ).filter(employee_id=data['user_id']).filter(request_status=HolidayRequestWorkflowStatus.ACCEPTED).filter(
         reason__in=[1, 2, 5])
-    lu_holidays = holidays.Luxembourg()
     if len(holiday_requests) > 0:
         sh_object = SicknessHolidayDaysCalculations(holidays_count=0,
                                                     sickness_days_count=0,
@@ -101,67 +98,16 @@ def how_many_hours_taken_in_period_v2(data, public_holidays):
                                                     number_of_public_holidays=0,
                                                     daily_working_hours=0,
                                                     holiday_sickness_requests_dates=holiday_requests)
-        counter = 0
-        counter_sickness = 0
-        counter_exceptional_break = 0
-        for holiday_request in holiday_requests:
-            if holiday_request.start_date == holiday_request.end_date:
-                delta = 1
-                my_date = holiday_request.start_date
-            else:
-                if holiday_request.end_date > data['end_date'].date():
-                    period_end_date = data['end_date'].date()
-                else:
-                    period_end_date = holiday_request.end_date
-                if holiday_request.start_date < data['start_date'].date():
-                    period_start_date = data['start_date'].date()
-                else:
-                    period_start_date = holiday_request.start_date
-                delta = period_end_date - period_start_date
-                my_date = period_start_date
-            if holiday_request.reason == 1 and my_date not in lu_holidays:
-                for _ in (range(1) if delta == 1 else range(delta.days)):
-                    if my_date in lu_holidays:
-                        pass
-                    else:
-                        if my_date.weekday() < 5 and holiday_request.requested_period != HolidayRequestChoice.req_full_day:
-                            counter += 0.5
-                        elif my_date.weekday() < 5 and holiday_request.requested_period == HolidayRequestChoice.req_full_day:
-                            counter += 1
-                    my_date = my_date + timedelta(days=1)
-
-            elif holiday_request.reason == 2:
-                for _ in (range(1) if delta == 1 else range(delta.days)):
-                    if my_date in lu_holidays:
-                        pass
-                    else:
-                        if my_date.weekday() < 5 and holiday_request.requested_period != HolidayRequestChoice.req_full_day:
-                            counter_sickness += 0.5
-                        elif my_date.weekday() < 5 and holiday_request.requested_period == HolidayRequestChoice.req_full_day:
-                            counter_sickness += 1
-                    my_date = my_date + timedelta(days=1)
-            elif holiday_request.reason == 5:
-                for _ in (range(1) if delta == 1 else range(delta.days)):
-                    if my_date in lu_holidays:
-                        pass
-                    else:
-                        if my_date.weekday() < 5 and holiday_request.requested_period != HolidayRequestChoice.req_full_day:
-                            counter_exceptional_break += 0.5
-                        elif my_date.weekday() < 5 and holiday_request.requested_period == HolidayRequestChoice.req_full_day:
-                            counter_exceptional_break += 1
-                    my_date = my_date + timedelta(days=1)
+        counter, counter_sickness, counter_exceptional_break = absence_days_in_period(
+            holiday_requests, data['start_date'], data['end_date'], skip_leaves_starting_on_public_holiday=True)
 
+        heures_jour = ContractTimeline.for_user(data['user_id']).covering_period(
+            data['start_date'], data['end_date']).number_of_hours / 5
         number_of_public_holidays = 0
-
-        heures_jour = Employee.objects.get(user_id=data['user_id']).employeecontractdetail_set.filter(Q(
-            end_date__gte=data['end_date'], start_date__lte=data['start_date']) | Q(
-            end_date__isnull=True,
-            start_date__lte=data['start_date'])).first().number_of_hours / 5
         for public_holiday in public_holidays:
             if public_holiday.calendar_date.weekday() < 5:
                 number_of_public_holidays = number_of_public_holidays + 1
 
-        counter_sickness = counter_sickness
         sh_object.holidays_count = counter
         sh_object.sickness_days_count = counter_sickness
         sh_object.exceptional_break = counter_exceptional_break
@@ -172,62 +118,45 @@ def how_many_hours_taken_in_period_v2(data, public_holidays):
     return [0, ""]
 
 
-def whois_off(day_off):
-    reqs = HolidayRequest.objects.filter(request_status=HolidayRequestWorkflowStatus.ACCEPTED,
-                                         start_date__lte=day_off, end_date__gte=day_off)
-    employees_abbreviations = ""
-    for r in reqs:
-        employees_abbreviations += r.employee.employee.abbreviation + ","
-    return employees_abbreviations[:-1]
+def _per_day(working_day, until, values):
+    if until is not None:
+        return {day.isoformat(): value for day, value in values.items()}
+    return values[as_day(working_day)]
+
+
+def whois_off(day_off, until=None):
+    """Abbreviations of the employees on leave, comma separated, per day when ``until`` is given."""
+    on_leave = day_roster.on_leave(as_day(day_off), until and as_day(until))
+    return _per_day(day_off, until, {day: ",".join(x['abbreviation'] for x in employees)
+                                     for day, employees in on_leave.items()})
 
 
-def whois_available(working_day):
-    employees_on_leave = [x.employee.employee for x in
-                          HolidayRequest.objects.filter(request_status=HolidayRequestWorkflowStatus.ACCEPTED,
-                                                        start_date__lte=working_day, end_date__gte=working_day)]
+def whois_available(working_day, until=None):
     # FIXME not correct way to retrieve active user/employee
-    return [x.abbreviation for x in Employee.objects.filter(end_contract__isnull=True) if x not in employees_on_leave]
-
-
-def whois_available_with_avatars_and_ids(working_day):
-    employees_on_leave = [x.employee.employee for x in
-                          HolidayRequest.objects.filter(request_status=HolidayRequestWorkflowStatus.ACCEPTED,
-                                                        start_date__lte=working_day, end_date__gte=working_day)]
-    employees = []
-    for x in Employee.objects.filter(end_contract__isnull=True):
-        if x not in employees_on_leave:
-            avatar_base64 = None
-            if x.minified_avatar:
-                try:
-                    # If avatar is stored locally
-                    if os.environ.get('LOCAL_ENV', None):
-                        with x.minified_avatar.storage.open(x.minified_avatar.name, 'rb') as avatar_file:
-                            avatar_base64 = base64.b64encode(avatar_file.read()).decode('utf-8')
-                    else:
-                        # If avatar is stored in a remote server
-                        response = requests.get(x.minified_avatar.url)
-                        avatar_base64 = base64.b64encode(response.content).decode('utf-8')
-                except Exception as e:
-                    print(f"Error converting avatar to base64: {e}")
-            employees.append({'id': str(x.id), 'abbreviation': str(x.abbreviation),
-                              'name': str(x.user),
-                              'minified_avatar': avatar_base64,
-                              'color_text': str(x.color_text),
-                              'color_cell': str(x.color_cell)})
-    return employees
-
-
-def which_shift(working_day, abbreviation):
-    employees_on_leave = [x.employee.employee for x in
-                          HolidayRequest.objects.filter(request_status=HolidayRequestWorkflowStatus.ACCEPTED,
-                                                        start_date__lte=working_day, end_date__gte=working_day)]
-    return [x.abbreviation for x in Employee.objects.filter(end_contract__isnull=True) if x not in employees_on_leave]
+    available = day_roster.available(as_day(working_day), until and as_day(until))
+    return _per_day(working_day, until, {day: [x['abbreviation'] for x in employees]
+                                         for day, employees in available.items()})
+
+
+def whois_available_with_avatars_and_ids(working_day, until=None):
+    available = day_roster.available(as_day(working_day), until and as_day(until))
+    payloads = {}
+    for x in {x['id']: x for employees in available.values() for x in employees}.values():
+        payloads[x['id']] = {'id': str(x['id']), 'abbreviation': str(x['abbreviation']),
+                             'name': x['name'],
+                             'minified_avatar': day_roster.avatar_base64(x),
+                             'color_text': str(x['color_text']),
+                             'color_cell': str(x['color_cell'])}
+    return _per_day(working_day, until, {day: [payloads[x['id']] for x in employees]
+                                         for day, employees in available.items()})
+
+
+def which_shift(working_day, abbreviation=None, until=None):
+    return whois_available(working_day, until=until)
 
 
 def get_bank_holidays(y, m):
-    import holidays
-    lu_holidays = holidays.Luxembourg()
     year = int(y)
     month = int(m)
-    return [date(year, month, d) for d in range(1, monthrange(year, month)[1] + 1) if
-            date(year, month, d) in lu_holidays]
+    return luxembourg_calendar.public_holidays_between(date(year, month, 1),
+                                                       date(year, month, 1) + timedelta(days=monthrange(year, month)[1]))
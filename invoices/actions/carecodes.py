@@ -1,222 +1,162 @@
 import csv
+from dataclasses import dataclass, field
 from datetime import date, timedelta
+from decimal import Decimal, InvalidOperation
 
 from django.db import transaction
 
 from invoices.models import CareCode, ValidityDate
+from invoices.pricing import care_code_prices
+
+# ValidityDate.gross_amount has 6 decimal places
+GROSS_AMOUNT_PRECISION = Decimal('0.000001')
+
+
+@dataclass
+class CareCodePriceDiff:
+    """
+    What import_care_code_prices changes in the ValidityDates, the objects are not saved on a dry run.
+    """
+    created: list = field(default_factory=list)
+    closed: list = field(default_factory=list)
+    updated: list = field(default_factory=list)
+    # previous prices carried on after the end date of the imported ones
+    continued: list = field(default_factory=list)
+    unchanged: list = field(default_factory=list)
+    unknown_codes: list = field(default_factory=list)
+    invalid_rows: list = field(default_factory=list)
+
+    def __str__(self):
+        return "%s prix créés, %s prix clôturés, %s prix modifiés, %s prix prolongés, %s inchangés, " \
+               "codes inconnus : %s" % (len(self.created), len(self.closed), len(self.updated), len(self.continued),
+                                        len(self.unchanged), self.unknown_codes)
+
+
+def read_care_code_prices(csv_file, code_column=1, amount_column=3, delimiter=';'):
+    """
+    Gross amount of each care code of a CNS tariff file (a path or a text file object), rows that are not a price
+    (titles, headers) are returned apart.
+    """
+    if isinstance(csv_file, str):
+        with open(csv_file, newline='', encoding='utf-8') as opened_file:
+            return read_care_code_prices(opened_file, code_column, amount_column, delimiter)
+    prices, invalid_rows = {}, []
+    for row in csv.reader(csv_file, delimiter=delimiter, quotechar='"'):
+        if len(row) <= max(code_column, amount_column):
+            continue
+        code = row[code_column].strip()
+        try:
+            prices[code] = Decimal(row[amount_column].strip().replace(',', '.')).quantize(GROSS_AMOUNT_PRECISION)
+        except InvalidOperation:
+            invalid_rows.append(row)
+    return prices, invalid_rows
+
+
+def plan_care_code_prices(prices, start_date, end_date=None):
+    """
+    Changes to the ValidityDates so that each care code of ``prices`` has its price from ``start_date`` to
+    ``end_date`` (open when None), computed from one query on the care codes and one on their validity dates.
+
+    A price already starting on ``start_date`` is updated, otherwise the price covering ``start_date`` is closed the
+    day before and a new one is created. The new price never overlaps a price starting later: it ends the day before.
+    When the previous price went on after ``end_date``, it is continued from the day after so that the care code
+    keeps a price. Applying the same file twice changes nothing the second time.
+    """
+    diff = CareCodePriceDiff()
+    care_codes = dict(CareCode.objects.filter(code__in=prices).values_list('code', 'id'))
+    diff.unknown_codes = sorted(code for code in prices if code not in care_codes)
+    validity_dates = {}
+    for validity_date in ValidityDate.objects.filter(care_code_id__in=care_codes.values()).order_by('start_date'):
+        validity_dates.setdefault(validity_date.care_code_id, []).append(validity_date)
+    for code, care_code_id in sorted(care_codes.items()):
+        gross_amount = prices[code]
+        intervals = validity_dates.get(care_code_id, [])
+        later_starts = [interval.start_date for interval in intervals if interval.start_date > start_date]
+        # last day a continuation of the previous price can cover, None when open
+        last_free_day = later_starts[0] - timedelta(days=1) if later_starts else None
+        new_end_date = end_date
+        if last_free_day and (new_end_date is None or new_end_date > last_free_day):
+            new_end_date = last_free_day
+        same_start = [interval for interval in intervals if interval.start_date == start_date]
+        covering = [interval for interval in intervals if interval.start_date < start_date and (
+            interval.end_date is None or interval.end_date >= start_date)]
+        # price that applied up to now, the one starting the latest like CareCode.gross_amount_date_based
+        previous = same_start[0] if same_start else covering[-1] if covering else None
+        previous_end_date, previous_amount = (previous.end_date, previous.gross_amount) if previous else (None, None)
+        if same_start:
+            validity_date = same_start[0]
+            if validity_date.gross_amount == gross_amount and validity_date.end_date == new_end_date:
+                diff.unchanged.append(validity_date)
+                continue
+            validity_date.gross_amount, validity_date.end_date = gross_amount, new_end_date
+            diff.updated.append(validity_date)
+        else:
+            for interval in covering:
+                interval.end_date = start_date - timedelta(days=1)
+                diff.closed.append(interval)
+            diff.created.append(ValidityDate(care_code_id=care_code_id, start_date=start_date,
+                                             end_date=new_end_date, gross_amount=gross_amount))
+        if previous is None or new_end_date is None or (
+                previous_end_date is not None and previous_end_date <= new_end_date):
+            continue
+        continuation_end_date = previous_end_date
+        if last_free_day and (continuation_end_date is None or continuation_end_date > last_free_day):
+            continuation_end_date = last_free_day
+        if continuation_end_date is None or continuation_end_date > new_end_date:
+            diff.continued.append(ValidityDate(care_code_id=care_code_id,
+                                               start_date=new_end_date + timedelta(days=1),
+                                               end_date=continuation_end_date, gross_amount=previous_amount))
+    return diff
+
+
+def import_care_code_prices(csv_file, start_date, end_date=None, dry_run=False, **csv_options):
+    """
+    Applies a CNS tariff file to the ValidityDates in one transaction, see plan_care_code_prices.
+
+    :param csv_file: path or text file object of the tariff, ``csv_options`` are passed to read_care_code_prices
+    :param dry_run: nothing is written, the CareCodePriceDiff tells what would change
+    """
+    prices, invalid_rows = read_care_code_prices(csv_file, **csv_options)
+    with transaction.atomic():
+        diff = plan_care_code_prices(prices, start_date, end_date)
+        diff.invalid_rows = invalid_rows
+        if dry_run:
+            return diff
+        # bulk operations send no signal
+        ValidityDate.objects.bulk_update(diff.closed + diff.updated, ['end_date', 'gross_amount'])
+        ValidityDate.objects.bulk_create(diff.created + diff.continued)
+    care_code_prices.invalidate()
+    return diff
+
+
+def care_code_prices_import_action(csv_file_path, start_date, end_date=None):
+    """
+    Admin action applying the tariff file ``csv_file_path`` to all its care codes, whatever the selection.
+    """
+
+    def action(self, request, queryset):
+        diff = import_care_code_prices(csv_file_path, start_date, end_date)
+        print(diff)
+        self.message_user(request, "Tarifs CNS du %s appliqués : %s" % (start_date, diff))
+
+    action.__name__ = 'update_prices_for_%s' % start_date.strftime('%Y_%m_%d')
+    action.short_description = "Appliquer les tarifs CNS du %s (%s)" % (start_date.strftime('%d/%m/%Y'),
+                                                                        csv_file_path)
+    return action
+
+
+update_prices_for_jan_2023 = care_code_prices_import_action('initialdata/2023_JAN_cns_codes.csv',
+                                                            date(2023, 1, 1), date(2023, 1, 31))
+update_prices_for_feb_2023 = care_code_prices_import_action('initialdata/2023_FEB_cns_codes.csv',
+                                                            date(2023, 2, 1), date(2023, 3, 31))
+update_prices_for_april_2023 = care_code_prices_import_action('initialdata/2023_APRIL_cns_codes.csv',
+                                                              date(2023, 4, 1))
+update_prices_for_september_2023 = care_code_prices_import_action('initialdata/2023_SEPTEMBER_cns_codes.csv',
+                                                                  date(2023, 9, 1))
+update_prices_for_april_2022 = care_code_prices_import_action('initialdata/2022_april_cns_codes.csv',
+                                                              date(2022, 4, 1), date(2022, 12, 31))
 
 
-def update_prices_for_jan_2023(self, request, queryset):
-
-
-    # Replace 'your_csv_file.csv' with the actual path to your CSV file
-    csv_file_path = 'initialdata/2023_JAN_cns_codes.csv'
-
-    # Replace 'your_start_date' with the actual date you want to use
-    your_start_date = date(2023, 1, 1)
-    your_end_date = date(2023, 1, 31)
-
-    with open(csv_file_path, newline='', encoding='utf-8') as csvfile:
-        reader = csv.reader(csvfile, delimiter=';', quotechar='"')
-
-        with transaction.atomic():
-            for row in reader:
-                print(row)
-                if len(row) < 4:
-                    continue
-                care_code_str = row[1].strip()
-                new_gross_amount = float(row[3].strip())
-
-                care_code = CareCode.objects.filter(code=care_code_str).first()
-
-                if care_code:
-                    validity_date, created = ValidityDate.objects.update_or_create(
-                        care_code=care_code,
-                        end_date=None,
-                        defaults={
-                            'start_date': your_start_date,
-                            'end_date': your_end_date,
-                            'gross_amount': new_gross_amount,
-                        }
-                    )
-                    if not created:
-                        validity_date.start_date = your_start_date
-                        validity_date.end_date = your_end_date
-                        validity_date.gross_amount = new_gross_amount
-                        validity_date.save()
-
-                    print(f"Updated CareCode {care_code_str} with gross amount {new_gross_amount}")
-
-def update_prices_for_feb_2023(self, request, queryset):
-
-
-    # Replace 'your_csv_file.csv' with the actual path to your CSV file
-    csv_file_path = 'initialdata/2023_FEB_cns_codes.csv'
-
-    # Replace 'your_start_date' with the actual date you want to use
-    your_start_date = date(2023, 2, 1)
-    your_end_date = date(2023, 3, 31)
-
-
-    with open(csv_file_path, newline='', encoding='utf-8') as csvfile:
-        reader = csv.reader(csvfile, delimiter=';', quotechar='"')
-
-        with transaction.atomic():
-            for row in reader:
-                print(row)
-                if len(row) < 4:
-                    continue
-                care_code_str = row[1].strip()
-                new_gross_amount = float(row[3].strip())
-
-                care_code = CareCode.objects.filter(code=care_code_str).first()
-
-                if care_code:
-                    validity_date, created = ValidityDate.objects.update_or_create(
-                        care_code=care_code,
-                        end_date=None,
-                        defaults={
-                            'start_date': your_start_date,
-                            'end_date': your_end_date,
-                            'gross_amount': new_gross_amount,
-                        }
-                    )
-                    if not created:
-                        validity_date.start_date = your_start_date
-                        validity_date.gross_amount = new_gross_amount
-                        validity_date.end_date = your_end_date
-                        validity_date.save()
-
-                    print(f"Updated CareCode {care_code_str} with gross amount {new_gross_amount}")
-
-
-def update_prices_for_april_2023(self, request, queryset):
-
-
-    # Replace 'your_csv_file.csv' with the actual path to your CSV file
-    csv_file_path = 'initialdata/2023_APRIL_cns_codes.csv'
-    # Replace 'your_start_date' with the actual date you want to use
-    your_start_date = date(2023, 4, 1)
-
-
-    with open(csv_file_path, newline='', encoding='utf-8') as csvfile:
-        reader = csv.reader(csvfile, delimiter=';', quotechar='"')
-
-        with transaction.atomic():
-            for row in reader:
-                print(row)
-                if len(row) < 4:
-                    continue
-                care_code_str = row[1].strip()
-                new_gross_amount = float(row[3].strip())
-
-                care_code = CareCode.objects.filter(code=care_code_str).first()
-
-                if care_code:
-                    validity_date, created = ValidityDate.objects.update_or_create(
-                        care_code=care_code,
-                        end_date=None,
-                        defaults={
-                            'start_date': your_start_date,
-                            'gross_amount': new_gross_amount,
-                        }
-                    )
-                    if not created:
-                        validity_date.start_date = your_start_date
-                        validity_date.gross_amount = new_gross_amount
-                        validity_date.save()
-
-                    print(f"Updated CareCode {care_code_str} with gross amount {new_gross_amount}")
-
-def update_prices_for_september_2023(self, request, queryset):
-
-
-    # Replace 'your_csv_file.csv' with the actual path to your CSV file
-    csv_file_path = 'initialdata/2023_SEPTEMBER_cns_codes.csv'
-    # Replace 'your_start_date' with the actual date you want to use
-    your_start_date = date(2023, 9, 1)
-
-
-    with open(csv_file_path, newline='', encoding='utf-8') as csvfile:
-        reader = csv.reader(csvfile, delimiter=';', quotechar='"')
-        list_of_care_codes_updated = []
-
-        with transaction.atomic():
-            for row in reader:
-                print(row)
-                if len(row) < 4:
-                    continue
-                care_code_str = row[1].strip()
-                new_gross_amount = float(row[3].strip())
-
-                care_code = CareCode.objects.filter(code=care_code_str).first()
-
-                if care_code:
-                    validity_date, created = ValidityDate.objects.get_or_create(
-                        care_code=care_code,
-                        end_date=None,
-                        defaults={
-                            'start_date': your_start_date,
-                            'gross_amount': new_gross_amount,
-                        }
-                    )
-                    if not created:
-                        # set validity end_date to one day before the start date of the new validity date
-                        validity_date.end_date = your_start_date - timedelta(days=1)
-                        # and create a new validity date object with the new start date and end_date None (open)
-                        validity_date.save()
-                        ValidityDate.objects.create(
-                            care_code=care_code,
-                            start_date=your_start_date,
-                            gross_amount=new_gross_amount,
-                        )
-
-
-                    print(f"Updated CareCode {care_code_str} with gross amount {new_gross_amount}")
-                    list_of_care_codes_updated.append(care_code_str)
-        self.message_user(request, f"Updated {len(list_of_care_codes_updated)} CareCodes {list_of_care_codes_updated} ")
-
-
-def update_prices_for_april_2022(self, request, queryset):
-
-
-    # Replace 'your_csv_file.csv' with the actual path to your CSV file
-    csv_file_path = 'initialdata/2022_april_cns_codes.csv'
-    # Replace 'your_start_date' with the actual date you want to use
-    your_start_date = date(2022, 4, 1)
-    your_end_date = date(2022, 12, 31)
-
-    with open(csv_file_path, newline='', encoding='utf-8') as csvfile:
-        reader = csv.reader(csvfile, delimiter=';', quotechar='"')
-
-        with transaction.atomic():
-            for row in reader:
-                print(row)
-                if len(row) < 4:
-                    continue
-                care_code_str = row[1].strip()
-                new_gross_amount = float(row[3].strip())
-
-                care_code = CareCode.objects.filter(code=care_code_str).first()
-
-                if care_code:
-                    validity_date, created = ValidityDate.objects.get_or_create(
-                        care_code=care_code,
-                        start_date=your_start_date,
-                        end_date=your_end_date,
-                        defaults={
-                            'start_date': your_start_date,
-                            'end_date': your_end_date,
-                            'gross_amount': new_gross_amount,
-                        }
-                    )
-                    if not created:
-                        validity_date.start_date = your_start_date
-                        validity_date.end_date = your_end_date
-                        validity_date.gross_amount = new_gross_amount
-                        validity_date.save()
-
-                    print(f"Updated CareCode {care_code_str} with gross amount {new_gross_amount}")
 def cleanup_2023(self, request, queryset):
     # Replace 'your_csv_file.csv' with the actual path to your CSV file
     csv_file_path = 'initialdata/2023_FEB_cns_codes.csv'
@@ -241,5 +181,3 @@ def cleanup_2023(self, request, queryset):
                     # remove all validity dates of 2023
                     deleted = ValidityDate.objects.filter(care_code=care_code, start_date__year=2023).delete()
                     print(f"Deleted {deleted[0]} validity dates for {care_code_str}")
-
-
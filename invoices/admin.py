@@ -20,7 +20,6 @@ from django.contrib.admin import TabularInline
 from django.contrib.admin.views.main import ChangeList
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin, csrf_protect_m
 from django.contrib.auth.models import User
-from django.core.cache import cache
 from django.core.checks import messages
 from django.core.exceptions import ValidationError
 from django.db import transaction
@@ -39,6 +38,7 @@ from openpyxl.styles.alignment import Alignment
 from dependence.actions.invoice_helpers import generate_aev_invoice_for_pinto
 from dependence.invoicing import LongTermCareInvoiceFile, LongTermCareInvoiceItem
 from dependence.longtermcareitem import LongTermPackage
+from helpers.absences import HolidayRequestAbsences
 from helpers.timesheet import build_use_case_objects
 from invoices.action import export_to_pdf, set_invoice_as_sent, set_invoice_as_paid, set_invoice_as_not_paid, \
     set_invoice_as_not_sent, find_all_invoice_items_with_broken_file, \
@@ -58,7 +58,7 @@ from invoices.enums.event import EventTypeEnum
 from invoices.enums.holidays import HolidayRequestWorkflowStatus
 from invoices.events import EventType, Event, AssignedAdditionalEmployee, ReportPicture, \
     create_or_update_google_calendar, EventList, EventGenericLink, EventLinkToMedicalCareSummaryPerPatientDetail, \
-    EventLinkToCareCode, GenericTaskDescription
+    EventLinkToCareCode, GenericTaskDescription, duplicate_events
 from invoices.filters.HolidayRequestFilters import FilteringYears, FilteringMonths
 from invoices.filters.SmartEmployeeFilter import SmartEmployeeFilter, SmartUserFilterForVisits, SmartPatientFilter, \
     SmartMedicalPrescriptionFilter, DistanceMatrixSmartPatientFilter, IsInvolvedInHealthCareFilter, \
@@ -70,6 +70,7 @@ from invoices.forms import ValidityDateFormSet, HospitalizationFormSet, \
     InvoiceItemForm, MedicalPrescriptionForm, AlternateAddressFormSet, EventLinkToMedicalCareSummaryPerPatientDetailForm
 from invoices.gcalendar2 import PrestationGoogleCalendarSurLu
 from invoices.googlemessages import post_webhook
+from invoices.helpers.timesheetcache import timesheet_calculations
 from invoices.holidays import HolidayRequest, AbsenceRequestFile
 from invoices.models import CareCode, Prestation, Patient, InvoiceItem, Physician, ValidityDate, MedicalPrescription, \
     Hospitalization, InvoiceItemBatch, InvoiceItemEmailLog, PatientAdminFile, InvoiceItemPrescriptionsList, \
@@ -81,9 +82,11 @@ from invoices.prefac import generate_flat_file, generate_flat_file_for_control
 from invoices.resources import ExpenseCard, Car, MaintenanceFile, ConvadisOAuth2Token, CarBooking
 from invoices.salaries import EmployeesMonthlyPayslipFile, EmployeePaySlip
 from invoices.timesheet import Timesheet, TimesheetDetail, TimesheetTask, \
-    SimplifiedTimesheetDetail, SimplifiedTimesheet, PublicHolidayCalendarDetail, PublicHolidayCalendar
+    SimplifiedTimesheetDetail, SimplifiedTimesheet, PublicHolidayCalendarDetail, PublicHolidayCalendar, \
+    schedule_timesheet_summaries_refresh
 from invoices.utils import EventCalendar
-from invoices.visitmodels import EmployeeVisit
+from invoices.processors.visits import match_visits
+from invoices.visitmodels import EmployeeVisit, GeocodedAddress
 from invoices.xeromodels import XeroToken
 
 
@@ -1235,11 +1238,11 @@ class InvoiceItemInlineAdmin(admin.TabularInline):
 @admin.register(InvoiceItemBatch)
 class InvoiceItemBatchAdmin(ModelAdminObjectActionsMixin, admin.ModelAdmin):
     inlines = [InvoiceItemInlineAdmin]
-    readonly_fields = ('count_invoices', 'created_date', 'modified_date')
+    readonly_fields = ('count_invoices', 'created_date', 'modified_date', 'stage_timings')
     list_filter = ('start_date', 'end_date', 'batch_type', 'batch_description')
     list_display = ('start_date', 'end_date', 'send_date', 'count_invoices', 'batch_type', 'batch_description',
                     'display_object_actions_list')
-    actions = [generate_flat_file_for_control, 'merge_invoices']
+    actions = [generate_flat_file_for_control, 'merge_invoices', 'detect_dirty_events']
 
     object_actions = [
         {
@@ -1285,6 +1288,17 @@ class InvoiceItemBatchAdmin(ModelAdminObjectActionsMixin, admin.ModelAdmin):
         self.message_user(request, "Les lots de factures sélectionnés ont été fusionnés.",
                           level=messages.INFO)
 
+    def detect_dirty_events(self, request, queryset):
+        for batch in queryset:
+            dirty_events = batch.events_during_batch_periods()
+            if dirty_events:
+                self.message_user(request, "%s: %s événement(s) sans prestation" % (batch, len(dirty_events)),
+                                  level=messages.WARNING)
+            else:
+                self.message_user(request, "%s: aucun événement sans prestation" % batch, level=messages.INFO)
+
+    detect_dirty_events.short_description = "Détecter les événements sans prestation"
+
     def print_events_associated_with_invoices(self, request, object_id, form_url='', extra_context=None, action=None):
         from django.template.response import TemplateResponse
         obj = self.get_object(request, object_id)
@@ -1395,6 +1409,12 @@ class HolidayRequestAdmin(admin.ModelAdmin):
                     'holiday_request_status', 'request_creator', 'total_days_in_current_year',
                     'sanity_check', 'total_hours_off_available')
 
+    def get_changelist_instance(self, request):
+        changelist = super(HolidayRequestAdmin, self).get_changelist_instance(request)
+        # hours of all the requests of the page computed at once instead of once per column and row
+        HolidayRequestAbsences.prefetch(changelist.result_list)
+        return changelist
+
     def accept_request(self, request, queryset):
         if not request.user.is_superuser:
             self.message_user(request, "Vous n'avez pas le droit de valider des %s." % self.verbose_name_plural,
@@ -1557,7 +1577,7 @@ def calculate_balance_for_previous_months(month, year, user_id):
     previous_timsheets = SimplifiedTimesheet.objects.filter(time_sheet_month=lastMonth.month,
                                                             time_sheet_year=lastMonth.year,
                                                             employee__user_id=user_id,
-                                                            timesheet_validated=True)
+                                                            timesheet_validated=True).select_related('summary')
     for prev_months_tsheet in previous_timsheets:
         return Decimal(round(prev_months_tsheet.hours_should_work_gross_in_sec / 3600, 2)) \
             - prev_months_tsheet.extra_hours_paid_current_month \
@@ -1573,9 +1593,9 @@ class SimplifiedTimesheetAdmin(CSVExportAdmin):
                   'simplifiedtimesheetdetail__start_date',
                   'simplifiedtimesheetdetail__end_date']
     list_display = ('timesheet_owner', 'timesheet_validated', 'time_sheet_year', 'time_sheet_month',
-                    'extra_hours_balance')
+                    'total_hours', 'hours_should_work', 'extra_hours_balance')
     list_filter = ['employee', 'time_sheet_year', 'time_sheet_month']
-    list_select_related = True
+    list_select_related = ('employee__user', 'user', 'summary')
     readonly_fields = ('timesheet_validated', 'total_hours',
                        'total_hours_sundays', 'total_hours_public_holidays', 'total_working_days',
                        'total_legal_working_hours',
@@ -1599,7 +1619,7 @@ class SimplifiedTimesheetAdmin(CSVExportAdmin):
     def timesheet_situation(self, request, queryset):
         _counter = 1
         file_data = ""
-        for tsheet in queryset:
+        for tsheet in queryset.select_related('user', 'summary'):
             if not tsheet.timesheet_validated:
                 self.message_user(request,
                                   "Timesheet %s n'est pas validée, vous devez la valider avant de pouvoir exporter le "
@@ -1613,7 +1633,8 @@ class SimplifiedTimesheetAdmin(CSVExportAdmin):
                 previous_timsheets = SimplifiedTimesheet.objects.filter(time_sheet_month=lastMonth.month,
                                                                         time_sheet_year=lastMonth.year,
                                                                         employee__user_id=tsheet.user.id,
-                                                                        timesheet_validated=True)
+                                                                        timesheet_validated=True).select_related(
+                    'summary')
                 if len(previous_timsheets) == 0:
                     file_data += "\n {counter} - {last_name} {first_name}:\n".format(counter=_counter,
                                                                                      last_name=tsheet.user.last_name.upper(),
@@ -1716,8 +1737,12 @@ class SimplifiedTimesheetAdmin(CSVExportAdmin):
 
     def force_cache_clearing(self, request, queryset):
         if request.user.is_superuser:
-            cache.clear()
-            self.message_user(request, u"Cache refresh OK.", level=messages.INFO)
+            for employee_id, year, month in queryset.values_list('employee_id', 'time_sheet_year',
+                                                                 'time_sheet_month'):
+                timesheet_calculations.invalidate_month(employee_id, year, month)
+            schedule_timesheet_summaries_refresh(id__in=list(queryset.values_list('id', flat=True)))
+            self.message_user(request, u"Cache refresh OK (hits: %(hits)d, misses: %(misses)d)." %
+                              timesheet_calculations.stats(), level=messages.INFO)
         else:
             self.message_user(request, u"Not super user.", level=messages.WARNING)
 
@@ -2190,8 +2215,9 @@ class EventListAdmin(admin.ModelAdmin):
         events_duplicated = []
         if len(queryset) < 6:
             print("duplicating %s events [direct call]" % len(queryset))
-            for e in queryset:
-                events_duplicated.append(e.duplicate_event_for_next_day(7))
+            events_duplicated = duplicate_events(
+                [(e, e.day + datetime.timedelta(days=7)) for e in queryset], created_by='duplicate_event_for_next_day',
+                employee=Employee.objects.get(id=1))
             self.message_user(request, "Duplicated %s events" % len(events_duplicated))
             # redirect to list filtering on duplicated events
             return HttpResponseRedirect(
@@ -2248,16 +2274,15 @@ class EventListAdmin(admin.ModelAdmin):
             self.message_user(request, "Vous n'avez pas le droit de dupliquer des %s." % self.verbose_name_plural,
                               level=messages.WARNING)
             return
-        events_duplicated = []
-        if len(queryset) < 6:
-            print("duplicating %s events [direct call]" % len(queryset))
-            for e in queryset:
-                events_duplicated = e.repeat_event_for_all_days_of_week(e.day)
-            self.message_user(request, "Duplicated %s events" % len(events_duplicated))
-            # redirect to list filtering on duplicated events
-            return HttpResponseRedirect(
-                reverse('admin:invoices_eventlist_changelist') + '?id__in=' + ','.join(
-                    [str(e.id) for e in events_duplicated]))
+        print("duplicating %s events for the whole week" % len(queryset))
+        events_duplicated = duplicate_events(
+            [(e, next_day) for e in queryset for next_day in Event.other_days_of_week(e.day)],
+            created_by='rpt_event_fr_all_days_of_wk', employee=Employee.objects.get(id=1))
+        self.message_user(request, "Duplicated %s events" % len(events_duplicated))
+        # redirect to list filtering on duplicated events
+        return HttpResponseRedirect(
+            reverse('admin:invoices_eventlist_changelist') + '?id__in=' + ','.join(
+                [str(e.id) for e in events_duplicated]))
 
     def duplicate_event_for_next_day(self, request, queryset):
         if not request.user.is_superuser and not request.user.groups.filter(name="planning manager").exists():
@@ -2268,8 +2293,9 @@ class EventListAdmin(admin.ModelAdmin):
         events_duplicated = []
         if len(queryset) < 6:
             print("duplicating %s events [direct call]" % len(queryset))
-            for e in queryset:
-                events_duplicated.append(e.duplicate_event_for_next_day(1))
+            events_duplicated = duplicate_events(
+                [(e, e.day + datetime.timedelta(days=1)) for e in queryset], created_by='duplicate_event_for_next_day',
+                employee=Employee.objects.get(id=1))
             self.message_user(request, "Duplicated %s events" % len(events_duplicated))
             # redirect to list filtering on duplicated events
             return HttpResponseRedirect(
@@ -2288,9 +2314,11 @@ class EventListAdmin(admin.ModelAdmin):
         if not request.user.is_superuser:
             self.message_user(request, "Must be super user", level=messages.ERROR)
             return
-        for e in queryset:
-            result = e.cleanup_all_events_on_google(dry_run=False)
-            self.message_user(request, "Deleted %s messages from Google calendar " % len(result),
+        # the reconciliation covers every calendar whatever the selected events
+        event = queryset.first()
+        if event is not None:
+            report = event.cleanup_all_events_on_google(dry_run=False)
+            self.message_user(request, "Deleted %s messages from Google calendar " % report.deleted_orphans,
                               level=messages.WARNING)
 
     def force_gcalendar_sync(self, request, queryset):
@@ -2653,9 +2681,14 @@ class EmployeeVisitAdmin(admin.ModelAdmin):
         if not request.user.is_superuser:
             self.message_user(request, "Vous n'avez pas le droit de vérifier les adresses des patients.", level=messages.WARNING)
             return
-        visits_patients_found_dict = {}
-        for visitq in queryset:
-            visits_patients_found_dict[visitq] = visitq.check_if_address_is_known(visitq)
+        visits_patients_found_dict = match_visits(list(queryset))
         self.message_user(request, "Adresses des patients vérifiées : %s" % visits_patients_found_dict)
 
 
+@admin.register(GeocodedAddress)
+class GeocodedAddressAdmin(admin.ModelAdmin):
+    list_display = ('address', 'latitude', 'longitude', 'created_at')
+    search_fields = ('address', 'normalized_address')
+    readonly_fields = ('created_at',)
+
+
@@ -1,4 +1,12 @@
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+from django.core.cache import cache
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 
 from invoices.models import Patient
 
@@ -24,3 +32,115 @@ class DistanceMatrix(models.Model):
         verbose_name = "Distance Matrix"
         ordering = ['patient_origin', 'patient_destination']
         unique_together = ['patient_origin', 'patient_destination']
+
+
+RouteEvaluation = namedtuple('RouteEvaluation', 'distance_in_km duration_in_mn legs missing_legs')
+
+
+class TravelTimeGraph:
+    """
+    Process wide copy of ``DistanceMatrix`` as two square NumPy arrays (km and minutes) indexed by the position of
+    the patients, -1 standing for a pair that was never computed.
+
+    The arrays are loaded with one query the first time they are needed and loaded again once the version stored in
+    the shared cache changed, which every change of a ``DistanceMatrix`` row does, so that a route of any length is
+    scored without any query.
+    """
+    version_key = 'distance-matrix:version'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = None
+
+    def _version(self):
+        try:
+            version = cache.get(self.version_key)
+            if version is None:
+                cache.add(self.version_key, time.time_ns(), timeout=None)
+                version = cache.get(self.version_key)
+            return version
+        except Exception as e:
+            # without the cache the graph of this process is only refreshed by the changes made in this process
+            print("Distance matrix version unavailable: %s" % e)
+            return None
+
+    def _load(self, version):
+        rows = np.array(list(DistanceMatrix.objects.order_by().values_list(
+            'patient_origin_id', 'patient_destination_id', 'distance_in_km', 'duration_in_mn')),
+            dtype=np.int64).reshape(-1, 4)
+        patient_ids = np.unique(rows[:, :2])
+        distances = np.full((len(patient_ids), len(patient_ids)), -1, dtype=np.int32)
+        durations = np.full((len(patient_ids), len(patient_ids)), -1, dtype=np.int32)
+        origins, destinations = np.searchsorted(patient_ids, rows[:, 0]), np.searchsorted(patient_ids, rows[:, 1])
+        distances[origins, destinations] = rows[:, 2]
+        durations[origins, destinations] = rows[:, 3]
+        np.fill_diagonal(distances, 0)
+        np.fill_diagonal(durations, 0)
+        return version, {patient_id: index for index, patient_id in enumerate(patient_ids.tolist())}, distances, \
+            durations
+
+    def _get_state(self):
+        version = self._version()
+        state = self._state
+        if state is None or (version is not None and state[0] != version):
+            with self._lock:
+                state = self._state
+                if state is None or (version is not None and state[0] != version):
+                    state = self._state = self._load(version)
+        return state
+
+    def invalidate(self):
+        self._state = None
+        try:
+            cache.set(self.version_key, time.time_ns(), timeout=None)
+        except Exception as e:
+            print("Distance matrix version unavailable, other processes not refreshed: %s" % e)
+
+    def leg(self, origin, destination):
+        """(km, minutes) from one patient to another, None when the distance was never computed."""
+        return self.evaluate([origin, destination]).legs[0] if origin != destination else (0, 0)
+
+    def submatrix(self, patient_ids):
+        """(km, minutes) arrays between the given patients in that order, -1 for the unknown pairs."""
+        _, index, distances, durations = self._get_state()
+        positions = np.array([index.get(patient_id, -1) for patient_id in patient_ids], dtype=np.int64)
+        known = (positions[:, None] >= 0) & (positions[None, :] >= 0)
+        rows, columns = np.maximum(positions, 0)[:, None], np.maximum(positions, 0)[None, :]
+        same = np.array(patient_ids)[:, None] == np.array(patient_ids)[None, :]
+        sub_distances = np.where(same, 0, np.where(known, distances[rows, columns] if len(index) else -1, -1))
+        sub_durations = np.where(same, 0, np.where(known, durations[rows, columns] if len(index) else -1, -1))
+        return sub_distances, sub_durations
+
+    def evaluate(self, patient_ids):
+        """
+        Totals of visiting the patients in the given order. ``legs`` holds (km, minutes) of every move, None for the
+        ones that are unknown, which are listed in ``missing_legs`` and left out of the totals.
+        """
+        _, index, distances, durations = self._get_state()
+        patient_ids = list(patient_ids)
+        if len(patient_ids) < 2:
+            return RouteEvaluation(0, 0, [], [])
+        positions = np.array([index.get(patient_id, -1) for patient_id in patient_ids])
+        origins, destinations = positions[:-1], positions[1:]
+        known = (origins >= 0) & (destinations >= 0)
+        leg_distances = np.full(len(origins), -1, dtype=np.int32)
+        leg_durations = np.full(len(origins), -1, dtype=np.int32)
+        leg_distances[known] = distances[origins[known], destinations[known]]
+        leg_durations[known] = durations[origins[known], destinations[known]]
+        # the same patient twice in a row is no move at all
+        same = np.array([origin == destination for origin, destination in zip(patient_ids[:-1], patient_ids[1:])])
+        leg_distances[same], leg_durations[same] = 0, 0
+        known = leg_distances >= 0
+        legs = [(int(distance), int(duration)) if is_known else None
+                for distance, duration, is_known in zip(leg_distances, leg_durations, known)]
+        missing_legs = [(patient_ids[position], patient_ids[position + 1]) for position in np.flatnonzero(~known)]
+        return RouteEvaluation(int(leg_distances[known].sum()), int(leg_durations[known].sum()), legs, missing_legs)
+
+
+travel_time_graph = TravelTimeGraph()
+
+
+@receiver(post_save, sender=DistanceMatrix, dispatch_uid="refresh_travel_time_graph_on_save")
+@receiver(post_delete, sender=DistanceMatrix, dispatch_uid="refresh_travel_time_graph_on_delete")
+def refresh_travel_time_graph(sender, instance, **kwargs):
+    travel_time_graph.invalidate()
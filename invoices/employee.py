@@ -23,6 +23,8 @@ from invoices.actions.gcontacts import GoogleContacts
 from invoices.enums.event import EventTypeEnum
 from invoices.enums.generic import GenderType
 from invoices.enums.holidays import ContractType
+from invoices.helpers.eventfeed import event_feed_version
+from invoices.helpers.roster import day_roster
 
 
 def get_employee_by_abbreviation(abbreviation):
@@ -630,3 +632,26 @@ def create_or_update_google_contact(sender, instance=None, created=False, **kwar
             print("Skipping google syncs")
             return
         sync_google_contacts_task.delay(employees)
+
+
+@receiver(post_save, sender=Employee, dispatch_uid='invalidate_roster_employees_on_save')
+@receiver(post_save, sender=EmployeeProxy, dispatch_uid='invalidate_roster_employees_on_proxy_save')
+@receiver(post_delete, sender=Employee, dispatch_uid='invalidate_roster_employees_on_delete')
+@receiver(post_save, sender=User, dispatch_uid='invalidate_roster_employees_on_user_save')
+def invalidate_roster_employees(sender, instance=None, **kwargs):
+    day_roster.invalidate_employees()
+
+
+@receiver(post_save, sender=Employee, dispatch_uid='bump_event_feed_version_on_employee_save')
+@receiver(post_save, sender=EmployeeProxy, dispatch_uid='bump_event_feed_version_on_employee_proxy_save')
+@receiver(post_delete, sender=Employee, dispatch_uid='bump_event_feed_version_on_employee_delete')
+def bump_event_feed_version_on_employee_change(sender, instance=None, **kwargs):
+    event_feed_version.bump()
+
+
+@receiver(post_save, sender=User, dispatch_uid='bump_event_feed_version_on_user_save')
+def bump_event_feed_version_on_user_change(sender, instance=None, update_fields=None, **kwargs):
+    # the feed shows employees by their username, a login only saves last_login
+    if update_fields is not None and set(update_fields) == {'last_login'}:
+        return
+    event_feed_version.bump()
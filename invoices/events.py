@@ -6,15 +6,14 @@ import os
 from datetime import datetime as dt
 from zoneinfo import ZoneInfo
 
-import pytz
 from constance import config
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.core.cache import cache
-from django.core.exceptions import ValidationError, ObjectDoesNotExist
+from django.core.exceptions import ValidationError
 from django.core.files.storage import default_storage
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Q, QuerySet
 from django.db.models.signals import post_save, pre_save, pre_delete, post_delete
 from django.dispatch import receiver
@@ -29,6 +28,8 @@ from invoices.employee import Employee
 from invoices.enums.event import EventTypeEnum
 from invoices.gcalendar2 import PrestationGoogleCalendarSurLu
 from invoices.googlemessages import post_webhook, post_webhook_pic_as_image
+from invoices.helpers.eventfeed import event_feed_version
+from invoices.helpers.roster import day_roster
 from invoices.models import Patient, SubContractor, PatientSubContractorRelationship
 from invoices.notifications import send_email_notification
 
@@ -122,97 +123,27 @@ class Event(models.Model):
     def is_in_validated_state(self):
         return self.state in [Event.STATES[2][0], Event.STATES[3][0], Event.STATES[4][0]]
 
+    @staticmethod
+    def other_days_of_week(date):
+        """
+        Returns the days of the week of 'date' (monday to sunday) except 'date' itself
+        """
+        first_day_of_week = date - datetime.timedelta(days=date.weekday())
+        return [first_day_of_week + datetime.timedelta(days=i) for i in range(7) if i != date.weekday()]
+
     def repeat_event_for_all_days_of_week(self, date):
         """
         Duplicate event, can be in the past as well, for example if day of week is Sunday, must duplicated for all days of the present week except for Sunday
         """
-
-        # Repeat event for all days of the week except 'date'
-        # Everytime, before duplication check if event already exists for that day
-        # if not, duplicate event for that day
-        # if yes, do nothing
-        # get the first day of the week for 'date'
-        first_day_of_week = date - datetime.timedelta(days=date.weekday())
-        events_created = []
-        for i in range(7):  # Loop through all days of the week
-            next_day = first_day_of_week + datetime.timedelta(days=i)
-            if next_day.weekday() == date.weekday():  # If the day is the same as 'date', skip
-                continue
-            if not Event.objects.filter(day=next_day, time_start_event=self.time_start_event,
-                                        time_end_event=self.time_end_event, event_type=self.event_type,
-                                        employees=self.employees, patient=self.patient).exists():
-                employee_num_1 = Employee.objects.get(id=1)
-                new_event = Event.objects.create(day=next_day, time_start_event=self.time_start_event,
-                                                 time_end_event=self.time_end_event,
-                                                 event_type_enum=self.event_type_enum,
-                                                 state=2, notes=self.notes,
-                                                 employees=employee_num_1,
-                                                 patient=self.patient,
-                                                 event_address=self.event_address,
-                                                 created_by='rpt_event_fr_all_days_of_wk')
-                # duplicate GenericTaskDescription
-                for generic_task in self.generictaskdescription_set.all():
-                    new_generic_task = GenericTaskDescription.objects.create(event=new_event, name=generic_task.name)
-                    new_generic_task.save()
-                # duplicate EventLinkToCareCode
-                for care_code in self.eventlinktocarecode_set.all():
-                    new_event_link_to_care_code = EventLinkToCareCode.objects.create(event=new_event,
-                                                                                     care_code=care_code.care_code)
-                    new_event_link_to_care_code.save()
-                # duplicate EventLinkToMedicalCareSummaryPerPatientDetail
-                for medical_care_summary in self.eventlinktomedicalcaresummaryperpatientdetail_set.all():
-                    new_event_link_to_medical_care_summary = EventLinkToMedicalCareSummaryPerPatientDetail.objects.create(
-                        event=new_event,
-                        medical_care_summary_per_patient_detail=medical_care_summary.medical_care_summary_per_patient_detail)
-                    new_event_link_to_medical_care_summary.save()
-                new_event.save()
-                # duplicate EventGenericLink objects
-                for event_generic_link in self.eventgenericlink_set.all():
-                    new_event_generic_link = EventGenericLink.objects.create(event=new_event,
-                                                                             content_type=event_generic_link.content_type,
-                                                                             object_id=event_generic_link.object_id)
-                    new_event_generic_link.save()
-                events_created.append(new_event)
-        return events_created
+        return duplicate_events([(self, next_day) for next_day in Event.other_days_of_week(date)],
+                                created_by='rpt_event_fr_all_days_of_wk', employee=Employee.objects.get(id=1))
 
     def duplicate_event_for_next_day(self, number_of_days=1):
-        # duplicate event for next day
-        # check if event already exists for next day
-        # if not, duplicate event for next day
-        # if yes, do nothing
+        # duplicate event for next day, do nothing if it already exists
         next_day = self.day + datetime.timedelta(days=number_of_days)
-        if not Event.objects.filter(day=next_day, time_start_event=self.time_start_event,
-                                    time_end_event=self.time_end_event, event_type=self.event_type,
-                                    employees=self.employees, patient=self.patient).exists():
-            employee_num_1 = Employee.objects.get(id=1)
-            new_event = Event.objects.create(day=next_day, time_start_event=self.time_start_event,
-                                             time_end_event=self.time_end_event,
-                                             event_type_enum=self.event_type_enum,
-                                             state=2, notes=self.notes,
-                                             employees=employee_num_1,
-                                             patient=self.patient,
-                                             event_address=self.event_address,
-                                             sub_contractor=self.sub_contractor,
-                                             created_by='duplicate_event_for_next_day')
-            # duplicate GenericTaskDescription
-            for generic_task in self.generictaskdescription_set.all():
-                new_generic_task = GenericTaskDescription.objects.create(event=new_event, name=generic_task.name)
-                new_generic_task.save()
-            # duplicate EventLinkToCareCode
-            for care_code in self.eventlinktocarecode_set.all():
-                new_event_link_to_care_code = EventLinkToCareCode.objects.create(event=new_event,
-                                                                                 care_code=care_code.care_code)
-                new_event_link_to_care_code.save()
-            # duplicate EventLinkToMedicalCareSummaryPerPatientDetail
-            for medical_care_summary in self.eventlinktomedicalcaresummaryperpatientdetail_set.all():
-                new_event_link_to_medical_care_summary = EventLinkToMedicalCareSummaryPerPatientDetail.objects.create(
-                    event=new_event,
-                    medical_care_summary_per_patient_detail=medical_care_summary.medical_care_summary_per_patient_detail)
-                new_event_link_to_medical_care_summary.save()
-            new_event.save()
-            return new_event
-        else:
-            return None
+        events_created = duplicate_events([(self, next_day)], created_by='duplicate_event_for_next_day',
+                                          employee=Employee.objects.get(id=1))
+        return events_created[0] if events_created else None
 
     def get_absolute_url(self):
         url = reverse('admin:%s_%s_change' % (self._meta.app_label, self._meta.model_name), args=[self.id])
@@ -261,90 +192,27 @@ class Event(models.Model):
             raise ValidationError(messages)
         if self.at_office:
             self.event_address = "%s %s" % (config.NURSE_ADDRESS, config.NURSE_ZIP_CODE_CITY)
-        else:
-            cal = create_or_update_google_calendar(self)
-            if cal:
-                self.calendar_id = cal.get('id')
-                self.calendar_url = cal.get('htmlLink')
-            else:
-                self.calendar_id = None
-                self.calendar_url = None
-
-    # FIXME pass date as parameter
-    def cleanup_all_events_on_google(self, dry_run):
-        calendar_gcalendar = PrestationGoogleCalendarSurLu()
-        # calendar_gcalendar.q_delete_event(self)
-        inur_ids = calendar_gcalendar.list_event_with_sur_id()
-        deleted_evts = []
-        for found_event in inur_ids:
-            deleted_evts.append(calendar_gcalendar.delete_event_by_google_id(calendar_id=found_event['email'],
-                                                                             event_id=found_event['gId'],
-                                                                             dry_run=dry_run))
-        return deleted_evts
+        # calendar_id and calendar_url are filled by the google calendar outbox drain once the event is saved
+
+    def cleanup_all_events_on_google(self, dry_run, service=None):
+        """
+        Deletes from google the google events of events deleted from the application, only reports them when
+        ``dry_run``. The calendars are reconciled from their changes since the previous run, not listed in full.
+        """
+        from invoices.processors.gcalendar import reconcile_google_calendars
+        return reconcile_google_calendars(service=service, delete_orphans=not dry_run)
 
     @job("default", timeout=6000)
     def display_unconnected_events(self, time_min=None):
-        # FIXME not complete one
-        calendar_gcalendar = PrestationGoogleCalendarSurLu()
-        # calendar_gcalendar.q_delete_event(self)
-        inur_ids = calendar_gcalendar.list_event_with_sur_id(time_min=time_min)
-        orphan_ids = []
-        events_different_times = []
-        events_deleted_from_nuno_but_still_in_google = []
-        localized_start = None
-        localized_end = None
-        for found_event in inur_ids:
-            # '2022-07-22T11:00:00Z'
-            lu_tz = pytz.timezone(found_event['start']['timeZone'])
-            try:
-                inur_event = Event.objects.get(pk=found_event['inurId'])
-            except ObjectDoesNotExist:
-                print(f"!! No Event found with id {found_event['inurId']} and google id {found_event['gId']}")
-                events_deleted_from_nuno_but_still_in_google.append(found_event)
-                calendar_gcalendar.delete_event_by_google_id(calendar_id=found_event['email'],
-                                                             event_id=found_event['gId'],
-                                                             dry_run=False)
-            try:
-                localized_start = lu_tz.localize(
-                    datetime.datetime.strptime(found_event['start']['dateTime'], '%Y-%m-%dT%H:%M:%SZ'))
-                localized_end = lu_tz.localize(
-                    datetime.datetime.strptime(found_event['end']['dateTime'], '%Y-%m-%dT%H:%M:%SZ'))
-            except ValueError as v:
-                print("%s %s" % (found_event['htmlLink'], found_event['start']['dateTime']))
-                pass
-                # localized_start = lu_tz.localize(
-                #     datetime.datetime.strptime(found_event['start']['dateTime'], '%Y-%m-%dT%H:%M:%S-04:00'))
-                # localized_end = lu_tz.localize(
-                #     datetime.datetime.strptime(found_event['end']['dateTime'], '%Y-%m-%dT%H:%M:%S-04:00'))
-
-            day_time_start_event = timezone.now().replace(year=inur_event.day.year, day=inur_event.day.day,
-                                                          month=inur_event.day.month,
-                                                          hour=inur_event.time_start_event.hour,
-                                                          minute=inur_event.time_start_event.minute,
-                                                          second=inur_event.time_start_event.second, microsecond=0)
-            day_time_end_event = timezone.now().replace(year=inur_event.day.year, day=inur_event.day.day,
-                                                        month=inur_event.day.month,
-                                                        hour=inur_event.time_end_event.hour,
-                                                        minute=inur_event.time_end_event.minute,
-                                                        second=inur_event.time_end_event.second, microsecond=0)
-            if not inur_event:
-                orphan_ids.append(found_event)
-
-            elif (localized_start and day_time_start_event != localized_start) or (
-                    localized_end and day_time_end_event != localized_end):
-                from dateutil.relativedelta import relativedelta
-                offset1 = relativedelta(day_time_start_event, localized_start)
-                offset2 = relativedelta(day_time_end_event, localized_end)
-                if (day_time_start_event - localized_start).seconds > 14400 \
-                        or (day_time_end_event - localized_end).seconds > 14400:
-                    events_different_times.append(inur_event)
-        print(orphan_ids)
-        print(events_different_times)
+        """
+        Reconciles the google calendars of the employees with the events, google events pointing to deleted events
+        are removed. ``time_min`` bounds the listing of calendars that were never synchronized.
+        """
+        from invoices.processors.gcalendar import reconcile_google_calendars
+        report = reconcile_google_calendars(time_min=time_min, delete_orphans=True)
+        print(report.as_text())
         send_email_notification("! Google calendar problems starting from %s time_min !" % time_min,
-                                "Orphans: \n%s \nEvents_different_times \n%s \n(%d) Events deleted from NUNO app but are still in google \n%s"
-                                % (
-                                orphan_ids, events_different_times, len(events_deleted_from_nuno_but_still_in_google),
-                                events_deleted_from_nuno_but_still_in_google),
+                                report.as_text(),
                                 to_emails=[User.objects.get(id=1).email])
 
     @property
@@ -431,6 +299,22 @@ class Event(models.Model):
                                        carecode=CareCode.objects.get(code='N307'))
         return p1, p2
 
+    @staticmethod
+    def describe(event_type_enum, day, patient=None, sub_contractor=None, employee_abbreviation=None,
+                 assigned_abbreviations=()):
+        """Title of an event out of its related values, so that it can be built without the instances."""
+        if event_type_enum == EventTypeEnum.BIRTHDAY:
+            return '%s for %s on %s' % (event_type_enum, patient, day)
+        if event_type_enum == EventTypeEnum.GENERIC:
+            return '%s for %s on %s' % (event_type_enum, patient, day)
+        if event_type_enum == EventTypeEnum.SUB_CARE:
+            return '%s : %s for %s on %s' % (sub_contractor, event_type_enum, patient, day)
+        if len(assigned_abbreviations) > 1:
+            return '%s ++ %s' % (",".join(assigned_abbreviations), patient.name if patient else None)
+        if patient:
+            return '%s - %s (%s)' % (employee_abbreviation, str(patient), event_type_enum)
+        return '%s (%s)' % (employee_abbreviation, event_type_enum)
+
     def __str__(self):  # Python 3: def __str__(self):,
         cached_patient = None
         if self.patient:
@@ -438,24 +322,23 @@ class Event(models.Model):
             if not cached_patient:
                 cache.set('cached_patient_%s' % self.patient.id, self.patient)
                 cached_patient = cache.get('cached_patient_%s' % self.patient.id)
-        if self.event_type_enum == EventTypeEnum.BIRTHDAY:
-            return '%s for %s on %s' % (self.event_type_enum, cached_patient, self.day)
-        if self.event_type_enum == EventTypeEnum.GENERIC:
-            return '%s for %s on %s' % (self.event_type_enum, cached_patient, self.day)
+        if self.event_type_enum in [EventTypeEnum.BIRTHDAY, EventTypeEnum.GENERIC]:
+            return Event.describe(self.event_type_enum, self.day, cached_patient)
         if self.event_type_enum == EventTypeEnum.SUB_CARE:
-            return '%s : %s for %s on %s' % (self.sub_contractor, self.event_type_enum, cached_patient, self.day)
+            return Event.describe(self.event_type_enum, self.day, cached_patient, sub_contractor=self.sub_contractor)
+        employee_abbreviation = None
         if self.employees:
             cached_employees = cache.get('event_employees_cache_%s' % self.employees.id)
             if not cached_employees:
                 cache.set('event_employees_cache_%s' % self.employees.id, self.employees)
                 cached_employees = cache.get('event_employees_cache_%s' % self.employees.id)
+            employee_abbreviation = cached_employees.abbreviation
+        assigned_abbreviations = ()
         if self.event_assigned.count() > 1:
-            return '%s ++ %s' % (
-                ",".join(a.assigned_additional_employee.abbreviation for a in self.event_assigned.all()),
-                cached_patient.name)
-        if cached_patient:
-            return '%s - %s (%s)' % (cached_employees.abbreviation, str(cached_patient), self.event_type_enum)
-        return '%s (%s)' % (cached_employees.abbreviation, self.event_type_enum)
+            assigned_abbreviations = [a.assigned_additional_employee.abbreviation for a in self.event_assigned.all()]
+        return Event.describe(self.event_type_enum, self.day, cached_patient,
+                              employee_abbreviation=employee_abbreviation,
+                              assigned_abbreviations=assigned_abbreviations)
 
 
 class GenericTaskDescription(models.Model):
@@ -522,6 +405,143 @@ class EventGenericLink(models.Model):
         unique_together = ('event', 'content_type', 'object_id')
 
 
+class GoogleCalendarOutbox(models.Model):
+    """
+    Changes of events waiting to be pushed to google calendar.
+
+    Rows are written in the transaction of the event change and drained by
+    ``invoices.processors.gcalendar.drain_google_calendar_outbox``, which coalesces the changes of a same event.
+    The event is referenced by id only so that the deletion of an event keeps its row. A drain claims its rows before
+    calling google and processed rows are deleted after ``GOOGLE_CALENDAR_OUTBOX_RETENTION``.
+    """
+    UPSERT = 'upsert'
+    DELETE = 'delete'
+    ACTIONS = [
+        (UPSERT, _('Create or update')),
+        (DELETE, _('Delete')),
+    ]
+
+    class Meta:
+        verbose_name = _('Google calendar outbox')
+        verbose_name_plural = _('Google calendar outbox')
+        ordering = ['id']
+        indexes = [models.Index(fields=['processed_on', 'id'])]
+
+    event_id = models.PositiveIntegerField(_('Event'), db_index=True)
+    action = models.CharField(_('Action'), max_length=6, choices=ACTIONS, default=UPSERT)
+    # calendar and google id of the google event to delete, an empty calendar is the general calendar
+    calendar = models.CharField(_('Calendar'), max_length=255, blank=True, null=True)
+    google_event_id = models.CharField(_('Google event id'), max_length=100, blank=True, null=True)
+    created_on = models.DateTimeField(default=timezone.now)
+    # set while a drain pushes the row to google
+    claimed_on = models.DateTimeField(blank=True, null=True)
+    processed_on = models.DateTimeField(blank=True, null=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True, null=True)
+
+    def __str__(self):
+        return '%s event %s' % (self.action, self.event_id)
+
+
+class GoogleCalendarSyncState(models.Model):
+    """
+    Sync token of a google calendar, from which ``invoices.processors.gcalendar.reconcile_google_calendars`` only
+    fetches the google events changed since its previous run.
+    """
+
+    class Meta:
+        verbose_name = _('Google calendar sync state')
+        verbose_name_plural = _('Google calendar sync states')
+
+    calendar = models.CharField(_('Calendar'), max_length=255, unique=True)
+    sync_token = models.CharField(_('Sync token'), max_length=255, blank=True, null=True)
+    synced_on = models.DateTimeField(_('Synced on'), blank=True, null=True)
+
+    def __str__(self):
+        return '%s synced on %s' % (self.calendar, self.synced_on)
+
+
+def has_google_calendar_event(google_event_id):
+    return google_event_id not in (None, '', '0')
+
+
+def schedule_google_calendar_outbox_drain():
+    if settings.TESTING:
+        return
+    from invoices.processors.gcalendar import drain_google_calendar_outbox
+    if os.environ.get('LOCAL_ENV', None) or config.SKIP_DJANGORQ:
+        transaction.on_commit(lambda: drain_google_calendar_outbox())
+    else:
+        transaction.on_commit(lambda: drain_google_calendar_outbox.delay())
+
+
+def _duplication_key(event, day, employees_id):
+    return day, event.time_start_event, event.time_end_event, event.event_type_id, employees_id, event.patient_id
+
+
+def duplicate_events(copies, created_by, employee=None):
+    """
+    Duplicates events in bulk, ``copies`` being (event, day) pairs.
+
+    A copy is skipped when an event already exists on its day with the same times, type, employee and patient as the
+    original, all the target days being checked in one query. The new events are assigned to ``employee`` (or keep
+    the employee of the original) and get the generic tasks, care codes, AEVs and generic links of their original,
+    everything being written with bulk inserts in a single transaction. The events are pushed to google calendar
+    once the transaction is committed and the cached rosters of the target days are refreshed.
+    """
+    copies = list(copies)
+    if not copies:
+        return []
+    originals = Event.objects.filter(id__in={event.id for event, _ in copies}).prefetch_related(
+        'generictaskdescription_set', 'eventlinktocarecode_set', 'eventlinktomedicalcaresummaryperpatientdetail_set',
+        'eventgenericlink_set').in_bulk()
+    with transaction.atomic():
+        existing_keys = set(Event.objects.filter(day__in={day for _, day in copies}).values_list(
+            'day', 'time_start_event', 'time_end_event', 'event_type_id', 'employees_id', 'patient_id'))
+        duplicates = []
+        for event, day in copies:
+            original = originals.get(event.id)
+            if original is None or _duplication_key(original, day, original.employees_id) in existing_keys:
+                continue
+            new_event = Event(day=day, time_start_event=original.time_start_event,
+                              time_end_event=original.time_end_event,
+                              event_type_enum=original.event_type_enum,
+                              state=2, notes=original.notes,
+                              employees_id=employee.id if employee else original.employees_id,
+                              patient_id=original.patient_id,
+                              event_address=original.event_address,
+                              sub_contractor_id=original.sub_contractor_id,
+                              created_by=created_by)
+            existing_keys.add(_duplication_key(new_event, day, new_event.employees_id))
+            duplicates.append((original, new_event))
+        events_created = Event.objects.bulk_create([new_event for _, new_event in duplicates])
+        GenericTaskDescription.objects.bulk_create(
+            [GenericTaskDescription(event=new_event, name=generic_task.name) for original, new_event in duplicates
+             for generic_task in original.generictaskdescription_set.all()])
+        EventLinkToCareCode.objects.bulk_create(
+            [EventLinkToCareCode(event=new_event, care_code_id=care_code.care_code_id)
+             for original, new_event in duplicates for care_code in original.eventlinktocarecode_set.all()])
+        EventLinkToMedicalCareSummaryPerPatientDetail.objects.bulk_create(
+            [EventLinkToMedicalCareSummaryPerPatientDetail(
+                event=new_event,
+                medical_care_summary_per_patient_detail_id=medical_care_summary.medical_care_summary_per_patient_detail_id)
+                for original, new_event in duplicates
+                for medical_care_summary in original.eventlinktomedicalcaresummaryperpatientdetail_set.all()])
+        EventGenericLink.objects.bulk_create(
+            [EventGenericLink(event=new_event, content_type_id=event_generic_link.content_type_id,
+                              object_id=event_generic_link.object_id)
+             for original, new_event in duplicates for event_generic_link in original.eventgenericlink_set.all()])
+        if events_created:
+            # bulk inserts do not send the signals that fill the google calendar outbox
+            GoogleCalendarOutbox.objects.bulk_create([GoogleCalendarOutbox(event_id=new_event.id)
+                                                      for new_event in events_created])
+            schedule_google_calendar_outbox_drain()
+            # nor the ones that refresh the cached roster of their days
+            for day in {new_event.day for new_event in events_created}:
+                day_roster.invalidate_days(day)
+    return events_created
+
+
 class AssignedAdditionalEmployee(models.Model):
     class Meta:
         verbose_name = u'Invité Traitant'
@@ -638,37 +658,29 @@ def create_or_update_google_calendar(instance):
 
 @receiver(pre_save, sender=Event, dispatch_uid="event_pre_save_gcalendar")
 def create_or_update_google_calendar_via_signal(sender, instance: Event, **kwargs):
-    if settings.TESTING:
-        print("** TEST mode")
+    if instance._update_without_signals or not instance.pk:
         return
-    calendar_gcalendar = PrestationGoogleCalendarSurLu()
-    if calendar_gcalendar.calendar is None:
-        print("No calendar_gcalendar")
+    old_event = Event.objects.filter(pk=instance.pk).values_list('employees_id', 'employees__user__email',
+                                                                 'calendar_id').first()
+    if old_event is None:
         return
-    if instance.pk:
-        old_event = Event.objects.get(pk=instance.pk)
-        if old_event.employees != instance.employees:
-            calendar_gcalendar.delete_event(old_event)
-    gmail_event = calendar_gcalendar.update_event(instance)
-    instance.calendar_id = gmail_event['id']
-    instance.calendar_url = gmail_event['htmlLink']
-    # instance.save()
+    old_employees_id, old_email, old_google_event_id = old_event
+    if old_employees_id != instance.employees_id and has_google_calendar_event(old_google_event_id):
+        # the google event lives in the calendar of the previous employee
+        GoogleCalendarOutbox.objects.create(event_id=instance.pk, action=GoogleCalendarOutbox.DELETE,
+                                            calendar=old_email, google_event_id=old_google_event_id)
 
 
 @receiver(post_save, sender=Event, dispatch_uid="event_post_save_gcalendar")
 def create_or_update_google_calendar_via_signal(sender, instance: Event, **kwargs):
-    if settings.TESTING:
-        print("** TEST mode")
-        return
     if instance._update_without_signals:
         print("Update without signals")
         return
-    calendar_gcalendar = PrestationGoogleCalendarSurLu()
-    # if calendar_gcalendar.calendar is None:
-    #    print("No calendar_gcalendar")
-    #    return
-    if instance.pk and calendar_gcalendar.calendar:
-        print(calendar_gcalendar.update_events_sur_id(instance))
+    GoogleCalendarOutbox.objects.create(event_id=instance.pk)
+    schedule_google_calendar_outbox_drain()
+    if settings.TESTING:
+        print("** TEST mode")
+        return
     if settings.GOOGLE_CHAT_WEBHOOK_URL:
         event_pictures_urls = None
         if instance.report_pictures.all():
@@ -757,28 +769,44 @@ def send_update_via_chat(sender, instance: ReportPicture, **kwargs):
 
 @receiver(pre_delete, sender=Event, dispatch_uid="event_delete_gcalendar_event")
 def delete_google_calendar(sender, instance: Event, **kwargs):
-    if settings.TESTING:
-        print("** TEST mode")
-        return
-    if instance.calendar_id != 0:
-        calendar_gcalendar = PrestationGoogleCalendarSurLu()
-        if not calendar_gcalendar.calendar:
-            print("No calendar_gcalendar")
-            return
-        calendar_gcalendar.delete_event(instance)
+    if has_google_calendar_event(instance.calendar_id):
+        GoogleCalendarOutbox.objects.create(event_id=instance.pk, action=GoogleCalendarOutbox.DELETE,
+                                            calendar=instance.employees.user.email if instance.employees else None,
+                                            google_event_id=instance.calendar_id)
+        schedule_google_calendar_outbox_drain()
 
 
 @receiver(pre_delete, sender=EventList, dispatch_uid="event_delete_gcalendar_event_list")
 def delete_google_calendar(sender, instance: Event, **kwargs):
-    if settings.TESTING:
-        print("** TEST mode")
-        return
-    if instance.calendar_id != 0:
-        calendar_gcalendar = PrestationGoogleCalendarSurLu()
-        if not calendar_gcalendar.calendar:
-            print("No calendar_gcalendar")
-            return
-        calendar_gcalendar.delete_event(instance)
+    if has_google_calendar_event(instance.calendar_id):
+        GoogleCalendarOutbox.objects.create(event_id=instance.pk, action=GoogleCalendarOutbox.DELETE,
+                                            calendar=instance.employees.user.email if instance.employees else None,
+                                            google_event_id=instance.calendar_id)
+        schedule_google_calendar_outbox_drain()
+
+
+@receiver(pre_save, sender=Event, dispatch_uid="remember_event_day")
+@receiver(pre_save, sender=EventList, dispatch_uid="remember_event_list_day")
+def remember_event_day(sender, instance, **kwargs):
+    instance.previous_day = None
+    if instance.pk:
+        instance.previous_day = Event.objects.filter(pk=instance.pk).values_list('day', flat=True).first()
+
+
+@receiver(post_save, sender=Event, dispatch_uid="invalidate_roster_on_event_save")
+@receiver(post_save, sender=EventList, dispatch_uid="invalidate_roster_on_event_list_save")
+@receiver(post_delete, sender=Event, dispatch_uid="invalidate_roster_on_event_delete")
+@receiver(post_delete, sender=EventList, dispatch_uid="invalidate_roster_on_event_list_delete")
+def invalidate_roster_on_event_change(sender, instance, **kwargs):
+    for day in {instance.day, getattr(instance, 'previous_day', None)}:
+        if day:
+            day_roster.invalidate_days(day)
+
+
+@receiver(post_save, sender=AssignedAdditionalEmployee, dispatch_uid="bump_event_feed_version_on_assigned_save")
+@receiver(post_delete, sender=AssignedAdditionalEmployee, dispatch_uid="bump_event_feed_version_on_assigned_delete")
+def bump_event_feed_version_on_assigned_employee_change(sender, instance, **kwargs):
+    event_feed_version.bump()
 
 
 def event_end_time_and_address_is_sometimes_mandatory(data):
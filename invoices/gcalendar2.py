@@ -180,7 +180,14 @@ class PrestationGoogleCalendarSurLu:
                                              eventId=event.calendar_id,
                                              body=event_body).execute()
 
-    def update_event(self, event):
+    @staticmethod
+    def calendar_id_for_event(event):
+        if event.employees:
+            return event.employees.user.email
+        return config.GENERAL_CALENDAR_ID
+
+    @staticmethod
+    def build_event_body(event):
         descr_line = "<b>%s</b> %s<br>"
         description = descr_line
         address = None
@@ -271,11 +278,11 @@ class PrestationGoogleCalendarSurLu:
                     'dateTime': naive_end_date.astimezone(ZoneInfo("Europe/Luxembourg")).isoformat(),
                 },
             }
+        return event_body
 
-        if event.employees:
-            calendar_id = event.employees.user.email
-        else:
-            calendar_id = config.GENERAL_CALENDAR_ID
+    def update_event(self, event):
+        event_body = self.build_event_body(event)
+        calendar_id = self.calendar_id_for_event(event)
 
         gmail_event = self.get_event(event_id=event.calendar_id, calendar_id=calendar_id)
         if gmail_event is None:
@@ -0,0 +1,34 @@
+import time
+
+from django.core.cache import cache
+
+
+class EventFeedVersion:
+    """
+    Version of what the planning feed shows of the employees and of the additional employees of the events.
+
+    Events, patients and sub contractors carry their own update time, the employees, their users and the additional
+    employees do not: their changes bump this token, which is part of the ETag of every range of the feed.
+    """
+    key = 'fullcalendar-events:version'
+
+    def get(self):
+        try:
+            version = cache.get(self.key)
+            if version is None:
+                cache.add(self.key, time.time_ns(), timeout=None)
+                version = cache.get(self.key)
+            return version
+        except Exception as e:
+            # without the cache every answer gets its own ETag, nothing stale is ever confirmed
+            print("Event feed version unavailable: %s" % e)
+            return time.time_ns()
+
+    def bump(self):
+        try:
+            cache.set(self.key, time.time_ns(), timeout=None)
+        except Exception as e:
+            print("Event feed version unavailable, not bumped: %s" % e)
+
+
+event_feed_version = EventFeedVersion()
@@ -0,0 +1,103 @@
+import hashlib
+import os
+import tempfile
+
+from django.conf import settings
+
+
+class StorageFileCache:
+    """
+    Local copies of storage files (prescription pdfs and thumbnails) shared by the workers of a host.
+
+    Blobs are stored under the sha256 of their content, so identical files uploaded under several names are kept
+    once. Each storage file is mapped to its blob through a fingerprint made of its name, size and modification
+    time, which only needs a metadata request: a file is downloaded again only when it changed. When the blobs
+    exceed ``STORAGE_FILE_CACHE_MAX_SIZE`` the least recently used ones are evicted.
+    """
+
+    @property
+    def directory(self):
+        return settings.STORAGE_FILE_CACHE_DIR
+
+    @property
+    def max_size(self):
+        return settings.STORAGE_FILE_CACHE_MAX_SIZE
+
+    def _blob_path(self, content_hash):
+        return os.path.join(self.directory, 'blobs', content_hash)
+
+    def _index_path(self, fingerprint):
+        return os.path.join(self.directory, 'index', hashlib.sha256(fingerprint.encode('utf-8')).hexdigest())
+
+    @staticmethod
+    def _fingerprint(field_file):
+        storage = field_file.storage
+        try:
+            return "%s:%s:%s" % (field_file.name, storage.size(field_file.name),
+                                 storage.get_modified_time(field_file.name).isoformat())
+        except Exception:
+            # not supported by the storage or missing file, the download below raises the errors of a missing file
+            return None
+
+    @staticmethod
+    def _write_atomically(path, content):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(descriptor, 'wb') as temporary_file:
+            temporary_file.write(content)
+        os.replace(temporary_path, path)
+
+    def _cached_blob_path(self, fingerprint):
+        try:
+            with open(self._index_path(fingerprint)) as index_file:
+                blob_path = self._blob_path(index_file.read().strip())
+            # mark the blob as recently used
+            os.utime(blob_path)
+            return blob_path
+        except FileNotFoundError:
+            return None
+
+    def get_path(self, field_file):
+        """
+        Returns the path of a local copy of the FieldFile, raising like opening it would when it is broken.
+        """
+        if not field_file:
+            raise ValueError("The '%s' attribute has no file associated with it." % field_file.field.name)
+        fingerprint = self._fingerprint(field_file)
+        if fingerprint is not None:
+            blob_path = self._cached_blob_path(fingerprint)
+            if blob_path is not None:
+                return blob_path
+        with field_file.storage.open(field_file.name, 'rb') as remote_file:
+            content = remote_file.read()
+        content_hash = hashlib.sha256(content).hexdigest()
+        blob_path = self._blob_path(content_hash)
+        if not os.path.exists(blob_path):
+            self._write_atomically(blob_path, content)
+            self.evict(keep=blob_path)
+        else:
+            os.utime(blob_path)
+        if fingerprint is not None:
+            self._write_atomically(self._index_path(fingerprint), content_hash.encode('utf-8'))
+        return blob_path
+
+    def evict(self, keep=None):
+        blobs_directory = os.path.join(self.directory, 'blobs')
+        blobs = []
+        for entry in os.scandir(blobs_directory):
+            if entry.is_file() and not entry.name.startswith('tmp') and entry.path != keep:
+                blob_stat = entry.stat()
+                blobs.append((blob_stat.st_mtime, blob_stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in blobs) + (os.path.getsize(keep) if keep else 0)
+        for _, size, path in sorted(blobs):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # evicted by another worker
+                pass
+            total_size -= size
+
+
+storage_file_cache = StorageFileCache()
@@ -1,43 +1,78 @@
-import io
-
-from PyPDF2 import PdfReader, PdfWriter
-
-
-def extract_individual_paylip_pdf(file_obj):
-    pdf_reader = PdfReader(file_obj)
-    payslips = {}
-    for page_number, page in enumerate(pdf_reader.pages, start=1):
-        text = page.extract_text()
-        for line in text.splitlines():
-            if line.startswith("Classe"):
-                values = line.split()
-                name = " ".join(values[2:])
-                # remove "ADULTE" from the name
-                name = name.replace("ADULTE", "")
-                name = name.replace("FAMILIALE", "")
-                # remove any spaces at beginning and end of the name
-                name = name.strip()
-                # Teixeira Da Costa
-                name = name.replace("TEIXERA", "Teixeira")
-                name = name.replace("DIPLOMEE D'ETAT Teixeira", "Teixeira")
-                #print(name)
-                #print("Page number is %s" % page_number)
-
-                pdf_writer = PdfWriter()
-                pdf_writer.add_page(page)
-
-                # Write the PDF data to a BytesIO object
-                pdf_data_io = io.BytesIO()
-                pdf_writer.write(pdf_data_io)
-
-                # Get the binary data from the BytesIO object
-                pdf_data = pdf_data_io.getvalue()
-
-                # Add the PDF data to the payslips dictionary
-                payslips[name] = pdf_data
-
-    if not payslips:
-        print("No payslip found in the pdf")
-    if len(payslips) != len(pdf_reader.pages):
-        print("Number of payslips found is not equal to the number of pages in the pdf : payslips %s, pages %s" % (len(payslips), len(pdf_reader.pages)))
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import fitz
+
+# pages given to each process at once
+PAGES_PER_TASK = 10
+
+
+def payslip_name(text):
+    """Name of the employee on the "Classe" line of a payslip page, None when the page is not a payslip."""
+    for line in text.splitlines():
+        if line.startswith("Classe"):
+            values = line.split()
+            name = " ".join(values[2:])
+            # remove "ADULTE" from the name
+            name = name.replace("ADULTE", "")
+            name = name.replace("FAMILIALE", "")
+            # remove any spaces at beginning and end of the name
+            name = name.strip()
+            # Teixeira Da Costa
+            name = name.replace("TEIXERA", "Teixeira")
+            name = name.replace("DIPLOMEE D'ETAT Teixeira", "Teixeira")
+            return name
+    return None
+
+
+def split_payslip_pages(pdf_path, first_page, last_page, output_directory):
+    """
+    Writes each payslip page from ``first_page`` to ``last_page`` (0 based, included) to its own pdf in
+    ``output_directory`` and returns (page number, name, path) of each of them. Runs in the processes of the pool.
+    """
+    payslips = []
+    with fitz.open(pdf_path) as document:
+        for page_number in range(first_page, last_page + 1):
+            name = payslip_name(document[page_number].get_text())
+            if name is None:
+                continue
+            path = os.path.join(output_directory, "payslip_%04d.pdf" % (page_number + 1))
+            with fitz.open() as payslip:
+                payslip.insert_pdf(document, from_page=page_number, to_page=page_number)
+                payslip.save(path, garbage=3, deflate=True)
+            payslips.append((page_number + 1, name, path))
     return payslips
+
+
+def split_payslips(pdf_path, output_directory, processes=None):
+    """
+    Splits a monthly payslip pdf into one pdf per payslip written in ``output_directory``, pages being read by a pool
+    of ``processes`` processes (one per cpu by default, none when 1). Yields (page number, name, path) as soon as the
+    pages of a task are written, so each payslip can be stored while the next ones are being split.
+    """
+    with fitz.open(pdf_path) as document:
+        page_count = document.page_count
+    tasks = [(first_page, min(first_page + PAGES_PER_TASK, page_count) - 1)
+             for first_page in range(0, page_count, PAGES_PER_TASK)]
+    processes = min(processes or os.cpu_count() or 1, len(tasks))
+    found = 0
+    if processes <= 1:
+        for first_page, last_page in tasks:
+            for payslip in split_payslip_pages(pdf_path, first_page, last_page, output_directory):
+                found += 1
+                yield payslip
+    else:
+        # spawned processes do not inherit the database connections of the worker
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [executor.submit(split_payslip_pages, pdf_path, first_page, last_page, output_directory)
+                       for first_page, last_page in tasks]
+            for future in as_completed(futures):
+                for payslip in future.result():
+                    found += 1
+                    yield payslip
+    if not found:
+        print("No payslip found in the pdf")
+    elif found != page_count:
+        print("Number of payslips found is not equal to the number of pages in the pdf : payslips %s, pages %s" % (
+            found, page_count))
@@ -0,0 +1,201 @@
+import base64
+import hashlib
+import os
+import time
+from datetime import date, datetime, timedelta
+
+import requests
+from django.core.cache import cache
+
+# events in these states do not keep an employee busy (see AvailableEmployeeList)
+IDLE_EVENT_STATES = (4, 5, 6)
+
+
+def as_day(value):
+    # instances saved with values that were not converted yet (strings, datetimes) still name a day
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, str):
+        return date.fromisoformat(value[:10])
+    return value
+
+
+def days_between(first_day, last_day):
+    first_day, last_day = as_day(first_day), as_day(last_day)
+    return [first_day + timedelta(days=offset) for offset in range((last_day - first_day).days + 1)]
+
+
+class DayRoster:
+    """
+    Availability of the staff per day, stored in the shared cache under the ``roster:`` namespace.
+
+    A day holds the users on accepted leave and the busy intervals of the employees assigned to events, it is built
+    once for all the missing days of a range (one query for the leaves, one for the events). Its key embeds a version
+    token of the day which is bumped when a holiday request or an event touching the day changes, like the ones of
+    TimesheetCalculationCache: a day built while it was invalidated is stored under the old version and never read.
+    The active employees and their avatars encoded in base64 are cached alongside, an avatar under the name of its
+    file so that a new upload is downloaded again.
+    """
+    namespace = 'roster'
+
+    def __init__(self, timeout=60 * 60 * 24):
+        self.timeout = timeout
+
+    def _version_key(self, day):
+        return '%s:version:%s' % (self.namespace, day.isoformat())
+
+    def _day_keys(self, days):
+        version_keys = [self._version_key(day) for day in days]
+        versions = cache.get_many(version_keys)
+        for version_key in version_keys:
+            if version_key not in versions:
+                # a version evicted from the cache is replaced by a new one, never by an older value
+                cache.add(version_key, time.time_ns(), timeout=None)
+                versions[version_key] = cache.get(version_key)
+        return {'%s:day:%s:%s' % (self.namespace, day.isoformat(), versions[version_key]): day
+                for day, version_key in zip(days, version_keys)}
+
+    def _build_days(self, days):
+        from invoices.events import Event
+        from invoices.enums.holidays import HolidayRequestWorkflowStatus
+        from invoices.holidays import HolidayRequest
+
+        entries = {day: {'on_leave': [], 'busy': []} for day in days}
+        holiday_requests = HolidayRequest.objects.filter(request_status=HolidayRequestWorkflowStatus.ACCEPTED,
+                                                         start_date__lte=days[-1], end_date__gte=days[0])
+        for user_id, start_date, end_date in holiday_requests.values_list('employee_id', 'start_date', 'end_date'):
+            for day in days_between(max(start_date, days[0]), min(end_date, days[-1])):
+                if day in entries:
+                    entries[day]['on_leave'].append(user_id)
+        events = Event.objects.filter(day__in=days, employees__isnull=False, time_start_event__isnull=False,
+                                      time_end_event__isnull=False).exclude(state__in=IDLE_EVENT_STATES)
+        for event_id, day, employee_id, start, end in events.order_by('id').values_list(
+                'id', 'day', 'employees_id', 'time_start_event', 'time_end_event'):
+            entries[day]['busy'].append((employee_id, start, end, event_id))
+        return entries
+
+    def days(self, first_day, last_day):
+        """Roster entries from ``first_day`` to ``last_day`` included, keyed by day."""
+        days = days_between(first_day, last_day)
+        try:
+            # the versions are read before the days are built, an invalidation meanwhile bumps them
+            keys = self._day_keys(days)
+            cached = cache.get_many(list(keys))
+        except Exception as e:
+            # the roster does not need the cache, an unreachable one only makes it slower
+            print("Roster cache unavailable: %s" % e)
+            return self._build_days(days)
+        entries = {keys[key]: entry for key, entry in cached.items()}
+        missing = [day for day in days if day not in entries]
+        if missing:
+            built = self._build_days(missing)
+            entries.update(built)
+            try:
+                cache.set_many({key: built[day] for key, day in keys.items() if day in built}, self.timeout)
+            except Exception as e:
+                print("Roster cache unavailable, days not stored: %s" % e)
+        return {day: entries[day] for day in days}
+
+    def day(self, day):
+        return self.days(day, day)[day]
+
+    def employees(self):
+        """Every employee with what the planning needs to display them, in the default order of the employees."""
+        from invoices.employee import Employee
+
+        try:
+            directory = cache.get('%s:employees' % self.namespace)
+        except Exception as e:
+            print("Roster cache unavailable: %s" % e)
+            directory = None
+        if directory is None:
+            directory = [{'id': employee.id, 'user_id': employee.user_id, 'abbreviation': employee.abbreviation,
+                          'name': str(employee.user), 'end_contract': employee.end_contract,
+                          'color_text': employee.color_text, 'color_cell': employee.color_cell,
+                          'avatar': employee.minified_avatar.name or None}
+                         for employee in Employee.objects.select_related('user')]
+            try:
+                cache.set('%s:employees' % self.namespace, directory, self.timeout)
+            except Exception as e:
+                print("Roster cache unavailable, employees not stored: %s" % e)
+        return directory
+
+    def avatar_base64(self, employee):
+        if not employee['avatar']:
+            return None
+        key = '%s:avatar:%s:%s' % (self.namespace, employee['id'],
+                                   hashlib.md5(employee['avatar'].encode('utf-8')).hexdigest())
+        try:
+            avatar_base64 = cache.get(key)
+        except Exception as e:
+            print("Roster cache unavailable: %s" % e)
+            key, avatar_base64 = None, None
+        if avatar_base64 is None:
+            from invoices.employee import Employee
+
+            storage = Employee._meta.get_field('minified_avatar').storage
+            try:
+                # If avatar is stored locally
+                if os.environ.get('LOCAL_ENV', None):
+                    with storage.open(employee['avatar'], 'rb') as avatar_file:
+                        avatar_base64 = base64.b64encode(avatar_file.read()).decode('utf-8')
+                else:
+                    # If avatar is stored in a remote server
+                    response = requests.get(storage.url(employee['avatar']))
+                    avatar_base64 = base64.b64encode(response.content).decode('utf-8')
+            except Exception as e:
+                print(f"Error converting avatar to base64: {e}")
+                return None
+            if key is not None:
+                try:
+                    cache.set(key, avatar_base64, None)
+                except Exception as e:
+                    print("Roster cache unavailable, avatar not stored: %s" % e)
+        return avatar_base64
+
+    def on_leave(self, first_day, last_day=None):
+        """Employees on accepted leave per day from ``first_day`` to ``last_day`` included, in the order of the
+        holiday requests."""
+        employees_by_user = {employee['user_id']: employee for employee in self.employees()}
+        return {day: [employees_by_user[user_id] for user_id in entry['on_leave'] if user_id in employees_by_user]
+                for day, entry in self.days(first_day, last_day or first_day).items()}
+
+    @staticmethod
+    def _available(employees, entry, day, active_only, start_time=None, end_time=None, exclude_event_id=None):
+        on_leave = set(entry['on_leave'])
+        busy = set()
+        if start_time is not None:
+            busy = {employee_id for employee_id, start, end, event_id in entry['busy']
+                    if start <= end_time and end >= start_time and str(event_id) != str(exclude_event_id)}
+        return [employee for employee in employees
+                if employee['user_id'] not in on_leave and employee['id'] not in busy and
+                (employee['end_contract'] is None if active_only else
+                 employee['end_contract'] is None or employee['end_contract'] >= day)]
+
+    def available(self, first_day, last_day=None, start_time=None, end_time=None, exclude_event_id=None,
+                  active_only=True):
+        """
+        Employees available per day from ``first_day`` to ``last_day`` included: not on leave and, when a time window
+        is given, not assigned to an event overlapping it (``exclude_event_id`` aside). ``active_only`` keeps the
+        employees without an end of contract, otherwise the ones whose contract has not ended on that day.
+        """
+        employees = self.employees()
+        return {day: self._available(employees, entry, day, active_only, start_time, end_time, exclude_event_id)
+                for day, entry in self.days(first_day, last_day or first_day).items()}
+
+    def invalidate_days(self, first_day, last_day=None):
+        version = time.time_ns()
+        try:
+            cache.set_many({self._version_key(day): version for day in days_between(first_day, last_day or first_day)},
+                           timeout=None)
+        except Exception as e:
+            print("Roster cache unavailable, days not invalidated: %s" % e)
+
+    def invalidate_employees(self):
+        try:
+            cache.delete('%s:employees' % self.namespace)
+        except Exception as e:
+            print("Roster cache unavailable, employees not invalidated: %s" % e)
+
+
+day_roster = DayRoster()
@@ -0,0 +1,92 @@
+import threading
+import time
+
+from django.core.cache import cache
+
+_MISSING = object()
+
+
+class TimesheetCalculationCache:
+    """
+    Timesheet calculations stored in the shared cache under the ``timesheet:`` namespace.
+
+    Every key embeds three version tokens: a global one (public holidays), one per employee (contracts) and one per
+    employee and month (timesheet, details, holiday requests). Invalidating bumps the matching token so that the
+    entries depending on it are never read again and expire by themselves, the rest of the cache is left untouched.
+    Hits and misses are counted per process.
+    """
+    namespace = 'timesheet'
+
+    def __init__(self, timeout=60 * 60 * 24):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _version_keys(self, employee_id, year, month):
+        return ['%s:version' % self.namespace,
+                '%s:version:%s' % (self.namespace, employee_id),
+                '%s:version:%s:%04d-%02d' % (self.namespace, employee_id, year, month)]
+
+    def _versions(self, version_keys):
+        versions = cache.get_many(version_keys)
+        for version_key in version_keys:
+            if version_key not in versions:
+                # a version evicted from the cache is replaced by a new one, never by an older value
+                cache.add(version_key, time.time_ns(), timeout=None)
+                versions[version_key] = cache.get(version_key)
+        return [versions[version_key] for version_key in version_keys]
+
+    def key(self, employee_id, year, month, name):
+        versions = self._versions(self._version_keys(employee_id, year, month))
+        return '%s:%s:%04d-%02d:%s:%s' % (self.namespace, employee_id, year, month, name,
+                                          '.'.join(str(version) for version in versions))
+
+    def get_or_set(self, employee_id, year, month, name, compute):
+        try:
+            key = self.key(employee_id, year, month, name)
+            value = cache.get(key, _MISSING)
+        except Exception as e:
+            # the calculations do not need the cache, an unreachable one only makes them slower
+            print("Timesheet calculations cache unavailable: %s" % e)
+            key, value = None, _MISSING
+        with self._lock:
+            if value is _MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if value is _MISSING:
+            value = compute()
+            if key is not None:
+                cache.set(key, value, self.timeout)
+        return value
+
+    def _bump(self, version_key):
+        try:
+            cache.set(version_key, time.time_ns(), timeout=None)
+        except Exception as e:
+            print("Timesheet calculations cache unavailable, %s not invalidated: %s" % (version_key, e))
+
+    def invalidate_month(self, employee_id, year, month):
+        self._bump(self._version_keys(employee_id, year, month)[2])
+
+    def invalidate_period(self, employee_id, start_date, end_date):
+        year, month = start_date.year, start_date.month
+        while (year, month) <= (end_date.year, end_date.month):
+            self.invalidate_month(employee_id, year, month)
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+    def invalidate_employee(self, employee_id):
+        self._bump('%s:version:%s' % (self.namespace, employee_id))
+
+    def invalidate_all(self):
+        self._bump('%s:version' % self.namespace)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_ratio': self.hits / total if total else 0}
+
+
+timesheet_calculations = TimesheetCalculationCache()
@@ -1,14 +1,13 @@
 # -*- coding: utf-8 -*-
 import os
-from collections import namedtuple
-from datetime import date, timedelta, datetime
+from datetime import date
 
 from constance import config
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.db import models
 from django.db.models import Q
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 from django.urls import reverse
 from django.utils.timezone import now
@@ -18,6 +17,7 @@ from invoices.db.fields import CurrentUserField
 from invoices.employee import Employee
 from invoices.enums.generic import HolidayRequestChoice
 from invoices.enums.holidays import HolidayRequestWorkflowStatus
+from invoices.helpers.roster import day_roster
 from invoices.notifications import send_email_notification, notify_user_that_holiday_request_is_created
 from invoices.validators import validators
 
@@ -75,114 +75,25 @@ class HolidayRequest(models.Model):
     reason = models.PositiveSmallIntegerField(
         choices=REASONS)
 
+    def get_absences(self):
+        absences = getattr(self, 'prefetched_absences', None)
+        if absences is None:
+            from helpers.absences import HolidayRequestAbsences
+            absences = HolidayRequestAbsences([self])
+        return absences
+
     @property
     def hours_taken(self):
-        # import holidays
-        # lu_holidays = holidays.Luxembourg()
-        # counter = 0
-        # delta = self.end_date - self.start_date
-        # date_comp = self.start_date
-        # jours_feries = 0
-        # if self.reason > 1:
-        #     return "Non applicable"
-        # for i in range(delta.days + 1):
-        #     if date_comp.weekday() < 5 and self.requested_period != HolidayRequestChoice.req_full_day:
-        #         counter += 0.5
-        #     elif date_comp.weekday() < 5 and self.requested_period == HolidayRequestChoice.req_full_day:
-        #         counter += 1
-        #     if date_comp in lu_holidays:
-        #         jours_feries = jours_feries + 1
-        #     date_comp = date_comp + timedelta(days=1)
-        # if Employee.objects.get(user_id=self.employee.id).employeecontractdetail_set.filter(
-        #         start_date__lte=self.start_date).first() is None:
-        #     return "définir les heures de travail contractuels svp."
-        # hours_jour = Employee.objects.get(user_id=self.employee.id).employeecontractdetail_set.filter(
-        #     start_date__lte=self.start_date).first().number_of_hours / 5
-        computation = self.hours_calculations(holiday_request=self)
-        if isinstance(computation, str) or "Non applicable" == computation:
-            return computation
-        return [(computation.num_days - computation.jours_feries) * computation.hours_jour,
-                "explication: ( (%.2f jours congés + %.2f jours maladie ) - %d jours fériés )  x %d nombre h. /j" % (
-                    computation.num_days,
-                    computation.num_days_sickness,
-                    computation.jours_feries,
-                    computation.hours_jour)]
+        return self.get_absences().hours_taken(self)
 
     def hours_calculations(self, same_year_only=False, holiday_request=None):
-        import holidays
-        lu_holidays = holidays.Luxembourg()
-        # if holiday end date is before employee start_contract date then return 0
-        if holiday_request.end_date < Employee.objects.get(user_id=holiday_request.employee.id).start_contract:
-            Computation = namedtuple('Computation', 'num_days num_days_sickness hours_jour jours_feries')
-            computation = Computation(0, 0, 0, 0)
-            return computation
-        counter_holidays = 0
-        counter_sickness_leaves = 0
-        if same_year_only and holiday_request.end_date.year != holiday_request.start_date.year:
-            delta = holiday_request.end_date.replace(year=holiday_request.start_date.year, month=12,
-                                                     day=31) - holiday_request.start_date
-        else:
-            delta = holiday_request.end_date - holiday_request.start_date
-        date_comp = holiday_request.start_date
-        jours_feries = 0
-        if holiday_request.reason > 2:
-            return "Non applicable"
-        if holiday_request.reason == 1:
-            for i in range(delta.days + 1):
-                if date_comp.weekday() < 5 and holiday_request.requested_period != HolidayRequestChoice.req_full_day:
-                    counter_holidays += 0.5
-                elif date_comp.weekday() < 5 and holiday_request.requested_period == HolidayRequestChoice.req_full_day:
-                    counter_holidays += 1
-                if date_comp in lu_holidays:
-                    jours_feries = jours_feries + 1
-                date_comp = date_comp + timedelta(days=1)
-        elif holiday_request.reason == 2:
-            for i in range(delta.days + 1):
-                if date_comp.weekday() < 5 and holiday_request.requested_period != HolidayRequestChoice.req_full_day:
-                    counter_sickness_leaves += 0.5
-                elif date_comp.weekday() < 5 and holiday_request.requested_period == HolidayRequestChoice.req_full_day:
-                    counter_sickness_leaves += 1
-                if date_comp in lu_holidays:
-                    jours_feries = jours_feries + 1
-                date_comp = date_comp + timedelta(days=1)
-
-        employee_contract_details = Employee.objects.get(
-            user_id=holiday_request.employee.id).employeecontractdetail_set.filter(
-            start_date__lte=holiday_request.start_date, end_date__isnull=True)
-        if employee_contract_details.count() > 1:
-            raise Exception("More than one contract for employee when calculating holiday request %s" % (holiday_request, holiday_request.id))
-        if employee_contract_details.count() == 0:
-            employee_contract_details = Employee.objects.get(
-                user_id=holiday_request.employee.id).employeecontractdetail_set.filter(
-                start_date__lte=holiday_request.start_date, end_date__gte=holiday_request.start_date)
-
-            if employee_contract_details.count() == 0:
-                # for employees who have a contract than ended before the start date of the holiday request
-                employee_contract_details = Employee.objects.get(
-                    user_id=holiday_request.employee.id).employeecontractdetail_set.filter(
-                    start_date__lte=holiday_request.start_date, end_date__lte=holiday_request.start_date).order_by("-end_date")
-                if employee_contract_details.count() == 0:
-                    raise Exception("No contract for employee when calculating holiday request %s id %s" % (holiday_request, holiday_request.id))
-            if employee_contract_details.count() > 1:
-                raise Exception("More than one contract for this employee %s for holiday request %s" % (holiday_request.employee, holiday_request))
-        if employee_contract_details.count() == 0:
-            raise Exception("No contract for this employee %s for holiday request %s" % (holiday_request.employee, holiday_request))
-        hours_jour = employee_contract_details.first().number_of_hours / 5
-
-        Computation = namedtuple('Computation', 'num_days num_days_sickness hours_jour jours_feries')
-        computation = Computation(counter_holidays, counter_sickness_leaves, hours_jour, jours_feries)
-        return computation
+        if holiday_request is None:
+            holiday_request = self
+        return holiday_request.get_absences().computation(holiday_request, same_year_only=same_year_only)
 
     @property
     def total_days_in_current_year(self):
-        holidays_taken_same_year = HolidayRequest.objects.filter(start_date__year=self.start_date.year,
-                                                                 request_status=HolidayRequestWorkflowStatus.ACCEPTED,
-                                                                 employee=self.employee,
-                                                                 reason=self.REASONS[0][0])
-        calculation = 0
-        for holiday_req in holidays_taken_same_year:
-            calculation += holiday_req.hours_calculations(same_year_only=True, holiday_request=holiday_req).num_days
-        return calculation
+        return self.get_absences().total_days_in_current_year(self)
 
     @property
     def total_hours_off_available(self, year=None):
@@ -191,25 +102,9 @@ class HolidayRequest(models.Model):
         :return: the number of hours off available for the employee
         @return:
         """
-        if year is None:
-            year = self.start_date.year
         # if employee contract detail end date is None or at least one contract detail date end is after the year
         # we are looking for, we can assume that the employee is still working for the company
-        if Employee.objects.get(user_id=self.employee.id).employeecontractdetail_set.filter(
-                end_date__isnull=True).exists() or \
-                Employee.objects.get(user_id=self.employee.id).employeecontractdetail_set.filter(
-                    end_date__year=year).exists():
-            hours_off_available = 0
-            # if self.start_date.year equals year then for month in range to as of now
-            # else for month in range 1 to 12
-            if self.start_date.year == year:
-                #
-                for month in range(1, self.end_date.month + 1):
-                    hours_off_available += self.hours_off_available_per_month(month, year)
-            else:
-                for month in range(1, 13):
-                    hours_off_available += self.hours_off_available_per_month(month, year)
-            return hours_off_available
+        return self.get_absences().total_hours_off_available(self, year=year)
 
     def hours_off_available_per_month(self, month, year):
         """
@@ -218,19 +113,13 @@ class HolidayRequest(models.Model):
         @param year:
         @return:
         """
-        hours_off_available = 0
-        employee_contract_details = Employee.objects.get(
-            user_id=self.employee.id).employeecontractdetail_set.filter(
-            start_date__lte=datetime(year, month, 1), end_date__isnull=True).first()
-        if employee_contract_details is None:
-            employee_contract_details = Employee.objects.get(
-                user_id=self.employee.id).employeecontractdetail_set.filter(
-                start_date__lte=datetime(year, month, 1), end_date__gt=datetime(year=year, month=month, day=1)).first()
+        from helpers.absences import ContractTimeline, HOURS_OFF_PER_MONTH_PER_WEEKLY_HOUR
+        employee_contract_details = ContractTimeline(
+            Employee.objects.get(user_id=self.employee.id).employeecontractdetail_set.all()).on_first_day_of_month(
+            year, month)
         if employee_contract_details is not None:
-            number_of_hours_off_for_the_month = employee_contract_details.number_of_hours * 0.43333333333333335
-            hours_off_available += number_of_hours_off_for_the_month
             # round to 2 decimals commercial
-            return round(hours_off_available, 2)
+            return round(employee_contract_details.number_of_hours * HOURS_OFF_PER_MONTH_PER_WEEKLY_HOUR, 2)
         else:
             return 0
 
@@ -339,3 +228,20 @@ def notify_holiday_request_creation(sender, instance, created, **kwargs):
         send_email_notification('A new %s' % instance,
                                 'please validate. %s' % url,
                                 to_emails)
+
+
+@receiver(pre_save, sender=HolidayRequest, dispatch_uid="remember_holiday_request_period")
+def remember_holiday_request_period(sender, instance, **kwargs):
+    # whatever was derived from the days the request covered before its dates changed is stale as well
+    instance.previous_period = None
+    if instance.pk:
+        instance.previous_period = HolidayRequest.objects.filter(pk=instance.pk).values_list(
+            'employee_id', 'start_date', 'end_date').first()
+
+
+@receiver(post_save, sender=HolidayRequest, dispatch_uid="invalidate_roster_on_holiday_request_save")
+@receiver(post_delete, sender=HolidayRequest, dispatch_uid="invalidate_roster_on_holiday_request_delete")
+def invalidate_roster_on_holiday_request_change(sender, instance, **kwargs):
+    day_roster.invalidate_days(instance.start_date, instance.end_date)
+    if getattr(instance, 'previous_period', None):
+        day_roster.invalidate_days(instance.previous_period[1], instance.previous_period[2])
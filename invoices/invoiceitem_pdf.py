@@ -3,7 +3,7 @@ import decimal
 from zoneinfo import ZoneInfo
 
 from constance import config
-from django.db.models import Case, Value, When, IntegerField
+from django.db.models import Case, Value, When, IntegerField, Prefetch
 from reportlab.lib import colors
 from reportlab.lib.enums import TA_CENTER, TA_JUSTIFY, TA_LEFT
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
@@ -12,39 +12,61 @@ from reportlab.platypus.flowables import Spacer, PageBreak, Image
 from reportlab.platypus.para import Paragraph
 from reportlab.platypus.tables import Table, TableStyle
 
+from invoices.helpers.filecache import storage_file_cache
+
+
+def order_invoices_for_pdf(queryset):
+    return queryset.annotate(
+        is_under_dependence_insurance_order=Case(
+            When(patient__is_under_dependence_insurance=False, then=Value(0)),
+            When(patient__is_under_dependence_insurance=True, then=Value(1)),
+            default=Value(2),
+            output_field=IntegerField(),
+        )).order_by('is_under_dependence_insurance_order', 'patient_id')
+
+
+def prefetch_invoices_for_pdf(queryset):
+    """
+    Loads the invoices with everything the pdf needs in a fixed number of queries: patient, invoicing details,
+    subcontractor, prestations (with care codes and employees) in ``pdf_prestations`` and prescriptions in
+    ``pdf_prescriptions``.
+    """
+    from invoices.models import Prestation, InvoiceItemPrescriptionsList
+    prestations = Prestation.objects.select_related('carecode', 'employee').order_by("date", "carecode__name")
+    prescriptions = InvoiceItemPrescriptionsList.objects.select_related('medical_prescription').order_by('id')
+    return queryset.select_related('patient', 'invoice_details', 'subcontractor').prefetch_related(
+        Prefetch('prestations', queryset=prestations, to_attr='pdf_prestations'),
+        Prefetch('prescriptions', queryset=prescriptions, to_attr='pdf_prescriptions'))
+
 
 def get_doc_elements(queryset, med_p=False, with_verification_page=False, batch_file=None):
     elements = []
     summary_data = []
-    already_added_images = []
     copies_of_medical_prescriptions = []
     invoicing_details = None
     total_number_of_lines = 0
-    for qs in queryset.annotate(
-            is_under_dependence_insurance_order=Case(
-                When(patient__is_under_dependence_insurance=False, then=Value(0)),
-                When(patient__is_under_dependence_insurance=True, then=Value(1)),
-                default=Value(2),
-                output_field=IntegerField(),
-            )).order_by('is_under_dependence_insurance_order', 'patient_id'):
+    for qs in prefetch_invoices_for_pdf(order_invoices_for_pdf(queryset)):
         if invoicing_details is None:
             invoicing_details = qs.invoice_details
         elif invoicing_details != qs.invoice_details:
             raise Exception("Invoices must have the same invoicing details found %s and %s" % (
                 invoicing_details, qs.invoice_details))
-        dd = [qs.prestations.all().order_by("date", "carecode__name")[i:i + 20] for i in
-              range(0, len(qs.prestations.all()), 20)]
-        total_number_of_lines += len(qs.prestations.all())
-        for _prestations in dd:
+        prestations = qs.pdf_prestations
+        prescriptions = qs.pdf_prescriptions
+        # pages of 20 prestations
+        dd = [prestations[i:i + 20] for i in range(0, len(prestations), 20)]
+        total_number_of_lines += len(prestations)
+        for page_number, _prestations in enumerate(dd, start=1):
             _inv = qs.invoice_number + (
-                ("" + str(dd.index(_prestations) + 1) + qs.invoice_date.strftime('%m%Y')) if len(dd) > 1 else "")
+                ("" + str(page_number) + qs.invoice_date.strftime('%m%Y')) if len(dd) > 1 else "")
             _result = _build_invoices(_prestations,
                                       _inv,
                                       qs.invoice_date,
                                       qs.accident_id,
                                       qs.accident_date,
                                       qs.invoice_details,
-                                      qs.subcontractor)
+                                      qs.subcontractor,
+                                      prescriptions)
 
             elements.extend(_result["elements"])
             summary_data.append((_result["invoice_number"], _result["patient_name"], _result["invoice_amount"],
@@ -52,9 +74,8 @@ def get_doc_elements(queryset, med_p=False, with_verification_page=False, batch_
                                  _result["prescription_date"], _result["prescription_end_date"]))
             elements.append(PageBreak())
             if med_p:
-                if qs.get_all_medical_prescriptions().exists():
-                    all_prescriptions = qs.get_all_medical_prescriptions().all()
-                    for prescription in all_prescriptions:
+                if prescriptions:
+                    for prescription in prescriptions:
                         try:
                             # print(prescription.medical_prescription.file_upload.file.name)
                             if prescription.medical_prescription.date.year == qs.invoice_date.year and \
@@ -62,18 +83,18 @@ def get_doc_elements(queryset, med_p=False, with_verification_page=False, batch_
                                 elements.append(
                                     Paragraph(u"Ajouter ordonnance ORIGINALE %s" % prescription.medical_prescription,
                                               ParagraphStyle(name="Normal", alignment=TA_LEFT, fontSize=14)))
-                                elements.append(Image(prescription.medical_prescription.thumbnail_img,
+                                elements.append(Image(storage_file_cache.get_path(
+                                    prescription.medical_prescription.thumbnail_img),
                                                       width=234.94,
                                                       height=389.595))
-                                already_added_images.append(prescription.medical_prescription.file_upload.file.name)
                             elif prescription.medical_prescription.date.year != qs.invoice_date.year or prescription.medical_prescription.date.month != qs.invoice_date.month:
                                 elements.append(
                                     Paragraph(u"Ajouter COPIE ordonnance  %s" % prescription.medical_prescription,
                                               ParagraphStyle(name="Normal", alignment=TA_LEFT, fontSize=14)))
-                                elements.append(Image(prescription.medical_prescription.thumbnail_img,
+                                elements.append(Image(storage_file_cache.get_path(
+                                    prescription.medical_prescription.thumbnail_img),
                                                       width=234.94,
                                                       height=389.595))
-                                already_added_images.append(prescription.medical_prescription.file_upload.file.name)
                             if prescription.medical_prescription.file_upload not in copies_of_medical_prescriptions:
                                 copies_of_medical_prescriptions.append(prescription.medical_prescription.file_upload)
                         except (FileNotFoundError, ValueError) as ex:
@@ -101,6 +122,27 @@ def get_doc_elements(queryset, med_p=False, with_verification_page=False, batch_
     return elements, copies_of_medical_prescriptions
 
 
+def get_medical_prescription_files(queryset):
+    """
+    Returns the prescription files that get_doc_elements(med_p=True) collects, in the same order,
+    without building the pdf elements, so that they can be merged independently of the invoices pdf.
+    """
+    copies_of_medical_prescriptions = []
+    for qs in prefetch_invoices_for_pdf(order_invoices_for_pdf(queryset)):
+        if not qs.pdf_prestations:
+            continue
+        for prescription in qs.pdf_prescriptions:
+            try:
+                # fetching the file raises the same errors as in get_doc_elements for broken prescriptions
+                storage_file_cache.get_path(prescription.medical_prescription.file_upload)
+            except (FileNotFoundError, ValueError) as ex:
+                print(ex)
+                continue
+            if prescription.medical_prescription.file_upload not in copies_of_medical_prescriptions:
+                copies_of_medical_prescriptions.append(prescription.medical_prescription.file_upload)
+    return copies_of_medical_prescriptions
+
+
 def _build_recap(recaps):
     elements = []
     data = []
@@ -225,7 +267,8 @@ def _build_final_page(total, order_number, invoicing_details, batch_start_date=N
     return elements
 
 
-def _build_invoices(prestations, invoice_number, invoice_date, accident_id, accident_date, invoicing_details, subcontractor):
+def _build_invoices(prestations, invoice_number, invoice_date, accident_id, accident_date, invoicing_details, subcontractor,
+                    prescription_list):
     # Draw things on the PDF. Here's where the PDF generation happens.
     # See the ReportLab documentation for the full list of functionality.
     # import pydevd; pydevd.settrace()
@@ -241,8 +284,6 @@ def _build_invoices(prestations, invoice_number, invoice_date, accident_id, acci
     number_of_lines = 0
     prescription_date = ''
     prescription_end_date = ''
-    from invoices.models import InvoiceItemPrescriptionsList
-    prescription_list = InvoiceItemPrescriptionsList.objects.filter(invoice_item__invoice_number=invoice_number).all()
     for prescription_list_item in prescription_list:
         prescription_date += format(prescription_list_item.medical_prescription.date, '%d/%m/%Y') + ' - '
         if prescription_list_item.medical_prescription.end_date:
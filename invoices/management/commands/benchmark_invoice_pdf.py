@@ -0,0 +1,110 @@
+import time
+from datetime import date, datetime, timedelta
+from io import BytesIO
+from zoneinfo import ZoneInfo
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import cm
+from reportlab.platypus import SimpleDocTemplate
+
+from invoices.employee import Employee, JobPosition
+from invoices.invoiceitem_pdf import get_doc_elements, order_invoices_for_pdf, prefetch_invoices_for_pdf
+from invoices.models import CareCode, Patient, Prestation, InvoiceItem, ValidityDate, Physician, \
+    MedicalPrescription, InvoiceItemPrescriptionsList
+from invoices.modelspackage import InvoicingDetails
+from invoices.prefac import QueryCounter
+
+
+def read_invoice(invoice, pages, prescriptions):
+    # what the pdf reads of an invoice, its prestations and its prescriptions
+    invoice.invoice_details, invoice.subcontractor
+    for page in pages:
+        for prestation in page:
+            prestation.carecode.code, prestation.employee.provider_code, prestation.invoice_item.patient.code_sn
+    for prescription in prescriptions:
+        prescription.medical_prescription.date
+
+
+def read_per_invoice(queryset):
+    """Query pattern get_doc_elements had before prefetching: the relations of each invoice are queried again."""
+    for invoice in order_invoices_for_pdf(queryset):
+        pages = [invoice.prestations.all().order_by("date", "carecode__name")[i:i + 20]
+                 for i in range(0, len(invoice.prestations.all()), 20)]
+        prescriptions = []
+        if invoice.get_all_medical_prescriptions().exists():
+            prescriptions = invoice.get_all_medical_prescriptions().all()
+        read_invoice(invoice, pages, prescriptions)
+
+
+def read_prefetched(queryset):
+    for invoice in prefetch_invoices_for_pdf(order_invoices_for_pdf(queryset)):
+        prestations = invoice.pdf_prestations
+        read_invoice(invoice, [prestations[i:i + 20] for i in range(0, len(prestations), 20)],
+                     invoice.pdf_prescriptions)
+
+
+class Command(BaseCommand):
+    help = 'Compares queries and time needed to read the invoices of a pdf per invoice (as before prefetching) ' \
+           'and with prefetch_invoices_for_pdf, then builds the pdf, on synthetic invoices created in a ' \
+           'transaction that is rolled back'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--invoices', type=int, default=500)
+        parser.add_argument('--prestations', type=int, default=25, help='prestations per invoice')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            queryset = self.create_synthetic_invoices(options['invoices'], options['prestations'])
+            for name, read in (('per invoice', read_per_invoice), ('prefetched', read_prefetched)):
+                counter = QueryCounter()
+                started_at = time.monotonic()
+                with connection.execute_wrapper(counter):
+                    read(queryset)
+                self.stdout.write("%s: %s queries, %.2fs to read the invoices" % (
+                    name, counter.count, time.monotonic() - started_at))
+            counter = QueryCounter()
+            started_at = time.monotonic()
+            with connection.execute_wrapper(counter):
+                elements, _ = get_doc_elements(queryset)
+            elements_built_at = time.monotonic()
+            SimpleDocTemplate(BytesIO(), rightMargin=2 * cm, leftMargin=2 * cm, topMargin=1 * cm,
+                              bottomMargin=1 * cm, pagesize=A4).build(elements)
+            self.stdout.write("pdf: %s queries, %.2fs to build the elements, %.2fs to render" % (
+                counter.count, elements_built_at - started_at, time.monotonic() - elements_built_at))
+            transaction.set_rollback(True)
+
+    @staticmethod
+    def create_synthetic_invoices(number_of_invoices, prestations_per_invoice):
+        # bulk_create everywhere so that no signal reaches external services
+        invoice_date = date(2023, 3, 31)
+        prestation_date = datetime(2023, 3, 1, 8, 0, tzinfo=ZoneInfo("Europe/Luxembourg"))
+        user = User.objects.create_user('benchmark-invoice-pdf')
+        employee = Employee.objects.bulk_create([Employee(user=user, start_contract=invoice_date,
+                                                          provider_code='000000-00',
+                                                          occupation=JobPosition.objects.create(name='benchmark'))])[0]
+        invoice_details = InvoicingDetails.objects.create(provider_code="000000", name="benchmark", address="address",
+                                                          zipcode_city="0000 city", bank_account="LU00")
+        care_code = CareCode.objects.create(code='BENCH', name='benchmark', description='benchmark', reimbursed=True)
+        ValidityDate.objects.create(care_code=care_code, start_date=date(2023, 1, 1), gross_amount=10)
+        physician = Physician.objects.bulk_create([Physician(provider_code='000000', first_name='benchmark',
+                                                             name='benchmark')])[0]
+        patients = Patient.objects.bulk_create(
+            [Patient(code_sn='19450101%05d' % i, first_name='first name', name='patient %s' % i, address='address',
+                     zipcode='0000', city='city') for i in range(number_of_invoices)])
+        prescriptions = MedicalPrescription.objects.bulk_create(
+            [MedicalPrescription(prescriptor=physician, patient=patient, date=date(2023, 2, 1))
+             for patient in patients])
+        invoices = InvoiceItem.objects.bulk_create(
+            [InvoiceItem(invoice_number='benchmark-%s' % i, invoice_date=invoice_date,
+                         invoice_details=invoice_details, patient=patient) for i, patient in enumerate(patients)])
+        InvoiceItemPrescriptionsList.objects.bulk_create(
+            [InvoiceItemPrescriptionsList(invoice_item=invoice, medical_prescription=prescription)
+             for invoice, prescription in zip(invoices, prescriptions)])
+        Prestation.objects.bulk_create(
+            [Prestation(invoice_item=invoice, employee=employee, carecode=care_code,
+                        date=prestation_date + timedelta(hours=day)) for invoice in invoices
+             for day in range(prestations_per_invoice)])
+        return InvoiceItem.objects.filter(invoice_details=invoice_details)
@@ -0,0 +1,31 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from invoices.actions.carecodes import import_care_code_prices
+
+
+class Command(BaseCommand):
+    help = 'Applies a CNS tariff file (csv) to the validity dates of the care codes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file_path', type=str, help='The path to the CSV file')
+        parser.add_argument('start_date', type=date.fromisoformat, help='First day of the prices, YYYY-MM-DD')
+        parser.add_argument('--end-date', type=date.fromisoformat, default=None,
+                            help='Last day of the prices, YYYY-MM-DD, open when not given')
+        parser.add_argument('--code-column', type=int, default=1)
+        parser.add_argument('--amount-column', type=int, default=3)
+        parser.add_argument('--delimiter', type=str, default=';')
+        parser.add_argument('--dry-run', action='store_true', help='Only shows what would change')
+
+    def handle(self, *args, **options):
+        diff = import_care_code_prices(options['file_path'], options['start_date'], options['end_date'],
+                                       dry_run=options['dry_run'], code_column=options['code_column'],
+                                       amount_column=options['amount_column'], delimiter=options['delimiter'])
+        for title, validity_dates in (('created', diff.created), ('closed', diff.closed), ('updated', diff.updated),
+                                      ('continued', diff.continued)):
+            for validity_date in validity_dates:
+                self.stdout.write("%s %s: %s" % (title, validity_date.care_code_id, validity_date))
+        for row in diff.invalid_rows:
+            self.stdout.write("invalid row: %s" % row)
+        self.stdout.write(self.style.SUCCESS('%s%s' % ('Dry run: ' if options['dry_run'] else '', diff)))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from invoices.events import GoogleCalendarSyncState
+from invoices.notifications import notify_system_via_google_webhook
+from invoices.processors.gcalendar import reconcile_google_calendars
+
+
+class Command(BaseCommand):
+    # not scheduled by the application, to be run by the scheduler of the platform like daily_patient_recap
+    help = 'Reconciles the google events changed since the previous run with the events of the application'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--time-min', help='start of the listing of calendars synchronized for the first time')
+        parser.add_argument('--delete-orphans', action='store_true',
+                            help='delete the google events of events deleted from the application')
+        parser.add_argument('--full', action='store_true', help='forget the sync tokens and list every calendar')
+
+    def handle(self, *args, **options):
+        if options['full']:
+            GoogleCalendarSyncState.objects.all().delete()
+        report = reconcile_google_calendars(time_min=options['time_min'], delete_orphans=options['delete_orphans'])
+        self.stdout.write(report.as_text())
+        if report.orphans or report.stale_copies or report.removed_from_google or report.different_times:
+            notify_system_via_google_webhook("*Google calendar reconciliation*\n%s" % report.as_text())
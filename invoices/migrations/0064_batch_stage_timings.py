@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-18 20:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoices', '0063_subcontractor_notification_flag'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invoiceitembatch',
+            name='stage_timings',
+            field=models.JSONField(blank=True, default=dict, verbose_name='Durée de génération des fichiers'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.16 on 2026-10-18 20:31
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoices', '0064_batch_stage_timings'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GoogleCalendarOutbox',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.PositiveIntegerField(db_index=True, verbose_name='Event')),
+                ('action', models.CharField(choices=[('upsert', 'Create or update'), ('delete', 'Delete')], default='upsert', max_length=6, verbose_name='Action')),
+                ('calendar', models.CharField(blank=True, max_length=255, null=True, verbose_name='Calendar')),
+                ('google_event_id', models.CharField(blank=True, max_length=100, null=True, verbose_name='Google event id')),
+                ('created_on', models.DateTimeField(default=django.utils.timezone.now)),
+                ('processed_on', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Google calendar outbox',
+                'verbose_name_plural': 'Google calendar outbox',
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['processed_on', 'id'], name='invoices_go_process_c726a1_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.16 on 2026-10-18 20:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoices', '0065_google_calendar_outbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GoogleCalendarSyncState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('calendar', models.CharField(max_length=255, unique=True, verbose_name='Calendar')),
+                ('sync_token', models.CharField(blank=True, max_length=255, null=True, verbose_name='Sync token')),
+                ('synced_on', models.DateTimeField(blank=True, null=True, verbose_name='Synced on')),
+            ],
+            options={
+                'verbose_name': 'Google calendar sync state',
+                'verbose_name_plural': 'Google calendar sync states',
+            },
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.16 on 2026-10-18 20:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoices', '0066_google_calendar_sync_state'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SimplifiedTimesheetSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total_hours', models.DurationField()),
+                ('total_sundays', models.DurationField()),
+                ('total_hours_during_public_holidays', models.DurationField()),
+                ('sundays_worked', models.JSONField(default=list)),
+                ('public_holidays_worked', models.JSONField(default=list)),
+                ('total_legal_working_hours', models.FloatField()),
+                ('holidays_count', models.FloatField()),
+                ('sickness_days_count', models.FloatField()),
+                ('exceptional_break', models.FloatField()),
+                ('number_of_public_holidays', models.PositiveSmallIntegerField()),
+                ('daily_working_hours', models.FloatField()),
+                ('absence_periods', models.JSONField(default=list)),
+                ('public_holidays', models.JSONField(blank=True, null=True)),
+                ('computed_on', models.DateTimeField(auto_now=True)),
+                ('simplified_timesheet', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='summary', to='invoices.simplifiedtimesheet')),
+            ],
+            options={
+                'verbose_name': 'Totaux temps de travail',
+                'verbose_name_plural': 'Totaux temps de travail',
+            },
+        ),
+    ]
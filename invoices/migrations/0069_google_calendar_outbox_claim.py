@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-18 21:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoices', '0068_geocoded_addresses'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='googlecalendaroutbox',
+            name='claimed_on',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -15,7 +15,7 @@ from django.core.exceptions import ValidationError
 from django.core.files.images import ImageFile
 from django.core.files.storage import default_storage
 from django.db import models
-from django.db.models import Q, IntegerField, Max
+from django.db.models import Q, IntegerField, Max, Exists, OuterRef
 from django.db.models.functions import Cast
 from django.db.models.signals import post_save, post_delete, pre_save
 from django.dispatch import receiver
@@ -36,6 +36,7 @@ from invoices.enums.generic import GenderType, BatchTypeChoices
 from invoices.enums.medical import BedsoreEvolutionStatus
 from invoices.modelspackage import InvoicingDetails
 from invoices.notifications import notify_system_via_google_webhook
+from invoices.pricing import care_code_prices
 # from invoices.processors.tasks import process_post_save, update_events_address
 from invoices.validators.validators import MyRegexValidator
 from invoices.xero.utils import get_xero_token, ensure_sub_contractor_contact_exists
@@ -64,29 +65,13 @@ class CareCode(models.Model):
 
     @property
     def current_gross_amount(self):
-        return self.gross_amount(datetime.date.today())
+        return self.gross_amount_date_based(timezone.localdate())
 
     def gross_amount(self, date):
-        for v in self.validity_dates.all():
-            if date.date() >= v.start_date:
-                if v.end_date is None:
-                    return v.gross_amount
-                elif date.date() <= v.end_date:
-                    return v.gross_amount
-        return 0
+        return care_code_prices.gross_amount(self.id, date.date())
 
     def gross_amount_date_based(self, date):
-        if date is None:
-            return 0
-        if self.validity_dates.count() == 0:
-            return 0
-        for v in self.validity_dates.all():
-            if date >= v.start_date:
-                if v.end_date is None:
-                    return v.gross_amount
-                elif date <= v.end_date:
-                    return v.gross_amount
-        return 0
+        return care_code_prices.gross_amount(self.id, date)
 
     def net_amount(self, date, private_patient, participation_statutaire):
         if not private_patient:
@@ -188,6 +173,13 @@ class ValidityDate(models.Model):
         return messages
 
 
+@receiver(post_save, sender=ValidityDate, dispatch_uid="validity_date_invalidate_prices_post_save")
+@receiver(post_delete, sender=ValidityDate, dispatch_uid="validity_date_invalidate_prices_post_delete")
+@receiver(post_save, sender=CareCode, dispatch_uid="care_code_invalidate_prices_post_save")
+def invalidate_care_code_prices(sender, instance, **kwargs):
+    care_code_prices.invalidate()
+
+
 def extract_birth_date(code_sn) -> object:
     stripped_sn_code = code_sn.replace(" ", "")
     if stripped_sn_code is not None and (stripped_sn_code[:4]).isdigit():
@@ -1143,6 +1135,8 @@ class InvoiceItemBatch(models.Model):
     generated_12_percent_invoice_files = models.FileField("Facture 12% PDF", blank=True, null=True,
                                                           upload_to=invoice_itembatch_12_pct_filename)
     batch_type = models.CharField(max_length=50, choices=BatchTypeChoices.choices, default=BatchTypeChoices.CNS_INF)
+    # filled by the generation stages of process_post_save
+    stage_timings = models.JSONField("Durée de génération des fichiers", default=dict, blank=True)
 
     # creation technical fields
     created_date = models.DateTimeField(auto_now_add=True)
@@ -1201,18 +1195,18 @@ class InvoiceItemBatch(models.Model):
         return InvoiceItem.objects.filter(batch=self).order_by('patient_id', 'invoice_number')
 
     def events_during_batch_periods(self):
+        """
+        Events of the batch period for patients not under dependence insurance that have no prestation invoiced
+        on their day, found in one query whatever the number of events.
+        """
         from invoices.events import Event
         from invoices.enums.event import EventTypeEnum
+        prestations_of_the_day = Prestation.objects.filter(invoice_item__patient=OuterRef('patient'),
+                                                           date__date=OuterRef('day'))
         events = Event.objects.filter(day__range=(self.start_date, self.end_date)).exclude(patient__isnull=True).filter(
-            patient__is_under_dependence_insurance=False).exclude(event_type_enum=EventTypeEnum.BIRTHDAY).order_by(
-            "patient__name", "day")
-        # grouped_events = events.values('patient__name').annotate(event_count=Count('id'))
-        dirty_events = []
-        for evt in events:
-            count_prestas = Prestation.objects.filter(date__date=evt.day, invoice_item__patient=evt.patient).count()
-            if count_prestas == 0:
-                dirty_events.append(evt)
-        return dirty_events
+            patient__is_under_dependence_insurance=False).exclude(event_type_enum=EventTypeEnum.BIRTHDAY).exclude(
+            Exists(prestations_of_the_day)).select_related('patient', 'employees').order_by("patient__name", "day")
+        return list(events)
 
 
 # @receiver(pre_save, sender=InvoiceItemBatch, dispatch_uid="invoiceitembatch_pre_save")
@@ -1,8 +1,13 @@
+import time
+from dataclasses import dataclass
+from io import StringIO
 from zoneinfo import ZoneInfo
 
 from constance import config
-from django.db.models import Case, When, Value, IntegerField
+from django.db import connection
+from django.db.models import Case, When, Value, IntegerField, Prefetch
 from django.http import HttpResponse
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 
@@ -162,31 +167,99 @@ def generate_all_invoice_lines_for_control(invoices, sending_date=None):
     return lines
 
 
-def generate_all_invoice_lines(invoices, invoice_batch_date=None, batch_type=None):
-    lines = ""
-    for invoice in invoices.annotate(
-            is_under_dependence_insurance_order=Case(
-                When(patient__is_under_dependence_insurance=False, then=Value(0)),
-                When(patient__is_under_dependence_insurance=True, then=Value(1)),
-                default=Value(2),
-                output_field=IntegerField(),
-            )).order_by('is_under_dependence_insurance_order', 'patient_id'):
+@dataclass
+class PrefacStats:
+    lines: int = 0
+    queries: int = 0
+    elapsed: float = 0.0
+
+    def __str__(self):
+        return "%d lines, %d queries, %.2f sec" % (self.lines, self.queries, self.elapsed)
+
+
+class QueryCounter:
+    """
+    Execute wrapper (see ``connection.execute_wrapper``) counting the SQL queries sent to the database.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def prefetch_invoices_for_prefac(invoices):
+    """
+    Loads in a fixed number of queries everything needed to build the flat file lines of the invoices:
+    patient, invoicing details, prestations (with care codes and employees) and prescriptions, prices come from
+    ``invoices.pricing.care_code_prices``.
+    Prestations are stored in ``prefac_prestations`` and prescriptions in ``prefac_prescriptions``.
+    """
+    from .models import Prestation, InvoiceItemPrescriptionsList
+    prestations = Prestation.objects.select_related('carecode', 'employee').order_by('date')
+    prescriptions = InvoiceItemPrescriptionsList.objects.filter(medical_prescription__isnull=False).select_related(
+        'medical_prescription__prescriptor').order_by('id')
+    return invoices.select_related('patient', 'invoice_details').prefetch_related(
+        Prefetch('prestations', queryset=prestations, to_attr='prefac_prestations'),
+        Prefetch('prescriptions', queryset=prescriptions, to_attr='prefac_prescriptions'))
+
+
+def _prestation_day(prestation_date):
+    # same conversion as the ORM does when a datetime is compared to a DateField
+    if timezone.is_aware(prestation_date):
+        return timezone.localdate(prestation_date)
+    return prestation_date.date()
+
+
+def first_valid_prescription(prescriptions, prestation_date):
+    """
+    In memory equivalent of ``InvoiceItem.get_first_valid_medical_prescription`` working on prefetched
+    ``InvoiceItemPrescriptionsList`` ordered by id.
+    """
+    care_day = _prestation_day(prestation_date)
+    for prescription_link in prescriptions:
+        medical_prescription = prescription_link.medical_prescription
+        if medical_prescription.end_date is None:
+            continue
+        if medical_prescription.date <= care_day <= medical_prescription.end_date:
+            return prescription_link
+    return None
+
+
+def stream_all_invoice_lines(invoices, invoice_batch_date=None, batch_type=None):
+    """
+    Yields the flat file lines (ending with a new line) of the invoices one by one.
+    """
+    provider = config.CODE_PRESTATAIRE
+    invoices = invoices.annotate(
+        is_under_dependence_insurance_order=Case(
+            When(patient__is_under_dependence_insurance=False, then=Value(0)),
+            When(patient__is_under_dependence_insurance=True, then=Value(1)),
+            default=Value(2),
+            output_field=IntegerField(),
+        )).order_by('is_under_dependence_insurance_order', 'patient_id')
+    for invoice in prefetch_invoices_for_prefac(invoices):
         invoice_dtls = invoice.invoice_details
         if invoice.invoice_date.year != invoice.invoice_date.year or invoice.invoice_date.month != invoice.invoice_date.month:
             raise ValueError(_("All invoice items must have same year and month"))
-        for prest in invoice.prestations.order_by('date'):
-            valid_prescription_list = invoice.get_first_valid_medical_prescription(prest.date)
+        participation_statutaire = invoice.patient.participation_statutaire and invoice.patient.age > 18
+        for prest in invoice.prefac_prestations:
+            valid_prescription_list = first_valid_prescription(invoice.prefac_prescriptions, prest.date)
             if not valid_prescription_list:
                 print(_("No valid prescription found for invoice item: " + str(invoice.id)))
                 valid_prescription = None
             else:
                 valid_prescription = valid_prescription_list.medical_prescription
+            gross_amount = prest.carecode.gross_amount(prest.date)
+            net_amount = prest.carecode.net_amount(prest.date, False, participation_statutaire)
             data = {
                 "version": "2",
                 # format date to YYYYMM00 for sending date replace days with 00
                 "date": format(invoice_batch_date, '%Y%m00'),
                 "payer": "U",
-                "provider": config.CODE_PRESTATAIRE,
+                "provider": provider,
                 # patient cns code only 11 digits
                 "patient": invoice.patient.code_sn.replace(" ", "")[:13],
                 # accident number if exists or empty 10 spaces
@@ -210,24 +283,37 @@ def generate_all_invoice_lines(invoices, invoice_batch_date=None, batch_type=Non
                 "end_time": format(prest.date.astimezone(ZoneInfo("Europe/Luxembourg")), '%H%M'),
                 "times_executed": "001",
                 # gross amount with int part only
-                "gross_amount": str(int(prest.carecode.gross_amount(prest.date))).zfill(7),
-                "gross_amount_decimals": str(int((prest.carecode.gross_amount(prest.date) - int(
-                    prest.carecode.gross_amount(prest.date))) * 100)).zfill(2),
-                "net_amount": str(int(
-                    prest.carecode.net_amount(prest.date, False,
-                                              invoice.patient.participation_statutaire and invoice.patient.age > 18))).zfill(
-                    7),
-                "net_amount_decimals": str(int((prest.carecode.net_amount(prest.date, False,
-                                                                          invoice.patient.participation_statutaire and invoice.patient.age > 18) - int(
-                    prest.carecode.net_amount(prest.date, False,
-                                              invoice.patient.participation_statutaire and invoice.patient.age > 18))) * 100)).zfill(
-                    2),
+                "gross_amount": str(int(gross_amount)).zfill(7),
+                "gross_amount_decimals": str(int((gross_amount - int(gross_amount)) * 100)).zfill(2),
+                "net_amount": str(int(net_amount)).zfill(7),
+                "net_amount_decimals": str(int((net_amount - int(net_amount)) * 100)).zfill(2),
                 "insurance_code": None,
                 "denial_code": None,
                 "currency": "EUR"
             }
-            # print(data)
-            lines += generate_file_line(data)
-    if lines.endswith("\n"):
-        lines = lines[:-1]
-    return lines
+            yield generate_file_line(data)
+
+
+def write_all_invoice_lines(invoices, sink, invoice_batch_date=None, batch_type=None):
+    """
+    Writes the flat file of the invoices into the file-like ``sink`` line by line (no new line after the last one)
+    and returns a ``PrefacStats`` with the number of lines, of SQL queries and the elapsed time.
+    """
+    stats = PrefacStats()
+    counter = QueryCounter()
+    start = time.monotonic()
+    with connection.execute_wrapper(counter):
+        for line in stream_all_invoice_lines(invoices, invoice_batch_date=invoice_batch_date, batch_type=batch_type):
+            if stats.lines:
+                sink.write("\n")
+            sink.write(line[:-1] if line.endswith("\n") else line)
+            stats.lines += 1
+    stats.queries = counter.count
+    stats.elapsed = time.monotonic() - start
+    return stats
+
+
+def generate_all_invoice_lines(invoices, invoice_batch_date=None, batch_type=None):
+    sink = StringIO()
+    write_all_invoice_lines(invoices, sink, invoice_batch_date=invoice_batch_date, batch_type=batch_type)
+    return sink.getvalue()
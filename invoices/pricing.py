@@ -0,0 +1,92 @@
+import threading
+import time
+from bisect import bisect_right
+
+
+class PriceIndex:
+    """
+    Process wide table of dated prices, loaded in one query and looked up by bisection.
+
+    Subclasses give the rows of the table with ``price_rows``, as (key, start date, end date, price) ordered by key,
+    start date and id. For each key the intervals are sorted by start date, a lookup returns the price of the interval
+    starting the latest among the ones covering the date. The table is dropped by ``invalidate``, which the signals
+    of the price model call when a price is saved or deleted in this process, and reloaded after ``max_age`` seconds
+    so that price changes made by other processes are eventually seen. ``_memo`` is emptied along with the table, for
+    subclasses memoizing their lookups.
+    """
+
+    def __init__(self, max_age=300):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._intervals = None
+        self._memo = {}
+        self._loaded_at = None
+
+    def price_rows(self):
+        raise NotImplementedError
+
+    def _load(self):
+        intervals = {}
+        for key, start_date, end_date, price in self.price_rows():
+            starts, rows = intervals.setdefault(key, ([], []))
+            starts.append(start_date)
+            rows.append((end_date, price))
+        return intervals
+
+    def _get_intervals(self):
+        intervals = self._intervals
+        if intervals is None or time.monotonic() - self._loaded_at > self.max_age:
+            with self._lock:
+                if self._intervals is None or time.monotonic() - self._loaded_at > self.max_age:
+                    self._intervals = self._load()
+                    self._memo = {}
+                    self._loaded_at = time.monotonic()
+                intervals = self._intervals
+        return intervals
+
+    def lookup(self, key, day, default=None, open_ended=True):
+        """
+        Returns the price of ``key`` valid on ``day`` (a date), or ``default`` if there is none. Intervals without
+        end date are ignored when ``open_ended`` is False.
+        """
+        key_intervals = self._get_intervals().get(key)
+        if key_intervals is None:
+            return default
+        starts, rows = key_intervals
+        position = bisect_right(starts, day)
+        # walk back from the latest interval starting before the day, an older one may still cover it
+        while position > 0:
+            position -= 1
+            end_date, price = rows[position]
+            if end_date is None and open_ended or end_date is not None and day <= end_date:
+                return price
+        return default
+
+    def invalidate(self):
+        with self._lock:
+            self._intervals = None
+            self._memo = {}
+            self._loaded_at = None
+
+
+class CareCodePriceIndex(PriceIndex):
+    """
+    Gross amounts of the ValidityDates of all the CareCodes, a lookup returns the same amount as iterating
+    ``validity_dates`` ordered by ``-start_date`` does.
+    """
+
+    def price_rows(self):
+        from invoices.models import ValidityDate
+        return ValidityDate.objects.order_by('care_code_id', 'start_date', 'id').values_list(
+            'care_code_id', 'start_date', 'end_date', 'gross_amount')
+
+    def gross_amount(self, care_code_id, day):
+        """
+        Returns the gross amount of the care code valid on ``day`` (a date) or 0 if there is none.
+        """
+        if care_code_id is None or day is None:
+            return 0
+        return self.lookup(care_code_id, day, default=0)
+
+
+care_code_prices = CareCodePriceIndex()
@@ -0,0 +1,378 @@
+import datetime
+import re
+from collections import defaultdict
+from dataclasses import dataclass, field
+from zoneinfo import ZoneInfo
+
+from constance import config
+from dateutil.parser import parse
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django_rq import job
+from googleapiclient.errors import HttpError
+
+from invoices.employee import Employee
+from invoices.events import Event, GoogleCalendarOutbox, GoogleCalendarSyncState, has_google_calendar_event
+from invoices.gcalendar2 import PrestationGoogleCalendarSurLu
+from invoices.notifications import notify_system_via_google_webhook
+
+# maximum number of calls the calendar api accepts in a batch request
+GOOGLE_CALENDAR_BATCH_SIZE = 50
+GOOGLE_CALENDAR_OUTBOX_MAX_ATTEMPTS = 5
+# entries claimed by a drain that did not finish (worker killed) are claimed again after that, more than the job timeout
+GOOGLE_CALENDAR_OUTBOX_CLAIM_TIMEOUT = datetime.timedelta(minutes=15)
+# processed entries are kept that long for troubleshooting, then deleted by the drain
+GOOGLE_CALENDAR_OUTBOX_RETENTION = datetime.timedelta(days=7)
+SUR_LU_ID_PATTERN = re.compile(r'<b>Sur LU ID:</b> (\d+)<br>')
+
+
+@dataclass
+class OutboxDrainReport:
+    entries: int = 0
+    inserted: int = 0
+    updated: int = 0
+    deleted: int = 0
+    failed_entries: list = field(default_factory=list)
+    http_batches: int = 0
+    purged: int = 0
+
+
+def _is_missing(exception):
+    return isinstance(exception, HttpError) and exception.resp.status in (404, 410)
+
+
+def execute_in_batches(service, requests, report=None):
+    """
+    Executes the (request_id, http request) pairs through the batch endpoint of the calendar api and returns the
+    (response, exception) of each request id.
+    """
+    results = {}
+
+    def callback(request_id, response, exception):
+        results[request_id] = (response, exception)
+
+    for start in range(0, len(requests), GOOGLE_CALENDAR_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=callback)
+        for request_id, request in requests[start:start + GOOGLE_CALENDAR_BATCH_SIZE]:
+            batch.add(request, request_id=request_id)
+        batch.execute()
+        if report is not None:
+            report.http_batches += 1
+    return results
+
+
+def _coalesce(entries):
+    # the deletions of google events are all kept, for an event only its state at drain time is pushed
+    deletions = defaultdict(list)
+    upserts = defaultdict(list)
+    for entry in entries:
+        if entry.action == GoogleCalendarOutbox.DELETE:
+            deletions[(entry.calendar or config.GENERAL_CALENDAR_ID, entry.google_event_id)].append(entry)
+        else:
+            upserts[entry.event_id].append(entry)
+    return deletions, upserts
+
+
+def claim_outbox_entries(last_id, limit):
+    """
+    Claims the next pending entries after ``last_id`` in a short transaction, the calls to google are then made
+    without holding any lock. Concurrent drains skip the claimed entries.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        entries = list(GoogleCalendarOutbox.objects.select_for_update(skip_locked=True).filter(
+            Q(claimed_on__isnull=True) | Q(claimed_on__lt=now - GOOGLE_CALENDAR_OUTBOX_CLAIM_TIMEOUT),
+            processed_on__isnull=True, attempts__lt=GOOGLE_CALENDAR_OUTBOX_MAX_ATTEMPTS,
+            id__gt=last_id).order_by('id')[:limit])
+        GoogleCalendarOutbox.objects.filter(id__in=[entry.id for entry in entries]).update(claimed_on=now)
+    return entries
+
+
+def drain_outbox_entries(service, entries, report):
+    """
+    Pushes claimed entries to google, then writes back the google ids and the state of the entries, which are
+    released.
+    """
+    deletions, upserts = _coalesce(entries)
+    events = Event.objects.select_related('patient', 'employees__user').prefetch_related(
+        'event_assigned__assigned_additional_employee__user').in_bulk(list(upserts))
+    requests = []
+    entries_of_request = {}
+    for i, ((calendar_id, google_event_id), deletion_entries) in enumerate(deletions.items()):
+        requests.append(('delete-%s' % i, service.events().delete(calendarId=calendar_id, eventId=google_event_id)))
+        entries_of_request['delete-%s' % i] = deletion_entries
+    bodies = {}
+    for event_id, upsert_entries in upserts.items():
+        event = events.get(event_id)
+        if event is None:
+            # deleted since, its deletion has its own entry
+            continue
+        calendar_id = PrestationGoogleCalendarSurLu.calendar_id_for_event(event)
+        body = PrestationGoogleCalendarSurLu.build_event_body(event)
+        bodies[event_id] = calendar_id, body
+        if has_google_calendar_event(event.calendar_id):
+            request_id = 'update-%s' % event_id
+            request = service.events().update(calendarId=calendar_id, eventId=event.calendar_id, body=body)
+        else:
+            request_id = 'insert-%s' % event_id
+            request = service.events().insert(calendarId=calendar_id, body=body)
+        requests.append((request_id, request))
+        entries_of_request[request_id] = upsert_entries
+    results = execute_in_batches(service, requests, report)
+
+    # google events that disappeared are created again
+    missing = [request_id for request_id, (_, exception) in results.items()
+               if request_id.startswith('update-') and _is_missing(exception)]
+    retries = []
+    for request_id in missing:
+        event_id = int(request_id.split('-')[1])
+        calendar_id, body = bodies[event_id]
+        retries.append(('insert-%s' % event_id, service.events().insert(calendarId=calendar_id, body=body)))
+        entries_of_request['insert-%s' % event_id] = entries_of_request.pop(request_id)
+        del results[request_id]
+    results.update(execute_in_batches(service, retries, report))
+
+    now = timezone.now()
+    changed_events = []
+    failed_entries = []
+    processed_entries = [entry for entry_list in upserts.values() for entry in entry_list
+                         if entry.event_id not in bodies]
+    for request_id, (response, exception) in results.items():
+        request_entries = entries_of_request[request_id]
+        action = request_id.split('-')[0]
+        if exception is not None and not (action == 'delete' and _is_missing(exception)):
+            for entry in request_entries:
+                entry.attempts += 1
+                entry.last_error = str(exception)
+            failed_entries.extend(request_entries)
+            continue
+        processed_entries.extend(request_entries)
+        if action == 'delete':
+            report.deleted += 1
+            continue
+        if action == 'insert':
+            report.inserted += 1
+        else:
+            report.updated += 1
+        event = events[int(request_id.split('-')[1])]
+        if event.calendar_id != response['id'] or event.calendar_url != response['htmlLink']:
+            event.calendar_id = response['id']
+            event.calendar_url = response['htmlLink']
+            # bulk_update does not apply auto_now, the ETag of the event feed depends on updated_on
+            event.updated_on = now
+            changed_events.append(event)
+    for entry in processed_entries:
+        entry.processed_on = now
+    for entry in processed_entries + failed_entries:
+        entry.claimed_on = None
+    report.failed_entries.extend(failed_entries)
+    with transaction.atomic():
+        # bulk updates do not send signals, the events are not put back in the outbox
+        Event.objects.bulk_update(changed_events, ['calendar_id', 'calendar_url', 'updated_on'])
+        GoogleCalendarOutbox.objects.bulk_update(processed_entries + failed_entries,
+                                                 ['claimed_on', 'processed_on', 'attempts', 'last_error'])
+
+
+@job("default", timeout=600)
+def drain_google_calendar_outbox(service=None, limit=500):
+    """
+    Pushes the pending changes of the google calendar outbox through the batch endpoint of the calendar api.
+
+    Changes of a same event are coalesced into one insert or update of its current state. Entries that fail are
+    retried by the next drains, up to ``GOOGLE_CALENDAR_OUTBOX_MAX_ATTEMPTS`` times. Entries processed more than
+    ``GOOGLE_CALENDAR_OUTBOX_RETENTION`` ago are deleted.
+    @param service: calendar api service, built from the credentials of the application when not given
+    @param limit: number of entries claimed at once
+    @return: OutboxDrainReport
+    """
+    report = OutboxDrainReport()
+    if service is None:
+        calendar_gcalendar = PrestationGoogleCalendarSurLu()
+        if calendar_gcalendar.calendar is None:
+            print("No calendar_gcalendar")
+            return report
+        service = calendar_gcalendar._service
+    last_id = 0
+    while True:
+        # entries that fail are left for the next drain
+        entries = claim_outbox_entries(last_id, limit)
+        if entries:
+            drain_outbox_entries(service, entries, report)
+        report.entries += len(entries)
+        if len(entries) < limit:
+            break
+        last_id = entries[-1].id
+    report.purged, _ = GoogleCalendarOutbox.objects.filter(
+        processed_on__lt=timezone.now() - GOOGLE_CALENDAR_OUTBOX_RETENTION).delete()
+    abandoned = [entry for entry in report.failed_entries if entry.attempts >= GOOGLE_CALENDAR_OUTBOX_MAX_ATTEMPTS]
+    if abandoned:
+        notify_system_via_google_webhook(
+            "*The following events could not be synced with google calendar: %s*\nLast error: %s" % (
+                sorted({entry.event_id for entry in abandoned}), abandoned[-1].last_error))
+    return report
+
+
+@dataclass
+class CalendarReconciliationReport:
+    calendars: int = 0
+    full_syncs: list = field(default_factory=list)
+    changed_google_events: int = 0
+    # google events of events deleted from the application
+    orphans: list = field(default_factory=list)
+    # google events of an existing event which are not its current google event
+    stale_copies: list = field(default_factory=list)
+    # events whose google event was deleted on google
+    removed_from_google: list = field(default_factory=list)
+    # events whose google event does not start or end at the same time
+    different_times: list = field(default_factory=list)
+    deleted_orphans: int = 0
+
+    def as_text(self):
+        return "Calendars: %s (full sync for %s)\nChanged google events: %s\nOrphans (%d): \n%s\n" \
+               "Stale copies (%d): \n%s\nRemoved from google (%d): \n%s\nEvents_different_times (%d): \n%s\n" \
+               "Orphans deleted from google: %s" % (
+                   self.calendars, self.full_syncs, self.changed_google_events,
+                   len(self.orphans), self.orphans, len(self.stale_copies), self.stale_copies,
+                   len(self.removed_from_google), self.removed_from_google,
+                   len(self.different_times), self.different_times, self.deleted_orphans)
+
+
+def list_changed_google_events(service, calendar_id, sync_token=None, time_min=None):
+    """
+    Returns the google events of the calendar changed since ``sync_token``, or all of them starting from
+    ``time_min`` when there is no token, with the sync token of the next run. An expired token raises an HttpError
+    with status 410.
+    """
+    google_events = []
+    page_token = None
+    while True:
+        params = {'calendarId': calendar_id}
+        if sync_token:
+            params['syncToken'] = sync_token
+        elif time_min:
+            params['timeMin'] = time_min
+        if page_token:
+            params['pageToken'] = page_token
+        response = service.events().list(**params).execute()
+        google_events.extend(response.get('items', []))
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return google_events, response.get('nextSyncToken')
+
+
+def _google_times_differ(event, google_event):
+    if not event.time_start_event or not event.time_end_event:
+        return False
+    google_start = google_event.get('start', {}).get('dateTime')
+    google_end = google_event.get('end', {}).get('dateTime')
+    if not google_start or not google_end:
+        return False
+    lu_tz = ZoneInfo("Europe/Luxembourg")
+    return parse(google_start) != datetime.datetime.combine(event.day, event.time_start_event, tzinfo=lu_tz) or \
+        parse(google_end) != datetime.datetime.combine(event.day, event.time_end_event, tzinfo=lu_tz)
+
+
+def _google_event_summary(calendar_id, google_event, event_id=None):
+    return {'email': calendar_id, 'gId': google_event['id'], 'inurId': event_id,
+            'htmlLink': google_event.get('htmlLink'), 'start': google_event.get('start'),
+            'end': google_event.get('end')}
+
+
+@job("default", timeout=6000)
+def reconcile_google_calendars(service=None, time_min=None, delete_orphans=False):
+    """
+    Compares the google events changed since the previous run with the events of the application.
+
+    The sync token of each calendar is stored in GoogleCalendarSyncState, so a run only lists the changes of the
+    calendars (calendars without token or whose token expired are listed from ``time_min``). The changed google
+    events are matched to the events in one query whatever their number.
+    @param service: calendar api service, built from the credentials of the application when not given
+    @param time_min: datetime or iso string from which calendars without sync token are listed
+    @param delete_orphans: deletes from google the google events of events deleted from the application
+    @return: CalendarReconciliationReport
+    """
+    report = CalendarReconciliationReport()
+    if service is None:
+        calendar_gcalendar = PrestationGoogleCalendarSurLu()
+        if calendar_gcalendar.calendar is None:
+            print("No calendar_gcalendar")
+            return report
+        service = calendar_gcalendar._service
+    if time_min is not None:
+        if isinstance(time_min, str):
+            time_min = parse(time_min)
+        time_min = time_min.astimezone(ZoneInfo("Europe/Luxembourg")).isoformat()
+    calendars = list(Employee.objects.filter(end_contract=None).filter(~Q(abbreviation='XXX')).values_list(
+        'user__email', flat=True))
+    states = GoogleCalendarSyncState.objects.in_bulk(calendars, field_name='calendar')
+    changes = []
+    new_states = []
+    for calendar_id in calendars:
+        state = states.get(calendar_id)
+        sync_token = state.sync_token if state else None
+        try:
+            try:
+                google_events, next_sync_token = list_changed_google_events(service, calendar_id, sync_token,
+                                                                            time_min)
+            except HttpError as e:
+                if e.resp.status != 410 or not sync_token:
+                    raise
+                # the token expired, the calendar is listed again
+                sync_token = None
+                google_events, next_sync_token = list_changed_google_events(service, calendar_id, None, time_min)
+        except HttpError as e:
+            if e.resp.status == 404:
+                print("Calendar does not exist for %s" % calendar_id)
+                continue
+            raise
+        if not sync_token:
+            report.full_syncs.append(calendar_id)
+        report.calendars += 1
+        changes.extend((calendar_id, google_event) for google_event in google_events)
+        new_states.append(GoogleCalendarSyncState(calendar=calendar_id, sync_token=next_sync_token,
+                                                  synced_on=timezone.now()))
+    report.changed_google_events = len(changes)
+
+    event_ids = {}
+    for calendar_id, google_event in changes:
+        match = SUR_LU_ID_PATTERN.search(google_event.get('description') or '')
+        if match:
+            event_ids[google_event['id']] = int(match.group(1))
+    google_ids = [google_event['id'] for _, google_event in changes]
+    events_by_id = {}
+    events_by_google_id = {}
+    for event in Event.objects.filter(Q(id__in=set(event_ids.values())) | Q(calendar_id__in=google_ids)):
+        events_by_id[event.id] = event
+        events_by_google_id[event.calendar_id] = event
+
+    orphans = []
+    for calendar_id, google_event in changes:
+        if google_event.get('status') == 'cancelled':
+            # deleted google events only come with their id
+            event = events_by_google_id.get(google_event['id'])
+            if event is not None and event.state != 5:
+                report.removed_from_google.append(event)
+            continue
+        event_id = event_ids.get(google_event['id'])
+        if event_id is None:
+            continue
+        event = events_by_id.get(event_id)
+        if event is None:
+            orphans.append((calendar_id, google_event['id']))
+            report.orphans.append(_google_event_summary(calendar_id, google_event, event_id))
+        elif event.calendar_id != google_event['id']:
+            report.stale_copies.append(_google_event_summary(calendar_id, google_event, event_id))
+        elif _google_times_differ(event, google_event):
+            report.different_times.append(event)
+
+    if delete_orphans and orphans:
+        results = execute_in_batches(service, [('delete-%s' % i, service.events().delete(calendarId=calendar_id,
+                                                                                          eventId=google_event_id))
+                                               for i, (calendar_id, google_event_id) in enumerate(orphans)])
+        report.deleted_orphans = len([exception for _, exception in results.values()
+                                      if exception is None or _is_missing(exception)])
+    # the tokens are only stored once the changes they cover were handled
+    GoogleCalendarSyncState.objects.bulk_create(new_states, update_conflicts=True, unique_fields=['calendar'],
+                                                update_fields=['sync_token', 'synced_on'])
+    return report
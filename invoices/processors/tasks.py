@@ -1,98 +1,183 @@
 import os
+import time
 import traceback
 from datetime import datetime
 from datetime import timedelta
-from io import BytesIO
+from io import BytesIO, StringIO
 
 from constance import config
 from django.core.files.base import ContentFile
+from django.db import transaction
 from django.db.models import Case, Value, When, IntegerField
+from django.utils import timezone
 from django_rq import job
 from pypdf import PdfMerger
 from reportlab.lib.units import cm
 from reportlab.platypus import SimpleDocTemplate
 
 from invoices.actions.gcontacts import GoogleContacts
-from invoices.invoiceitem_pdf import get_doc_elements
+from invoices.helpers.filecache import storage_file_cache
+from invoices.invoiceitem_pdf import get_doc_elements, get_medical_prescription_files
 from invoices.notifications import notify_system_via_google_webhook
-from invoices.prefac import generate_all_invoice_lines
+from invoices.prefac import write_all_invoice_lines
 
 
-@job
-def process_post_save(instance):
-    try:
-        notify_system_via_google_webhook(
-            "Processing batch {0}".format(instance))
-        print("Processing batch {0}".format(instance))
-        # calculate how much time it takes to process the batch
-        start = datetime.now()
-        _must_update = False
+def get_batch_invoices(instance):
+    from invoices.models import InvoiceItem
+    return InvoiceItem.objects.filter(batch=instance).annotate(
+        is_under_dependence_insurance_order=Case(
+            When(patient__is_under_dependence_insurance=False, then=Value(0)),
+            When(patient__is_under_dependence_insurance=True, then=Value(1)),
+            default=Value(2),
+            output_field=IntegerField(),
+        )).order_by('is_under_dependence_insurance_order', 'patient_id')
 
-        if instance.force_update:
-            print("Forcing update of the batch {0}".format(instance))
-            _must_update = True
-            instance.version += 1
-            instance.force_update = False
-        if _must_update:
-            from invoices.models import InvoiceItem
-            print("* InvoiceItemBatch - process_post_save - Processing batch {0}".format(instance))
-            batch_invoices = InvoiceItem.objects.filter(batch=instance).annotate(
-                is_under_dependence_insurance_order=Case(
-                    When(patient__is_under_dependence_insurance=False, then=Value(0)),
-                    When(patient__is_under_dependence_insurance=True, then=Value(1)),
-                    default=Value(2),
-                    output_field=IntegerField(),
-                )).order_by('is_under_dependence_insurance_order', 'patient_id')
-            file_content = generate_all_invoice_lines(batch_invoices, invoice_batch_date=instance.end_date,
-                                                      batch_type=instance.batch_type)
-            instance.prefac_file = ContentFile(file_content.encode('utf-8'), 'prefac.txt')
 
-            # generate the pdf invoice file
-            # Create a BytesIO buffer
-            buffer = BytesIO()
-            doc = SimpleDocTemplate(buffer, rightMargin=2 * cm, leftMargin=2 * cm, topMargin=1 * cm,
-                                    bottomMargin=1 * cm)
-            elements, copies_of_medical_prescriptions = get_doc_elements(batch_invoices, med_p=True,
-                                                                         with_verification_page=True, batch_file=instance)
-            doc.build(elements)
-            # Go to the beginning of the buffer
-            buffer.seek(0)
-            instance.generated_invoice_files = ContentFile(buffer.read(), 'invoice.pdf')
+def build_batch_prefac_file(instance, batch_invoices):
+    prefac_buffer = StringIO()
+    prefac_stats = write_all_invoice_lines(batch_invoices, prefac_buffer, invoice_batch_date=instance.end_date,
+                                           batch_type=instance.batch_type)
+    print("Prefac file of batch {0} generated: {1}".format(instance, prefac_stats))
+    return ContentFile(prefac_buffer.getvalue().encode('utf-8'), 'prefac.txt')
 
 
-            buffer_12_pct = BytesIO()
-            doc_12_pct = SimpleDocTemplate(buffer_12_pct, rightMargin=2 * cm, leftMargin=2 * cm, topMargin=1 * cm,
-                                    bottomMargin=1 * cm)
-            from invoices.action_private_participation import pdf_private_invoice_pp
-            pdf_elements_12_pct = pdf_private_invoice_pp(modeladmin=None, request=None, queryset=batch_invoices,
-                                                         return_elements=True)
-            doc_12_pct.build(pdf_elements_12_pct)
-            buffer_12_pct.seek(0)
-            instance.generated_12_percent_invoice_files = ContentFile(buffer_12_pct.read(), 'invoice_12_pct.pdf')
+def build_batch_invoice_pdf(instance, batch_invoices):
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(buffer, rightMargin=2 * cm, leftMargin=2 * cm, topMargin=1 * cm,
+                            bottomMargin=1 * cm)
+    # prescriptions are merged by their own stage
+    elements, _ = get_doc_elements(batch_invoices, med_p=True, with_verification_page=True, batch_file=instance)
+    doc.build(elements)
+    return ContentFile(buffer.getvalue(), 'invoice.pdf')
 
-            merger = PdfMerger()
-            for file in copies_of_medical_prescriptions:
-                merger.append(file)
-            pdf_buffer = BytesIO()
-            merger.write(pdf_buffer)
-            pdf_buffer.seek(0)
-            instance.medical_prescriptions = ContentFile(pdf_buffer.read(), 'ordos.pdf')
-            instance.save()
-            end = datetime.now()
-            if os.environ.get('LOCAL_ENV', None):
-                print("Batch {0} processed in {1} seconds".format(instance, (end - start).seconds))
+
+def build_batch_12_pct_pdf(instance, batch_invoices):
+    buffer_12_pct = BytesIO()
+    doc_12_pct = SimpleDocTemplate(buffer_12_pct, rightMargin=2 * cm, leftMargin=2 * cm, topMargin=1 * cm,
+                                   bottomMargin=1 * cm)
+    from invoices.action_private_participation import pdf_private_invoice_pp
+    pdf_elements_12_pct = pdf_private_invoice_pp(modeladmin=None, request=None, queryset=batch_invoices,
+                                                 return_elements=True)
+    doc_12_pct.build(pdf_elements_12_pct)
+    return ContentFile(buffer_12_pct.getvalue(), 'invoice_12_pct.pdf')
+
+
+def build_batch_medical_prescriptions_pdf(instance, batch_invoices):
+    merger = PdfMerger()
+    # local copies are reused by the next versions of the batch
+    for file in get_medical_prescription_files(batch_invoices):
+        merger.append(storage_file_cache.get_path(file))
+    pdf_buffer = BytesIO()
+    merger.write(pdf_buffer)
+    return ContentFile(pdf_buffer.getvalue(), 'ordos.pdf')
+
+
+# each stage generates the file stored in the InvoiceItemBatch field of the same name
+BATCH_STAGE_BUILDERS = {
+    'prefac_file': build_batch_prefac_file,
+    'generated_invoice_files': build_batch_invoice_pdf,
+    'generated_12_percent_invoice_files': build_batch_12_pct_pdf,
+    'medical_prescriptions': build_batch_medical_prescriptions_pdf,
+}
+
+
+@job
+def process_post_save(instance):
+    """
+    Bumps the version of the batch when a regeneration is forced and dispatches one job per file to generate,
+    the stages run concurrently on the workers and each one stores its file as soon as it is ready.
+    """
+    try:
+        if not instance.force_update:
+            return
+        print("Forcing update of the batch {0}".format(instance))
+        notify_system_via_google_webhook(
+            "Processing batch {0}".format(instance))
+        instance.version += 1
+        instance.force_update = False
+        from invoices.models import InvoiceItemBatch
+        # update() does not send post_save, the batch would be processed again otherwise
+        InvoiceItemBatch.objects.filter(pk=instance.pk).update(
+            version=instance.version, force_update=False,
+            stage_timings={'version': instance.version, 'started_at': timezone.now().isoformat(), 'stages': {}})
+        for stage in BATCH_STAGE_BUILDERS:
+            if os.environ.get('LOCAL_ENV', None) or config.SKIP_DJANGORQ:
+                process_batch_stage(instance.pk, instance.version, stage)
             else:
-                url = config.ROOT_URL + '/admin/invoices/invoiceitembatch/?id=' + '{0}'.format(instance.id)
-                notify_system_via_google_webhook(
-                    "Batch {0} processed in {1} seconds click on link to check {2}".format(instance, (end - start).seconds,
-                                                                                             url))
+                process_batch_stage.delay(instance.pk, instance.version, stage)
     except Exception as e:
         print("An error occurred while processing the batch: {0}".format(e))
         error_detail = traceback.format_exc()
         notify_system_via_google_webhook(
             "*An error occurred while processing the batch: {0}*\nDetails:\n{1}".format(e, error_detail))
 
+
 @job("default", timeout=6000)
+def process_batch_stage(batch_id, version, stage):
+    """
+    Generates one file of the batch and stores it with the time it took in InvoiceItemBatch.stage_timings
+    @param batch_id: id of the InvoiceItemBatch
+    @param version: version of the batch the stage was dispatched for, stages of older versions are skipped
+    @param stage: one of BATCH_STAGE_BUILDERS
+    """
+    from invoices.models import InvoiceItemBatch
+    instance = InvoiceItemBatch.objects.get(pk=batch_id)
+    if instance.version != version:
+        print("Skipping stage {0} of batch {1}: version {2} is outdated".format(stage, instance, version))
+        return None
+    start = time.monotonic()
+    file_name = None
+    try:
+        content = BATCH_STAGE_BUILDERS[stage](instance, get_batch_invoices(instance))
+        file_field = getattr(instance, stage)
+        file_field.save(content.name, content, save=False)
+        file_name = file_field.name
+        status = 'done'
+    except Exception as e:
+        status = 'error'
+        error_detail = traceback.format_exc()
+        notify_system_via_google_webhook(
+            "*An error occurred while generating {0} of batch {1}: {2}*\nDetails:\n{3}".format(stage, instance, e,
+                                                                                              error_detail))
+    return record_batch_stage(batch_id, version, stage, status, time.monotonic() - start, file_name)
+
+
+def record_batch_stage(batch_id, version, stage, status, seconds, file_name=None):
+    """
+    Stores the outcome of a stage on the batch, rows are locked so that stages finishing at the same time
+    do not overwrite each other's timings. Notifies the system once all the stages of the version are finished.
+    @return: the stage timings of the batch or None if the batch has been regenerated in between
+    """
+    from invoices.models import InvoiceItemBatch
+    with transaction.atomic():
+        instance = InvoiceItemBatch.objects.select_for_update().get(pk=batch_id)
+        if instance.version != version:
+            return None
+        timings = instance.stage_timings or {}
+        timings.setdefault('stages', {})[stage] = {'status': status,
+                                                   'seconds': round(seconds, 2),
+                                                   'finished_at': timezone.now().isoformat()}
+        fields = {'stage_timings': timings}
+        if file_name:
+            fields[stage] = file_name
+        InvoiceItemBatch.objects.filter(pk=batch_id).update(**fields)
+    if len(timings['stages']) == len(BATCH_STAGE_BUILDERS):
+        total = sum(t['seconds'] for t in timings['stages'].values())
+        wall_clock = total
+        if timings.get('started_at'):
+            wall_clock = (timezone.now() - datetime.fromisoformat(timings['started_at'])).total_seconds()
+        if os.environ.get('LOCAL_ENV', None):
+            print("Batch {0} processed in {1:.0f} seconds ({2:.0f} seconds of work)".format(instance, wall_clock,
+                                                                                         total))
+        else:
+            url = config.ROOT_URL + '/admin/invoices/invoiceitembatch/?id=' + '{0}'.format(instance.id)
+            notify_system_via_google_webhook(
+                "Batch {0} processed in {1:.0f} seconds ({2:.0f} seconds of work) click on link to check {3}".format(
+                    instance, wall_clock, total, url))
+    return timings
+
+
+@job("default", timeout=600)
 def duplicate_event_for_next_day_for_several_events(events, who_created, number_of_days=1):
     """
     Duplicate the event for the next day
@@ -102,23 +187,10 @@ def duplicate_event_for_next_day_for_several_events(events, who_created, number_
     @return:
     """
     start = datetime.now()
-    events_created = []
     try:
-        for event in events:
-            next_day = event.day + timedelta(days=number_of_days)
-            from invoices.events import Event
-            if not Event.objects.filter(day=next_day, time_start_event=event.time_start_event,
-                                        time_end_event=event.time_end_event, event_type=event.event_type,
-                                        employees=event.employees, patient=event.patient).exists():
-                new_event = Event.objects.create(day=next_day, time_start_event=event.time_start_event,
-                                                 time_end_event=event.time_end_event,
-                                                 event_type_enum=event.event_type_enum,
-                                                 state=2, notes=event.notes,
-                                                 employees=event.employees, patient=event.patient,
-                                                 event_address=event.event_address,
-                                                 created_by='duplicate_event_for_next_day')
-                new_event.save()
-                events_created.append(new_event)
+        from invoices.events import duplicate_events
+        events_created = duplicate_events([(event, event.day + timedelta(days=number_of_days)) for event in events],
+                                          created_by='duplicate_event_for_next_day')
         if events_created and len(events_created) > 0:
             # build url to the newly created events
             url = config.ROOT_URL + '/admin/invoices/eventlist/?id__in=' + ','.join(
@@ -0,0 +1,208 @@
+import random
+import time
+from collections import namedtuple
+
+from django.core.cache import cache
+from django_rq import job
+
+from invoices.distancematrix import travel_time_graph
+
+# a visit of a patient: its planned start and end in minutes since midnight, the end may be unknown
+Visit = namedtuple('Visit', 'event_id patient_id start end')
+
+
+def minutes_since_midnight(value):
+    return None if value is None else value.hour * 60 + value.minute
+
+
+class TourOptimizer:
+    """
+    Proposes the order of the visits of a day that minimizes the travel time read from the travel-time graph.
+
+    A visit may start ``window`` minutes before or after its planned start (the nurse waits when early), lasts as long
+    as planned, and every minute late beyond the window costs ``lateness_penalty`` minutes of travel. A leg missing
+    from the distance matrix counts as ``unknown_leg_minutes``. The order is built by nearest neighbour, improved by
+    relocating visits and reversing segments, then by a genetic algorithm (pygad) when asked, all within
+    ``time_budget`` seconds.
+    """
+
+    def __init__(self, visits, window=60, lateness_penalty=10, unknown_leg_minutes=60, time_budget=5.0,
+                 use_genetic_algorithm=False, seed=None, graph=travel_time_graph):
+        self.visits = list(visits)
+        self.window = window
+        self.lateness_penalty = lateness_penalty
+        self.time_budget = time_budget
+        self.use_genetic_algorithm = use_genetic_algorithm
+        self.seed = seed
+        self.distances, self.durations = graph.submatrix([visit.patient_id for visit in self.visits])
+        self.unknown = self.durations < 0
+        self.travel = self.durations.copy()
+        self.travel[self.unknown] = unknown_leg_minutes
+        self.travel = self.travel.tolist()
+        self.day_start = min([visit.start for visit in self.visits if visit.start is not None], default=0)
+        self._deadline = None
+
+    def _service(self, visit):
+        if visit.start is None or visit.end is None:
+            return 0
+        return max(visit.end - visit.start, 0)
+
+    def schedule(self, order):
+        """Travel minutes and minutes late beyond the windows of visiting in that order."""
+        travel, lateness, clock, previous = 0, 0, self.day_start, None
+        for position in order:
+            visit = self.visits[position]
+            if previous is not None:
+                travel += self.travel[previous][position]
+                clock += self.travel[previous][position]
+            if visit.start is not None:
+                clock = max(clock, visit.start - self.window)
+                lateness += max(0, clock - visit.start - self.window)
+            clock += self._service(visit)
+            previous = position
+        return travel, lateness
+
+    def cost(self, order):
+        travel, lateness = self.schedule(order)
+        return travel + self.lateness_penalty * lateness
+
+    def _out_of_time(self):
+        return time.monotonic() > self._deadline
+
+    def nearest_neighbour(self):
+        remaining = set(range(len(self.visits)))
+        first = min(remaining, key=lambda position: (self.visits[position].start is None,
+                                                     self.visits[position].start or 0, position))
+        order = [first]
+        remaining.remove(first)
+        while remaining:
+            following = min(remaining, key=lambda position: (self.cost(order + [position]), position))
+            order.append(following)
+            remaining.remove(following)
+        return order
+
+    def local_search(self, order):
+        best, best_cost = list(order), self.cost(order)
+        improved = True
+        while improved and not self._out_of_time():
+            improved = False
+            size = len(best)
+            # relocate one visit
+            for source in range(size):
+                for target in range(size):
+                    if source == target:
+                        continue
+                    candidate = best[:source] + best[source + 1:]
+                    candidate.insert(target, best[source])
+                    candidate_cost = self.cost(candidate)
+                    if candidate_cost < best_cost:
+                        best, best_cost, improved = candidate, candidate_cost, True
+                if self._out_of_time():
+                    return best
+            # reverse a segment (2-opt)
+            for start in range(size - 1):
+                for end in range(start + 2, size + 1):
+                    candidate = best[:start] + best[start:end][::-1] + best[end:]
+                    candidate_cost = self.cost(candidate)
+                    if candidate_cost < best_cost:
+                        best, best_cost, improved = candidate, candidate_cost, True
+                if self._out_of_time():
+                    return best
+        return best
+
+    def genetic_algorithm(self, order):
+        try:
+            import pygad
+        except ImportError:
+            print("pygad is not installed, tour not improved by a genetic algorithm")
+            return order
+        size = len(order)
+        randomizer = random.Random(self.seed)
+        population = [list(order)] + [randomizer.sample(range(size), size) for _ in range(19)]
+
+        def fitness(ga_instance, solution, solution_index):
+            solution = [int(gene) for gene in solution]
+            if len(set(solution)) != size:
+                return -float('inf')
+            return -self.cost(solution)
+
+        def on_generation(ga_instance):
+            if self._out_of_time():
+                return "stop"
+
+        ga_instance = pygad.GA(num_generations=500, num_parents_mating=10, fitness_func=fitness,
+                               initial_population=population, gene_type=int, gene_space=list(range(size)),
+                               allow_duplicate_genes=False, mutation_type='swap', crossover_type=None,
+                               keep_elitism=2, on_generation=on_generation, random_seed=self.seed,
+                               suppress_warnings=True)
+        ga_instance.run()
+        solution, _, _ = ga_instance.best_solution()
+        solution = [int(gene) for gene in solution]
+        if len(set(solution)) == size and self.cost(solution) < self.cost(order):
+            return self.local_search(solution)
+        return order
+
+    def optimize(self):
+        self._deadline = time.monotonic() + self.time_budget
+        if len(self.visits) < 3:
+            return list(range(len(self.visits)))
+        order = self.local_search(self.nearest_neighbour())
+        if self.use_genetic_algorithm and not self._out_of_time():
+            order = self.genetic_algorithm(order)
+        return order
+
+    def summary(self, order):
+        travel, lateness = self.schedule(order)
+        legs = list(zip(order, order[1:]))
+        return {'event_ids': [self.visits[position].event_id for position in order],
+                'duration_in_mn': travel,
+                'distance_in_km': int(sum(max(self.distances[origin][destination], 0)
+                                          for origin, destination in legs)),
+                'lateness_in_mn': lateness,
+                'missing_legs': [(self.visits[origin].patient_id, self.visits[destination].patient_id)
+                                 for origin, destination in legs if self.unknown[origin][destination]]}
+
+    def propose(self):
+        """The planned order (by start time) against the proposed one, and what the proposed one saves."""
+        planned = list(range(len(self.visits)))
+        order = self.optimize()
+        if self.cost(order) >= self.cost(planned):
+            order = planned
+        current, proposed = self.summary(planned), self.summary(order)
+        return {'current': current, 'proposed': proposed,
+                'savings_in_mn': current['duration_in_mn'] - proposed['duration_in_mn'],
+                'savings_in_km': current['distance_in_km'] - proposed['distance_in_km']}
+
+
+def tour_proposal_cache_key(employee_id, day):
+    return 'tours:%s:%s' % (employee_id, day)
+
+
+def get_tour_proposal(employee_id, day):
+    try:
+        return cache.get(tour_proposal_cache_key(employee_id, day))
+    except Exception as e:
+        print("Tour proposal of %s on %s unavailable: %s" % (employee_id, day, e))
+        return None
+
+
+@job("default", timeout=600)
+def optimize_employee_tour(employee_id, day, time_budget=10.0, use_genetic_algorithm=False):
+    """
+    Proposes a visit order for the events of an employee on a day and keeps the proposal in the cache for a day.
+    """
+    from invoices.events import Event
+    from invoices.helpers.roster import IDLE_EVENT_STATES
+
+    events = Event.objects.filter(employees_id=employee_id, day=day, patient__isnull=False).exclude(
+        state__in=IDLE_EVENT_STATES).order_by('time_start_event', 'id').values_list(
+        'id', 'patient_id', 'time_start_event', 'time_end_event')
+    visits = [Visit(event_id, patient_id, minutes_since_midnight(start), minutes_since_midnight(end))
+              for event_id, patient_id, start, end in events]
+    proposal = TourOptimizer(visits, time_budget=time_budget, use_genetic_algorithm=use_genetic_algorithm).propose()
+    proposal.update({'employee_id': employee_id, 'day': str(day)})
+    try:
+        cache.set(tour_proposal_cache_key(employee_id, day), proposal, 60 * 60 * 24)
+    except Exception as e:
+        print("Tour proposal of %s on %s not stored: %s" % (employee_id, day, e))
+    return proposal
@@ -0,0 +1,179 @@
+import math
+import re
+from collections import defaultdict
+
+import requests
+from constance import config
+from django.db.models import Q
+
+from invoices.events import Event
+from invoices.helpers.roster import IDLE_EVENT_STATES
+from invoices.models import AlternateAddress, Patient
+from invoices.visitmodels import EmployeeVisit, GeocodedAddress
+
+GEOCODE_URL = "https://api.openrouteservice.org/geocode/search"
+EARTH_RADIUS_IN_M = 6371008.8
+# a visit is a visit to a patient when the phone stopped less than that from the patient address
+VISIT_RADIUS_IN_M = 100
+
+
+def normalize_address(address):
+    """Lower case, without punctuation nor repeated spaces, and with the L- of Luxembourg zip codes."""
+    address = re.sub(r"[,;.]", " ", (address or "").lower())
+    address = re.sub(r"\bl\s*-\s*(\d{4})\b", r"l-\1", address)
+    return " ".join(address.split())[:255]
+
+
+def haversine(latitude, longitude, other_latitude, other_longitude):
+    """Great-circle distance in meters."""
+    latitude, longitude, other_latitude, other_longitude = map(math.radians, (latitude, longitude, other_latitude,
+                                                                              other_longitude))
+    a = math.sin((other_latitude - latitude) / 2) ** 2 + \
+        math.cos(latitude) * math.cos(other_latitude) * math.sin((other_longitude - longitude) / 2) ** 2
+    return 2 * EARTH_RADIUS_IN_M * math.asin(math.sqrt(a))
+
+
+def geocode_with_openrouteservice(address):
+    """(latitude, longitude) of the address, None when it is unknown. Raises when openrouteservice cannot answer."""
+    headers = {
+        "Authorization": config.OPENROUTE_SERVICE_API_KEY,
+        "Content-Type": "application/json",
+    }
+    response = requests.get(GEOCODE_URL, headers=headers, params={"text": address}, timeout=30)
+    response.raise_for_status()
+    features = response.json().get("features")
+    if not features:
+        return None
+    longitude, latitude = features[0]["geometry"]["coordinates"][:2]
+    return latitude, longitude
+
+
+def geocode(addresses, geocoder=geocode_with_openrouteservice):
+    """
+    Coordinates of each address, None when unknown. Addresses already geocoded are read with one query, the other ones
+    are geocoded and stored, so openrouteservice is only asked about new addresses. Addresses it could not find are
+    not stored and are asked again next time.
+    """
+    normalized = {address: normalize_address(address) for address in addresses if address}
+    # rows without coordinates were stored by an earlier version, they are geocoded again
+    known = {row.normalized_address: row for row in GeocodedAddress.objects.filter(
+        normalized_address__in=set(normalized.values()), latitude__isnull=False)}
+    for address, key in normalized.items():
+        if key in known:
+            continue
+        try:
+            coordinates = geocoder(address)
+        except Exception as e:
+            print("Address %s could not be geocoded: %s" % (address, e))
+            continue
+        if not coordinates:
+            print("Address %s not found" % address)
+            continue
+        latitude, longitude = coordinates
+        known[key], _ = GeocodedAddress.objects.update_or_create(normalized_address=key,
+                                                                 defaults={'address': address, 'latitude': latitude,
+                                                                           'longitude': longitude})
+    coordinates = {}
+    for address in addresses:
+        row = known.get(normalized.get(address))
+        coordinates[address] = (row.latitude, row.longitude) if row else None
+    return coordinates
+
+
+class SpatialIndex:
+    """
+    Grid over points given in degrees, with cells at least ``radius`` meters wide: the points within ``radius`` of a
+    location are in its cell or in one of the 8 around it.
+    """
+
+    def __init__(self, points, radius=VISIT_RADIUS_IN_M):
+        self.radius = radius
+        self.points = list(points)
+        highest_latitude = max([abs(latitude) for latitude, longitude, value in self.points], default=0)
+        self.latitude_step = math.degrees(radius / EARTH_RADIUS_IN_M)
+        self.longitude_step = self.latitude_step / max(math.cos(math.radians(min(highest_latitude + 1, 89))), 0.01)
+        self.cells = defaultdict(list)
+        for point in self.points:
+            self.cells[self._cell(point[0], point[1])].append(point)
+
+    def _cell(self, latitude, longitude):
+        return math.floor(latitude / self.latitude_step), math.floor(longitude / self.longitude_step)
+
+    def nearest(self, latitude, longitude):
+        """(distance in meters, value) of the nearest point within the radius, None when there is none."""
+        row, column = self._cell(latitude, longitude)
+        best = None
+        for neighbour in ((row + i, column + j) for i in (-1, 0, 1) for j in (-1, 0, 1)):
+            for point_latitude, point_longitude, value in self.cells.get(neighbour, ()):
+                distance = haversine(latitude, longitude, point_latitude, point_longitude)
+                if distance <= self.radius and (best is None or distance < best[0]):
+                    best = (distance, value)
+        return best
+
+
+def patient_addresses(patient_ids, days):
+    """Address of each patient on each day, alternate addresses included, in two queries."""
+    patients = Patient.objects.filter(id__in=patient_ids).only('address', 'zipcode', 'city', 'country')
+    alternates = defaultdict(list)
+    first, last = min(days), max(days)
+    for alternate in AlternateAddress.objects.filter(patient_id__in=patient_ids, start_date__lte=last).filter(
+            Q(end_date__gte=first) | Q(end_date__isnull=True)).order_by('start_date'):
+        alternates[alternate.patient_id].append(alternate)
+    addresses = {}
+    for patient in patients:
+        for day in days:
+            address = patient.full_address
+            for alternate in alternates[patient.id]:
+                if alternate.start_date <= day and (alternate.end_date is None or alternate.end_date >= day):
+                    address = alternate.full_address
+            addresses[(patient.id, day)] = address
+    return addresses
+
+
+def match_visits(visits, radius=VISIT_RADIUS_IN_M, geocoder=geocode_with_openrouteservice):
+    """
+    Sets the patient of each finished visit to the nearest patient the employee had to visit that day, when the visit
+    is within ``radius`` meters of the patient address. All the visits are matched in one pass: the events of all the
+    employees on all the days are read with one query, addresses are geocoded once (see ``geocode``) and each
+    employee-day gets its own ``SpatialIndex``. Returns the patient found for each visit id.
+    """
+    visits = [visit for visit in visits if visit.departure_date_time]
+    if not visits:
+        return {}
+    user_ids = {visit.user_id for visit in visits}
+    days = {visit.arrival_date_time.date() for visit in visits}
+    events = list(Event.objects.filter(day__in=days, employees__user_id__in=user_ids, patient__isnull=False).exclude(
+        state__in=IDLE_EVENT_STATES).values_list('day', 'employees__user_id', 'patient_id', 'event_address',
+                                                 'at_office'))
+    addresses = patient_addresses({event[2] for event in events}, days)
+    planned = defaultdict(set)
+    for day, user_id, patient_id, event_address, at_office in events:
+        # same address as Event.get_event_address
+        address = event_address if event_address or at_office else addresses.get((patient_id, day))
+        if address:
+            planned[(user_id, day)].add((patient_id, address))
+    coordinates = geocode({address for patients in planned.values() for patient_id, address in patients},
+                          geocoder=geocoder)
+    indexes = {key: SpatialIndex([coordinates[address] + (patient_id,) for patient_id, address in patients
+                                  if coordinates.get(address)], radius=radius)
+               for key, patients in planned.items()}
+    found, matched = {}, []
+    for visit in visits:
+        index = indexes.get((visit.user_id, visit.arrival_date_time.date()))
+        nearest = index.nearest(visit.latitude, visit.longitude) if index else None
+        if nearest is None:
+            print(f"Visit {visit.id} is not a visit to a patient planned that day")
+            found[visit.id] = None
+            continue
+        distance, patient_id = nearest
+        found[visit.id] = patient_id
+        if visit.patient_id != patient_id:
+            visit.patient_id = patient_id
+            matched.append(visit)
+        print(f"Visit {visit.id} is a visit to patient {patient_id} ({int(distance)} meters)")
+    EmployeeVisit.objects.bulk_update(matched, ['patient'])
+    patients = Patient.objects.in_bulk({patient_id for patient_id in found.values() if patient_id})
+    for visit in visits:
+        if found.get(visit.id):
+            visit.patient = patients[found[visit.id]]
+    return {visit_id: patients.get(patient_id) for visit_id, patient_id in found.items()}
@@ -1,15 +1,17 @@
 import os
+import tempfile
+from bisect import bisect_left
 from email.mime.application import MIMEApplication
 
-from django.core.files.base import ContentFile
+from django.core.files import File
 from django.core.mail import EmailMessage
-from django.db import models
+from django.db import models, transaction
 from django.utils.translation import gettext_lazy as _
 from django_rq import job
 
 from invoices import settings
 from invoices.employee import Employee
-from invoices.helpers.pdf import extract_individual_paylip_pdf
+from invoices.helpers.pdf import split_payslips
 
 
 # from scripts.extract_salaries_from_pdf import read_pdf
@@ -32,39 +34,75 @@ class EmployeesMonthlyPayslipFile(models.Model):
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
 
-        # Open the file from the FileField
-        with self.file.open('rb') as file_obj:
-            payslips = extract_individual_paylip_pdf(file_obj)
-        if payslips is None:
-            raise ValueError("No payslips found in the PDF file")
-
-        # Process the extracted payslips asynchronously if not local environment
+        # Split the file in the worker if not local environment, once the row can be read by the worker
         if os.environ.get('LOCAL_ENV', None):
-            _process_extracted_payslip(employeesMonthlyPayslipFileInstance=self,
-                                            payslips=payslips)
+            transaction.on_commit(lambda: split_monthly_payslip_file(self.pk))
         else:
-            _process_extracted_payslip.delay(employeesMonthlyPayslipFileInstance=self,
-                                                  payslips=payslips)
+            transaction.on_commit(lambda: split_monthly_payslip_file.delay(self.pk))
+
+
+class EmployeeNameIndex:
+    """
+    Employees looked up by the first word of the name printed on a payslip, like ``user__last_name__istartswith``,
+    from their last names loaded in one query.
+    """
+
+    def __init__(self):
+        employees = sorted(((employee.user.last_name.lower(), employee.id, employee)
+                            for employee in Employee.objects.select_related('user')), key=lambda row: row[:2])
+        self.last_names = [last_name for last_name, employee_id, employee in employees]
+        self.employees = [employee for last_name, employee_id, employee in employees]
+
+    def find(self, name):
+        """Employees whose last name starts with the first word of ``name``."""
+        prefix = name.split()[0].lower() if name.split() else ''
+        position = bisect_left(self.last_names, prefix)
+        found = []
+        while position < len(self.last_names) and self.last_names[position].startswith(prefix):
+            found.append(self.employees[position])
+            position += 1
+        return found
 
 
 @job("default", timeout=6000)
-def _process_extracted_payslip(employeesMonthlyPayslipFileInstance, payslips):
-    for name, pdf_data in payslips.items():
-        print("Processing payslip for %s" % name)
-        employee = Employee.objects.get(user__last_name__istartswith=name.split()[0])
-        if not employee:
-            raise ValueError(f"Employee with last name {name.split()[0]} not found")
-        payslip, created = EmployeePaySlip.objects.get_or_create(employee=employee, year=employeesMonthlyPayslipFileInstance.year,
-                                  month=employeesMonthlyPayslipFileInstance.month)
-
-        # Create a ContentFile object from the PDF data
-        pdf_file = ContentFile(pdf_data,
-                               name=f"{employeesMonthlyPayslipFileInstance.year}_{employeesMonthlyPayslipFileInstance.month}_{name.replace(' ', '_')}_payslip.pdf")
-
-        # Save the PDF file to the file field of the EmployeePaySlip object
-        payslip.file.save(pdf_file.name, pdf_file)
-
-        payslip.save()
+def split_monthly_payslip_file(payslip_file_id, processes=None):
+    """
+    Splits a monthly payslip file into the EmployeePaySlip of each employee: the pages are split by a pool of
+    processes (see invoices.helpers.pdf.split_payslips) and each payslip is stored as soon as its page is written.
+    """
+    monthly_file = EmployeesMonthlyPayslipFile.objects.get(pk=payslip_file_id)
+    employees = EmployeeNameIndex()
+    payslips = {payslip.employee_id: payslip for payslip in
+                EmployeePaySlip.objects.filter(year=monthly_file.year, month=monthly_file.month)}
+    stored_pages = {}
+    unknown_names = []
+    with tempfile.TemporaryDirectory() as directory:
+        pdf_path = os.path.join(directory, 'payslips.pdf')
+        with monthly_file.file.open('rb') as source, open(pdf_path, 'wb') as destination:
+            for chunk in source.chunks():
+                destination.write(chunk)
+        for page_number, name, path in split_payslips(pdf_path, directory, processes=processes):
+            print("Processing payslip for %s" % name)
+            found = employees.find(name)
+            if len(found) != 1:
+                print("%s employees found for the payslip of %s on page %s" % (len(found), name, page_number))
+                unknown_names.append(name)
+                continue
+            employee = found[0]
+            # when an employee has several pages, the last one is kept
+            if stored_pages.get(employee.id, 0) > page_number:
+                continue
+            payslip = payslips.get(employee.id) or EmployeePaySlip(employee=employee, year=monthly_file.year,
+                                                                  month=monthly_file.month)
+            with open(path, 'rb') as pdf_file:
+                payslip.file.save(f"{monthly_file.year}_{monthly_file.month}_{name.replace(' ', '_')}_payslip.pdf",
+                                  File(pdf_file))
+            os.remove(path)
+            payslips[employee.id] = payslip
+            stored_pages[employee.id] = page_number
+    if unknown_names:
+        raise ValueError(f"Employees not found for the payslips of {unknown_names}")
+    return len(stored_pages)
 
 
 class EmployeePaySlip(models.Model):
@@ -11,6 +11,7 @@ import json
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 import os
 import sys
+import tempfile
 
 import dj_database_url
 from dotenv import load_dotenv
@@ -336,6 +337,11 @@ AWS_ACCESS_KEY_ID = os.environ['AWS_ACCESS_KEY_ID']
 AWS_SECRET_ACCESS_KEY = os.environ['AWS_SECRET_ACCESS_KEY']
 AWS_STORAGE_BUCKET_NAME = os.environ['AWS_STORAGE_BUCKET_NAME']
 
+# Local copies of the prescription files and thumbnails embedded in the batch pdfs, see invoices/helpers/filecache.py
+STORAGE_FILE_CACHE_DIR = os.environ.get('STORAGE_FILE_CACHE_DIR',
+                                        os.path.join(tempfile.gettempdir(), 'inur-storage-file-cache'))
+STORAGE_FILE_CACHE_MAX_SIZE = int(os.environ.get('STORAGE_FILE_CACHE_MAX_SIZE', 512 * 1024 * 1024))
+
 # GOOGLE CHAT WEBHOOK CONFIGURATION
 GOOGLE_CHAT_WEBHOOK_URL = os.environ['GOOGLE_CHAT_WEBHOOK_URL']
 
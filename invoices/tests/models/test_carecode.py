@@ -1,5 +1,8 @@
+from datetime import date, datetime
+from decimal import Decimal
+
 from django.test import TestCase
-from invoices.models import CareCode
+from invoices.models import CareCode, ValidityDate
 
 
 class CareCodeTestCase(TestCase):
@@ -13,3 +16,35 @@ class CareCodeTestCase(TestCase):
 
     def test_autocomplete(self):
         self.assertEqual(CareCode.autocomplete_search_fields(), ('name', 'code'))
+
+
+class CareCodeGrossAmountTestCase(TestCase):
+    def setUp(self):
+        self.care_code = CareCode.objects.create(code='code', name='some name', description='description')
+        ValidityDate.objects.create(care_code=self.care_code, start_date=date(2022, 1, 1),
+                                    end_date=date(2022, 12, 31), gross_amount=10)
+        ValidityDate.objects.create(care_code=self.care_code, start_date=date(2023, 1, 1), gross_amount=12)
+        ValidityDate.objects.create(care_code=self.care_code, start_date=date(2023, 6, 1),
+                                    end_date=date(2023, 6, 30), gross_amount=15)
+
+    def test_gross_amount_date_based(self):
+        self.assertEqual(0, self.care_code.gross_amount_date_based(date(2021, 12, 31)))
+        self.assertEqual(10, self.care_code.gross_amount_date_based(date(2022, 12, 31)))
+        self.assertEqual(12, self.care_code.gross_amount_date_based(date(2023, 5, 31)))
+        self.assertEqual(15, self.care_code.gross_amount_date_based(date(2023, 6, 15)))
+        self.assertEqual(12, self.care_code.gross_amount_date_based(date(2023, 7, 1)))
+        self.assertEqual(0, self.care_code.gross_amount_date_based(None))
+
+    def test_gross_amount_uses_price_index(self):
+        when = datetime(2023, 6, 15, 10, 0)
+        self.care_code.gross_amount(when)
+        with self.assertNumQueries(0):
+            self.assertEqual(15, self.care_code.gross_amount(when))
+            self.assertEqual(Decimal('13.20'), self.care_code.net_amount(when, False, True))
+
+    def test_price_index_invalidated_on_change(self):
+        self.assertEqual(12, self.care_code.gross_amount_date_based(date(2024, 1, 1)))
+        ValidityDate.objects.filter(start_date=date(2023, 1, 1)).get().delete()
+        self.assertEqual(0, self.care_code.gross_amount_date_based(date(2024, 1, 1)))
+        ValidityDate.objects.create(care_code=self.care_code, start_date=date(2024, 1, 1), gross_amount=20)
+        self.assertEqual(20, self.care_code.gross_amount_date_based(date(2024, 1, 1)))
@@ -0,0 +1,73 @@
+from datetime import date, time
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from invoices.employee import Employee, JobPosition
+from invoices.events import Event, GenericTaskDescription, EventLinkToCareCode, duplicate_events
+from invoices.models import CareCode, Patient
+
+
+class DuplicateEventsTestCase(TestCase):
+    def setUp(self):
+        user = User.objects.create_user('testuser', email='testuser@test.com', password='testing')
+        self.employee = Employee.objects.bulk_create([Employee(id=1, user=user, start_contract=date(2023, 1, 1),
+                                                               provider_code='300744-44',
+                                                               occupation=JobPosition.objects.create(name='nurse'))])[0]
+        self.patient = Patient.objects.bulk_create([Patient(code_sn='1945010112345', first_name='first name',
+                                                            name='name')])[0]
+        self.care_code = CareCode.objects.create(code='N101', name='some name', description='description',
+                                                 reimbursed=True)
+
+    def _create_events(self, days, employee=None):
+        events = Event.objects.bulk_create(
+            [Event(day=day, time_start_event=time(8, 0), time_end_event=time(8, 30), patient=self.patient,
+                   employees=employee, notes='notes') for day in days])
+        GenericTaskDescription.objects.bulk_create([GenericTaskDescription(event=event, name='task %s' % i)
+                                                    for event in events for i in range(2)])
+        EventLinkToCareCode.objects.bulk_create([EventLinkToCareCode(event=event, care_code=self.care_code)
+                                                 for event in events])
+        return events
+
+    def test_duplicate_with_child_rows(self):
+        event = self._create_events([date(2023, 3, 1)], employee=self.employee)[0]
+        events_created = duplicate_events([(event, date(2023, 3, 2)), (event, date(2023, 3, 3))],
+                                          created_by='duplicate_event_for_next_day')
+        self.assertEqual(2, len(events_created))
+        for new_event in Event.objects.filter(id__in=[e.id for e in events_created]):
+            self.assertEqual(self.employee, new_event.employees)
+            self.assertEqual(self.patient, new_event.patient)
+            self.assertEqual('notes', new_event.notes)
+            self.assertEqual('duplicate_event_for_next_day', new_event.created_by)
+            self.assertEqual(['task 0', 'task 1'],
+                             sorted(new_event.generictaskdescription_set.values_list('name', flat=True)))
+            self.assertEqual([self.care_code.id],
+                             list(new_event.eventlinktocarecode_set.values_list('care_code_id', flat=True)))
+
+    def test_existing_events_are_not_duplicated_again(self):
+        event = self._create_events([date(2023, 3, 1)], employee=self.employee)[0]
+        self.assertIsNotNone(event.duplicate_event_for_next_day(1))
+        self.assertIsNone(event.duplicate_event_for_next_day(1))
+        self.assertEqual(1, Event.objects.filter(day=date(2023, 3, 2)).count())
+
+    def test_repeat_event_for_all_days_of_week(self):
+        # wednesday
+        event = self._create_events([date(2023, 3, 1)], employee=self.employee)[0]
+        events_created = event.repeat_event_for_all_days_of_week(event.day)
+        self.assertEqual([date(2023, 2, 27), date(2023, 2, 28), date(2023, 3, 2), date(2023, 3, 3),
+                          date(2023, 3, 4), date(2023, 3, 5)], [e.day for e in events_created])
+        self.assertEqual([], event.repeat_event_for_all_days_of_week(event.day))
+
+    def test_query_count_does_not_depend_on_events(self):
+        small = self._create_events([date(2023, 3, 1)])
+        large = self._create_events([date(2023, 4, day) for day in range(1, 21)])
+        with CaptureQueriesContext(connection) as small_queries:
+            duplicate_events([(event, event.day.replace(day=event.day.day + 7)) for event in small], created_by='test')
+        with CaptureQueriesContext(connection) as large_queries:
+            events_created = duplicate_events([(event, event.day.replace(month=5)) for event in large],
+                                              created_by='test')
+        self.assertEqual(20, len(events_created))
+        self.assertEqual(40, GenericTaskDescription.objects.filter(event__in=events_created).count())
+        self.assertEqual(len(small_queries), len(large_queries))
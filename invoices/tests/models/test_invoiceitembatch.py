@@ -1,9 +1,12 @@
-from datetime import datetime
+from datetime import date, datetime
+from zoneinfo import ZoneInfo
 
 from django.test import TestCase
 from django.utils import timezone
 
-from invoices.models import Patient, InvoiceItem, InvoiceItemBatch
+from invoices.enums.event import EventTypeEnum
+from invoices.events import Event
+from invoices.models import Patient, InvoiceItem, InvoiceItemBatch, CareCode, Prestation
 from invoices.modelspackage import InvoicingDetails
 
 
@@ -107,3 +110,53 @@ class InvoiceItemBatchTestCase(TestCase):
     #     batch_december.delete()
     #     batch_october.delete()
     #     batch_all.delete()
+
+
+class EventsDuringBatchPeriodsTestCase(TestCase):
+    def setUp(self):
+        self.patient = Patient.objects.bulk_create([Patient(code_sn='1945010112345', first_name='first name',
+                                                            name='name')])[0]
+        self.patient_under_dependence = Patient.objects.bulk_create(
+            [Patient(code_sn='1945010154321', first_name='first name', name='dependant',
+                     is_under_dependence_insurance=True)])[0]
+        invoice_details = InvoicingDetails.objects.create(provider_code="111111", name="BEST.lu",
+                                                          address="Sesame Street",
+                                                          zipcode_city="1234 Sesame Street",
+                                                          bank_account="LU12 3456 7890 1234 5678")
+        self.invoice = InvoiceItem.objects.create(invoice_number='1', invoice_date=date(2023, 3, 31),
+                                                  invoice_details=invoice_details, patient=self.patient)
+        self.care_code = CareCode.objects.create(code='N101', name='some name', description='description',
+                                                 reimbursed=True)
+        self.batch = InvoiceItemBatch.objects.bulk_create(
+            [InvoiceItemBatch(start_date=date(2023, 3, 1), end_date=date(2023, 3, 31))])[0]
+
+    def _create_events(self, days, patient=None, event_type_enum=EventTypeEnum.CARE):
+        return Event.objects.bulk_create([Event(day=date(2023, 3, day), patient=patient or self.patient,
+                                                event_type_enum=event_type_enum) for day in days])
+
+    def _create_prestations(self, days, hour=9):
+        Prestation.objects.bulk_create(
+            [Prestation(invoice_item=self.invoice, carecode=self.care_code, employee=None,
+                        date=datetime(2023, 3, day, hour, 30, tzinfo=ZoneInfo("Europe/Luxembourg")))
+             for day in days])
+
+    def test_events_without_prestations(self):
+        dirty_events = self._create_events([2, 4])
+        self._create_events([3])
+        self._create_events([5], patient=self.patient_under_dependence)
+        self._create_events([6], event_type_enum=EventTypeEnum.BIRTHDAY)
+        self._create_prestations([3])
+        # late in the evening in Luxembourg is still the same day
+        self._create_prestations([1], hour=23)
+        self._create_events([1])
+        self.assertEqual([event.id for event in dirty_events],
+                         [event.id for event in self.batch.events_during_batch_periods()])
+
+    def test_query_count_does_not_depend_on_events(self):
+        self._create_events(range(1, 32))
+        self._create_prestations(range(1, 32, 2))
+        with self.assertNumQueries(1):
+            dirty_events = self.batch.events_during_batch_periods()
+            for event in dirty_events:
+                str(event.patient), event.employees
+        self.assertEqual(15, len(dirty_events))
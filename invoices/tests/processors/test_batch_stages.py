@@ -0,0 +1,44 @@
+import shutil
+import tempfile
+from datetime import date
+
+from django.test import TestCase, override_settings
+
+from invoices.models import InvoiceItemBatch
+from invoices.processors.tasks import BATCH_STAGE_BUILDERS, process_batch_stage, record_batch_stage
+
+MEDIA_ROOT = tempfile.mkdtemp()
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage')
+class BatchStagesTestCase(TestCase):
+    def setUp(self):
+        # bulk_create does not send post_save, which would dispatch the stages through redis
+        self.batch = InvoiceItemBatch.objects.bulk_create([
+            InvoiceItemBatch(start_date=date(2023, 3, 1), end_date=date(2023, 3, 31), batch_description='test',
+                             version=2, stage_timings={'version': 2, 'stages': {}})])[0]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def test_stage_stores_its_file_and_timing(self):
+        timings = process_batch_stage(self.batch.id, 2, 'prefac_file')
+        self.batch.refresh_from_db()
+        self.assertTrue(self.batch.prefac_file.name)
+        self.assertEqual('done', timings['stages']['prefac_file']['status'])
+        self.assertEqual(timings, self.batch.stage_timings)
+        self.assertFalse(self.batch.generated_invoice_files)
+
+    def test_outdated_stage_is_skipped(self):
+        self.assertIsNone(process_batch_stage(self.batch.id, 1, 'prefac_file'))
+        self.batch.refresh_from_db()
+        self.assertFalse(self.batch.prefac_file)
+        self.assertEqual({}, self.batch.stage_timings['stages'])
+
+    def test_stages_do_not_overwrite_each_other(self):
+        for stage in BATCH_STAGE_BUILDERS:
+            record_batch_stage(self.batch.id, 2, stage, 'done', 1.5)
+        self.batch.refresh_from_db()
+        self.assertEqual(set(BATCH_STAGE_BUILDERS), set(self.batch.stage_timings['stages']))
@@ -0,0 +1,279 @@
+import itertools
+from datetime import date, time, timedelta
+
+import httplib2
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.utils import timezone
+from googleapiclient.errors import HttpError
+
+from invoices.employee import Employee, JobPosition
+from invoices.events import Event, GoogleCalendarOutbox, GoogleCalendarSyncState
+from invoices.models import Patient
+from invoices.processors.gcalendar import drain_google_calendar_outbox, reconcile_google_calendars, \
+    GOOGLE_CALENDAR_OUTBOX_RETENTION
+
+
+class FakeRequest:
+    def __init__(self, call, *args):
+        self.call = call
+        self.args = args
+
+    def execute(self):
+        return self.call(*self.args)
+
+
+class FakeEvents:
+    def __init__(self, service):
+        self.service = service
+
+    def insert(self, calendarId, body):
+        return FakeRequest(self.service.insert, calendarId, body)
+
+    def update(self, calendarId, eventId, body):
+        return FakeRequest(self.service.update, calendarId, eventId, body)
+
+    def delete(self, calendarId, eventId):
+        return FakeRequest(self.service.delete, calendarId, eventId)
+
+    def list(self, calendarId, syncToken=None, timeMin=None, pageToken=None):
+        return FakeRequest(self.service.list, calendarId, syncToken, pageToken)
+
+
+class FakeBatch:
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        self.service.http_round_trips += 1
+        for request_id, request in self.requests:
+            try:
+                self.callback(request_id, request.execute(), None)
+            except HttpError as e:
+                self.callback(request_id, None, e)
+
+
+class FakeCalendarService:
+    """
+    In memory calendar api answering the calls made by the outbox drain.
+    """
+
+    page_size = 2
+
+    def __init__(self):
+        self.calendars = {}
+        self.http_round_trips = 0
+        self.ids = itertools.count(1)
+        # sequence number of the last change of each google event, deleted ones included
+        self.changes = {}
+        self.sequence = itertools.count(1)
+        self.list_calls = 0
+
+    def events(self):
+        return FakeEvents(self)
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self, callback)
+
+    def _get(self, calendar_id, event_id):
+        try:
+            return self.calendars[calendar_id][event_id]
+        except KeyError:
+            raise HttpError(httplib2.Response({'status': 404}), b'Not Found')
+
+    def insert(self, calendar_id, body):
+        event_id = 'g%s' % next(self.ids)
+        google_event = dict(body, id=event_id, htmlLink='https://calendar/%s' % event_id)
+        self.calendars.setdefault(calendar_id, {})[event_id] = google_event
+        self.changes.setdefault(calendar_id, {})[event_id] = next(self.sequence)
+        return google_event
+
+    def update(self, calendar_id, event_id, body):
+        google_event = self._get(calendar_id, event_id)
+        google_event.update(body)
+        self.changes[calendar_id][event_id] = next(self.sequence)
+        return google_event
+
+    def delete(self, calendar_id, event_id):
+        self._get(calendar_id, event_id)
+        del self.calendars[calendar_id][event_id]
+        self.changes[calendar_id][event_id] = next(self.sequence)
+        return ''
+
+    def list(self, calendar_id, sync_token, page_token):
+        self.list_calls += 1
+        if calendar_id not in self.calendars:
+            raise HttpError(httplib2.Response({'status': 404}), b'Not Found')
+        if sync_token == 'expired':
+            raise HttpError(httplib2.Response({'status': 410}), b'Gone')
+        changes = self.changes[calendar_id]
+        changed_ids = sorted((event_id for event_id, sequence in changes.items()
+                              if sync_token and sequence > int(sync_token)
+                              or not sync_token and event_id in self.calendars[calendar_id]),
+                             key=changes.get)
+        start = int(page_token or 0)
+        items = [self.calendars[calendar_id].get(event_id, {'id': event_id, 'status': 'cancelled'})
+                 for event_id in changed_ids[start:start + self.page_size]]
+        if start + self.page_size < len(changed_ids):
+            return {'items': items, 'nextPageToken': str(start + self.page_size)}
+        return {'items': items, 'nextSyncToken': str(max(changes.values(), default=0))}
+
+
+class GoogleCalendarOutboxTestCase(TestCase):
+    def setUp(self):
+        jobposition = JobPosition.objects.create(name='nurse')
+        self.employees = Employee.objects.bulk_create(
+            [Employee(user=User.objects.create_user('nurse%s' % i, email='nurse%s@test.com' % i),
+                      abbreviation='N%s' % i, start_contract=date(2023, 1, 1), occupation=jobposition)
+             for i in range(2)])
+        self.patient = Patient.objects.bulk_create([Patient(code_sn='1945010112345', first_name='first name',
+                                                            name='name')])[0]
+        self.service = FakeCalendarService()
+
+    def _create_event(self, day=1):
+        return Event.objects.create(day=date(2023, 3, day), time_start_event=time(8, 0), time_end_event=time(8, 30),
+                                    patient=self.patient, employees=self.employees[0])
+
+    def test_saving_an_event_only_writes_the_outbox(self):
+        event = self._create_event()
+        self.assertEqual([(event.id, GoogleCalendarOutbox.UPSERT)],
+                         list(GoogleCalendarOutbox.objects.values_list('event_id', 'action')))
+        self.assertEqual(0, self.service.http_round_trips)
+
+    def test_changes_of_an_event_are_coalesced(self):
+        events = [self._create_event(day) for day in range(1, 4)]
+        for note in ('first', 'second'):
+            events[0].notes = note
+            events[0].save()
+        updated_on = events[0].updated_on
+        report = drain_google_calendar_outbox(service=self.service)
+        self.assertEqual(3, report.inserted)
+        self.assertEqual(1, self.service.http_round_trips)
+        self.assertEqual(3, len(self.service.calendars['nurse0@test.com']))
+        events[0].refresh_from_db()
+        self.assertIn('second', self.service.calendars['nurse0@test.com'][events[0].calendar_id]['description'])
+        self.assertEqual('https://calendar/%s' % events[0].calendar_id, events[0].calendar_url)
+        # the planning feed sees the new link
+        self.assertGreater(events[0].updated_on, updated_on)
+        self.assertFalse(GoogleCalendarOutbox.objects.filter(processed_on__isnull=True).exists())
+        # writing back the google ids does not fill the outbox again
+        self.assertEqual(0, drain_google_calendar_outbox(service=self.service).entries)
+
+    def test_event_moved_to_another_employee(self):
+        event = self._create_event()
+        drain_google_calendar_outbox(service=self.service)
+        event.refresh_from_db()
+        event.employees = self.employees[1]
+        event.save()
+        report = drain_google_calendar_outbox(service=self.service)
+        self.assertEqual((1, 1), (report.deleted, report.inserted))
+        self.assertEqual({}, self.service.calendars['nurse0@test.com'])
+        self.assertEqual(1, len(self.service.calendars['nurse1@test.com']))
+
+    def test_deleted_event_and_missing_google_event(self):
+        kept, deleted = self._create_event(1), self._create_event(2)
+        drain_google_calendar_outbox(service=self.service)
+        kept.refresh_from_db()
+        deleted.refresh_from_db()
+        # removed on google by someone
+        del self.service.calendars['nurse0@test.com'][kept.calendar_id]
+        kept.save()
+        deleted.delete()
+        report = drain_google_calendar_outbox(service=self.service)
+        self.assertEqual((1, 1, 0), (report.deleted, report.inserted, report.updated))
+        kept.refresh_from_db()
+        self.assertEqual([kept.calendar_id], list(self.service.calendars['nurse0@test.com']))
+
+
+    def test_entries_are_claimed_while_google_is_called(self):
+        self._create_event()
+        claimed = []
+        insert = self.service.insert
+
+        def insert_and_check_claim(calendar_id, body):
+            claimed.extend(GoogleCalendarOutbox.objects.values_list('claimed_on', flat=True))
+            return insert(calendar_id, body)
+
+        self.service.insert = insert_and_check_claim
+        drain_google_calendar_outbox(service=self.service)
+        self.assertEqual(1, len(claimed))
+        self.assertIsNotNone(claimed[0])
+        self.assertIsNone(GoogleCalendarOutbox.objects.get().claimed_on)
+
+    def test_processed_entries_are_purged_after_the_retention(self):
+        old_event, event = self._create_event(1), self._create_event(2)
+        drain_google_calendar_outbox(service=self.service)
+        GoogleCalendarOutbox.objects.filter(event_id=old_event.id).update(
+            processed_on=timezone.now() - GOOGLE_CALENDAR_OUTBOX_RETENTION - timedelta(days=1))
+        report = drain_google_calendar_outbox(service=self.service)
+        self.assertEqual(1, report.purged)
+        self.assertEqual([event.id], list(GoogleCalendarOutbox.objects.values_list('event_id', flat=True)))
+
+
+class ReconcileGoogleCalendarsTestCase(TestCase):
+    def setUp(self):
+        jobposition = JobPosition.objects.create(name='nurse')
+        self.employee = Employee.objects.bulk_create(
+            [Employee(user=User.objects.create_user('nurse', email='nurse@test.com'), abbreviation='N',
+                      start_contract=date(2023, 1, 1), occupation=jobposition)])[0]
+        self.patient = Patient.objects.bulk_create([Patient(code_sn='1945010112345', first_name='first name',
+                                                            name='name')])[0]
+        self.service = FakeCalendarService()
+        self.events = [Event.objects.create(day=date(2023, 3, day), time_start_event=time(8, 0),
+                                            time_end_event=time(8, 30), patient=self.patient,
+                                            employees=self.employee) for day in range(1, 6)]
+        drain_google_calendar_outbox(service=self.service)
+        for event in self.events:
+            event.refresh_from_db()
+
+    def test_only_changes_are_listed_after_the_first_run(self):
+        report = reconcile_google_calendars(service=self.service)
+        self.assertEqual((['nurse@test.com'], 5), (report.full_syncs, report.changed_google_events))
+        self.assertEqual([], report.orphans + report.stale_copies + report.removed_from_google)
+        self.assertEqual([], report.different_times)
+        self.assertEqual(str(max(self.service.changes['nurse@test.com'].values())),
+                         GoogleCalendarSyncState.objects.get(calendar='nurse@test.com').sync_token)
+        self.assertEqual(0, reconcile_google_calendars(service=self.service).changed_google_events)
+
+    def test_differences_are_reported(self):
+        reconcile_google_calendars(service=self.service)
+        moved, removed, orphan = self.events[0], self.events[1], self.events[2]
+        google_events = self.service.calendars['nurse@test.com']
+        self.service.update('nurse@test.com', moved.calendar_id,
+                            {'start': {'dateTime': '2023-03-01T09:00:00+01:00'}})
+        self.service.delete('nurse@test.com', removed.calendar_id)
+        orphan_google_id = orphan.calendar_id
+        # deleted without going through the outbox
+        Event.objects.filter(pk=orphan.pk).delete()
+        self.service.update('nurse@test.com', orphan_google_id, {})
+        with self.assertNumQueries(4):
+            report = reconcile_google_calendars(service=self.service, delete_orphans=True)
+        self.assertEqual(3, report.changed_google_events)
+        self.assertEqual([moved], report.different_times)
+        self.assertEqual([removed], report.removed_from_google)
+        self.assertEqual([orphan_google_id], [google_event['gId'] for google_event in report.orphans])
+        self.assertEqual(1, report.deleted_orphans)
+        self.assertNotIn(orphan_google_id, google_events)
+
+    def test_cleanup_deletes_orphans_unless_dry_run(self):
+        reconcile_google_calendars(service=self.service)
+        orphan_google_id = self.events[0].calendar_id
+        Event.objects.filter(pk=self.events[0].pk).delete()
+        self.service.update('nurse@test.com', orphan_google_id, {})
+        report = self.events[1].cleanup_all_events_on_google(dry_run=True, service=self.service)
+        self.assertEqual((1, 1, 0), (report.changed_google_events, len(report.orphans), report.deleted_orphans))
+        self.assertIn(orphan_google_id, self.service.calendars['nurse@test.com'])
+        self.service.update('nurse@test.com', orphan_google_id, {})
+        report = self.events[1].cleanup_all_events_on_google(dry_run=False, service=self.service)
+        self.assertEqual(1, report.deleted_orphans)
+        self.assertNotIn(orphan_google_id, self.service.calendars['nurse@test.com'])
+
+    def test_expired_sync_token(self):
+        GoogleCalendarSyncState.objects.create(calendar='nurse@test.com', sync_token='expired')
+        report = reconcile_google_calendars(service=self.service)
+        self.assertEqual((['nurse@test.com'], 5), (report.full_syncs, report.changed_google_events))
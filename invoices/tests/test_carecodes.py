@@ -0,0 +1,78 @@
+import io
+from datetime import date
+from decimal import Decimal
+
+from django.test import TestCase
+
+from invoices.actions.carecodes import import_care_code_prices, read_care_code_prices
+from invoices.models import CareCode, ValidityDate
+
+TARIFF = """1 - Prélèvements et analyses
+Désignation;Code;Coefficient;Tarif;
+Prélèvement pour analyse microbiologique;N101;2.55;21,50;
+Prélèvement de selles pour analyses;N103;2.55;21.5;
+Soin inconnu;N999;1;3.00;
+"""
+
+
+class ImportCareCodePricesTestCase(TestCase):
+    def setUp(self):
+        self.known, self.new = CareCode.objects.bulk_create([
+            CareCode(code=code, name=code, description=code, reimbursed=True) for code in ('N101', 'N103')])
+        ValidityDate.objects.create(care_code=self.known, start_date=date(2023, 4, 1), gross_amount=19.3)
+
+    def _import(self, start_date=date(2023, 9, 1), **kwargs):
+        return import_care_code_prices(io.StringIO(TARIFF), start_date, **kwargs)
+
+    def test_prices_are_closed_and_opened(self):
+        self.assertEqual(Decimal('19.3'), self.known.gross_amount_date_based(date(2023, 9, 1)))
+        with self.assertNumQueries(6):
+            diff = self._import()
+        self.assertEqual(['N999'], diff.unknown_codes)
+        self.assertEqual(1, len(diff.invalid_rows))
+        self.assertEqual((2, 1, 0), (len(diff.created), len(diff.closed), len(diff.updated)))
+        self.assertEqual([(date(2023, 4, 1), date(2023, 8, 31), Decimal('19.3')),
+                          (date(2023, 9, 1), None, Decimal('21.5'))],
+                         list(self.known.validity_dates.order_by('start_date').values_list(
+                             'start_date', 'end_date', 'gross_amount')))
+        self.assertEqual(Decimal('19.3'), self.known.gross_amount_date_based(date(2023, 8, 31)))
+        self.assertEqual(Decimal('21.5'), self.known.gross_amount_date_based(date(2023, 9, 1)))
+        self.assertEqual(Decimal('21.5'), self.new.gross_amount_date_based(date(2024, 1, 1)))
+        # applying the file again changes nothing
+        diff = self._import()
+        self.assertEqual((0, 0, 0, 2), (len(diff.created), len(diff.closed), len(diff.updated), len(diff.unchanged)))
+        self.assertEqual(3, ValidityDate.objects.count())
+
+    def test_dry_run_and_earlier_tariff(self):
+        diff = self._import(dry_run=True)
+        self.assertEqual(2, len(diff.created))
+        self.assertEqual(1, ValidityDate.objects.count())
+        # a tariff older than the current price ends the day before it
+        self._import(start_date=date(2023, 1, 1))
+        self.assertEqual((date(2023, 1, 1), date(2023, 3, 31)),
+                         self.known.validity_dates.values_list('start_date', 'end_date').get(
+                             start_date=date(2023, 1, 1)))
+        diff = self._import(start_date=date(2023, 1, 1), end_date=date(2023, 1, 31))
+        self.assertEqual(2, len(diff.updated))
+        self.assertEqual(2, len(diff.continued))
+        diff = self._import(start_date=date(2023, 1, 1), end_date=date(2023, 1, 31))
+        self.assertEqual((0, 0, 2), (len(diff.updated), len(diff.continued), len(diff.unchanged)))
+
+    def test_bounded_tariff_is_followed_by_the_previous_price(self):
+        ValidityDate.objects.filter(care_code=self.known).update(start_date=date(2022, 4, 1))
+        diff = self._import(start_date=date(2023, 1, 1), end_date=date(2023, 1, 31))
+        self.assertEqual((2, 1, 1), (len(diff.created), len(diff.closed), len(diff.continued)))
+        self.assertEqual([(date(2022, 4, 1), date(2022, 12, 31), Decimal('19.3')),
+                          (date(2023, 1, 1), date(2023, 1, 31), Decimal('21.5')),
+                          (date(2023, 2, 1), None, Decimal('19.3'))],
+                         list(self.known.validity_dates.order_by('start_date').values_list(
+                             'start_date', 'end_date', 'gross_amount')))
+        # the care code keeps a price on every day after the first one
+        for day in (date(2022, 12, 31), date(2023, 1, 31), date(2023, 2, 1), date(2024, 1, 1)):
+            self.assertTrue(self.known.gross_amount_date_based(day), day)
+        self.assertEqual(Decimal('19.3'), self.known.gross_amount_date_based(date(2023, 2, 1)))
+
+    def test_cns_tariff_files_are_read(self):
+        prices, invalid_rows = read_care_code_prices('initialdata/2023_SEPTEMBER_cns_codes.csv')
+        self.assertTrue(prices)
+        self.assertTrue(all(code for code in prices))
@@ -0,0 +1,74 @@
+from datetime import date, time
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+
+from invoices.distancematrix import DistanceMatrix, TravelTimeGraph, travel_time_graph
+from invoices.employee import Employee, JobPosition
+from invoices.events import Event
+from invoices.models import Patient
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                       'LOCATION': 'travel-time-graph'}})
+class TravelTimeGraphTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.patients = Patient.objects.bulk_create([
+            Patient(code_sn='code_sn%s' % index, first_name='first name %s' % index, name='name %s' % index,
+                    address='address %s' % index, zipcode='zipcode %s' % index, city='city %s' % index,
+                    phone_number='000') for index in range(4)])
+        self.ids = [patient.id for patient in self.patients]
+        DistanceMatrix.objects.bulk_create([
+            DistanceMatrix(patient_origin_id=origin, patient_destination_id=destination,
+                           distance_in_km=distance, duration_in_mn=duration)
+            for origin, destination, distance, duration in ((self.ids[0], self.ids[1], 5, 10),
+                                                            (self.ids[1], self.ids[2], 7, 12),
+                                                            (self.ids[2], self.ids[0], 3, 4))])
+        self.graph = TravelTimeGraph()
+
+    def test_route_is_scored_without_queries(self):
+        self.graph.evaluate([])
+        with self.assertNumQueries(0):
+            route = self.graph.evaluate([self.ids[0], self.ids[1], self.ids[1], self.ids[2], self.ids[0]])
+        self.assertEqual(15, route.distance_in_km)
+        self.assertEqual(26, route.duration_in_mn)
+        self.assertEqual([(5, 10), (0, 0), (7, 12), (3, 4)], route.legs)
+        self.assertEqual([], route.missing_legs)
+        route = self.graph.evaluate([self.ids[0], self.ids[3], self.ids[1], self.ids[2]])
+        self.assertEqual((7, 12), (route.distance_in_km, route.duration_in_mn))
+        self.assertEqual([(self.ids[0], self.ids[3]), (self.ids[3], self.ids[1])], route.missing_legs)
+
+    def test_graph_is_refreshed_when_rows_change(self):
+        self.assertIsNone(self.graph.leg(self.ids[1], self.ids[0]))
+        DistanceMatrix.objects.create(patient_origin_id=self.ids[1], patient_destination_id=self.ids[0],
+                                      distance_in_km=6, duration_in_mn=11)
+        self.assertEqual((6, 11), self.graph.leg(self.ids[1], self.ids[0]))
+        DistanceMatrix.objects.filter(patient_origin_id=self.ids[0]).get().delete()
+        self.assertIsNone(self.graph.leg(self.ids[0], self.ids[1]))
+
+    def test_day_of_a_nurse(self):
+        user = User.objects.create_user('testuser', email='testuser@test.com', password='testing')
+        employee = Employee.objects.bulk_create([Employee(user=user, start_contract=date(2020, 1, 1),
+                                                          abbreviation='AA',
+                                                          occupation=JobPosition.objects.create(name='name 0'))])[0]
+        Event.objects.bulk_create([
+            Event(day=date(2023, 3, 1), time_start_event=time(start, 0), time_end_event=time(start, 30),
+                  state=state, event_type_enum='CARE', employees=employee, patient=self.patients[index])
+            for start, index, state in ((8, 0, 2), (9, 1, 2), (10, 3, 6), (11, 2, 3))])
+        travel_time_graph.invalidate()
+        client = APIClient()
+        client.force_authenticate(user=user)
+        response = client.get('/api/v1/route/%s/2023-03-01/' % employee.id)
+        self.assertEqual([self.ids[0], self.ids[1], self.ids[2]], response.data['patient_ids'])
+        self.assertEqual((12, 22), (response.data['distance'], response.data['duration']))
+        self.assertEqual(400, client.get('/api/v1/route/%s/2023-13-01/' % employee.id).status_code)
+        self.assertEqual(405, client.post('/api/v1/route/%s/2023-03-01/' % employee.id).status_code)
+        self.assertEqual(405, client.get('/api/v1/route/').status_code)
+        response = client.post('/api/v1/route/', {'patient_ids': [self.ids[0], self.ids[1]]}, format='json')
+        self.assertEqual((5, 10), (response.data['distance'], response.data['duration']))
+        response = client.get('/api/v1/distance_duration/%s/%s/' % (self.ids[2], self.ids[0]))
+        self.assertEqual({'text': 'Distance from name 2 first name 2 to name 0 first name 0 is 3 km and it takes 4 mn',
+                          'distance': 3, 'duration': 4}, response.data)
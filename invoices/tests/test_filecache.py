@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+from unittest.mock import patch
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.db.models.fields.files import FieldFile
+from django.test import SimpleTestCase, override_settings
+
+from invoices.helpers.filecache import storage_file_cache
+from invoices.models import MedicalPrescription
+
+
+class StorageFileCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.storage = FileSystemStorage(location=self.media_root)
+        self.settings_override = override_settings(STORAGE_FILE_CACHE_DIR=self.cache_dir,
+                                                   STORAGE_FILE_CACHE_MAX_SIZE=1000)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def _field_file(self, name, content):
+        name = self.storage.save(name, ContentFile(content))
+        field_file = FieldFile(MedicalPrescription(), MedicalPrescription._meta.get_field('file_upload'), name)
+        field_file.storage = self.storage
+        return field_file
+
+    def test_file_is_downloaded_once(self):
+        field_file = self._field_file('prescription.pdf', b'%PDF content')
+        with patch.object(FileSystemStorage, 'open', wraps=self.storage.open) as storage_open:
+            path = storage_file_cache.get_path(field_file)
+            self.assertEqual(path, storage_file_cache.get_path(field_file))
+        self.assertEqual(1, storage_open.call_count)
+        with open(path, 'rb') as cached_file:
+            self.assertEqual(b'%PDF content', cached_file.read())
+
+    def test_identical_contents_share_a_blob(self):
+        first = storage_file_cache.get_path(self._field_file('first.pdf', b'same'))
+        second = storage_file_cache.get_path(self._field_file('second.pdf', b'same'))
+        self.assertEqual(first, second)
+
+    def test_changed_file_is_downloaded_again(self):
+        field_file = self._field_file('prescription.pdf', b'first version')
+        first = storage_file_cache.get_path(field_file)
+        self.storage.delete(field_file.name)
+        self.storage.save(field_file.name, ContentFile(b'second version, longer'))
+        second = storage_file_cache.get_path(field_file)
+        self.assertNotEqual(first, second)
+        with open(second, 'rb') as cached_file:
+            self.assertEqual(b'second version, longer', cached_file.read())
+
+    def test_least_recently_used_blobs_are_evicted(self):
+        first = storage_file_cache.get_path(self._field_file('first.pdf', b'1' * 400))
+        os.utime(first, (1, 1))
+        second = storage_file_cache.get_path(self._field_file('second.pdf', b'2' * 400))
+        third = storage_file_cache.get_path(self._field_file('third.pdf', b'3' * 400))
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.exists(second))
+        self.assertTrue(os.path.exists(third))
+
+    def test_missing_file_raises(self):
+        field_file = self._field_file('prescription.pdf', b'content')
+        self.storage.delete(field_file.name)
+        with self.assertRaises(FileNotFoundError):
+            storage_file_cache.get_path(field_file)
+        with self.assertRaises(ValueError):
+            storage_file_cache.get_path(MedicalPrescription().file_upload)
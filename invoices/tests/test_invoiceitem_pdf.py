@@ -0,0 +1,81 @@
+from datetime import date, datetime, timedelta
+from io import StringIO
+from zoneinfo import ZoneInfo
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+
+from invoices.employee import Employee, JobPosition
+from invoices.invoiceitem_pdf import get_doc_elements
+from invoices.models import CareCode, Patient, Prestation, InvoiceItem, ValidityDate, Physician, \
+    MedicalPrescription, InvoiceItemPrescriptionsList
+from invoices.modelspackage import InvoicingDetails
+from invoices.prefac import QueryCounter
+
+
+class InvoiceItemPdfTestCase(TestCase):
+    def setUp(self):
+        self.date = datetime(2023, 3, 1, 9, 30, tzinfo=ZoneInfo("Europe/Luxembourg"))
+        user = User.objects.create_user('testuser', email='testuser@test.com', password='testing')
+        self.employee = Employee.objects.create(user=user,
+                                                start_contract=self.date,
+                                                provider_code='300744-44',
+                                                occupation=JobPosition.objects.create(name='name 0'))
+        self.invoice_details = InvoicingDetails.objects.create(
+            provider_code="111111",
+            name="BEST.lu",
+            address="Sesame Street",
+            zipcode_city="1234 Sesame Street",
+            bank_account="LU12 3456 7890 1234 5678")
+        self.patient = Patient.objects.create(code_sn='1945010112345', first_name='first name', name='name',
+                                              address='address', zipcode='1234', city='city')
+        self.physician = Physician.objects.create(provider_code='123456', first_name='doc', name='tor')
+        self.prescription = MedicalPrescription.objects.create(prescriptor=self.physician, patient=self.patient,
+                                                               date=date(2023, 2, 1), end_date=date(2023, 6, 30))
+        self.care_code = CareCode.objects.create(code='N101', name='some name', description='description',
+                                                 reimbursed=True)
+        ValidityDate.objects.create(care_code=self.care_code, start_date=date(2023, 1, 1), gross_amount=12.25)
+
+    def _create_invoice(self, invoice_number, number_of_prestations):
+        invoice = InvoiceItem.objects.create(invoice_number=invoice_number,
+                                             invoice_date=date(2023, 3, 31),
+                                             invoice_details=self.invoice_details,
+                                             patient=self.patient)
+        InvoiceItemPrescriptionsList.objects.create(invoice_item=invoice, medical_prescription=self.prescription)
+        for hour in range(number_of_prestations):
+            Prestation.objects.create(invoice_item=invoice, employee=self.employee, carecode=self.care_code,
+                                      date=self.date + timedelta(hours=hour))
+        return invoice
+
+    def _build(self):
+        counter = QueryCounter()
+        with connection.execute_wrapper(counter):
+            elements, _ = get_doc_elements(InvoiceItem.objects.all())
+        return elements, counter.count
+
+    def test_pages_of_20_prestations(self):
+        self._create_invoice('1', 45)
+        elements, _ = get_doc_elements(InvoiceItem.objects.all(), with_verification_page=True)
+        titles = [element.simpletext for element in elements if hasattr(element, 'simpletext')
+                  and element.simpletext.startswith("Mémoire d'Honoraires")]
+        self.assertEqual(["Mémoire d'Honoraires Num. 1%s032023 en date du : 2023-03-31" % page
+                          for page in (1, 2, 3)], titles)
+
+    def test_query_count_does_not_depend_on_invoices(self):
+        self._create_invoice('1', 3)
+        # warm up configuration and price caches
+        self._build()
+        _, small = self._build()
+        for number in range(2, 6):
+            self._create_invoice(str(number), 25)
+        _, large = self._build()
+        self.assertEqual(small, large)
+
+    def test_benchmark_command(self):
+        out = StringIO()
+        call_command('benchmark_invoice_pdf', invoices=3, prestations=21, stdout=out)
+        per_invoice, prefetched = [int(line.split(': ')[1].split()[0]) for line in out.getvalue().splitlines()[:2]]
+        self.assertGreater(per_invoice, prefetched)
+        self.assertFalse(InvoiceItem.objects.filter(invoice_number__startswith='benchmark').exists())
@@ -0,0 +1,77 @@
+import os
+import tempfile
+from datetime import date
+from unittest.mock import patch
+
+import fitz
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.test import TestCase, override_settings
+
+from invoices.employee import Employee, JobPosition
+from invoices.helpers.pdf import split_payslips
+from invoices.salaries import EmployeePaySlip, EmployeesMonthlyPayslipFile
+
+
+def payslips_pdf(names):
+    with fitz.open() as document:
+        for name in names:
+            page = document.new_page()
+            page.insert_text((72, 72), "Bulletin de salaire\nClasse 1 %s ADULTE\nSalaire de base" % name)
+        return document.tobytes()
+
+
+class SplitPayslipsTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.media_root = self.directory.name
+        self.settings_override = override_settings(
+            DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage', MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        occupation = JobPosition.objects.create(name='name 0')
+        self.employees = Employee.objects.bulk_create([
+            Employee(user=User.objects.create_user(username, last_name=last_name), start_contract=date(2020, 1, 1),
+                     abbreviation=username, occupation=occupation)
+            for username, last_name in (('AD', 'Dupont'), ('BM', 'Martin'), ('CM', 'Martinez'))])
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.directory.cleanup()
+
+    def test_pages_are_split_in_a_process_pool(self):
+        path = os.path.join(self.media_root, 'payslips.pdf')
+        with open(path, 'wb') as pdf_file:
+            pdf_file.write(payslips_pdf(['DUPONT Jean'] * 12 + ['MARTIN Paul']))
+        payslips = sorted(split_payslips(path, self.media_root, processes=2))
+        self.assertEqual(13, len(payslips))
+        self.assertEqual((13, 'MARTIN Paul'), payslips[-1][:2])
+        with fitz.open(payslips[-1][2]) as payslip:
+            self.assertEqual(1, payslip.page_count)
+            self.assertIn('MARTIN Paul', payslip[0].get_text())
+
+    def test_monthly_file_is_split_into_employee_payslips(self):
+        EmployeePaySlip.objects.create(employee=self.employees[0], year=2023, month=3)
+        with patch.dict(os.environ, {'LOCAL_ENV': '1'}), self.captureOnCommitCallbacks(execute=True):
+            EmployeesMonthlyPayslipFile.objects.create(
+                year=2023, month=3, file=ContentFile(payslips_pdf(['DUPONT Jean', 'MARTINEZ Ana']), name='03.pdf'))
+        self.assertEqual({self.employees[0].id, self.employees[2].id},
+                         set(EmployeePaySlip.objects.values_list('employee_id', flat=True)))
+        payslip = EmployeePaySlip.objects.get(employee=self.employees[2])
+        with payslip.file.open('rb') as pdf_file, fitz.open(stream=pdf_file.read(), filetype='pdf') as document:
+            self.assertIn('MARTINEZ Ana', document[0].get_text())
+        # "MARTIN" is the start of two last names
+        with patch.dict(os.environ, {'LOCAL_ENV': '1'}), self.assertRaises(ValueError), \
+                self.captureOnCommitCallbacks(execute=True):
+            EmployeesMonthlyPayslipFile.objects.create(
+                year=2023, month=4, file=ContentFile(payslips_pdf(['MARTIN Paul', 'DUPONT Jean']), name='04.pdf'))
+        self.assertTrue(EmployeePaySlip.objects.filter(employee=self.employees[0], year=2023, month=4).exists())
+
+    def test_split_is_enqueued_once_the_upload_is_committed(self):
+        with patch('invoices.salaries.split_monthly_payslip_file') as split:
+            with self.captureOnCommitCallbacks() as callbacks:
+                monthly_file = EmployeesMonthlyPayslipFile.objects.create(
+                    year=2023, month=5, file=ContentFile(payslips_pdf(['DUPONT Jean']), name='05.pdf'))
+                split.delay.assert_not_called()
+            for callback in callbacks:
+                callback()
+        split.delay.assert_called_once_with(monthly_file.pk)
@@ -0,0 +1,73 @@
+from datetime import date, datetime, timedelta
+from io import StringIO
+from zoneinfo import ZoneInfo
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from invoices.employee import Employee, JobPosition
+from invoices.models import CareCode, Patient, Prestation, InvoiceItem, ValidityDate, Physician, \
+    MedicalPrescription, InvoiceItemPrescriptionsList
+from invoices.modelspackage import InvoicingDetails
+from invoices.prefac import generate_all_invoice_lines, write_all_invoice_lines
+
+
+class PrefacTestCase(TestCase):
+    def setUp(self):
+        self.date = datetime(2023, 3, 1, 9, 30, tzinfo=ZoneInfo("Europe/Luxembourg"))
+        jobposition = JobPosition.objects.create(name='name 0')
+        user = User.objects.create_user('testuser', email='testuser@test.com', password='testing')
+        self.employee = Employee.objects.create(user=user,
+                                                start_contract=self.date,
+                                                provider_code='300744-44',
+                                                occupation=jobposition)
+        self.invoice_details = InvoicingDetails.objects.create(
+            provider_code="111111",
+            name="BEST.lu",
+            address="Sesame Street",
+            zipcode_city="1234 Sesame Street",
+            bank_account="LU12 3456 7890 1234 5678")
+        self.patient = Patient.objects.create(code_sn='1945010112345', first_name='first name', name='name')
+        self.physician = Physician.objects.create(provider_code='123456', first_name='doc', name='tor')
+        self.prescription = MedicalPrescription.objects.create(prescriptor=self.physician, patient=self.patient,
+                                                               date=date(2023, 2, 1), end_date=date(2023, 6, 30))
+        self.care_code = CareCode.objects.create(code='N101', name='some name', description='description',
+                                                 reimbursed=True)
+        ValidityDate.objects.create(care_code=self.care_code, start_date=date(2022, 1, 1),
+                                    end_date=date(2022, 12, 31), gross_amount=10.5)
+        ValidityDate.objects.create(care_code=self.care_code, start_date=date(2023, 1, 1), gross_amount=12.25)
+
+    def _create_invoice(self, invoice_number, number_of_prestations):
+        invoice = InvoiceItem.objects.create(invoice_number=invoice_number,
+                                             invoice_date=self.date,
+                                             invoice_details=self.invoice_details,
+                                             patient=self.patient)
+        InvoiceItemPrescriptionsList.objects.create(invoice_item=invoice, medical_prescription=self.prescription)
+        for day in range(number_of_prestations):
+            Prestation.objects.create(invoice_item=invoice, employee=self.employee, carecode=self.care_code,
+                                      date=self.date + timedelta(days=day))
+        return invoice
+
+    def test_line_content(self):
+        self._create_invoice('1', 1)
+        lines = generate_all_invoice_lines(InvoiceItem.objects.all(), invoice_batch_date=date(2023, 3, 31))
+        self.assertEqual(1, len(lines.split("\n")))
+        self.assertEqual(
+            "220230300U      194501011234500000000001000000000000002023020120230630123456300744N101      "
+            "202303012023030109300930001000001225000001225       EUR",
+            lines)
+
+    def test_query_count_does_not_depend_on_prestations(self):
+        self._create_invoice('1', 2)
+        # warm up configuration caches
+        generate_all_invoice_lines(InvoiceItem.objects.all(), invoice_batch_date=date(2023, 3, 31))
+        small = write_all_invoice_lines(InvoiceItem.objects.all(), StringIO(), invoice_batch_date=date(2023, 3, 31))
+        self._create_invoice('2', 10)
+        self._create_invoice('3', 10)
+        sink = StringIO()
+        large = write_all_invoice_lines(InvoiceItem.objects.all(), sink, invoice_batch_date=date(2023, 3, 31))
+        self.assertEqual(2, small.lines)
+        self.assertEqual(22, large.lines)
+        self.assertEqual(small.queries, large.queries)
+        self.assertEqual(22, len(sink.getvalue().split("\n")))
+        self.assertFalse(sink.getvalue().endswith("\n"))
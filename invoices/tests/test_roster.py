@@ -0,0 +1,113 @@
+from datetime import date, time
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from helpers import holidays
+from invoices.employee import Employee, JobPosition
+from invoices.enums.generic import HolidayRequestChoice
+from invoices.enums.holidays import HolidayRequestWorkflowStatus
+from invoices.events import Event, duplicate_events
+from invoices.helpers.roster import day_roster
+from invoices.holidays import HolidayRequest
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                       'LOCATION': 'day-roster'}})
+class DayRosterTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        job_position = JobPosition.objects.create(name='name 0')
+        self.employees = []
+        for abbreviation in ('AA', 'BB', 'CC'):
+            user = User.objects.create_user(abbreviation.lower(), email='%s@test.com' % abbreviation.lower(),
+                                            password='testing')
+            self.employees += Employee.objects.bulk_create([Employee(user=user, start_contract=date(2020, 1, 1),
+                                                                     abbreviation=abbreviation,
+                                                                     occupation=job_position)])
+        self.holiday_request = HolidayRequest.objects.create(employee=self.employees[1].user,
+                                                             start_date=date(2023, 3, 6), end_date=date(2023, 3, 7),
+                                                             requested_period=HolidayRequestChoice.req_full_day,
+                                                             reason=1,
+                                                             request_status=HolidayRequestWorkflowStatus.ACCEPTED)
+
+    def test_whois_off_and_available(self):
+        self.assertEqual("BB", holidays.whois_off(date(2023, 3, 6)))
+        self.assertEqual(['AA', 'CC'], holidays.whois_available(date(2023, 3, 7)))
+        self.assertEqual({'2023-03-07': ['AA', 'CC'], '2023-03-08': ['AA', 'BB', 'CC']},
+                         holidays.whois_available(date(2023, 3, 7), until=date(2023, 3, 8)))
+        self.assertEqual([(str(self.employees[0].id), 'AA', None), (str(self.employees[2].id), 'CC', None)],
+                         [(x['id'], x['abbreviation'], x['minified_avatar'])
+                          for x in holidays.whois_available_with_avatars_and_ids(date(2023, 3, 7))])
+
+    def test_month_is_read_from_the_cache(self):
+        holidays.whois_available(date(2023, 3, 1), until=date(2023, 3, 31))
+        with self.assertNumQueries(0):
+            availability = holidays.whois_available(date(2023, 3, 1), until=date(2023, 3, 31))
+        self.assertEqual(31, len(availability))
+        self.assertEqual(['AA', 'CC'], availability['2023-03-06'])
+
+    def test_holiday_request_changes_refresh_the_days(self):
+        self.assertEqual("BB", holidays.whois_off(date(2023, 3, 6)))
+        self.assertEqual("", holidays.whois_off(date(2023, 3, 20)))
+        self.holiday_request.start_date = date(2023, 3, 20)
+        self.holiday_request.end_date = date(2023, 3, 20)
+        self.holiday_request.save()
+        self.assertEqual("", holidays.whois_off(date(2023, 3, 6)))
+        self.assertEqual("BB", holidays.whois_off(date(2023, 3, 20)))
+        self.holiday_request.delete()
+        self.assertEqual("", holidays.whois_off(date(2023, 3, 20)))
+
+    def test_events_keep_employees_busy(self):
+        def available():
+            return [x['abbreviation'] for x in day_roster.available(date(2023, 3, 8), start_time=time(9, 0),
+                                                                     end_time=time(10, 0))[date(2023, 3, 8)]]
+
+        self.assertEqual(['AA', 'BB', 'CC'], available())
+        event = Event.objects.bulk_create([Event(day=date(2023, 3, 8), time_start_event=time(8, 0),
+                                                 time_end_event=time(9, 30), employees=self.employees[2],
+                                                 state=2, event_type_enum='GENERIC')])[0]
+        # created without signals, the cached day is still the one computed before
+        self.assertEqual(['AA', 'BB', 'CC'], available())
+        day_roster.invalidate_days(event.day)
+        self.assertEqual(['AA', 'BB'], available())
+        self.assertEqual(['AA', 'BB', 'CC'], [x['abbreviation'] for x in day_roster.available(
+            date(2023, 3, 8), start_time=time(9, 0), end_time=time(10, 0), exclude_event_id=event.id)[date(2023, 3, 8)]])
+
+    def test_day_invalidated_while_it_is_built_is_built_again(self):
+        build_days = day_roster._build_days
+
+        def build_days_and_change(days):
+            entries = build_days(days)
+            # a leave accepted for the day by another process once the day was read
+            HolidayRequest.objects.filter(pk=self.holiday_request.pk).update(end_date=date(2023, 3, 8))
+            day_roster.invalidate_days(date(2023, 3, 8))
+            return entries
+
+        with patch.object(day_roster, '_build_days', side_effect=build_days_and_change):
+            self.assertEqual(['AA', 'BB', 'CC'], holidays.whois_available(date(2023, 3, 8)))
+        self.assertEqual(['AA', 'CC'], holidays.whois_available(date(2023, 3, 8)))
+
+    def test_duplicated_events_refresh_their_days(self):
+        event = Event.objects.create(day=date(2023, 3, 8), time_start_event=time(9, 0), time_end_event=time(9, 30),
+                                     employees=self.employees[2], state=2, event_type_enum='GENERIC')
+        self.assertEqual(['AA', 'BB', 'CC'], holidays.whois_available(date(2023, 3, 9)))
+        duplicate_events([(event, date(2023, 3, 9))], created_by='test')
+        self.assertEqual(['AA', 'BB'], [x['abbreviation'] for x in day_roster.available(
+            date(2023, 3, 9), start_time=time(9, 0), end_time=time(10, 0))[date(2023, 3, 9)]])
+
+    def test_available_employees_for_a_range_of_days(self):
+        client = APIClient()
+        client.force_authenticate(user=self.employees[0].user)
+        response = client.get(reverse('available-employees'), {'start': '2023-03-07T09:00:00',
+                                                                'end': '2023-03-07T10:00:00', 'id': 0})
+        self.assertEqual(['AA', 'CC'], [x['abbreviation'] for x in response.json()])
+        response = client.get(reverse('available-employees'), {'start': '2023-03-07T09:00:00',
+                                                                'end': '2023-03-07T10:00:00', 'id': 0,
+                                                                'until': '2023-03-08'})
+        self.assertEqual({'2023-03-07': ['AA', 'CC'], '2023-03-08': ['AA', 'BB', 'CC']},
+                         {day: [x['abbreviation'] for x in employees] for day, employees in response.json().items()})
@@ -0,0 +1,65 @@
+from datetime import date
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from invoices.employee import Employee, JobPosition
+from invoices.helpers.timesheetcache import TimesheetCalculationCache
+from invoices.timesheet import SimplifiedTimesheet
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                       'LOCATION': 'timesheet-calculations'}})
+class TimesheetCalculationCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.calculations = TimesheetCalculationCache()
+        self.computed = []
+
+    def _get(self, employee_id, year, month):
+        def compute():
+            self.computed.append((employee_id, year, month))
+            return len(self.computed)
+
+        return self.calculations.get_or_set(employee_id, year, month, 'total', compute)
+
+    def test_hits_and_misses(self):
+        self.assertEqual(1, self._get(1, 2023, 3))
+        self.assertEqual(1, self._get(1, 2023, 3))
+        self.assertEqual(2, self._get(1, 2023, 4))
+        self.assertEqual({'hits': 1, 'misses': 2, 'hit_ratio': 1 / 3}, self.calculations.stats())
+
+    def test_invalidate_month_only_drops_that_month(self):
+        self._get(1, 2023, 3)
+        self._get(1, 2023, 4)
+        self._get(2, 2023, 3)
+        self.calculations.invalidate_month(1, 2023, 3)
+        self.assertEqual(4, self._get(1, 2023, 3))
+        self.assertEqual(2, self._get(1, 2023, 4))
+        self.assertEqual(3, self._get(2, 2023, 3))
+
+    def test_invalidate_period_and_employee(self):
+        for month in (11, 12):
+            self._get(1, 2022, month)
+        self._get(1, 2023, 1)
+        self._get(1, 2023, 2)
+        self._get(2, 2023, 1)
+        self.calculations.invalidate_period(1, date(2022, 12, 20), date(2023, 1, 5))
+        self.assertEqual(1, self._get(1, 2022, 11))
+        self.assertEqual(6, self._get(1, 2022, 12))
+        self.assertEqual(7, self._get(1, 2023, 1))
+        self.assertEqual(4, self._get(1, 2023, 2))
+        self.calculations.invalidate_employee(1)
+        self.assertEqual(8, self._get(1, 2023, 2))
+        self.assertEqual(5, self._get(2, 2023, 1))
+
+    def test_timesheet_save_keeps_unrelated_cache_entries(self):
+        user = User.objects.create_user('testuser', email='testuser@test.com', password='testing')
+        employee = Employee.objects.bulk_create([Employee(user=user, start_contract=date(2023, 1, 1),
+                                                          occupation=JobPosition.objects.create(name='name 0'))])[0]
+        cache.set('vehicles-last-position', 'position')
+        self._get(employee.id, 2023, 3)
+        SimplifiedTimesheet.objects.create(employee=employee, time_sheet_year=2023, time_sheet_month=3, user=user)
+        self.assertEqual('position', cache.get('vehicles-last-position'))
+        self.assertEqual(2, self._get(employee.id, 2023, 3))
@@ -0,0 +1,84 @@
+import os
+from datetime import date, time
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+
+from invoices.distancematrix import DistanceMatrix, TravelTimeGraph
+from invoices.employee import Employee, JobPosition
+from invoices.events import Event
+from invoices.models import Patient
+from invoices.processors.tours import TourOptimizer, Visit
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                       'LOCATION': 'tours'}})
+class TourOptimizerTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.patients = Patient.objects.bulk_create([
+            Patient(code_sn='code_sn%s' % index, first_name='first name %s' % index, name='name %s' % index,
+                    address='address %s' % index, zipcode='zipcode %s' % index, city='city %s' % index,
+                    phone_number='000') for index in range(5)])
+        # patients live along a road, 10 minutes and 5 km apart
+        DistanceMatrix.objects.bulk_create([
+            DistanceMatrix(patient_origin=origin, patient_destination=destination,
+                           distance_in_km=abs(i - j) * 5, duration_in_mn=abs(i - j) * 10)
+            for i, origin in enumerate(self.patients) for j, destination in enumerate(self.patients) if i != j])
+        self.graph = TravelTimeGraph()
+
+    def _visits(self, positions, starts=None):
+        starts = starts or [None] * len(positions)
+        return [Visit(index, self.patients[position].id, start, start + 30 if start is not None else None)
+                for index, (position, start) in enumerate(zip(positions, starts))]
+
+    def test_zigzag_is_straightened(self):
+        proposal = TourOptimizer(self._visits([0, 3, 1, 4, 2]), graph=self.graph).propose()
+        self.assertEqual(100, proposal['current']['duration_in_mn'])
+        self.assertEqual(40, proposal['proposed']['duration_in_mn'])
+        self.assertEqual(60, proposal['savings_in_mn'])
+        self.assertEqual(30, proposal['savings_in_km'])
+        self.assertEqual([0, 2, 4, 1, 3], proposal['proposed']['event_ids'])
+
+    def test_time_windows_are_kept(self):
+        # the visit of the patient at the far end has to start at 8:00, the others are free
+        visits = self._visits([1, 4, 0, 2], starts=[None, 8 * 60, None, None])
+        proposal = TourOptimizer(visits, window=0, graph=self.graph).propose()
+        self.assertEqual(1, proposal['proposed']['event_ids'][0])
+        self.assertEqual(0, proposal['proposed']['lateness_in_mn'])
+        self.assertEqual(40, proposal['proposed']['duration_in_mn'])
+
+    def test_genetic_algorithm_never_makes_it_worse(self):
+        visits = self._visits([0, 3, 1, 4, 2])
+        proposal = TourOptimizer(visits, time_budget=1, use_genetic_algorithm=True, seed=1, graph=self.graph).propose()
+        self.assertEqual(40, proposal['proposed']['duration_in_mn'])
+
+    def test_proposal_for_the_day_of_a_nurse(self):
+        user = User.objects.create_user('testuser', email='testuser@test.com', password='testing')
+        employee = Employee.objects.bulk_create([Employee(user=user, start_contract=date(2020, 1, 1),
+                                                          abbreviation='AA',
+                                                          occupation=JobPosition.objects.create(name='name 0'))])[0]
+        Event.objects.bulk_create([
+            Event(day=date(2023, 3, 1), time_start_event=time(8 + hour, 0), time_end_event=time(8 + hour, 15),
+                  state=2, event_type_enum='CARE', employees=employee, patient=self.patients[position])
+            for hour, position in enumerate([0, 2, 1])])
+        client = APIClient()
+        client.force_authenticate(user=user)
+        url = '/api/v1/tour/%s/2023-03-01/' % employee.id
+        self.assertEqual(404, client.get(url).status_code)
+        with patch.dict(os.environ, {'LOCAL_ENV': '1'}):
+            response = client.post(url, {'time_budget': 1}, format='json')
+        self.assertEqual(30, response.data['current']['duration_in_mn'])
+        self.assertEqual(20, response.data['proposed']['duration_in_mn'])
+        self.assertEqual(response.data, client.get(url).data)
+        self.assertEqual(400, client.post(url, {'time_budget': 'soon'}, format='json').status_code)
+        self.assertEqual(400, client.post(url, {'genetic_algorithm': 'maybe'}, format='json').status_code)
+        with patch('api.views.optimize_employee_tour') as optimize:
+            client.post(url, {'genetic_algorithm': 'false', 'time_budget': '120'}, format='json')
+        optimize.delay.assert_called_once_with(employee.id, date(2023, 3, 1), time_budget=60,
+                                               use_genetic_algorithm=False)
+        self.assertEqual(400, client.get('/api/v1/tour/%s/2023-02-30/' % employee.id).status_code)
+        self.assertEqual(400, client.post('/api/v1/tour/%s/tomorrow/' % employee.id, format='json').status_code)
@@ -0,0 +1,87 @@
+from datetime import date, datetime, time
+
+import pytz
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from invoices.employee import Employee, JobPosition
+from invoices.events import Event
+from invoices.models import AlternateAddress, Patient
+from invoices.processors.visits import SpatialIndex, geocode, haversine, match_visits, normalize_address
+from invoices.visitmodels import EmployeeVisit, GeocodedAddress
+
+
+class GeocoderStub:
+    """Addresses are 'latitude longitude' in the street name."""
+
+    def __init__(self):
+        self.addresses = []
+
+    def __call__(self, address):
+        self.addresses.append(address)
+        if address.startswith('nowhere'):
+            return None
+        latitude, longitude = address.split(' L-')[0].split()
+        return float(latitude), float(longitude)
+
+
+class GeocodingTestCase(TestCase):
+    def test_addresses_are_geocoded_once(self):
+        geocoder = GeocoderStub()
+        coordinates = geocode(['49.6 6.1 L-1234 Luxembourg, LU', 'nowhere L-1234 Luxembourg, LU'], geocoder=geocoder)
+        self.assertEqual((49.6, 6.1), coordinates['49.6 6.1 L-1234 Luxembourg, LU'])
+        self.assertIsNone(coordinates['nowhere L-1234 Luxembourg, LU'])
+        with self.assertNumQueries(1):
+            coordinates = geocode(['49.6  6.1 l - 1234 luxembourg LU'], geocoder=geocoder)
+        self.assertEqual((49.6, 6.1), coordinates['49.6  6.1 l - 1234 luxembourg LU'])
+        self.assertEqual(2, len(geocoder.addresses))
+        # an address not found is asked again
+        geocode(['nowhere L-1234 Luxembourg, LU'], geocoder=geocoder)
+        self.assertEqual(3, len(geocoder.addresses))
+        self.assertEqual(1, GeocodedAddress.objects.count())
+        self.assertEqual('49 6 6 1 l-1234 luxembourg lu', normalize_address('49.6, 6.1  L- 1234 Luxembourg, LU'))
+
+    def test_spatial_index(self):
+        index = SpatialIndex([(49.6, 6.1, 'a'), (49.6005, 6.1, 'b'), (49.61, 6.1, 'c')], radius=100)
+        self.assertEqual('a', index.nearest(49.6002, 6.1)[1])
+        self.assertEqual('b', index.nearest(49.6004, 6.1)[1])
+        self.assertIsNone(index.nearest(49.605, 6.1))
+        # 0.001 degree of longitude is about 72 m at that latitude
+        self.assertEqual('a', index.nearest(49.6, 6.101)[1])
+        self.assertAlmostEqual(72, haversine(49.6, 6.1, 49.6, 6.101), delta=1)
+
+
+class MatchVisitsTestCase(TestCase):
+    def setUp(self):
+        self.patients = Patient.objects.bulk_create([
+            Patient(code_sn='code_sn%s' % index, first_name='first name %s' % index, name='name %s' % index,
+                    address='49.6%s 6.1' % index, zipcode='1234', city='Luxembourg', country='LU',
+                    phone_number='000') for index in range(3)])
+        occupation = JobPosition.objects.create(name='name 0')
+        self.users = [User.objects.create_user('user%s' % index, password='testing') for index in range(2)]
+        employees = Employee.objects.bulk_create([Employee(user=user, start_contract=date(2020, 1, 1),
+                                                           abbreviation='A%s' % index, occupation=occupation)
+                                                  for index, user in enumerate(self.users)])
+        Event.objects.bulk_create([
+            Event(day=date(2023, 3, 1), time_start_event=time(8 + index, 0), time_end_event=time(8 + index, 30),
+                  state=2, event_type_enum='CARE', employees=employees[employee], patient=self.patients[patient])
+            for index, (employee, patient) in enumerate(((0, 0), (0, 1), (1, 2)))])
+        AlternateAddress.objects.bulk_create([AlternateAddress(patient=self.patients[2], start_date=date(2023, 2, 1),
+                                                               full_address='49.7 6.2 L-1234 Luxembourg, LU')])
+
+    def _visit(self, user, latitude, longitude):
+        arrival = datetime(2023, 3, 1, 10, 0, tzinfo=pytz.utc)
+        return EmployeeVisit.objects.create(user=user, latitude=latitude, longitude=longitude,
+                                            arrival_date_time=arrival, departure_date_time=arrival)
+
+    def test_visits_of_all_staff_in_one_pass(self):
+        visits = [self._visit(self.users[0], 49.6101, 6.1), self._visit(self.users[0], 49.6200, 6.1003),
+                  self._visit(self.users[1], 49.7, 6.2001), self._visit(self.users[1], 49.6, 6.1)]
+        geocoder = GeocoderStub()
+        found = match_visits(visits, geocoder=geocoder)
+        self.assertEqual([self.patients[1], None, self.patients[2], None], [found[visit.id] for visit in visits])
+        self.assertEqual(self.patients[1].id, EmployeeVisit.objects.get(pk=visits[0].pk).patient_id)
+        self.assertEqual(3, len(geocoder.addresses))
+        # everything is known now: no geocoding
+        self.assertEqual(self.patients[2], visits[2].check_if_address_is_known(visits[2]))
+        self.assertEqual(3, len(geocoder.addresses))
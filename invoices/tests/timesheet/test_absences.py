@@ -0,0 +1,77 @@
+from datetime import date
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from helpers.absences import HolidayRequestAbsences, luxembourg_calendar, Computation
+from invoices.employee import Employee, EmployeeContractDetail, JobPosition
+from invoices.enums.generic import HolidayRequestChoice
+from invoices.enums.holidays import HolidayRequestWorkflowStatus
+from invoices.holidays import HolidayRequest
+
+
+class LuxembourgCalendarTestCase(TestCase):
+
+    def test_counts(self):
+        # August 2022 has 23 weekdays and the 15th is a public holiday
+        self.assertEqual([23], list(luxembourg_calendar.weekdays([date(2022, 8, 1)], [date(2022, 8, 31)])))
+        self.assertEqual([22], list(luxembourg_calendar.working_days([date(2022, 8, 1)], [date(2022, 9, 1)])))
+        self.assertEqual(22, luxembourg_calendar.working_days_in_month(date(2022, 8, 1)))
+        # christmas, 26th of December and new year
+        self.assertEqual([3, 0], list(luxembourg_calendar.public_holidays_count(
+            [date(2022, 12, 20), date(2023, 1, 2)], [date(2023, 1, 1), date(2023, 1, 10)])))
+        self.assertEqual([True, False], list(luxembourg_calendar.is_public_holiday(
+            [date(2022, 8, 15), date(2022, 8, 16)])))
+        self.assertEqual([date(2022, 12, 25), date(2022, 12, 26)],
+                         luxembourg_calendar.public_holidays_between(date(2022, 12, 1), date(2022, 12, 31)))
+
+
+class HolidayRequestAbsencesTestCase(TestCase):
+
+    def setUp(self):
+        job_position = JobPosition.objects.create(name='name 0')
+        self.users = []
+        for index, number_of_hours in enumerate((40, 20)):
+            user = User.objects.create_user('user%s' % index, email='user%s@test.com' % index, password='testing')
+            employee = Employee.objects.bulk_create([Employee(user=user, start_contract=date(2020, 1, 1),
+                                                              occupation=job_position)])[0]
+            EmployeeContractDetail.objects.create(start_date=date(2020, 1, 1), number_of_hours=number_of_hours,
+                                                  employee_link=employee, number_of_days_holidays=26)
+            self.users.append(user)
+        requests = []
+        for user in self.users:
+            requests += [
+                HolidayRequest(employee=user, start_date=date(2022, 12, 19), end_date=date(2022, 12, 30),
+                               requested_period=HolidayRequestChoice.req_full_day, reason=1,
+                               request_status=HolidayRequestWorkflowStatus.ACCEPTED),
+                HolidayRequest(employee=user, start_date=date(2022, 3, 7), end_date=date(2022, 3, 8),
+                               requested_period=HolidayRequestChoice.req_morning, reason=1,
+                               request_status=HolidayRequestWorkflowStatus.ACCEPTED),
+                HolidayRequest(employee=user, start_date=date(2022, 5, 2), end_date=date(2022, 5, 2),
+                               requested_period=HolidayRequestChoice.req_full_day, reason=3,
+                               request_status=HolidayRequestWorkflowStatus.ACCEPTED),
+            ]
+        HolidayRequest.objects.bulk_create(requests)
+
+    def test_computations(self):
+        holiday_requests = list(HolidayRequest.objects.filter(employee=self.users[0]).order_by('start_date'))
+        absences = HolidayRequestAbsences(holiday_requests)
+        self.assertEqual([Computation(1.0, 0, 8.0, 0), "Non applicable", Computation(10, 0, 8.0, 2)],
+                         [absences.computation(holiday_request) for holiday_request in holiday_requests])
+        # 10 weekdays minus christmas and the 26th of December
+        self.assertEqual(64.0, holiday_requests[2].hours_taken[0])
+        self.assertEqual(11.0, absences.total_days_in_current_year(holiday_requests[0]))
+        # 40 hours a week earn 17.33 hours off per month, counted up to the end of the request
+        self.assertAlmostEqual(17.33 * 12, absences.total_hours_off_available(holiday_requests[2]))
+
+    def test_prefetch_computes_a_page_at_once(self):
+        holiday_requests = list(HolidayRequest.objects.order_by('id'))
+        expected = [(holiday_request.hours_taken, holiday_request.total_days_in_current_year,
+                     holiday_request.total_hours_off_available) for holiday_request in holiday_requests]
+        holiday_requests = list(HolidayRequest.objects.order_by('id'))
+        # employees, contracts, then the accepted leaves of the years of the page
+        with self.assertNumQueries(3):
+            HolidayRequestAbsences.prefetch(holiday_requests)
+            self.assertEqual(expected, [(holiday_request.hours_taken, holiday_request.total_days_in_current_year,
+                                         holiday_request.total_hours_off_available)
+                                        for holiday_request in holiday_requests])
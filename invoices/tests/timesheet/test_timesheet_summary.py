@@ -0,0 +1,130 @@
+import os
+from contextlib import contextmanager
+from datetime import date, datetime, time, timedelta
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.utils import timezone
+
+from invoices.employee import Employee, EmployeeContractDetail, JobPosition
+from invoices.enums.generic import HolidayRequestChoice
+from invoices.enums.holidays import HolidayRequestWorkflowStatus
+from invoices.holidays import HolidayRequest
+from invoices.timesheet import SimplifiedTimesheet, SimplifiedTimesheetDetail, SimplifiedTimesheetSummary
+
+
+class SimplifiedTimesheetSummaryTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('testuser', email='testuser@test.com', password='testing')
+        self.employee = Employee.objects.create(user=self.user,
+                                                start_contract=date(2018, 6, 1),
+                                                occupation=JobPosition.objects.create(name='name 0'))
+        with self._committed():
+            self.contract = EmployeeContractDetail.objects.create(start_date=date(2018, 6, 1),
+                                                                  number_of_hours=40,
+                                                                  employee_link=self.employee,
+                                                                  number_of_days_holidays=26)
+            self.simplified_timesheet = SimplifiedTimesheet.objects.create(employee=self.employee,
+                                                                           time_sheet_year=2022,
+                                                                           time_sheet_month=8,
+                                                                           user=self.user)
+            self._add_detail(day=1)
+
+    @contextmanager
+    def _committed(self):
+        # runs the summary refreshes scheduled on commit, in this process
+        with patch.dict(os.environ, {'LOCAL_ENV': '1'}), self.captureOnCommitCallbacks(execute=True):
+            yield
+
+    def _add_detail(self, day):
+        return SimplifiedTimesheetDetail.objects.create(
+            start_date=timezone.make_aware(datetime(2022, 8, day, 8, 0)),
+            end_date=time(16, 0),
+            simplified_timesheet=self.simplified_timesheet)
+
+    def _reload(self):
+        return SimplifiedTimesheet.objects.select_related('summary').get(pk=self.simplified_timesheet.pk)
+
+    def test_totals_are_read_from_the_summary(self):
+        computed_hours = self.simplified_timesheet.hours_should_work
+        self.assertEqual(1, SimplifiedTimesheetSummary.objects.count())
+        with self.assertNumQueries(1):
+            simplified_timesheet = self._reload()
+            self.assertEqual("8 h:0 mn", simplified_timesheet.total_hours)
+            self.assertEqual(computed_hours, simplified_timesheet.hours_should_work)
+            # 22 working days in August 2022 (15th is a public holiday) x 8 hours
+            self.assertEqual(176, simplified_timesheet.total_legal_working_hours)
+
+    def test_detail_change_refreshes_summary(self):
+        self.assertEqual("8 h:0 mn", self.simplified_timesheet.total_hours)
+        with self._committed():
+            detail = self._add_detail(day=2)
+        self.assertEqual(timedelta(hours=16), SimplifiedTimesheetSummary.objects.get().total_hours)
+        self.assertEqual("16 h:0 mn", self.simplified_timesheet.total_hours)
+        with self._committed():
+            detail.delete()
+        self.assertEqual("8 h:0 mn", self._reload().total_hours)
+
+    def test_reads_do_not_store_summaries(self):
+        # the refresh of this timesheet is not committed yet
+        simplified_timesheet = SimplifiedTimesheet.objects.create(employee=self.employee,
+                                                                  time_sheet_year=2022,
+                                                                  time_sheet_month=9,
+                                                                  user=self.user)
+        self.assertEqual("0 h:0 mn", simplified_timesheet.total_hours)
+        self.assertEqual(176, self.simplified_timesheet.total_legal_working_hours)
+        self.assertEqual([self.simplified_timesheet.id],
+                         list(SimplifiedTimesheetSummary.objects.values_list('simplified_timesheet_id', flat=True)))
+
+    def test_holiday_request_refreshes_summaries_of_its_months_only(self):
+        with self._committed():
+            other_timesheet = SimplifiedTimesheet.objects.create(employee=self.employee,
+                                                                 time_sheet_year=2022,
+                                                                 time_sheet_month=10,
+                                                                 user=self.user)
+        other_computed_on = other_timesheet.summary.computed_on
+        self.assertEqual(0, self.simplified_timesheet.total_hours_holidays_and_sickness_taken)
+        with self._committed():
+            holiday_request = HolidayRequest.objects.create(employee=self.user,
+                                                            start_date=date(2022, 8, 8),
+                                                            end_date=date(2022, 8, 10),
+                                                            requested_period=HolidayRequestChoice.req_full_day,
+                                                            reason=1,
+                                                            request_status=HolidayRequestWorkflowStatus.ACCEPTED)
+        self.assertEqual(other_computed_on, SimplifiedTimesheetSummary.objects.get(
+            simplified_timesheet=other_timesheet).computed_on)
+        simplified_timesheet = self._reload()
+        # 2 days of holidays and the 15th of August, 8 hours each
+        self.assertEqual(24, simplified_timesheet.total_hours_holidays_and_sickness_taken)
+        self.assertEqual([(date(2022, 8, 8), date(2022, 8, 10))],
+                         [(period.start_date, period.end_date) for period in
+                          simplified_timesheet.total_hours_holidays_and_sickness_taken_object
+                          .holiday_sickness_requests_dates])
+
+        # moving the request to another month refreshes both months
+        holiday_request.start_date = date(2022, 10, 10)
+        holiday_request.end_date = date(2022, 10, 12)
+        with self._committed():
+            holiday_request.save()
+        self.assertEqual(0, self._reload().total_hours_holidays_and_sickness_taken)
+        self.assertEqual(16, SimplifiedTimesheet.objects.select_related('summary').get(
+            pk=other_timesheet.pk).total_hours_holidays_and_sickness_taken)
+
+    def test_contract_change_refreshes_summaries(self):
+        self.assertEqual(176, self.simplified_timesheet.total_legal_working_hours)
+        self.contract.number_of_hours = 20
+        with self._committed():
+            self.contract.save()
+        self.assertEqual(88, self._reload().total_legal_working_hours)
+
+    def test_sundays_are_materialized(self):
+        with self._committed():
+            self._add_detail(day=7)
+        self.assertEqual("16 h:0 mn", self.simplified_timesheet.total_hours)
+        summary = SimplifiedTimesheetSummary.objects.get()
+        self.assertEqual(timedelta(hours=16), summary.total_hours)
+        self.assertEqual(timedelta(hours=8), summary.total_sundays)
+        self.assertEqual(['07/08/2022'], summary.sundays_worked)
+        self.assertEqual("8 h:0 mn (['07/08/2022'])", self._reload().total_hours_sundays)
@@ -1,24 +1,30 @@
 # -*- coding: utf-8 -*-
 import calendar
+import os
 from datetime import date, datetime
+from types import SimpleNamespace
 from typing import Any, Union
 
-from django.core.cache import cache
+from constance import config
 from django.core.exceptions import ValidationError
 from django.core.validators import MaxValueValidator
-from django.db import models
-from django.db.models import Q
-from django.db.models.signals import post_save
+from django.db import models, transaction
+from django.db.models import F, Q
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.utils import timezone
+from django_rq import job
 
 from helpers.holidays import how_many_hours_taken_in_period_v2
+from helpers.models import SicknessHolidayDaysCalculations, TotalTimesheetCalculations
 from helpers.timesheet import calculate_total_hours, display_in_hours_minutes_value, how_many_working_days_in_range, \
-    hours_should_work_gross_in_sec
+    hours_should_work_gross_in_sec, compute_total_hours
 from invoices.db.fields import CurrentUserField
-from invoices.employee import Employee
+from invoices.employee import Employee, EmployeeContractDetail
 from invoices.enums.generic import HolidayRequestChoice
 from invoices.enums.holidays import HolidayRequestWorkflowStatus
+from invoices.helpers.timesheetcache import timesheet_calculations
+from invoices.holidays import HolidayRequest
 
 
 class Timesheet(models.Model):
@@ -171,9 +177,11 @@ class SimplifiedTimesheet(models.Model):
 
     def __calculate_total_hours(self):
         if self.id:
-            calculated_hours = cache.get('total_hours_dictionary%s' % self.id)
-            if calculated_hours is not None:
-                return calculated_hours
+            return timesheet_calculations.get_or_set(self.employee_id, self.time_sheet_year, self.time_sheet_month,
+                                                     'total_hours_dictionary', self.__compute_total_hours)
+        return self.__compute_total_hours()
+
+    def __compute_total_hours(self):
         calculated_hours = {"total": 0,
                             "total_sundays": 0,
                             "total_public_holidays": 0,
@@ -197,11 +205,15 @@ class SimplifiedTimesheet(models.Model):
         calculated_hours["total"] = total
         calculated_hours["total_sundays"] = total_sundays
         calculated_hours["total_public_holidays"] = total_public_holidays
-        if self.id:
-            cache.set('total_hours_dictionary%s' % self.id, calculated_hours)
         return calculated_hours
 
     def absence_hours_taken(self):
+        if self.id:
+            return timesheet_calculations.get_or_set(self.employee_id, self.time_sheet_year, self.time_sheet_month,
+                                                     'absence_hours_taken', self.__compute_absence_hours_taken)
+        return self.__compute_absence_hours_taken()
+
+    def __compute_absence_hours_taken(self):
         data = {'start_date': self.get_start_date, 'end_date': self.get_end_date, 'user_id': self.user.id}
         return how_many_hours_taken_in_period_v2(data,
                                                  PublicHolidayCalendarDetail.objects.filter(
@@ -247,10 +259,7 @@ class SimplifiedTimesheet(models.Model):
 
     @property
     def hours_should_work_xxx(self):
-        if self.id:
-            calculated_hours = cache.get('total_hours_dictionary%s' % self.id)
-            if calculated_hours is None:
-                calculated_hours = self.__calculate_total_hours()
+        calculated_hours = self.__calculate_total_hours()
         total_legal_working_hours = self.date_range(self.get_start_date, self.get_end_date) * \
                                     ((self.employee.employeecontractdetail_set.filter(Q(
                                         end_date__gte=self.get_end_date, start_date__lte=self.get_start_date) | Q(
@@ -289,10 +298,14 @@ class SimplifiedTimesheet(models.Model):
     def total_working_days(self):
         return "Jours ouvrables %d, Heures contractuelles %d (h/semaine)" % (
             how_many_working_days_in_range(self.get_start_date),
-            (self.employee.employeecontractdetail_set.filter(Q(
-                end_date__gte=self.get_end_date, start_date__lte=self.get_start_date) | Q(
-                end_date__isnull=True,
-                start_date__lte=self.get_start_date)).first().number_of_hours))
+            timesheet_calculations.get_or_set(self.employee_id, self.time_sheet_year, self.time_sheet_month,
+                                              'contract_number_of_hours', self.__contract_number_of_hours))
+
+    def __contract_number_of_hours(self):
+        return self.employee.employeecontractdetail_set.filter(Q(
+            end_date__gte=self.get_end_date, start_date__lte=self.get_start_date) | Q(
+            end_date__isnull=True,
+            start_date__lte=self.get_start_date)).first().number_of_hours
 
     # FIXME this is deprecated use new one
     def total_hours_xxx(self):
@@ -451,6 +464,103 @@ class SimplifiedTimesheetDetail(models.Model):
         return ''
 
 
+class SimplifiedTimesheetSummary(models.Model):
+    """
+    Totals of a SimplifiedTimesheet as computed by ``compute_total_hours``.
+
+    The row is computed again by ``refresh_timesheet_summaries`` once a change of the timesheet, of one of its
+    details, of an holiday request of its user overlapping its month or of a contract of its employee is committed.
+    Reading the totals only selects the row.
+    """
+
+    class Meta(object):
+        verbose_name = u'Totaux temps de travail'
+        verbose_name_plural = u'Totaux temps de travail'
+
+    simplified_timesheet = models.OneToOneField(SimplifiedTimesheet, related_name='summary',
+                                                on_delete=models.CASCADE)
+    total_hours = models.DurationField()
+    total_sundays = models.DurationField()
+    total_hours_during_public_holidays = models.DurationField()
+    sundays_worked = models.JSONField(default=list)
+    public_holidays_worked = models.JSONField(default=list)
+    total_legal_working_hours = models.FloatField()
+    holidays_count = models.FloatField()
+    sickness_days_count = models.FloatField()
+    exceptional_break = models.FloatField()
+    number_of_public_holidays = models.PositiveSmallIntegerField()
+    daily_working_hours = models.FloatField()
+    absence_periods = models.JSONField(default=list)
+    public_holidays = models.JSONField(null=True, blank=True)
+    computed_on = models.DateTimeField(auto_now=True)
+
+    @staticmethod
+    def compute_totals(simplified_timesheet):
+        calculations = compute_total_hours(simplified_timesheet)
+        absence = calculations.total_hours_holidays_absence_taken_object
+        public_holidays = None
+        if absence.public_holidays is not None:
+            public_holidays = [public_holiday.isoformat() for public_holiday in absence.public_holidays]
+        return {'total_hours': calculations.total_hours,
+                'total_sundays': calculations.total_sundays,
+                'total_hours_during_public_holidays': calculations.total_hours_during_public_holidays,
+                'sundays_worked': calculations.list_of_sundays_worked,
+                'public_holidays_worked': calculations.list_of_public_holidays_worked,
+                'total_legal_working_hours': calculations.total_legal_working_hours,
+                'holidays_count': absence.holidays_count,
+                'sickness_days_count': absence.sickness_days_count,
+                'exceptional_break': absence.exceptional_break,
+                'number_of_public_holidays': absence.number_of_public_holidays,
+                'daily_working_hours': absence.daily_working_hours,
+                'absence_periods': [[holiday_request.start_date.isoformat(), holiday_request.end_date.isoformat()]
+                                    for holiday_request in absence.holiday_sickness_requests_dates],
+                'public_holidays': public_holidays}
+
+    @classmethod
+    def compute(cls, simplified_timesheet):
+        summary, _ = cls.objects.update_or_create(simplified_timesheet=simplified_timesheet,
+                                                  defaults=cls.compute_totals(simplified_timesheet))
+        return summary
+
+    @classmethod
+    def get(cls, simplified_timesheet):
+        """
+        Returns the stored summary of the timesheet. A timesheet without one yet (its refresh is not done) gets a
+        summary computed in memory, which is not saved.
+        """
+        try:
+            return simplified_timesheet.summary
+        except cls.DoesNotExist:
+            summary = cls(**cls.compute_totals(simplified_timesheet))
+        simplified_timesheet.summary = summary
+        return summary
+
+    def as_calculations(self):
+        absence = SicknessHolidayDaysCalculations(
+            holidays_count=self.holidays_count,
+            sickness_days_count=self.sickness_days_count,
+            exceptional_break=self.exceptional_break,
+            number_of_public_holidays=self.number_of_public_holidays,
+            daily_working_hours=self.daily_working_hours,
+            holiday_sickness_requests_dates=[SimpleNamespace(start_date=date.fromisoformat(start_date),
+                                                             end_date=date.fromisoformat(end_date))
+                                             for start_date, end_date in self.absence_periods])
+        if self.public_holidays is not None:
+            absence.public_holidays = [date.fromisoformat(public_holiday) for public_holiday in self.public_holidays]
+        calculations = TotalTimesheetCalculations(total_hours=self.total_hours,
+                                                  total_sundays=self.total_sundays,
+                                                  total_hours_during_public_holidays=self.total_hours_during_public_holidays,
+                                                  total_hours_holidays_absence_taken=absence.compute_total_hours(),
+                                                  total_hours_holidays_absence_taken_object=absence,
+                                                  total_legal_working_hours=self.total_legal_working_hours)
+        calculations.list_of_sundays_worked = list(self.sundays_worked)
+        calculations.list_of_public_holidays_worked = list(self.public_holidays_worked)
+        return calculations
+
+    def __str__(self):
+        return u'Totaux de %s' % self.simplified_timesheet_id
+
+
 class PublicHolidayCalendar(models.Model):
     calendar_year = models.PositiveIntegerField(
         default=current_year())
@@ -528,5 +638,83 @@ def validate_date_range_vs_holiday_requests(data, employee_id):
 
 @receiver(post_save, sender=SimplifiedTimesheet, dispatch_uid="notify_timesheet_refresh_cache")
 def notify_timesheet_refresh_cache(sender, instance, created, **kwargs):
-    cache.clear()
-    print(cache)
+    timesheet_calculations.invalidate_month(instance.employee_id, instance.time_sheet_year, instance.time_sheet_month)
+
+
+@job("default", timeout=6000)
+def refresh_timesheet_summaries(start_date=None, end_date=None, **filters):
+    """
+    Computes again the summaries of the timesheets matching ``filters`` whose month intersects [start_date, end_date].
+    """
+    timesheets = SimplifiedTimesheet.objects.filter(**filters)
+    if start_date is not None or end_date is not None:
+        timesheets = timesheets.annotate(period=F('time_sheet_year') * 100 + F('time_sheet_month'))
+        if start_date is not None:
+            timesheets = timesheets.filter(period__gte=start_date.year * 100 + start_date.month)
+        if end_date is not None:
+            timesheets = timesheets.filter(period__lte=end_date.year * 100 + end_date.month)
+    for simplified_timesheet in timesheets:
+        SimplifiedTimesheetSummary.compute(simplified_timesheet)
+
+
+def schedule_timesheet_summaries_refresh(start_date=None, end_date=None, **filters):
+    # computed once the change is committed, so that the worker reads it
+    if os.environ.get('LOCAL_ENV', None) or config.SKIP_DJANGORQ:
+        transaction.on_commit(lambda: refresh_timesheet_summaries(start_date, end_date, **filters))
+    else:
+        transaction.on_commit(lambda: refresh_timesheet_summaries.delay(start_date, end_date, **filters))
+
+
+def forget_timesheet_summary(simplified_timesheet):
+    # drop the summary cached on the instance so that the next read selects it again
+    simplified_timesheet._state.fields_cache.pop('summary', None)
+
+
+@receiver(post_save, sender=SimplifiedTimesheet, dispatch_uid="refresh_timesheet_summary")
+def refresh_timesheet_summary(sender, instance, created, **kwargs):
+    schedule_timesheet_summaries_refresh(id=instance.id)
+    forget_timesheet_summary(instance)
+
+
+@receiver(post_save, sender=SimplifiedTimesheetDetail, dispatch_uid="refresh_timesheet_summary_on_detail_save")
+@receiver(post_delete, sender=SimplifiedTimesheetDetail, dispatch_uid="refresh_timesheet_summary_on_detail_delete")
+def refresh_timesheet_summary_on_detail_change(sender, instance, **kwargs):
+    schedule_timesheet_summaries_refresh(id=instance.simplified_timesheet_id)
+    simplified_timesheet = instance._state.fields_cache.get('simplified_timesheet')
+    if simplified_timesheet is not None:
+        forget_timesheet_summary(simplified_timesheet)
+    else:
+        simplified_timesheet = SimplifiedTimesheet.objects.filter(pk=instance.simplified_timesheet_id).first()
+    if simplified_timesheet is not None:
+        timesheet_calculations.invalidate_month(simplified_timesheet.employee_id, simplified_timesheet.time_sheet_year,
+                                                simplified_timesheet.time_sheet_month)
+
+
+@receiver(post_save, sender=HolidayRequest, dispatch_uid="refresh_timesheet_summaries_on_holiday_request_save")
+@receiver(post_delete, sender=HolidayRequest, dispatch_uid="refresh_timesheet_summaries_on_holiday_request_delete")
+def refresh_timesheet_summaries_on_holiday_request_change(sender, instance, **kwargs):
+    periods = [(instance.employee_id, instance.start_date, instance.end_date)]
+    if getattr(instance, 'previous_period', None):
+        periods.append(instance.previous_period)
+    employee_ids = {}
+    for user_id, start_date, end_date in set(periods):
+        schedule_timesheet_summaries_refresh(start_date=start_date, end_date=end_date, user_id=user_id)
+        if user_id not in employee_ids:
+            employee_ids[user_id] = list(Employee.objects.filter(user_id=user_id).values_list('id', flat=True))
+        for employee_id in employee_ids[user_id]:
+            timesheet_calculations.invalidate_period(employee_id, start_date, end_date)
+
+
+@receiver(post_save, sender=EmployeeContractDetail, dispatch_uid="refresh_timesheet_summaries_on_contract_save")
+@receiver(post_delete, sender=EmployeeContractDetail,
+          dispatch_uid="refresh_timesheet_summaries_on_contract_delete")
+def refresh_timesheet_summaries_on_contract_change(sender, instance, **kwargs):
+    schedule_timesheet_summaries_refresh(employee_id=instance.employee_link_id)
+    timesheet_calculations.invalidate_employee(instance.employee_link_id)
+
+
+@receiver(post_save, sender=PublicHolidayCalendarDetail, dispatch_uid="invalidate_timesheet_calculations_on_holiday")
+@receiver(post_delete, sender=PublicHolidayCalendarDetail,
+          dispatch_uid="invalidate_timesheet_calculations_on_holiday_delete")
+def invalidate_timesheet_calculations_on_public_holiday_change(sender, instance, **kwargs):
+    timesheet_calculations.invalidate_all()
@@ -13,7 +13,8 @@ from api import views
 from api.views import EventProcessorView, cleanup_event, whois_off, whois_available, get_bank_holidays, \
     get_active_care_plans, how_many_care_given, how_many_patients, how_many_care_hours, \
     FullCalendarEventViewSet, AvailableEmployeeList, AvailablePatientList, build_payroll_sheet, DistanceAPIView, \
-    NunoEventsService, whois_available_with_avatars_and_ids, AvailableEventStateList
+    NunoEventsService, whois_available_with_avatars_and_ids, AvailableEventStateList, RouteAPIView, \
+    EmployeeDayRouteAPIView, TourAPIView
 # get_active_care_plans, how_many_care_given, how_many_patients, how_many_care_hours, YaleEventProcessorView
 from invoices.eventviews import Calendar1View, load_calendar_form, update_calendar_form
 from invoices.views import delete_prestation, home_view, password_change, login_view, robots_view
@@ -224,6 +225,9 @@ urlpatterns += [
 
 urlpatterns += [
     path('api/v1/distance_duration/<str:origin>/<str:destination>/', DistanceAPIView.as_view(), name='distance_api'),
+    path('api/v1/route/', RouteAPIView.as_view(), name='route_api'),
+    path('api/v1/route/<int:employee_id>/<str:day>/', EmployeeDayRouteAPIView.as_view(), name='employee_day_route_api'),
+    path('api/v1/tour/<int:employee_id>/<str:day>/', TourAPIView.as_view(), name='employee_day_tour_api'),
 ]
 
 urlpatterns += [